@@ -1,7 +1,8 @@
 import json
 import random
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
+import numpy as np
 from PipelineRun import PipelineRun
 from TaskRun import TaskRun
 
@@ -0,0 +1,392 @@
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from compression import put_arguments, extension, default_codec
+from key_layout import raw_key, default_layout, build_manifest, write_manifest, split_by_hour
+from instrumentation import timer, increment, print_summary
+
+## Batch size and concurrency that tune themselves.
+##
+## Batch sizes used to be fixed by hand (5 lifecycles per upload in `simulate_events.py`, one object per event in
+## `send_events` and `send_event`), so they were too small for S3 and too large for a throttled or slow backend.
+## `AIMDController` adjusts both at runtime from what every call reports, like TCP congestion control:
+##     - additive increase: after a full round of successful calls (one per allowed concurrent call) within the
+##       latency target, the batch size grows by `batch_step` and the concurrency by `concurrency_step`
+##     - multiplicative decrease, at most once per round so one burst of failures only counts once:
+##         throttled (503 SlowDown and friends)  -> concurrency * `decrease` (bigger batches mean fewer requests)
+##         error rate over `error_threshold`     -> batch size and concurrency * `decrease`
+##         latency over `target_latency`         -> batch size * `decrease`
+## so throughput saws just below whatever the backend allows, in every environment, without manual tuning.
+## `slot()` holds each call to the current concurrency limit.
+##
+## `AdaptiveUploader` uses a controller to upload raw events as multi-event NDJSON objects, retrying throttled and
+## failed writes with jittered exponential backoff.  Every reader accepts these objects (the Lambda, `backfill_raw.py`,
+## `sqs_worker.py`, and `redrive_dlq.py`, see `event_streams.iter_body`), and each one gets a manifest like the
+## batches from `send_events`, so time-window backfills find it without listing `raw/`.
+## The Lambda only uses a controller to retry its throttled part writes with backoff; its part size stays fixed,
+## so a retried object rewrites the same parts.
+
+ADAPTIVE_ENV_VAR = "CDEVENTS_ADAPTIVE"
+THROTTLE_CODES = ("SlowDown", "Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+                  "TooManyRequestsException", "RequestThrottled", "ProvisionedThroughputExceededException")
+
+def is_throttle(error):
+    '''
+    Input: `error` (dtype: Exception)
+    Returns: `throttled` (dtype: bool) Whether the error asks the caller to slow down (503 SlowDown, 429, ...)
+    '''
+
+    if not isinstance(error, ClientError):
+        return False
+
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+    return code in THROTTLE_CODES or status == 429 or (status == 503 and code != "ServiceUnavailable")
+
+def is_retryable(error):
+    '''
+    Input: `error` (dtype: Exception)
+    Returns: `retryable` (dtype: bool) Whether the same call may succeed if it is tried again
+    '''
+
+    if isinstance(error, ClientError):
+        return is_throttle(error) or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def backoff(attempt, base=0.05, cap=5.0):
+    '''
+    Returns: `seconds` (dtype: float) How long to wait before retry number `attempt` (full jitter, so callers that
+        failed together do not retry together)
+    '''
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class AIMDController():
+    def __init__(self, initial_batch=100, min_batch=1, max_batch=10000, batch_step=None, initial_concurrency=4,
+                 min_concurrency=1, max_concurrency=32, concurrency_step=1, target_latency=1.0, decrease=0.5,
+                 error_threshold=0.05, window=50, smoothing=0.3):
+        '''
+        Inputs:
+            `initial_batch`/`min_batch`/`max_batch` (dtype: int): The starting batch size and its bounds
+            `batch_step` (dtype: int): How much the batch size grows per good round (a tenth of `initial_batch` by default)
+            `initial_concurrency`/`min_concurrency`/`max_concurrency` (dtype: int): The same for calls in flight
+            `concurrency_step` (dtype: int): How much the concurrency grows per good round
+            `target_latency` (dtype: float): The slowest a call may be, in seconds, before batches shrink
+            `decrease` (dtype: float): The factor applied on a decrease
+            `error_threshold` (dtype: float): The share of failed calls in the last `window` that shrinks both
+            `window` (dtype: int): How many recent calls the error rate is measured over
+            `smoothing` (dtype: float): The weight of the newest latency in its moving average
+
+        Returns: object (dtype: AIMDController) Read `batch_size`/`concurrency`, and `record` every call
+        '''
+
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_step = batch_step or max(1, initial_batch // 10)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency_step = concurrency_step
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.error_threshold = error_threshold
+        self.smoothing = smoothing
+
+        self.condition = threading.Condition()
+        self._batch_size = min(max(initial_batch, min_batch), max_batch)
+        self._concurrency = min(max(initial_concurrency, min_concurrency), max_concurrency)
+        self.in_flight = 0
+        self.latency = None
+        self.recent_errors = deque(maxlen=window)
+        self.since_change = 0
+        self.since_decrease = self._concurrency
+        self.counts = {"calls": 0, "items": 0, "throttled": 0, "errors": 0, "increases": 0,
+                       "decreases_throttled": 0, "decreases_errors": 0, "decreases_latency": 0}
+
+        return
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    def shrink(self, reason, batch=False, concurrency=False):
+        if batch:
+            self._batch_size = max(self.min_batch, int(self._batch_size * self.decrease))
+        if concurrency:
+            self._concurrency = max(self.min_concurrency, int(self._concurrency * self.decrease))
+
+        ## Judge the new settings only by calls made with them
+        self.latency = None
+        self.since_change = 0
+        self.since_decrease = 0
+        self.counts["decreases_" + reason] += 1
+        increment("aimd_decreases_" + reason)
+
+        return
+
+    def record(self, latency, items=1, throttled=False, error=False):
+        '''
+        Inputs:
+            `latency` (dtype: float): How long the call took, in seconds
+            `items` (dtype: int): How many items (i.e. events) it carried
+            `throttled` (dtype: bool): The backend asked to slow down
+            `error` (dtype: bool): The call failed for another reason
+        '''
+
+        with self.condition:
+            self.counts['calls'] += 1
+            self.counts['items'] += items
+            self.since_change += 1
+            self.since_decrease += 1
+            self.recent_errors.append(bool(error))
+            if not (throttled or error):
+                self.latency = latency if self.latency is None else \
+                    self.smoothing * latency + (1 - self.smoothing) * self.latency
+
+            ## A round is one call for every call allowed in flight.  Calls that were already in flight when the
+            ## settings last shrank report the same congestion again, so they do not shrink them further.
+            can_decrease = self.since_decrease >= self._concurrency
+
+            if throttled:
+                self.counts['throttled'] += 1
+                if can_decrease:
+                    self.shrink("throttled", concurrency=True)
+            elif error:
+                self.counts['errors'] += 1
+                if can_decrease and sum(self.recent_errors) > self.error_threshold * len(self.recent_errors):
+                    self.shrink("errors", batch=True, concurrency=True)
+            elif self.latency > self.target_latency:
+                if can_decrease:
+                    self.shrink("latency", batch=True)
+            elif self.since_change >= self._concurrency:
+                self._batch_size = min(self.max_batch, self._batch_size + self.batch_step)
+                self._concurrency = min(self.max_concurrency, self._concurrency + self.concurrency_step)
+                self.since_change = 0
+                self.counts['increases'] += 1
+
+            self.condition.notify_all()
+
+        return
+
+    @contextmanager
+    def slot(self):
+        '''
+        Function Overview:
+            Waits until fewer than `concurrency` calls are in flight, and holds a place for the call made inside.
+        '''
+
+        with self.condition:
+            while self.in_flight >= self._concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def call(self, func, items=1, max_attempts=5):
+        '''
+        Inputs:
+            `func` (dtype: function): The call to make, with no arguments
+            `items` (dtype: int): How many items it carries
+            `max_attempts` (dtype: int): Tries before a retryable error is raised
+
+        Returns: The result of `func`.  Every attempt is recorded, and throttled or 5xx attempts are retried
+            after a backoff; other errors are raised right away.
+        '''
+
+        for attempt in range(max_attempts):
+            with self.slot():
+                start = time.perf_counter()
+                try:
+                    result = func()
+                except Exception as e:
+                    throttled = is_throttle(e)
+                    self.record(time.perf_counter() - start, items, throttled=throttled, error=not throttled)
+                    if not is_retryable(e) or attempt == max_attempts - 1:
+                        raise
+                    error = e
+                else:
+                    self.record(time.perf_counter() - start, items)
+                    return result
+
+            increment("aimd_retries")
+            print("Retrying after {}: {}".format(type(error).__name__, error))
+            time.sleep(backoff(attempt))
+
+    def stats(self):
+        '''
+        Returns: `stats` (dtype: dict) The current settings and what led to them
+        '''
+
+        with self.condition:
+            stats = dict(self.counts)
+            stats.update({"batch_size": self._batch_size, "concurrency": self._concurrency,
+                          "latency_ms": round(self.latency * 1000.0, 3) if self.latency is not None else None})
+
+        return stats
+
+class AdaptiveUploader():
+    def __init__(self, s3, bucket, controller=None, prefix="raw/", layout=None, compression=None, max_attempts=5):
+        '''
+        Inputs:
+            `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The CDEvents bucket
+            `controller` (dtype: AIMDController): Sizes the batches and the number of uploads in flight
+            `prefix` (dtype: str): The raw folder
+            `layout` (dtype: str): "flat" or "partitioned" (see `key_layout.py`); defaults to `CDEVENTS_RAW_LAYOUT`
+            `compression` (dtype: str): "none", "gzip", or "zstd"; defaults to `CDEVENTS_COMPRESSION`
+            `max_attempts` (dtype: int): Tries per batch before it counts as failed
+
+        Returns: object (dtype: AdaptiveUploader) `submit` events as they are generated, then `close()`.  `submit`
+            blocks while `max_concurrency` batches are already waiting or uploading, so a fast producer can't
+            queue up more events than the uploads can take.
+
+        Overview:
+            Each batch is written as one NDJSON object named like a raw event, with a batch id instead of an
+            event id (i.e. `raw/dt=2023-04-04/hr=22/07/batch-<uuid>.ndjson`), followed by its manifest
+            (`manifests/raw/dt=2023-04-04/hr=22/batch-<uuid>.json`).  The batch id is what readers deduplicate
+            the object by (see `dedup.event_id_from_key`).  Batches end at hour boundaries, so every object and
+            manifest is filed under the hour all of its events are from.
+        '''
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.controller = controller or AIMDController(initial_batch=100, max_batch=5000, target_latency=1.0)
+        self.prefix = prefix
+        self.layout = layout or default_layout()
+        self.compression = compression or default_codec()
+        self.max_attempts = max_attempts
+
+        self.pending = []
+        self.futures = []
+        self.lock = threading.Lock()
+        self.stats_counts = {"events": 0, "objects": 0, "manifests": 0, "failed_batches": 0, "failed_events": 0,
+                             "failed_manifests": 0}
+        self.executor = ThreadPoolExecutor(max_workers=self.controller.max_concurrency)
+        self.in_flight = threading.BoundedSemaphore(self.controller.max_concurrency)
+
+        return
+
+    def submit(self, events):
+        '''
+        Input: `events` (dtype: list) Raw events to upload; full batches, and batches ended by an event from
+            another hour, are handed to the upload threads right away
+        '''
+
+        self.pending.extend(events)
+        while self.pending:
+            size = min(len(split_by_hour(self.pending)[0]), self.controller.batch_size)
+            if size == len(self.pending) and size < self.controller.batch_size:
+                break
+            batch, self.pending = self.pending[:size], self.pending[size:]
+            self.start_upload(batch)
+
+        return
+
+    def start_upload(self, batch):
+        with timer("adaptive_submit_wait"):
+            self.in_flight.acquire()
+        future = self.executor.submit(self.upload, batch)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+        return
+
+    def upload(self, batch):
+        batch_id = "batch-{}".format(uuid.uuid4())
+        key = raw_key({"event_id": batch_id, "context": batch[0]['context']}, prefix=self.prefix, layout=self.layout,
+                      extension=".ndjson" + extension(self.compression))
+        with timer("json_dumps"):
+            body = "".join(json.dumps(event) + "\n" for event in batch)
+        put_args = put_arguments(body, self.compression, content_type="application/x-ndjson")
+
+        try:
+            with timer("s3_put_batch"):
+                self.controller.call(lambda: self.s3.put_object(Bucket=self.bucket, Key=key, **put_args),
+                                     items=len(batch), max_attempts=self.max_attempts)
+        except Exception as e:
+            print("Failed to upload batch {}: {}".format(batch_id, e))
+            with self.lock:
+                self.stats_counts['failed_batches'] += 1
+                self.stats_counts['failed_events'] += len(batch)
+            return None
+
+        with self.lock:
+            self.stats_counts['events'] += len(batch)
+            self.stats_counts['objects'] += 1
+        increment("events_sent", len(batch))
+        increment("bytes_sent", len(put_args['Body']))
+
+        entries = [(key, event, len(put_args['Body']) if i == 0 else 0) for i, event in enumerate(batch)]
+        manifest = build_manifest(entries, self.layout, batch_id=batch_id)
+        try:
+            with timer("s3_put_manifest"):
+                self.controller.call(lambda: write_manifest(self.s3, self.bucket, manifest, prefix=self.prefix),
+                                     max_attempts=self.max_attempts)
+        except Exception as e:
+            ## The object is still found by listing `raw/` and by its S3 notification
+            print("Failed to write the manifest of batch {}: {}".format(batch_id, e))
+            with self.lock:
+                self.stats_counts['failed_manifests'] += 1
+            return key
+
+        with self.lock:
+            self.stats_counts['manifests'] += 1
+
+        return key
+
+    def close(self):
+        '''
+        Returns: `stats` (dtype: dict) Events and objects uploaded, failures, and the controller's `stats()`
+        '''
+
+        for batch in split_by_hour(self.pending):
+            self.start_upload(batch)
+        self.pending = []
+
+        keys = [future.result() for future in self.futures]
+        self.executor.shutdown()
+
+        stats = dict(self.stats_counts)
+        stats['keys'] = [key for key in keys if key is not None]
+        stats['controller'] = self.controller.stats()
+
+        return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upload simulated events in batches sized by an AIMD controller")
+    parser.add_argument("--bucket", default=os.environ.get("CDEVENT_BUCKET"))
+    parser.add_argument("--batches", type=int, default=100, help="Generated batches of 5 lifecycles")
+    parser.add_argument("--target-latency", type=float, default=1.0)
+    parser.add_argument("--max-concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    import boto3
+    from simulation_functions import create_events
+
+    controller = AIMDController(target_latency=args.target_latency, max_concurrency=args.max_concurrency)
+    uploader = AdaptiveUploader(boto3.client("s3"), args.bucket, controller)
+    for _ in range(args.batches):
+        uploader.submit(create_events(5)[0])
+
+    stats = uploader.close()
+    stats['keys'] = len(stats['keys'])
+    print(json.dumps(stats, indent=4))
+    print_summary("adaptive.py")
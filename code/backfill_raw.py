@@ -0,0 +1,498 @@
+import os
+import json
+import time
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from compression import decode_body, open_body, put_arguments, extension
+from event_streams import iter_body
+from key_layout import hours_between, iter_hour_manifests, overlaps, MANIFEST_LOOKBACK_HOURS
+from instrumentation import timer, increment, print_summary
+
+## Reprocess everything under `raw/` into large consolidated processed files.
+##
+## The key space under the raw prefix is split into ranges: 16 ranges on the first hex character of the
+## event_id for the flat layout, plus up to `target_ranges` more between the `dt=/hr=/<shard>/` folders of the
+## partitioned layout (found by listing those folders, see `discover_boundaries`).  The boundaries are saved with
+## the run's checkpoints, so a resumed run uses the same ranges even if new partitions appeared in the meantime.
+## Each range is listed page by page in parallel, the objects on each page are fetched concurrently (an
+## object may hold one event or a whole batch, see `fetch_raw_events`), flattened with the same
+## `flatten_event_entry` the simulator uses, and written out as NDJSON "part" files of about `part_size` events:
+##     <output_prefix><run_id>/<range>/part-00000.ndjson
+##
+## After every part is written, the range's checkpoint object is updated with the last raw key
+## covered by that part:
+##     <output_prefix><run_id>/_checkpoints/<range>.json
+## Running the command again with the same `run_id` resumes each range after its checkpoint, and
+## because part names are deterministic, a part that was half-written when the run stopped is simply
+## overwritten.  Memory use is bounded by `part_size` events per range, regardless of how many raw
+## objects there are.
+##
+## When a time window (`start`/`end`) is given, nothing is listed under `raw/` at all: each hour of the
+## window is one range, and its keys come from the batch manifests filed under that hour
+## (see `key_layout.py`).
+
+DEFAULT_SPLIT_CHARACTERS = "123456789abcdef"
+DEFAULT_TARGET_RANGES = 64
+
+def default_boundaries(prefix):
+    '''
+    Input: `prefix` (dtype: str): The raw prefix being reprocessed (i.e. "raw/")
+    Returns: `boundaries` (dtype: list): Split points that divide the `<prefix><uuid>.json` key space
+        into 16 ranges, one per leading hex character
+    '''
+
+    return [prefix + character for character in DEFAULT_SPLIT_CHARACTERS]
+
+def list_folders(s3, bucket, prefix):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket to list
+        `prefix` (dtype: str): The folder to look in (i.e. "raw/dt=2023-04-04/")
+
+    Returns: `folders` (dtype: list): The folders directly below `prefix`, in sorted order
+    '''
+
+    folders = []
+    token = None
+
+    while True:
+        arguments = {"Bucket": bucket, "Prefix": prefix, "Delimiter": "/"}
+        if token:
+            arguments['ContinuationToken'] = token
+
+        with timer("s3_list"):
+            page = s3.list_objects_v2(**arguments)
+        folders.extend(item['Prefix'] for item in page.get('CommonPrefixes', []))
+
+        if not page.get('IsTruncated'):
+            return sorted(folders)
+
+        token = page['NextContinuationToken']
+
+def discover_boundaries(s3, bucket, prefix, target_ranges=DEFAULT_TARGET_RANGES):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket holding the raw events
+        `prefix` (dtype: str): The raw prefix being reprocessed
+        `target_ranges` (dtype: int): About how many ranges to split the partitioned keys into
+
+    Returns: `boundaries` (dtype: list): `default_boundaries(prefix)` plus split points between the hour (or, when
+        there are fewer hours than `target_ranges`, shard) folders of the partitioned layout, spread evenly
+    '''
+
+    hours = []
+    for day in list_folders(s3, bucket, prefix):
+        if day[len(prefix):].startswith("dt="):
+            hours.extend(list_folders(s3, bucket, day))
+
+    folders = hours
+    if 0 < len(hours) < target_ranges:
+        folders = []
+        for hour in hours:
+            folders.extend(list_folders(s3, bucket, hour) or [hour])
+
+    step = max(1, len(folders) // target_ranges)
+
+    return sorted(set(default_boundaries(prefix)) | set(folders[step::step]))
+
+def key_ranges(boundaries):
+    '''
+    Input: `boundaries` (dtype: list): Sorted split points between key ranges
+    Returns: `ranges` (dtype: list): `(name, lower, upper)` tuples.  A range holds every key where
+        `lower < key <= upper`; `None` means unbounded.
+    '''
+
+    edges = [None] + list(boundaries) + [None]
+    ranges = []
+
+    for i in range(len(edges) - 1):
+        ranges.append(("r{:03d}".format(i), edges[i], edges[i + 1]))
+
+    return ranges
+
+def list_range(s3, bucket, prefix, lower, upper, start_after=None, page_size=1000):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+        `bucket` (dtype: str): The bucket to list
+        `prefix` (dtype: str): The raw prefix being reprocessed
+        `lower`/`upper` (dtype: str): The key range to list (see `key_ranges`)
+        `start_after` (dtype: str): A checkpointed key to resume after (optional)
+        `page_size` (dtype: int): Keys per `list_objects_v2` call (max 1000)
+
+    Returns: A generator of pages, where each page is a list of keys in sorted order
+    '''
+
+    if start_after is None or (lower is not None and start_after < lower):
+        start_after = lower
+
+    token = None
+
+    while True:
+        arguments = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": page_size}
+        if token:
+            arguments['ContinuationToken'] = token
+        elif start_after:
+            arguments['StartAfter'] = start_after
+
+        with timer("s3_list"):
+            page = s3.list_objects_v2(**arguments)
+
+        keys = [item['Key'] for item in page.get('Contents', [])]
+        in_range = [key for key in keys if upper is None or key <= upper]
+
+        if in_range:
+            yield in_range
+
+        if len(in_range) < len(keys) or not page.get('IsTruncated'):
+            return
+
+        token = page['NextContinuationToken']
+
+def manifest_pages(s3, bucket, prefix, hour, start, end, start_after=None, page_size=1000):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket holding the manifests
+        `prefix` (dtype: str): The raw prefix the manifests describe
+        `hour` (dtype: datetime): The manifest partition to read
+        `start`/`end` (dtype: datetime): Only batches overlapping this window are included
+        `start_after` (dtype: str): A checkpointed key to resume after (optional)
+        `page_size` (dtype: int): Keys per page
+
+    Returns: A generator of pages of raw keys (like `list_range`) taken from the hour's manifests
+    '''
+
+    keys = set()
+    for manifest in iter_hour_manifests(s3, bucket, hour, prefix):
+        if overlaps(manifest, start, end):
+            keys.update(manifest['keys'])
+
+    keys = sorted(key for key in keys if start_after is None or key > start_after)
+
+    for i in range(0, len(keys), page_size):
+        yield keys[i:i + page_size]
+
+def fetch_raw_events(s3, bucket, key):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket holding the raw object
+        `key` (dtype: str): The key of the raw object
+
+    Returns: `(key, events, error)` where `events` is the list of raw events in the object (a single event, a JSON
+        array, NDJSON, or a `.cdeb` stream, see `event_streams.iter_body`), and exactly one of `events` and
+        `error` is None
+    '''
+
+    try:
+        with timer("s3_get"):
+            response = s3.get_object(Bucket=bucket, Key=key)
+        with timer("decode_event"):
+            return key, list(iter_body(open_body(response, key), key)), None
+    except (ClientError, ValueError) as e:
+        return key, None, "{}: {}".format(type(e).__name__, e)
+
+def fetch_manifest(s3, bucket, key):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket holding the manifest
+        `key` (dtype: str): The key of a batch manifest (see `key_layout.py`)
+
+    Returns: `(manifest, error)` where exactly one of `manifest` and `error` is None
+    '''
+
+    try:
+        with timer("s3_get"):
+            manifest = json.loads(decode_body(s3.get_object(Bucket=bucket, Key=key), key))
+    except (ClientError, ValueError) as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+    if not (isinstance(manifest, dict) and isinstance(manifest.get('keys'), list)):
+        return None, "ValueError: manifest has no list of keys"
+
+    return manifest, None
+
+class Backfill():
+    def __init__(self, s3, bucket, run_id=None, raw_prefix="raw/", output_prefix="processed/backfill/",
+                 boundaries=None, part_size=50000, fetch_workers=32, range_workers=4, page_size=1000,
+                 start=None, end=None, compression="none"):
+        '''
+        Inputs:
+            `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The bucket holding the raw events (processed files are written to the same bucket)
+            `run_id` (dtype: str): Names the output folder and checkpoints.  Reuse it to resume an interrupted run.
+            `raw_prefix` (dtype: str): The prefix to reprocess
+            `output_prefix` (dtype: str): Where consolidated part files are written
+            `boundaries` (dtype: list): Split points between key ranges.  By default they are found with
+                `discover_boundaries` on the first run and saved with the checkpoints.
+            `part_size` (dtype: int): Maximum number of flattened events per part file
+            `fetch_workers` (dtype: int): Number of concurrent GETs, shared by all ranges
+            `range_workers` (dtype: int): Number of key ranges listed and processed at the same time
+            `page_size` (dtype: int): Keys per listing call
+            `start`/`end` (dtype: datetime): Only reprocess batches from this time window, using manifests instead of listing
+            `compression` (dtype: str): "none", "gzip", or "zstd" for the part files (see `compression.py`)
+
+        Returns: object (dtype: Backfill) A reprocessing job; call `run()` to start or resume it
+        '''
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.run_id = run_id or time.strftime("%Y%m%dT%H%M%S") + "-" + str(uuid.uuid4())[:8]
+        self.raw_prefix = raw_prefix
+        self.output_prefix = output_prefix
+        self.boundaries = boundaries
+        self.part_size = part_size
+        self.fetch_workers = fetch_workers
+        self.range_workers = range_workers
+        self.page_size = page_size
+        self.start = start
+        self.end = end
+        self.compression = compression
+
+        return
+
+    def run_prefix(self):
+        return "{}{}/".format(self.output_prefix, self.run_id)
+
+    def checkpoint_key(self, range_name):
+        return "{}_checkpoints/{}.json".format(self.run_prefix(), range_name)
+
+    def part_key(self, range_name, part_number):
+        return "{}{}/part-{:05d}.ndjson{}".format(self.run_prefix(), range_name, part_number, extension(self.compression))
+
+    def load_boundaries(self):
+        '''
+        Input: None
+        Returns: `boundaries` (dtype: list): The run's key range boundaries, read from its checkpoints if the run
+            was started before, otherwise discovered from the listing and saved
+        '''
+
+        if self.boundaries is not None:
+            return self.boundaries
+
+        key = self.checkpoint_key("_boundaries")
+        try:
+            self.boundaries = json.loads(self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read())
+            return self.boundaries
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ("NoSuchKey", "404"):
+                raise
+
+        self.boundaries = discover_boundaries(self.s3, self.bucket, self.raw_prefix)
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(self.boundaries), ContentType="application/json")
+
+        return self.boundaries
+
+    def load_checkpoint(self, range_name):
+        '''
+        Input: `range_name` (dtype: str): The range to look up
+        Returns: `checkpoint` (dtype: dict): The saved progress for the range, or a fresh checkpoint
+        '''
+
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.checkpoint_key(range_name))['Body'].read()
+            return json.loads(body)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ("NoSuchKey", "404"):
+                raise
+
+        return {"last_key": None, "parts": 0, "records": 0, "failed": 0, "done": False}
+
+    def save_checkpoint(self, range_name, checkpoint):
+        self.s3.put_object(Bucket=self.bucket, Key=self.checkpoint_key(range_name),
+                           Body=json.dumps(checkpoint), ContentType="application/json")
+
+    def write_part(self, range_name, checkpoint, records, failures, last_key):
+        '''
+        Inputs:
+            `range_name` (dtype: str): The range the records came from
+            `checkpoint` (dtype: dict): The range's checkpoint, updated in place
+            `records` (dtype: list): Flattened events for this part
+            `failures` (dtype: list): `{"key": ..., "error": ...}` for raw objects that could not be processed
+            `last_key` (dtype: str): The last raw key covered by this part
+
+        Function Overview:
+            Writes the part file (and a small `.failed.json` file next to it if anything failed), and only then
+            advances the checkpoint past `last_key`.
+        '''
+
+        part_number = checkpoint['parts']
+        part_key = self.part_key(range_name, part_number)
+
+        if records:
+            with timer("json_dumps"):
+                body = "\n".join(json.dumps(record) for record in records) + "\n"
+            with timer("compress"):
+                put_args = put_arguments(body, self.compression, content_type="application/x-ndjson")
+            with timer("s3_put_part"):
+                self.s3.put_object(Bucket=self.bucket, Key=part_key, **put_args)
+            increment("bytes_written", len(put_args['Body']))
+            increment("parts_written")
+
+        if failures:
+            failed_key = "{}{}/part-{:05d}.failed.json".format(self.run_prefix(), range_name, part_number)
+            self.s3.put_object(Bucket=self.bucket, Key=failed_key, Body=json.dumps(failures), ContentType="application/json")
+
+        checkpoint['parts'] = part_number + 1
+        checkpoint['records'] += len(records)
+        checkpoint['failed'] += len(failures)
+        checkpoint['last_key'] = last_key
+        self.save_checkpoint(range_name, checkpoint)
+
+        return
+
+    def ranges(self):
+        '''
+        Input: None
+        Returns: `ranges` (dtype: list): `(range_name, pages)` pairs, where `pages(start_after)` returns a generator
+            of pages of raw keys for the range
+        '''
+
+        ranges = []
+
+        if self.start is None:
+            for range_name, lower, upper in key_ranges(self.load_boundaries()):
+                pages = lambda start_after, lower=lower, upper=upper: list_range(
+                    self.s3, self.bucket, self.raw_prefix, lower, upper, start_after=start_after, page_size=self.page_size)
+                ranges.append((range_name, pages))
+        else:
+            for hour in hours_between(self.start - timedelta(hours=MANIFEST_LOOKBACK_HOURS), self.end):
+                pages = lambda start_after, hour=hour: manifest_pages(
+                    self.s3, self.bucket, self.raw_prefix, hour, self.start, self.end, start_after=start_after,
+                    page_size=self.page_size)
+                ranges.append((hour.strftime("dt=%Y-%m-%d-hr=%H"), pages))
+
+        return ranges
+
+    def process_range(self, executor, range_name, pages):
+        '''
+        Inputs:
+            `executor` (dtype: ThreadPoolExecutor): The shared pool used to fetch raw objects
+            `range_name` (dtype: str): The name of the range (used for its checkpoint and part files)
+            `pages` (dtype: function): Returns the pages of raw keys for the range after a given key (see `ranges`)
+
+        Returns: `checkpoint` (dtype: dict): The final checkpoint for the range
+        '''
+
+        checkpoint = self.load_checkpoint(range_name)
+        if checkpoint['done']:
+            return checkpoint
+
+        records = []
+        failures = []
+        last_key = checkpoint['last_key']
+
+        for keys in pages(checkpoint['last_key']):
+            fetched = executor.map(lambda key: fetch_raw_events(self.s3, self.bucket, key), keys)
+
+            for key, events, error in fetched:
+                last_key = key
+
+                if error is not None:
+                    failures.append({"key": key, "error": error})
+                    increment("events_failed")
+
+                ## The checkpoint covers whole objects, so a batch object is never split across parts
+                for event in events or []:
+                    try:
+                        records.append(normalize_processed(flatten_event_entry(event)))
+                        increment("events_flattened")
+                    except (KeyError, TypeError, AttributeError) as e:
+                        failures.append({"key": key, "event_id": event.get('event_id') if isinstance(event, dict) else None,
+                                         "error": "{}: {}".format(type(e).__name__, e)})
+                        increment("events_failed")
+
+                if len(records) >= self.part_size:
+                    self.write_part(range_name, checkpoint, records, failures, last_key)
+                    records = []
+                    failures = []
+
+        if records or failures:
+            self.write_part(range_name, checkpoint, records, failures, last_key)
+
+        checkpoint['done'] = True
+        self.save_checkpoint(range_name, checkpoint)
+
+        return checkpoint
+
+    def run(self):
+        '''
+        Input: None
+        Returns: `report` (dtype: dict): Per-range checkpoints and totals:
+            {
+                "run_id": "20230404T223153-1a2b3c4d",
+                "output": "processed/backfill/20230404T223153-1a2b3c4d/",
+                "records": 1500,
+                "failed": 0,
+                "parts": 16,
+                "ranges": {"r000": {...checkpoint...}, ...}
+            }
+
+        Function Overview:
+            Processes every key range (see the module comment above) and returns once all ranges are done.
+        '''
+
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetch_executor:
+            with ThreadPoolExecutor(max_workers=self.range_workers) as range_executor:
+                futures = {}
+                for range_name, pages in self.ranges():
+                    futures[range_name] = range_executor.submit(self.process_range, fetch_executor, range_name, pages)
+
+                for range_name, future in futures.items():
+                    results[range_name] = future.result()
+
+        report = {
+            "run_id": self.run_id,
+            "output": self.run_prefix(),
+            "records": sum(result['records'] for result in results.values()),
+            "failed": sum(result['failed'] for result in results.values()),
+            "parts": sum(result['parts'] for result in results.values()),
+            "ranges": results
+        }
+
+        return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reprocess every raw CDEvent into consolidated processed NDJSON files")
+    parser.add_argument("--bucket", default=os.environ.get("CDEVENT_BUCKET"))
+    parser.add_argument("--run-id", default=None, help="Reuse the run id of an interrupted run to resume it")
+    parser.add_argument("--raw-prefix", default="raw/")
+    parser.add_argument("--output-prefix", default="processed/backfill/")
+    parser.add_argument("--part-size", type=int, default=50000)
+    parser.add_argument("--fetch-workers", type=int, default=32)
+    parser.add_argument("--range-workers", type=int, default=4)
+    parser.add_argument("--start", default=None, help="Only reprocess batches from this time on (YYYY-MM-DDTHH), using manifests")
+    parser.add_argument("--end", default=None, help="End of the --start window (exclusive, YYYY-MM-DDTHH)")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none", help="Compression for the part files")
+    parser.add_argument("--local-root", default=None, help="Run against a local object store in this directory instead of S3")
+    args = parser.parse_args()
+
+    if args.local_root:
+        from local_aws import LocalS3
+        s3_client = LocalS3(args.local_root)
+    else:
+        import boto3
+        s3_client = boto3.client("s3")
+
+    start = datetime.strptime(args.start, "%Y-%m-%dT%H") if args.start else None
+    end = datetime.strptime(args.end, "%Y-%m-%dT%H") if args.end else (start + timedelta(hours=1) if start else None)
+
+    backfill = Backfill(s3_client, args.bucket, run_id=args.run_id, raw_prefix=args.raw_prefix,
+                        output_prefix=args.output_prefix, part_size=args.part_size,
+                        fetch_workers=args.fetch_workers, range_workers=args.range_workers, start=start, end=end,
+                        compression=args.compression)
+    report = backfill.run()
+
+    print(json.dumps({k: v for k, v in report.items() if k != "ranges"}, indent=4))
+    print_summary("backfill_raw.py")
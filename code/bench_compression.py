@@ -0,0 +1,93 @@
+import json
+import time
+import argparse
+from event_streams import iter_events
+from simulation_functions import flatten_event_entry
+from compression import compress, decompress, zstandard
+
+## Benchmark per-event compression of raw and processed (flattened) CDEvents.
+##
+## For every codec and level this reports the bytes saved and the CPU time spent per event to
+## compress (producer / Lambda PUT side) and decompress (Lambda GET / Athena side), so the cost of
+## turning compression on can be weighed against the S3 storage, PUT bandwidth and scan bytes saved.
+
+def bench_codec(bodies, codec, level):
+    '''
+    Inputs:
+        `bodies` (dtype: list): Encoded JSON bodies (dtype: bytes), one per event
+        `codec` (dtype: str): "none", "gzip", or "zstd"
+        `level` (dtype: int): The compression level
+
+    Returns: `result` (dtype: dict) Sizes and per-event timings for this codec and level
+    '''
+
+    start = time.process_time()
+    compressed = [compress(body, codec, level) for body in bodies]
+    compress_seconds = time.process_time() - start
+
+    start = time.process_time()
+    for data in compressed:
+        decompress(data, codec)
+    decompress_seconds = time.process_time() - start
+
+    original_bytes = sum(len(body) for body in bodies)
+    compressed_bytes = sum(len(data) for data in compressed)
+
+    result = {
+        "codec": codec,
+        "level": level,
+        "events": len(bodies),
+        "bytes_per_event": round(compressed_bytes / len(bodies), 1),
+        "bytes_saved_per_event": round((original_bytes - compressed_bytes) / len(bodies), 1),
+        "ratio": round(original_bytes / compressed_bytes, 2),
+        "compress_us_per_event": round(compress_seconds * 1e6 / len(bodies), 2),
+        "decompress_us_per_event": round(decompress_seconds * 1e6 / len(bodies), 2)
+    }
+
+    return result
+
+def run_bench(path, limit=None):
+    '''
+    Inputs:
+        `path` (dtype: str): A raw events file (see `event_streams.iter_events`)
+        `limit` (dtype: int): Only use the first `limit` events (optional)
+
+    Returns: `results` (dtype: list) One result per (kind, codec, level), where kind is "raw" or "processed"
+    '''
+
+    raw_bodies = []
+    processed_bodies = []
+
+    for i, event in enumerate(iter_events(path)):
+        if limit is not None and i >= limit:
+            break
+        raw_bodies.append(json.dumps(event).encode("utf-8"))
+        processed_bodies.append(json.dumps(flatten_event_entry(event)).encode("utf-8"))
+
+    settings = [("none", None), ("gzip", 1), ("gzip", 6), ("gzip", 9)]
+    if zstandard is not None:
+        settings += [("zstd", 1), ("zstd", 3), ("zstd", 19)]
+
+    results = []
+    for kind, bodies in (("raw", raw_bodies), ("processed", processed_bodies)):
+        for codec, level in settings:
+            result = bench_codec(bodies, codec, level)
+            result['kind'] = kind
+            results.append(result)
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-event gzip/zstd compression of raw and processed CDEvents")
+    parser.add_argument("path", nargs="?", default="../simulated_data/simulated_raw_events.json")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    print("{:<10}{:<6}{:>6}{:>12}{:>12}{:>8}{:>16}{:>18}".format(
+        "kind", "codec", "level", "bytes/evt", "saved/evt", "ratio", "compress us/evt", "decompress us/evt"))
+
+    for result in run_bench(args.path, args.limit):
+        print("{:<10}{:<6}{:>6}{:>12}{:>12}{:>8}{:>16}{:>18}".format(
+            result['kind'], result['codec'], str(result['level'] or "-"), result['bytes_per_event'],
+            result['bytes_saved_per_event'], result['ratio'], result['compress_us_per_event'],
+            result['decompress_us_per_event']))
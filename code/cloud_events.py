@@ -0,0 +1,128 @@
+import json
+
+## CDEvents as CloudEvents over HTTP.
+##
+## CDEvents are CloudEvents, so a raw event is sent with these CloudEvents attributes:
+##     id      - event_id (unique per event; `context.id` is shared by every event in a lifecycle)
+##     source  - context.source
+##     type    - context.type
+##     time    - context.timestamp in RFC 3339 (i.e. "2023-04-04T22:31:53.796517Z")
+##     subject - subject.id
+## and the whole raw event as the JSON `data`.  The CloudEvents HTTP binding has three content modes:
+##     binary     - the attributes are `ce-*` headers and the body is the event (Content-Type: application/json)
+##     structured - the body is one CloudEvent envelope (Content-Type: application/cloudevents+json)
+##     batch      - the body is a JSON array of envelopes (Content-Type: application/cloudevents-batch+json)
+
+SPEC_VERSION = "1.0"
+MODES = ("binary", "structured", "batch")
+STRUCTURED_CONTENT_TYPE = "application/cloudevents+json"
+BATCH_CONTENT_TYPE = "application/cloudevents-batch+json"
+ATTRIBUTES = ("specversion", "id", "source", "type", "time", "subject", "datacontenttype")
+
+def rfc3339(timestamp):
+    '''
+    Input: `timestamp` (dtype: str) A CDEvent timestamp (i.e. "2023-04-04 22:31:53.796517")
+    Returns: `time` (dtype: str) The same time in RFC 3339, as UTC (i.e. "2023-04-04T22:31:53.796517Z")
+    '''
+
+    return timestamp.replace(" ", "T", 1) + "Z"
+
+def attributes(event):
+    '''
+    Input: `event` (dtype: dict) A raw CDEvent entry
+    Returns: `attributes` (dtype: dict) Its CloudEvents context attributes
+    '''
+
+    context = event['context']
+
+    return {
+        "specversion": SPEC_VERSION,
+        "id": event.get('event_id') or context['id'],
+        "source": context['source'],
+        "type": context['type'],
+        "time": rfc3339(context['timestamp']),
+        "subject": event['subject']['id'],
+        "datacontenttype": "application/json"
+    }
+
+def envelope(event):
+    '''
+    Input: `event` (dtype: dict) A raw CDEvent entry
+    Returns: `envelope` (dtype: dict) The structured-mode CloudEvent, with the event as `data`
+    '''
+
+    structured = attributes(event)
+    structured['data'] = event
+
+    return structured
+
+def to_http(events, mode="binary"):
+    '''
+    Inputs:
+        `events` (dtype: list): Raw events for one request (exactly one unless `mode` is "batch")
+        `mode` (dtype: str): "binary", "structured", or "batch"
+
+    Returns: `(headers, body)` The request headers and body (dtype: bytes) for the content mode
+    '''
+
+    if mode not in MODES:
+        raise ValueError("mode {} is not one of {}".format(mode, MODES))
+    if mode != "batch" and len(events) != 1:
+        raise ValueError("{} mode sends exactly one event per request, got {}".format(mode, len(events)))
+
+    if mode == "binary":
+        headers = {"ce-" + name: value for name, value in attributes(events[0]).items() if name != "datacontenttype"}
+        headers['Content-Type'] = "application/json"
+        return headers, json.dumps(events[0]).encode("utf-8")
+
+    if mode == "structured":
+        return {"Content-Type": STRUCTURED_CONTENT_TYPE}, json.dumps(envelope(events[0])).encode("utf-8")
+
+    return {"Content-Type": BATCH_CONTENT_TYPE}, json.dumps([envelope(event) for event in events]).encode("utf-8")
+
+def from_http(headers, body):
+    '''
+    Inputs:
+        `headers` (dtype: dict): Request headers, with lower-case names
+        `body` (dtype: bytes): The request body
+
+    Returns: `(mode, events)` The content mode and the list of CDEvents (the `data` of each CloudEvent)
+
+    Function Overview:
+        Raises a ValueError if the request is not a CloudEvent with JSON data in one of the three modes.
+    '''
+
+    content_type = headers.get('content-type', "").split(";")[0].strip().lower()
+
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise ValueError("Body is not JSON: {}".format(e))
+
+    if content_type == BATCH_CONTENT_TYPE:
+        if not isinstance(payload, list):
+            raise ValueError("A batch must be a JSON array of CloudEvents")
+        return "batch", [event_data(item) for item in payload]
+
+    if content_type == STRUCTURED_CONTENT_TYPE:
+        return "structured", [event_data(payload)]
+
+    if 'ce-specversion' not in headers:
+        raise ValueError("Not a CloudEvent: no ce-specversion header and Content-Type is {!r}".format(content_type))
+    if headers['ce-specversion'] != SPEC_VERSION:
+        raise ValueError("Unsupported CloudEvents specversion {}".format(headers['ce-specversion']))
+
+    return "binary", [payload]
+
+def event_data(structured):
+    '''
+    Input: `structured` (dtype: dict) A structured-mode CloudEvent
+    Returns: `data` (dtype: dict) Its `data`, the CDEvent
+    '''
+
+    if not isinstance(structured, dict) or structured.get('specversion') != SPEC_VERSION:
+        raise ValueError("Not a CloudEvents {} envelope".format(SPEC_VERSION))
+    if 'data' not in structured:
+        raise ValueError("CloudEvent {} has no JSON data".format(structured.get('id')))
+
+    return structured['data']
@@ -0,0 +1,365 @@
+import os
+import json
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from compression import decode_body, put_arguments
+from event_streams import parse_timestamp
+from key_layout import hours_between, partition_path
+from schemas import PROCESSED_COLUMNS, normalize_processed
+from instrumentation import timer, increment, print_summary
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Merge the many small `processed/` objects written by the Lambda into a few large, sorted files.
+##
+## One processed object per event means ~250k tiny objects a day, and Athena pays a per-object cost on
+## every scan.  A compaction run takes every small object for a time window (the hour partitions
+## `processed/dt=YYYY-MM-DD/hr=HH/`), or every object at the top level of `processed/` for the flat layout,
+## sorts the events by timestamp, and writes them out per hour as Parquet (or NDJSON.gz without pyarrow):
+##     compacted/dt=2023-04-04/hr=22/part-00000-<commit_id>.parquet
+##
+## The run is made safe to interrupt by a commit manifest, `compacted/_commits/<commit_id>.json`:
+##     1. the manifest is written with status "writing" and the list of source keys, and a pending marker
+##        `compacted/_commits/_pending/<commit_id>` is written next to it,
+##     2. the merged files are written and checked with a HEAD request,
+##     3. the manifest is marked "committed",
+##     4. only then are the original objects deleted, the manifest is marked "cleaned", and the marker removed.
+## Every run first finishes the commits that still have a pending marker, using the source keys saved in their
+## manifest: a "writing" commit rewrites the same files, and a "committed" one finishes its deletes.  Only then
+## are the sources listed, so sources that an interrupted run already merged are never merged again, even if
+## new sources arrived in the meantime.  Compacted files use a different format than the JSON under
+## `processed/`, so they live under their own prefix (and their own Glue table).
+
+COMMIT_FOLDER = "_commits/"
+PENDING_FOLDER = "_pending/"
+DELETE_BATCH_SIZE = 1000
+
+def default_format():
+    '''
+    Input: None
+    Returns: `file_format` (dtype: str) "parquet" if pyarrow is installed, otherwise "ndjson"
+    '''
+
+    return "parquet" if pyarrow is not None else "ndjson"
+
+def encode_records(records, file_format):
+    '''
+    Inputs:
+        `records` (dtype: list): Normalized processed events (see `schemas.normalize_processed`)
+        `file_format` (dtype: str): "parquet" or "ndjson"
+
+    Returns: `(put_args, extension)` keyword arguments for `put_object` and the file extension
+    '''
+
+    if file_format == "parquet":
+        if pyarrow is None:
+            raise ValueError("Parquet output requires the `pyarrow` package (pip install pyarrow)")
+
+        schema = pyarrow.schema([(column, pyarrow.string()) for column in PROCESSED_COLUMNS])
+        table = pyarrow.Table.from_pylist(records, schema=schema)
+        buffer = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(table, buffer, compression="snappy")
+
+        return {"Body": buffer.getvalue().to_pybytes(), "ContentType": "application/vnd.apache.parquet"}, ".parquet"
+
+    body = "".join(json.dumps(record) + "\n" for record in records)
+
+    return put_arguments(body, "gzip", content_type="application/x-ndjson"), ".ndjson.gz"
+
+class Compaction():
+    def __init__(self, s3, bucket, source_prefix="processed/", output_prefix="compacted/", file_format=None,
+                 max_rows_per_file=1000000, fetch_workers=32):
+        '''
+        Inputs:
+            `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The CDEvents bucket
+            `source_prefix` (dtype: str): Where the small processed objects are
+            `output_prefix` (dtype: str): Where merged files and commit manifests are written
+            `file_format` (dtype: str): "parquet" or "ndjson" (defaults to parquet when pyarrow is installed)
+            `max_rows_per_file` (dtype: int): The largest number of events in a single merged file
+            `fetch_workers` (dtype: int): Number of concurrent GETs
+
+        Returns: object (dtype: Compaction) A compaction job; call `run()` for each window
+        '''
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.source_prefix = source_prefix
+        self.output_prefix = output_prefix
+        self.file_format = file_format or default_format()
+        self.max_rows_per_file = max_rows_per_file
+        self.fetch_workers = fetch_workers
+
+        return
+
+    def list_keys(self, prefix, delimiter=None):
+        keys = []
+        token = None
+
+        while True:
+            arguments = {"Bucket": self.bucket, "Prefix": prefix}
+            if delimiter:
+                arguments['Delimiter'] = delimiter
+            if token:
+                arguments['ContinuationToken'] = token
+
+            with timer("s3_list"):
+                page = self.s3.list_objects_v2(**arguments)
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+
+            if not page.get('IsTruncated'):
+                return keys
+            token = page['NextContinuationToken']
+
+    def source_keys(self, start=None, end=None):
+        '''
+        Inputs:
+            `start`/`end` (dtype: datetime): The window to compact (end exclusive).  If omitted, the objects at the
+                top level of the source prefix (the flat layout) are compacted instead.
+
+        Returns: `keys` (dtype: list) The small objects to merge, sorted
+        '''
+
+        if start is None:
+            return sorted(self.list_keys(self.source_prefix, delimiter="/"))
+
+        keys = []
+        for hour in hours_between(start, end):
+            keys.extend(self.list_keys(self.source_prefix + partition_path(hour)))
+
+        return sorted(keys)
+
+    def commit_key(self, commit_id):
+        return "{}{}{}.json".format(self.output_prefix, COMMIT_FOLDER, commit_id)
+
+    def load_commit(self, commit_id):
+        try:
+            return json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.commit_key(commit_id))['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ("NoSuchKey", "404"):
+                raise
+
+        return None
+
+    def pending_key(self, commit_id):
+        return "{}{}{}{}".format(self.output_prefix, COMMIT_FOLDER, PENDING_FOLDER, commit_id)
+
+    def save_commit(self, commit):
+        self.s3.put_object(Bucket=self.bucket, Key=self.commit_key(commit['commit_id']), Body=json.dumps(commit),
+                           ContentType="application/json")
+
+    def fetch(self, key):
+        '''
+        Input: `key` (dtype: str) A processed object: one JSON event, or NDJSON batches written by `sqs_worker.py`
+        Returns: `records` (dtype: list) The normalized events in the object
+        '''
+
+        with timer("s3_get"):
+            response = self.s3.get_object(Bucket=self.bucket, Key=key)
+            body = decode_body(response, key)
+        with timer("json_loads"):
+            if ".ndjson" in key:
+                return [normalize_processed(json.loads(line)) for line in body.splitlines() if line.strip()]
+            return [normalize_processed(json.loads(body))]
+
+    def write_files(self, records, commit_id):
+        '''
+        Inputs:
+            `records` (dtype: list): Normalized events, sorted by timestamp
+            `commit_id` (dtype: str): Included in every file name so reruns overwrite the same files
+
+        Returns: `files` (dtype: list) `{"key", "rows", "bytes", "min_timestamp", "max_timestamp"}` for every file,
+            after each one has been confirmed with a HEAD request
+        '''
+
+        partitions = {}
+        for record in records:
+            partitions.setdefault(partition_path(parse_timestamp(record['context_timestamp'])), []).append(record)
+
+        files = []
+        for partition, partition_records in sorted(partitions.items()):
+            for part, offset in enumerate(range(0, len(partition_records), self.max_rows_per_file)):
+                chunk = partition_records[offset:offset + self.max_rows_per_file]
+
+                with timer("encode_" + self.file_format):
+                    put_args, file_extension = encode_records(chunk, self.file_format)
+                key = "{}{}part-{:05d}-{}{}".format(self.output_prefix, partition, part, commit_id, file_extension)
+
+                with timer("s3_put_compacted"):
+                    self.s3.put_object(Bucket=self.bucket, Key=key, **put_args)
+
+                ## Don't trust the PUT alone before deleting anything: read the size back
+                head = self.s3.head_object(Bucket=self.bucket, Key=key)
+                if head['ContentLength'] != len(put_args['Body']):
+                    raise IOError("Compacted file {} has {} bytes, expected {}".format(
+                        key, head['ContentLength'], len(put_args['Body'])))
+
+                files.append({
+                    "key": key,
+                    "rows": len(chunk),
+                    "bytes": len(put_args['Body']),
+                    "min_timestamp": chunk[0]['context_timestamp'],
+                    "max_timestamp": chunk[-1]['context_timestamp']
+                })
+                increment("compacted_files_written")
+
+        return files
+
+    def delete_sources(self, commit):
+        '''
+        Input: `commit` (dtype: dict) A committed manifest
+
+        Function Overview:
+            Deletes the original small objects in batches of 1000 and marks the commit as cleaned.
+        '''
+
+        keys = commit['source_keys']
+        for offset in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = [{"Key": key} for key in keys[offset:offset + DELETE_BATCH_SIZE]]
+            with timer("s3_delete_batch"):
+                self.s3.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+            increment("source_objects_deleted", len(batch))
+
+        commit['status'] = "cleaned"
+        commit['cleaned_at'] = str(datetime.now())
+        self.save_commit(commit)
+        self.s3.delete_object(Bucket=self.bucket, Key=self.pending_key(commit['commit_id']))
+
+        return
+
+    def write_commit(self, commit):
+        '''
+        Input: `commit` (dtype: dict) A manifest with status "writing"
+
+        Function Overview:
+            Merges the commit's source keys into its files and marks it "committed".  Rerunning it for the same
+            commit writes the same file names, so files from an interrupted attempt are overwritten.
+        '''
+
+        keys = commit['source_keys']
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            records = [record for records in executor.map(self.fetch, keys) for record in records]
+
+        with timer("sort"):
+            records.sort(key=lambda record: (record['context_timestamp'] or "", record['event_id'] or ""))
+
+        commit['files'] = self.write_files(records, commit['commit_id'])
+        commit['rows'] = len(records)
+        commit['status'] = "committed"
+        self.save_commit(commit)
+        increment("events_compacted", len(records))
+
+        return
+
+    def resume(self, delete_originals=True):
+        '''
+        Input: `delete_originals` (dtype: bool): Whether to finish the deletes of committed runs
+
+        Returns: `commits` (dtype: list) The interrupted commits that were finished (see the module comment)
+        '''
+
+        commits = []
+        for marker in self.list_keys(self.pending_key("")):
+            commit = self.load_commit(marker[len(self.pending_key("")):])
+
+            if commit is None:
+                ## Interrupted before the manifest was written, so nothing was merged yet
+                self.s3.delete_object(Bucket=self.bucket, Key=marker)
+                continue
+
+            print("Resuming interrupted compaction {} ({})".format(commit['commit_id'], commit['status']))
+            if commit['status'] == "writing":
+                self.write_commit(commit)
+            if delete_originals and commit['status'] == "committed":
+                self.delete_sources(commit)
+            commits.append(commit)
+            increment("compactions_resumed")
+
+        return commits
+
+    def run(self, start=None, end=None, delete_originals=True):
+        '''
+        Inputs:
+            `start`/`end` (dtype: datetime): The window to compact (see `source_keys`)
+            `delete_originals` (dtype: bool): Whether to delete the small objects once the merge is committed
+
+        Returns: `commit` (dtype: dict) The commit manifest (or, if only interrupted runs were finished, the last
+            of those), or None if there was nothing to compact:
+            {
+                "commit_id": "6c1f0e2a9b3d4f51",
+                "status": "cleaned",
+                "format": "parquet",
+                "window": {"start": "2023-04-04 22:00:00", "end": "2023-04-04 23:00:00"},
+                "rows": 10416,
+                "files": [{"key": "compacted/dt=2023-04-04/hr=22/part-00000-6c1f0e2a9b3d4f51.parquet", ...}],
+                "source_count": 10416,
+                "source_keys": [...]
+            }
+        '''
+
+        resumed = self.resume(delete_originals)
+
+        keys = self.source_keys(start, end)
+        if not keys:
+            return resumed[-1] if resumed else None
+
+        commit_id = hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()[:16]
+        commit = self.load_commit(commit_id)
+
+        if commit is None:
+            commit = {
+                "commit_id": commit_id,
+                "created_at": str(datetime.now()),
+                "status": "writing",
+                "format": self.file_format,
+                "window": {"start": str(start) if start else None, "end": str(end) if end else None},
+                "rows": None,
+                "files": [],
+                "source_count": len(keys),
+                "source_keys": keys
+            }
+            self.save_commit(commit)
+            self.s3.put_object(Bucket=self.bucket, Key=self.pending_key(commit_id), Body=b"")
+            self.write_commit(commit)
+
+        if delete_originals and commit['status'] == "committed":
+            self.delete_sources(commit)
+
+        return commit
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge small processed CDEvent objects into large sorted files")
+    parser.add_argument("--bucket", default=os.environ.get("CDEVENT_BUCKET"))
+    parser.add_argument("--start", default=None, help="First hour to compact (YYYY-MM-DDTHH).  Omit to compact the flat processed/ layout.")
+    parser.add_argument("--end", default=None, help="End of the window (exclusive, YYYY-MM-DDTHH).  Defaults to one hour after --start.")
+    parser.add_argument("--format", choices=["parquet", "ndjson"], default=None)
+    parser.add_argument("--max-rows-per-file", type=int, default=1000000)
+    parser.add_argument("--keep-originals", action="store_true", help="Write and commit the merged files but don't delete the sources")
+    parser.add_argument("--local-root", default=None, help="Run against a local object store in this directory instead of S3")
+    args = parser.parse_args()
+
+    if args.local_root:
+        from local_aws import LocalS3
+        s3_client = LocalS3(args.local_root)
+    else:
+        import boto3
+        s3_client = boto3.client("s3")
+
+    start = datetime.strptime(args.start, "%Y-%m-%dT%H") if args.start else None
+    end = datetime.strptime(args.end, "%Y-%m-%dT%H") if args.end else (start + timedelta(hours=1) if start else None)
+
+    compaction = Compaction(s3_client, args.bucket, file_format=args.format, max_rows_per_file=args.max_rows_per_file)
+    commit = compaction.run(start, end, delete_originals=not args.keep_originals)
+
+    if commit is None:
+        print("Nothing to compact")
+    else:
+        print(json.dumps({k: v for k, v in commit.items() if k != "source_keys"}, indent=4))
+    print_summary("compact_processed.py")
@@ -0,0 +1,297 @@
+import io
+import os
+import gzip
+import zlib
+
+## Optional compression for raw and processed objects.
+##
+## Raw and processed events are ~1 KB of JSON that repeats the same sources, URLs, and types, so they
+## compress very well.  Objects are written with the matching `ContentEncoding` and file extension:
+##     none -> raw/<event_id>.json
+##     gzip -> raw/<event_id>.json.gz   (ContentEncoding: gzip)
+##     zstd -> raw/<event_id>.json.zst  (ContentEncoding: zstd)
+## and `decode_body` undoes whichever one was used, based on the ContentEncoding, the extension, or
+## the magic bytes at the start of the data, in that order.  zstd needs the optional `zstandard`
+## package; gzip only needs the standard library.
+##
+## `open_body` is the streaming version of `decode_body`: it returns a file object that decompresses the S3 body
+## as it is read, so an object holding thousands of events never has to be in memory all at once.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENV_VAR = "CDEVENTS_COMPRESSION"
+CODECS = ("none", "gzip", "zstd")
+EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+CONTENT_ENCODINGS = {"none": None, "gzip": "gzip", "zstd": "zstd"}
+DEFAULT_LEVELS = {"none": None, "gzip": 6, "zstd": 3}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def default_codec():
+    '''
+    Input: None
+    Returns: `codec` (dtype: str) The codec selected with `CDEVENTS_COMPRESSION` ("none" if unset)
+    '''
+
+    codec = os.environ.get(COMPRESSION_ENV_VAR, "none")
+    check_codec(codec)
+
+    return codec
+
+def check_codec(codec):
+    '''
+    Input: `codec` (dtype: str) One of "none", "gzip", or "zstd"
+
+    Function Overview:
+        Raises a ValueError for unknown codecs, or if zstd is requested without `zstandard` installed.
+    '''
+
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec {!r}, expected one of {}".format(codec, CODECS))
+
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the `zstandard` package (pip install zstandard)")
+
+    return
+
+def extension(codec):
+    '''
+    Input: `codec` (dtype: str)
+    Returns: `extension` (dtype: str) The suffix added after ".json" for this codec (i.e. ".gz")
+    '''
+
+    return EXTENSIONS[codec]
+
+def compress(data, codec, level=None):
+    '''
+    Inputs:
+        `data` (dtype: bytes or str): The object body
+        `codec` (dtype: str): One of "none", "gzip", or "zstd"
+        `level` (dtype: int): The compression level (defaults to 6 for gzip and 3 for zstd)
+
+    Returns: `compressed` (dtype: bytes)
+    '''
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    if codec == "none":
+        return data
+
+    check_codec(codec)
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+
+    if codec == "gzip":
+        ## mtime=0 keeps the output identical for identical input
+        return gzip.compress(data, compresslevel=level, mtime=0)
+
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+def detect_codec(data, content_encoding=None, key=None):
+    '''
+    Inputs:
+        `data` (dtype: bytes): The (possibly compressed) object body
+        `content_encoding` (dtype: str): The object's ContentEncoding, if known
+        `key` (dtype: str): The object's key, if known
+
+    Returns: `codec` (dtype: str) The codec the data was written with
+    '''
+
+    if content_encoding:
+        for codec, encoding in CONTENT_ENCODINGS.items():
+            if encoding == content_encoding.lower():
+                return codec
+
+    if key:
+        if key.endswith(".gz"):
+            return "gzip"
+        if key.endswith(".zst"):
+            return "zstd"
+
+    if data[:2] == GZIP_MAGIC:
+        return "gzip"
+    if data[:4] == ZSTD_MAGIC:
+        return "zstd"
+
+    return "none"
+
+def decompress(data, codec):
+    '''
+    Inputs:
+        `data` (dtype: bytes): A compressed object body
+        `codec` (dtype: str): The codec it was compressed with
+
+    Returns: `data` (dtype: bytes) The original object body
+    '''
+
+    if codec == "none":
+        return data
+
+    check_codec(codec)
+
+    ## A body can hold several gzip members or zstd frames (i.e. one per batch appended by `NDJSONFileSink`), and
+    ## each decompressor stops at the end of one, so keep going with whatever it leaves unused
+    chunks = []
+    while data:
+        if codec == "gzip":
+            ## wbits=31 decodes gzip framing without the overhead of a GzipFile
+            decompressor = zlib.decompressobj(31)
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        chunks.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise ValueError("The {} body ended before the end of its compressed data".format(codec))
+        data = decompressor.unused_data
+
+    return b"".join(chunks)
+
+def decode_body(response, key=None):
+    '''
+    Inputs:
+        `response` (dtype: dict): The response from `s3.get_object`
+        `key` (dtype: str): The object's key
+
+    Returns: `data` (dtype: bytes) The decompressed object body
+    '''
+
+    data = response['Body'].read()
+    codec = detect_codec(data, response.get('ContentEncoding'), key)
+
+    return decompress(data, codec)
+
+class DecompressingReader():
+    def __init__(self, fileobj, codec, head=b"", chunk_size=1 << 16):
+        '''
+        Inputs:
+            `fileobj` (dtype: file): A binary file object or S3 `StreamingBody` of (possibly compressed) data
+            `codec` (dtype: str): The codec the data was written with
+            `head` (dtype: bytes): Data already read from `fileobj` (i.e. to detect the codec)
+            `chunk_size` (dtype: int): How many compressed bytes to read at a time
+
+        Returns: object (dtype: DecompressingReader) A read-only binary file object of the decompressed data
+
+        Overview:
+            Decompresses a chunk at a time, holding at most about `16 * chunk_size` decompressed bytes at once.
+            Concatenated gzip members or zstd frames (i.e. batches appended to the same object) are read one after
+            another, and a body that ends partway through one raises a ValueError.  zstd's decompressobj takes no
+            output limit and only emits whole blocks, so zstd input is fed `chunk_size // 16` bytes at a time
+            instead; for data compressed less than 256 to 1 that keeps each read within the bound plus the one
+            block being finished (`zstandard.BLOCKSIZE_MAX`, 128 KB).
+        '''
+
+        check_codec(codec)
+
+        self.fileobj = fileobj
+        self.codec = codec
+        self.pending = head
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.position = 0
+        self.eof = False
+        self.decompressor = self.new_decompressor()
+        self.member_started = False
+
+        return
+
+    def new_decompressor(self):
+        if self.codec == "gzip":
+            ## wbits=31 decodes gzip framing, like `decompress`
+            return zlib.decompressobj(31)
+        if self.codec == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+
+        return None
+
+    def fill(self):
+        data = self.pending or self.fileobj.read(self.chunk_size)
+        self.pending = b""
+
+        if not data:
+            if self.member_started and not self.decompressor.eof:
+                raise ValueError("The {} body ended before the end of its compressed data".format(self.codec))
+            self.eof = True
+            return
+
+        if self.decompressor is None:
+            self.buffer += data
+            return
+
+        try:
+            if self.decompressor.eof:
+                self.decompressor = self.new_decompressor()
+            self.member_started = True
+
+            if self.codec == "zstd":
+                step = max(self.chunk_size // 16, 1)
+                self.buffer += self.decompressor.decompress(data[:step])
+                self.pending = self.decompressor.unused_data + data[step:]
+                return
+
+            self.buffer += self.decompressor.decompress(data, 16 * self.chunk_size)
+            self.pending = self.decompressor.unconsumed_tail or self.decompressor.unused_data
+        except zlib.error as e:
+            raise ValueError("Corrupt gzip body: {}".format(e))
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ValueError("Corrupt zstd body: {}".format(e))
+            raise
+
+        return
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            self.fill()
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+def open_body(response, key=None, chunk_size=1 << 16):
+    '''
+    Inputs:
+        `response` (dtype: dict): The response from `s3.get_object`
+        `key` (dtype: str): The object's key
+        `chunk_size` (dtype: int): How many bytes to read from the body at a time
+
+    Returns: `body` (dtype: DecompressingReader) A file object of the decompressed body, read as it streams in
+    '''
+
+    head = response['Body'].read(chunk_size)
+    if not head:
+        ## The body is already closed once it is read to the end
+        return DecompressingReader(io.BytesIO(), "none")
+    codec = detect_codec(head, response.get('ContentEncoding'), key)
+
+    return DecompressingReader(response['Body'], codec, head=head, chunk_size=chunk_size)
+
+def put_arguments(body, codec, level=None, content_type="application/json"):
+    '''
+    Inputs:
+        `body` (dtype: bytes or str): The uncompressed object body
+        `codec` (dtype: str): One of "none", "gzip", or "zstd"
+        `level` (dtype: int): The compression level (optional)
+        `content_type` (dtype: str): The ContentType of the uncompressed body
+
+    Returns: `arguments` (dtype: dict) `Body`, `ContentType`, and (if compressed) `ContentEncoding` keyword
+        arguments for `s3.put_object`
+    '''
+
+    arguments = {"Body": compress(body, codec, level), "ContentType": content_type}
+    if CONTENT_ENCODINGS[codec]:
+        arguments['ContentEncoding'] = CONTENT_ENCODINGS[codec]
+
+    return arguments
@@ -0,0 +1,287 @@
+import os
+import math
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from instrumentation import increment
+
+## Skip events that have already been processed.
+##
+## SQS delivers at least once and S3 can send the same notification twice, so the Lambda can see
+## the same raw event more than once.  A `Deduplicator` checks each event_id against:
+##     1. an in-memory LRU of recently processed ids (per warm Lambda container or worker process), then
+##     2. an optional persistent store shared across invocations:
+##          `MarkerStore`      - one empty marker object per processed event_id (exact, shared by every
+##                               Lambda container; works against S3 or a `LocalS3`)
+##          `BloomFilterStore` - a file-backed Bloom filter (constant memory, tiny false-positive rate;
+##                               suited to a single long-running worker, since the file is local to one
+##                               machine or Lambda container)
+## Events are only marked after they have been written successfully, so a failure part way through
+## processing is retried rather than skipped.
+
+def event_id_from_key(key):
+    '''
+    Input: `key` (dtype: str): A raw event key (i.e. "raw/dt=2023-04-04/hr=22/07/609198c9-....json.gz")
+    Returns: `event_id` (dtype: str) The event id the object is named after
+
+    Function Overview:
+        Raw objects are named after their event_id in every key layout (or after their batch id, i.e.
+        "batch-<uuid>", when they hold several events), so duplicates can be skipped before the object is even
+        downloaded.
+    '''
+
+    return key.rsplit("/", 1)[-1].split(".", 1)[0]
+
+class LRUSet():
+    def __init__(self, capacity):
+        '''
+        Input: `capacity` (dtype: int): The maximum number of ids to remember
+        Returns: object (dtype: LRUSet) A bounded set that forgets the least recently used id when full
+        '''
+
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+        return
+
+    def __contains__(self, item):
+        with self.lock:
+            if item in self.items:
+                self.items.move_to_end(item)
+                return True
+        return False
+
+    def add(self, item):
+        with self.lock:
+            self.items[item] = None
+            self.items.move_to_end(item)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+class BloomFilter():
+    def __init__(self, capacity=1000000, error_rate=0.001, bits=None, num_hashes=None, data=None):
+        '''
+        Inputs:
+            `capacity` (dtype: int): The number of items the filter is sized for
+            `error_rate` (dtype: float): The false-positive rate at `capacity` items
+            `bits`/`num_hashes`/`data`: Used to rebuild a saved filter (see `from_bytes`)
+
+        Returns: object (dtype: BloomFilter) A Bloom filter using `bits = -n*ln(p)/ln(2)^2` bits and
+            `k = bits/n*ln(2)` hash functions, derived from one blake2b digest by double hashing.
+        '''
+
+        if bits is None:
+            bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+
+        self.bits = bits
+        self.num_hashes = num_hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+        return
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack(">QQ", digest)
+        second |= 1  ## An odd step visits every bit position
+
+        return [(first + i * second) % self.bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def add(self, item):
+        with self.lock:
+            for position in self.positions(item):
+                self.data[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def merge(self, other):
+        '''
+        Input: `other` (dtype: BloomFilter): A filter with the same size and number of hashes
+
+        Function Overview:
+            Adds everything in `other` to this filter (a bitwise OR), i.e. to combine filters from several workers.
+        '''
+
+        if (other.bits, other.num_hashes) != (self.bits, self.num_hashes):
+            raise ValueError("Only Bloom filters with the same size and number of hashes can be merged")
+
+        with self.lock:
+            merged = int.from_bytes(self.data, "little") | int.from_bytes(other.data, "little")
+            self.data = bytearray(merged.to_bytes(len(self.data), "little"))
+            self.count += other.count
+
+        return
+
+    def to_bytes(self):
+        return struct.pack(">4sQIQ", b"BLM1", self.bits, self.num_hashes, self.count) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        magic, bits, num_hashes, count = struct.unpack(">4sQIQ", payload[:24])
+        if magic != b"BLM1":
+            raise ValueError("Not a saved BloomFilter")
+
+        bloom_filter = cls(bits=bits, num_hashes=num_hashes, data=payload[24:])
+        bloom_filter.count = count
+
+        return bloom_filter
+
+class MarkerStore():
+    def __init__(self, s3, bucket, prefix="dedup/processed/"):
+        '''
+        Inputs:
+            `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The bucket to keep markers in
+            `prefix` (dtype: str): The folder marker objects are written under
+
+        Returns: object (dtype: MarkerStore) An exact, persistent record of processed event ids, shared by every
+            Lambda container.  A lookup is one HEAD request, which is far cheaper than the GET + flatten + PUT
+            it saves.
+        '''
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+        return
+
+    def __contains__(self, event_id):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.prefix + event_id)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def add(self, event_id):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + event_id, Body=b"")
+
+    def flush(self):
+        return
+
+class BloomFilterStore():
+    def __init__(self, path, capacity=1000000, error_rate=0.0001, save_every=1000):
+        '''
+        Inputs:
+            `path` (dtype: str): The file the filter is saved to (loaded from it if it already exists)
+            `capacity`/`error_rate`: Sizing for a new filter (see `BloomFilter`)
+            `save_every` (dtype: int): Save the filter after this many new ids (and on `flush`)
+
+        Returns: object (dtype: BloomFilterStore) A persistent Bloom filter of processed event ids.  A false
+            positive skips an event that was never processed, so size the filter with a small `error_rate`.
+        '''
+
+        self.path = path
+        self.save_every = save_every
+        self.unsaved = 0
+
+        if os.path.exists(path):
+            with open(path, "rb") as saved:
+                self.bloom_filter = BloomFilter.from_bytes(saved.read())
+        else:
+            self.bloom_filter = BloomFilter(capacity, error_rate)
+
+        return
+
+    def __contains__(self, event_id):
+        return event_id in self.bloom_filter
+
+    def add(self, event_id):
+        self.bloom_filter.add(event_id)
+        self.unsaved += 1
+
+        if self.unsaved >= self.save_every:
+            self.flush()
+
+    def flush(self):
+        '''
+        Function Overview:
+            Atomically writes the filter to `path`, if any ids were added since it was last saved.
+        '''
+
+        if self.unsaved == 0 and os.path.exists(self.path):
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".bloom-")
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(self.bloom_filter.to_bytes())
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+
+        return
+
+class Deduplicator():
+    def __init__(self, lru_capacity=100000, store=None):
+        '''
+        Inputs:
+            `lru_capacity` (dtype: int): How many recently processed ids to keep in memory
+            `store`: An optional persistent store (`MarkerStore` or `BloomFilterStore`)
+
+        Returns: object (dtype: Deduplicator) Checks and records processed event ids.  Hits and misses are
+            counted in `stats` and in the shared instrumentation counters (`dedup_hits_memory`,
+            `dedup_hits_store`, `dedup_misses`).
+        '''
+
+        self.recent = LRUSet(lru_capacity)
+        self.store = store
+        self.stats = {"hits_memory": 0, "hits_store": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+        return
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+        increment("dedup_" + name)
+
+    def is_duplicate(self, event_id):
+        '''
+        Input: `event_id` (dtype: str)
+        Returns: `duplicate` (dtype: bool) Whether the event has already been processed
+        '''
+
+        if event_id in self.recent:
+            self.count("hits_memory")
+            return True
+
+        if self.store is not None and event_id in self.store:
+            ## Remember it locally so the next duplicate doesn't need the store
+            self.recent.add(event_id)
+            self.count("hits_store")
+            return True
+
+        self.count("misses")
+
+        return False
+
+    def mark(self, event_id):
+        '''
+        Input: `event_id` (dtype: str): An event that has been processed and written successfully
+        '''
+
+        self.recent.add(event_id)
+        if self.store is not None:
+            self.store.add(event_id)
+
+        return
+
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+
+        return
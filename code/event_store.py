@@ -0,0 +1,444 @@
+import os
+import glob
+import json
+import mmap
+import time
+import struct
+import argparse
+import numpy as np
+from event_streams import iter_events
+from sketches import stable_hash
+from instrumentation import timer, increment, print_summary
+
+## An indexed local store of raw events, for looking up one event or one whole lifecycle without scanning.
+##
+## Events are appended as NDJSON lines to segment files of up to `segment_bytes` each:
+##     <root>/segment-00000.ndjson
+## Every event adds three records to an append-only journal, `<root>/index.journal`, one per key it can be found
+## by: its event_id, its `context.id`, and its run id (the id of its `pipelineRun`/`taskRun`; every event of a
+## lifecycle shares the same context id and run id).  A record is 24 bytes: the key's 64-bit hash, and the
+## segment, length, and offset of the event's line.
+##
+## `build_index` turns the journal into `<root>/index.table`, an open-addressing hash table over the key hashes
+## (twice as many slots as keys, linear probing) followed by the event locations grouped by key.  Reads go through
+## memory-mapped files: a lookup hashes the key, probes a slot or two of the table, and reads the event straight
+## out of its segment, so it costs the same however large the store grows.  Records journaled since the last
+## `build_index` are looked up in memory, so new events can be found right away.  Hashes can collide, so every
+## event found is checked against the key before it is returned.
+
+SEGMENT_PATTERN = "segment-{:05d}.ndjson"
+JOURNAL_NAME = "index.journal"
+TABLE_NAME = "index.table"
+TABLE_MAGIC = b"CDIX"
+TABLE_VERSION = 1
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+RECORD = struct.Struct("<QIIQ")          ## key hash, segment, length, offset
+HEADER = struct.Struct("<4sIQQQ")        ## magic, version, slots, locations, journal records covered
+SLOT = struct.Struct("<QQI")             ## key hash, first location, number of locations
+LOCATION = struct.Struct("<IIQ")         ## segment, length, offset
+
+RECORD_DTYPE = np.dtype([("hash", "<u8"), ("segment", "<u4"), ("length", "<u4"), ("offset", "<u8")])
+SLOT_DTYPE = np.dtype([("hash", "<u8"), ("start", "<u8"), ("count", "<u4")])
+LOCATION_DTYPE = np.dtype([("segment", "<u4"), ("length", "<u4"), ("offset", "<u8")])
+
+def key_hash(kind, value):
+    '''
+    Inputs:
+        `kind` (dtype: str): "event", "context", or "run"
+        `value` (dtype: str): The id
+
+    Returns: `hash` (dtype: int) A non-zero 64-bit hash (zero marks an empty slot in the table)
+    '''
+
+    return stable_hash("{}:{}".format(kind, value)) or 1
+
+def event_keys(event):
+    '''
+    Input: `event` (dtype: dict) A raw CDEvent entry
+    Returns: `keys` (dtype: list) The `(kind, id)` pairs the event is indexed under
+    '''
+
+    keys = [("event", event['event_id'])]
+    if isinstance(event.get('context'), dict) and event['context'].get('id'):
+        keys.append(("context", event['context']['id']))
+
+    content = event.get('subject', {}).get('content', {}) if isinstance(event.get('subject'), dict) else {}
+    run = content.get('pipelineRun') or content.get('taskRun') if isinstance(content, dict) else None
+    if isinstance(run, dict) and run.get('id'):
+        keys.append(("run", run['id']))
+
+    return keys
+
+def build_table(records):
+    '''
+    Input: `records` (dtype: numpy.ndarray) Journal records (`RECORD_DTYPE`)
+    Returns: `(slots, locations)` The hash table (`SLOT_DTYPE`) and the locations it points into (`LOCATION_DTYPE`)
+
+    Function Overview:
+        Locations are sorted by key hash (keeping journal order within a key), so each key's locations are one
+        contiguous run.  Keys are placed with linear probing, one probe step for every unplaced key per round.
+    '''
+
+    order = np.argsort(records['hash'], kind="stable")
+    records = records[order]
+    locations = np.empty(len(records), dtype=LOCATION_DTYPE)
+    for field in LOCATION_DTYPE.names:
+        locations[field] = records[field]
+
+    keys, starts, counts = np.unique(records['hash'], return_index=True, return_counts=True)
+    size = 1
+    while size < 2 * max(len(keys), 1):
+        size *= 2
+    mask = np.uint64(size - 1)
+
+    slots = np.zeros(size, dtype=SLOT_DTYPE)
+    pending = np.arange(len(keys))
+    probe = np.uint64(0)
+    while len(pending):
+        positions = ((keys[pending] + probe) & mask).astype(np.int64)
+        free = slots['hash'][positions] == 0
+        ## Only the first key aiming at a free slot gets it this round
+        claimed, first = np.unique(positions[free], return_index=True)
+        winners = pending[free][first]
+
+        slots['hash'][claimed] = keys[winners]
+        slots['start'][claimed] = starts[winners]
+        slots['count'][claimed] = counts[winners]
+
+        pending = np.setdiff1d(pending, winners, assume_unique=True)
+        probe += np.uint64(1)
+
+    return slots, locations
+
+class EventStore():
+    def __init__(self, root, segment_bytes=DEFAULT_SEGMENT_BYTES):
+        '''
+        Inputs:
+            `root` (dtype: str): The store's folder (created if it does not exist)
+            `segment_bytes` (dtype: int): Start a new segment once the current one is this large
+
+        Returns: object (dtype: EventStore) Call `append` to add events, `get`/`lifecycle` to look them up, and
+            `close` when done (which also rebuilds the index)
+        '''
+
+        self.root = root
+        self.segment_bytes = segment_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self.segment_maps = {}
+        self.table = None
+        self.table_file = None
+        self.covered = 0
+        self.recent = {}      ## key hash -> [(segment, length, offset)] for records journaled since `build_index`
+
+        self.recover()
+        self.open_table()
+
+        self.segment = max([self.segment_number(path) for path in self.segment_paths()] or [0])
+        self.writer = open(self.segment_path(self.segment), "ab")
+        self.journal = open(os.path.join(root, JOURNAL_NAME), "ab")
+        self.load_recent()
+
+        return
+
+    def segment_path(self, number):
+        return os.path.join(self.root, SEGMENT_PATTERN.format(number))
+
+    def segment_paths(self):
+        return sorted(glob.glob(os.path.join(self.root, "segment-*.ndjson")))
+
+    @staticmethod
+    def segment_number(path):
+        return int(os.path.basename(path)[len("segment-"):-len(".ndjson")])
+
+    def recover(self):
+        '''
+        Function Overview:
+            Undoes a write that was cut short: a partial journal record is dropped, and segment data past the last
+            journaled event (written before its records were) is truncated, so it is not appended after.
+        '''
+
+        journal_path = os.path.join(self.root, JOURNAL_NAME)
+        size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        last_segment, end = 0, 0
+
+        if size % RECORD.size:
+            with open(journal_path, "r+b") as f:
+                f.truncate(size - size % RECORD.size)
+            size -= size % RECORD.size
+
+        if size:
+            with open(journal_path, "rb") as f:
+                f.seek(size - RECORD.size)
+                _, last_segment, length, offset = RECORD.unpack(f.read(RECORD.size))
+            end = offset + length + 1
+
+        for path in self.segment_paths():
+            number = self.segment_number(path)
+            if number > last_segment:
+                os.remove(path)
+            elif number == last_segment and os.path.getsize(path) > end:
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+
+        return
+
+    def open_table(self):
+        path = os.path.join(self.root, TABLE_NAME)
+        if not os.path.exists(path):
+            return
+
+        self.table_file = open(path, "rb")
+        self.table = mmap.mmap(self.table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slot_count, self.location_count, self.covered = HEADER.unpack_from(self.table, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError("{} is not a version {} event index".format(path, TABLE_VERSION))
+        self.locations_start = HEADER.size + self.slot_count * SLOT.size
+
+        return
+
+    def close_table(self):
+        if self.table is not None:
+            self.table.close()
+            self.table_file.close()
+        self.table = None
+        self.table_file = None
+        self.covered = 0
+
+        return
+
+    def load_recent(self):
+        '''
+        Function Overview:
+            Reads the journal records the table does not cover yet into memory.
+        '''
+
+        self.recent = {}
+        with open(os.path.join(self.root, JOURNAL_NAME), "rb") as f:
+            f.seek(self.covered * RECORD.size)
+            data = f.read()
+
+        for hash_value, segment, length, offset in RECORD.iter_unpack(data):
+            self.recent.setdefault(hash_value, []).append((segment, length, offset))
+
+        return
+
+    def append(self, events):
+        '''
+        Input: `events` (dtype: iterable) Raw events
+        Returns: `count` (dtype: int) How many events were appended
+        '''
+
+        count = 0
+        lines = []
+        records = []
+        position = self.writer.tell()
+
+        with timer("store_append"):
+            for event in events:
+                line = json.dumps(event).encode("utf-8")
+                if position and position + len(line) + 1 > self.segment_bytes:
+                    self.write(lines, records)
+                    lines, records = [], []
+                    self.writer.close()
+                    self.segment += 1
+                    self.writer = open(self.segment_path(self.segment), "ab")
+                    position = 0
+
+                for kind, value in event_keys(event):
+                    records.append((key_hash(kind, value), self.segment, len(line), position))
+                lines.append(line + b"\n")
+                position += len(line) + 1
+                count += 1
+
+            self.write(lines, records)
+
+        increment("store_events_appended", count)
+
+        return count
+
+    def write(self, lines, records):
+        ## Segment data goes first, so the journal never points past the end of a segment
+        self.writer.write(b"".join(lines))
+        self.writer.flush()
+        self.journal.write(b"".join(RECORD.pack(*record) for record in records))
+        self.journal.flush()
+
+        for hash_value, segment, length, offset in records:
+            self.recent.setdefault(hash_value, []).append((segment, length, offset))
+
+        ## A map of the segment being written ends where the segment did when it was mapped
+        segment_map = self.segment_maps.pop(self.segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+        return
+
+    def build_index(self):
+        '''
+        Returns: `stats` (dtype: dict) `{"keys": 4500, "locations": 9513, "slots": 16384, "seconds": 0.004}`
+
+        Function Overview:
+            Rebuilds the hash table from the whole journal and swaps it in atomically.
+        '''
+
+        start = time.perf_counter()
+        self.journal.flush()
+        records = np.fromfile(os.path.join(self.root, JOURNAL_NAME), dtype=RECORD_DTYPE)
+
+        with timer("store_build_index"):
+            slots, locations = build_table(records)
+
+        path = os.path.join(self.root, TABLE_NAME)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(slots), len(locations), len(records)))
+            f.write(slots.tobytes())
+            f.write(locations.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.close_table()
+        os.replace(temporary, path)
+        self.open_table()
+        self.load_recent()
+
+        return {"keys": int(np.count_nonzero(slots['hash'])), "locations": len(locations), "slots": len(slots),
+                "seconds": round(time.perf_counter() - start, 3)}
+
+    def locations(self, kind, value):
+        '''
+        Inputs:
+            `kind` (dtype: str): "event", "context", or "run"
+            `value` (dtype: str): The id
+
+        Returns: `locations` (dtype: list) `(segment, length, offset)` of every event indexed under the key
+        '''
+
+        hash_value = key_hash(kind, value)
+        found = []
+
+        if self.table is not None and self.slot_count:
+            mask = self.slot_count - 1
+            position = hash_value & mask
+            while True:
+                slot_hash, first, count = SLOT.unpack_from(self.table, HEADER.size + position * SLOT.size)
+                if slot_hash == 0:
+                    break
+                if slot_hash == hash_value:
+                    found = [LOCATION.unpack_from(self.table, self.locations_start + index * LOCATION.size)
+                             for index in range(first, first + count)]
+                    break
+                position = (position + 1) & mask
+
+        return found + self.recent.get(hash_value, [])
+
+    def read(self, segment, length, offset):
+        segment_map = self.segment_maps.get(segment)
+        if segment_map is None:
+            with open(self.segment_path(segment), "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.segment_maps[segment] = segment_map
+
+        return json.loads(segment_map[offset:offset + length])
+
+    def find(self, kind, value):
+        events = []
+        seen = set()
+        for location in self.locations(kind, value):
+            ## Two keys of the same event that share a hash point at the same location twice
+            if location in seen:
+                continue
+            seen.add(location)
+
+            event = self.read(*location)
+            if (kind, value) in event_keys(event):
+                events.append(event)
+
+        return events
+
+    def get(self, event_id):
+        '''
+        Input: `event_id` (dtype: str)
+        Returns: `event` (dtype: dict) The raw event, or None if it is not in the store
+        '''
+
+        with timer("store_get"):
+            events = self.find("event", event_id)
+
+        return events[0] if events else None
+
+    def lifecycle(self, run_or_context_id):
+        '''
+        Input: `run_or_context_id` (dtype: str) A run id (`pipelineRun.id`/`taskRun.id`) or a `context.id`
+        Returns: `events` (dtype: list) Every event of the lifecycle, in timestamp order
+        '''
+
+        with timer("store_lifecycle"):
+            events = self.find("run", run_or_context_id) or self.find("context", run_or_context_id)
+
+        return sorted(events, key=lambda event: event['context']['timestamp'])
+
+    def stats(self):
+        '''
+        Returns: `stats` (dtype: dict) Segment, event, and index sizes
+        '''
+
+        journal_records = os.path.getsize(os.path.join(self.root, JOURNAL_NAME)) // RECORD.size
+        paths = self.segment_paths()
+
+        return {"segments": len(paths), "segment_bytes": sum(os.path.getsize(path) for path in paths),
+                "journal_records": journal_records, "indexed_records": self.covered,
+                "unindexed_records": journal_records - self.covered,
+                "index_bytes": os.path.getsize(os.path.join(self.root, TABLE_NAME)) if self.table is not None else 0}
+
+    def close(self, build_index=True):
+        '''
+        Input: `build_index` (dtype: bool) Rebuild the index first if events were appended since it was built
+        '''
+
+        if build_index and self.recent:
+            self.build_index()
+
+        self.writer.close()
+        self.journal.close()
+        for segment_map in self.segment_maps.values():
+            segment_map.close()
+        self.segment_maps = {}
+        self.close_table()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look up raw events and lifecycles in an indexed local store")
+    parser.add_argument("store", help="The store's folder")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="Append raw event files (JSON arrays, NDJSON, .cdeb) and rebuild the index")
+    add_parser.add_argument("paths", nargs="+")
+    get_parser = subparsers.add_parser("get", help="Print one event by event_id")
+    get_parser.add_argument("event_id")
+    lifecycle_parser = subparsers.add_parser("lifecycle", help="Print every event of a run, by run id or context id")
+    lifecycle_parser.add_argument("id")
+    subparsers.add_parser("stats", help="Print the store's size")
+    args = parser.parse_args()
+
+    with EventStore(args.store) as store:
+        if args.command == "add":
+            for path in args.paths:
+                print("{}: {} events".format(path, store.append(iter_events(path))))
+            print(json.dumps(store.build_index(), indent=4))
+        elif args.command == "get":
+            print(json.dumps(store.get(args.event_id), indent=4))
+        elif args.command == "lifecycle":
+            print(json.dumps(store.lifecycle(args.id), indent=4))
+        else:
+            print(json.dumps(store.stats(), indent=4))
+
+    print_summary("event_store.py")
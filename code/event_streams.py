@@ -0,0 +1,286 @@
+import io
+import gzip
+import json
+import codecs
+from datetime import datetime
+from wire_format import iter_stream, is_binary, loads_event, EXTENSION as BINARY_EXTENSION
+
+## Streaming readers for raw CDEvent datasets.
+##
+## `simulated_raw_events.json` is one big JSON array, so `json.load` has to hold the whole
+## file (and every decoded event) in memory at once.  These readers yield one event at a time
+## instead, so replay, backfill, and analysis tools can work on files far larger than memory.
+## `iter_body` does the same for an object body that is being streamed (i.e. from S3, see `compression.open_body`).
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+JSON_DECODER = json.JSONDecoder()
+
+def decode_next(fileobj, buffer, position, eof, chunk_size):
+    '''
+    Inputs:
+        `fileobj` (dtype: file): The text-mode file the buffer is read from
+        `buffer` (dtype: str): Text read from the file so far
+        `position` (dtype: int): Where the next JSON value starts in `buffer`
+        `eof` (dtype: bool): Whether the whole file has been read
+        `chunk_size` (dtype: int): How many characters to read at a time
+
+    Returns: `(value, buffer, end, eof)` The decoded value, the (possibly refilled) buffer, and the position just after the value
+
+    Function Overview:
+        Decodes one value with `JSONDecoder.raw_decode`, reading more of the file only when the value runs past
+        the end of the buffer.  Everything before `position` is dropped whenever the buffer is refilled.
+    '''
+
+    while True:
+        try:
+            value, end = JSON_DECODER.raw_decode(buffer, position)
+            ## A bare number that ends exactly at the end of the buffer may continue in the next chunk
+            if end < len(buffer) or eof:
+                return value, buffer, end, eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+
+        chunk = fileobj.read(chunk_size)
+        buffer, position, eof = buffer[position:] + chunk, 0, chunk == ""
+
+def iter_json_array(fileobj, chunk_size=1 << 16):
+    '''
+    Inputs:
+        `fileobj` (dtype: file): A text-mode file object positioned at the start of a JSON array
+            (i.e. `[{...}, {...}, ...]`)
+        `chunk_size` (dtype: int): How many characters to read from the file at a time
+
+    Returns: A generator that yields each element of the array as it is decoded
+
+    Function Overview:
+        This function incrementally decodes a top-level JSON array without ever loading the full array.
+        It keeps a small text buffer, decodes one element at a time with `JSONDecoder.raw_decode`, and only
+        reads more of the file when an element is split across the end of the buffer.
+    '''
+
+    buffer = ""
+    position = 0
+    eof = False
+    started = False
+
+    def fill(buffer, position):
+        ## Drop everything already decoded and append the next chunk from the file
+        chunk = fileobj.read(chunk_size)
+        return buffer[position:] + chunk, 0, chunk == ""
+
+    while True:
+        ## Skip whitespace and separators between elements
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                if buffer[position] == "," and not started:
+                    raise ValueError("Unexpected ',' before the start of the JSON array")
+                position += 1
+
+            if position < len(buffer) or eof:
+                break
+            buffer, position, eof = fill(buffer, position)
+
+        if position >= len(buffer):
+            if started:
+                raise ValueError("JSON array was not closed before the end of the file")
+            return
+
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array, found {!r}".format(buffer[position]))
+            started = True
+            position += 1
+            continue
+
+        if buffer[position] == "]":
+            return
+
+        element, buffer, position, eof = decode_next(fileobj, buffer, position, eof, chunk_size)
+        yield element
+
+def iter_json_documents(fileobj, chunk_size=1 << 16):
+    '''
+    Inputs:
+        `fileobj` (dtype: file): A text-mode file object holding JSON documents separated by whitespace
+        `chunk_size` (dtype: int): How many characters to read from the file at a time
+
+    Returns: A generator that yields each document as it is decoded
+
+    Function Overview:
+        Covers NDJSON as well as a single (possibly pretty-printed) JSON object, since documents are found by
+        decoding rather than by splitting lines.
+    '''
+
+    buffer = ""
+    position = 0
+    eof = False
+
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+
+            if position < len(buffer) or eof:
+                break
+            chunk = fileobj.read(chunk_size)
+            buffer, position, eof = buffer[position:] + chunk, 0, chunk == ""
+
+        if position >= len(buffer):
+            return
+
+        document, buffer, position, eof = decode_next(fileobj, buffer, position, eof, chunk_size)
+        yield document
+
+def iter_ndjson(fileobj):
+    '''
+    Input: `fileobj` (dtype: file): A text-mode file object with one JSON document per line (NDJSON)
+    Returns: A generator that yields each decoded line, skipping blank lines
+    '''
+
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def open_text(path):
+    '''
+    Input: `path` (dtype: str): A path to a `.json`, `.ndjson`, or `.jsonl` file, optionally ending in `.gz`
+    Returns: A text-mode file object, transparently decompressing gzip files
+    '''
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+
+    return io.open(path, "r", encoding="utf-8")
+
+def iter_events(path):
+    '''
+    Input: `path` (dtype: str): A raw events file, either a JSON array (like `simulated_raw_events.json`),
+        NDJSON, or binary events (`.cdeb`, see `wire_format.py`), optionally gzip-compressed
+    Returns: A generator that yields one raw CDEvent dictionary at a time
+
+    Function Overview:
+        Binary files are recognized by their extension.  Otherwise the format is detected from the first
+        non-whitespace character: `[` means a JSON array, anything else is treated as NDJSON.
+    '''
+
+    if path.endswith((BINARY_EXTENSION, BINARY_EXTENSION + ".gz")):
+        with (gzip.open(path, "rb") if path.endswith(".gz") else io.open(path, "rb")) as fileobj:
+            for event in iter_stream(fileobj):
+                yield event
+        return
+
+    with open_text(path) as fileobj:
+        first = ""
+        while True:
+            first = fileobj.read(1)
+            if first == "" or not first.isspace():
+                break
+
+        if first == "":
+            return
+
+        ## Put the first character back in front of the rest of the file
+        rest = _PrefixedReader(first, fileobj)
+
+        if first == "[":
+            for event in iter_json_array(rest):
+                yield event
+        else:
+            for event in iter_ndjson(rest):
+                yield event
+
+def iter_body(fileobj, key=None, chunk_size=1 << 16):
+    '''
+    Inputs:
+        `fileobj` (dtype: file): A binary-mode file object holding decompressed raw events (see `compression.open_body`)
+        `key` (dtype: str): The object's key, used to recognize `.cdeb` streams
+        `chunk_size` (dtype: int): How many bytes to read at a time
+
+    Returns: A generator that yields one raw CDEvent dictionary at a time
+
+    Function Overview:
+        Accepts everything a raw object may hold: a single event (JSON or binary), a JSON array, NDJSON, or a
+        stream of length-prefixed binary events (`.cdeb`).  Only `chunk_size` bytes plus the event being decoded
+        are held in memory, however many events the object carries.
+    '''
+
+    head = fileobj.read(chunk_size)
+
+    ## A single binary event is not length-prefixed, and is small enough to decode at once
+    if is_binary(head):
+        yield loads_event(head + fileobj.read())
+        return
+
+    if key and key.endswith(tuple(BINARY_EXTENSION + suffix for suffix in ("", ".gz", ".zst"))):
+        for event in iter_stream(_PrefixedReader(head, fileobj), chunk_size):
+            yield event
+        return
+
+    ## Leading whitespace is dropped, so the first byte tells a JSON array from NDJSON or a single object
+    while head.isspace() or head == b"":
+        if head == b"":
+            return
+        head = fileobj.read(chunk_size)
+    head = head.lstrip()
+
+    text = codecs.getreader("utf-8")(_PrefixedReader(head, fileobj))
+    events = iter_json_array(text, chunk_size) if head[:1] == b"[" else iter_json_documents(text, chunk_size)
+    for event in events:
+        yield event
+
+def event_timestamp(event):
+    '''
+    Input: `event` (dtype: dict) A raw CDEvent entry
+    Returns: `timestamp` (dtype: datetime) The parsed `context.timestamp` of the event
+    '''
+
+    return parse_timestamp(event['context']['timestamp'])
+
+def parse_timestamp(value):
+    '''
+    Input: `value` (dtype: str) A CDEvent timestamp string (i.e. "2023-03-24 10:55:33.124459")
+    Returns: `timestamp` (dtype: datetime)
+
+    Function Overview:
+        `str(datetime.now())` drops the microseconds when they happen to be zero, so both forms are accepted.
+    '''
+
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+class _PrefixedReader():
+    def __init__(self, prefix, fileobj):
+        '''
+        Inputs:
+            `prefix` (dtype: str): Text that has already been read from `fileobj`
+            `fileobj` (dtype: file): The rest of the file
+
+        Overview:
+            A minimal file-like wrapper used by `iter_events` after peeking at the first character.
+        '''
+
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+        return
+
+    def read(self, size=-1):
+        if self.prefix:
+            prefix, self.prefix = self.prefix, ""
+            if size is None or size < 0:
+                return prefix + self.fileobj.read()
+            return prefix + self.fileobj.read(max(size - len(prefix), 0))
+
+        return self.fileobj.read(size)
+
+    def __iter__(self):
+        if self.prefix:
+            prefix, self.prefix = self.prefix, ""
+            yield prefix + self.fileobj.readline()
+
+        for line in self.fileobj:
+            yield line
@@ -0,0 +1,296 @@
+import ssl
+import json
+import time
+import asyncio
+import argparse
+from itertools import islice
+from collections import Counter
+from urllib.parse import urlsplit
+from cloud_events import to_http, MODES
+from http_protocol import format_request, read_response
+from sketches import TDigest
+from instrumentation import increment, print_summary
+
+## Push simulated CDEvents to webhook receivers as CloudEvents over HTTP.
+##
+## `HTTPEmitter` sends events with asyncio, so one process can keep hundreds of requests in flight.  `concurrency`
+## workers share a pool of keep-alive connections (`ConnectionPool`), so connections are opened once and reused
+## instead of paying a TCP (and TLS) handshake per event.  Requests use one of the CloudEvents content modes
+## from `cloud_events.py`: binary or structured (one event per request) or batch (`batch_size` events per
+## request).  `rate` caps requests per second for steady load tests; without it the emitter sends as fast as the
+## receiver answers.
+##     emitter = HTTPEmitter("http://localhost:8080/events", mode="binary", concurrency=64)
+##     stats = emitter.run(events)
+##     -> {"requests": 3171, "events": 3171, "errors": 0, "requests_per_second": 4783.5,
+##         "latency_ms": {"p50": 6.7, "p95": 8.8, "p99": 12.8, "max": 20.4}, "status_counts": {"202": 3171}, ...}
+## A non-2xx response, a failed connection, or a response cut short counts as an error; a request on a reused
+## connection that the server had already closed is retried once on a new connection.  Any other exception in a
+## worker stops the run and is raised from `emit`, instead of leaving the producer waiting on a full queue.
+
+class ConnectionPool():
+    def __init__(self, url, size=64, timeout=10.0):
+        '''
+        Inputs:
+            `url` (dtype: str): The receiver's URL (http:// or https://)
+            `size` (dtype: int): The most connections to keep open
+            `timeout` (dtype: float): Seconds to wait to connect, or for a response
+
+        Returns: object (dtype: ConnectionPool) Keep-alive connections to one host, opened as they are needed
+        '''
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("Only http:// and https:// URLs are supported, got {}".format(url))
+
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.host_header = parts.netloc
+        self.target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.open = 0
+        self.opened = 0
+        self.available = None
+
+        return
+
+    async def acquire(self):
+        '''
+        Returns: `(reader, writer, reused)` An idle connection, or a new one if fewer than `size` are open
+        '''
+
+        if self.available is None:
+            self.available = asyncio.Semaphore(self.size)
+        await self.available.acquire()
+
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            self.discard(writer, release=False)
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+        except BaseException:
+            self.available.release()
+            raise
+        self.open += 1
+        self.opened += 1
+
+        return reader, writer, False
+
+    def release(self, reader, writer):
+        self.idle.append((reader, writer))
+        self.available.release()
+
+    def discard(self, writer, release=True):
+        self.open -= 1
+        writer.close()
+        if release:
+            self.available.release()
+
+    async def request(self, method, headers, body):
+        '''
+        Inputs:
+            `method` (dtype: str): i.e. "POST"
+            `headers` (dtype: dict): Request headers
+            `body` (dtype: bytes): Request body
+
+        Returns: `(status, headers, body)` The response
+        '''
+
+        message = format_request(method, self.target, self.host_header, headers, body)
+
+        for attempt in (1, 2):
+            reader, writer, reused = await self.acquire()
+            try:
+                writer.write(message)
+                await writer.drain()
+                status, response_headers, response_body, keep_alive = await asyncio.wait_for(read_response(reader), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.discard(writer)
+                ## The server may have closed an idle keep-alive connection just before we used it
+                if reused and attempt == 1:
+                    continue
+                raise
+            except BaseException:
+                self.discard(writer)
+                raise
+
+            if keep_alive:
+                self.release(reader, writer)
+            else:
+                self.discard(writer)
+
+            return status, response_headers, response_body
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            self.open -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+def batches(events, size):
+    events = iter(events)
+    while True:
+        batch = list(islice(events, size))
+        if not batch:
+            return
+        yield batch
+
+class HTTPEmitter():
+    def __init__(self, url, mode="binary", concurrency=64, pool_size=None, batch_size=100, rate=None, timeout=10.0,
+                 headers=None):
+        '''
+        Inputs:
+            `url` (dtype: str): Where to POST events (i.e. "http://localhost:8080/events")
+            `mode` (dtype: str): The CloudEvents content mode, "binary", "structured", or "batch"
+            `concurrency` (dtype: int): How many requests to keep in flight
+            `pool_size` (dtype: int): The most connections to open (defaults to `concurrency`)
+            `batch_size` (dtype: int): Events per request in batch mode
+            `rate` (dtype: float): The most requests to start per second (unlimited if None)
+            `timeout` (dtype: float): Seconds to wait to connect, or for a response
+            `headers` (dtype: dict): Extra headers for every request (i.e. an Authorization header)
+
+        Returns: object (dtype: HTTPEmitter)
+        '''
+
+        if mode not in MODES:
+            raise ValueError("mode {} is not one of {}".format(mode, MODES))
+
+        self.url = url
+        self.mode = mode
+        self.concurrency = concurrency
+        self.pool_size = pool_size or concurrency
+        self.batch_size = batch_size if mode == "batch" else 1
+        self.rate = rate
+        self.timeout = timeout
+        self.headers = headers or {}
+
+        return
+
+    async def emit(self, events):
+        '''
+        Input: `events` (dtype: iterable): Raw events (a list, or a generator for long runs)
+        Returns: `stats` (dtype: dict) See the module overview
+        '''
+
+        pool = ConnectionPool(self.url, self.pool_size, self.timeout)
+        work = asyncio.Queue(maxsize=self.concurrency * 2)
+        latencies = TDigest()
+        statuses = Counter()
+        stats = {"requests": 0, "events": 0, "errors": 0, "bytes_sent": 0}
+        error_examples = []
+
+        async def worker():
+            while True:
+                batch = await work.get()
+                if batch is None:
+                    return
+
+                headers, body = to_http(batch, self.mode)
+                headers.update(self.headers)
+                start = time.perf_counter()
+                try:
+                    status, _, _ = await pool.request("POST", headers, body)
+                except (OSError, EOFError, asyncio.TimeoutError, ValueError) as e:
+                    status = type(e).__name__
+                    if len(error_examples) < 10:
+                        error_examples.append(str(e) or status)
+                latencies.add((time.perf_counter() - start) * 1000.0)
+
+                statuses[str(status)] += 1
+                stats['requests'] += 1
+                stats['events'] += len(batch)
+                stats['bytes_sent'] += len(body)
+                if not isinstance(status, int) or not 200 <= status < 300:
+                    stats['errors'] += 1
+
+        async def put(item):
+            try:
+                work.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                pass
+
+            ## Only wait on a full queue while every worker is still alive to drain it
+            putter = asyncio.ensure_future(work.put(item))
+            while not putter.done():
+                running = [task for task in workers if not task.done()]
+                await asyncio.wait([putter] + running, return_when=asyncio.FIRST_COMPLETED)
+                for task in workers:
+                    if task.done() and not task.cancelled() and task.exception() is not None:
+                        putter.cancel()
+                        raise task.exception()
+
+        start = time.perf_counter()
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            for number, batch in enumerate(batches(events, self.batch_size)):
+                if self.rate:
+                    ## Pace request starts evenly instead of sending in bursts
+                    delay = start + number / float(self.rate) - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await put(batch)
+            for _ in workers:
+                await put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await pool.close()
+
+        wall_seconds = time.perf_counter() - start
+        increment("http_requests", stats['requests'])
+        increment("http_errors", stats['errors'])
+
+        stats.update({
+            "mode": self.mode,
+            "connections_opened": pool.opened,
+            "wall_seconds": round(wall_seconds, 3),
+            "requests_per_second": round(stats['requests'] / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+            "events_per_second": round(stats['events'] / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+            "latency_ms": {name: round(latencies.quantile(q), 3) if latencies.count else None
+                           for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+            "status_counts": dict(statuses),
+            "error_examples": error_examples
+        })
+
+        return stats
+
+    def run(self, events):
+        '''
+        Input: `events` (dtype: iterable): Raw events
+        Returns: `stats` (dtype: dict) `emit` run on a new event loop, for callers that are not async
+        '''
+
+        return asyncio.run(self.emit(events))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send simulated CDEvents to an HTTP receiver as CloudEvents")
+    parser.add_argument("url", help="i.e. http://localhost:8080/events")
+    parser.add_argument("--mode", choices=MODES, default="binary")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=None, help="Requests per second (unlimited by default)")
+    parser.add_argument("--path", help="Send a raw events file (JSON array or NDJSON) instead of generating events")
+    parser.add_argument("--lifecycles", type=int, default=500, help="Event lifecycles to generate if --path is not set")
+    args = parser.parse_args()
+
+    if args.path:
+        from event_streams import iter_events
+        events = iter_events(args.path)
+    else:
+        from simulation_functions import create_events
+        events = create_events(args.lifecycles)[0]
+
+    emitter = HTTPEmitter(args.url, mode=args.mode, concurrency=args.concurrency, batch_size=args.batch_size, rate=args.rate)
+    print(json.dumps(emitter.run(events), indent=4))
+    print_summary("http_emitter.py")
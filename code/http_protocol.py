@@ -0,0 +1,165 @@
+import asyncio
+
+## Just enough HTTP/1.1 for the CloudEvents emitter, the ingest receiver, and the local webhook stand-in.
+##
+## Messages are read from and written to asyncio streams.  Bodies are framed with Content-Length (or chunked
+## transfer encoding when reading), and connections are kept alive unless either side sends
+## `Connection: close`, so a client can reuse one connection for many requests.
+
+MAX_HEAD_BYTES = 64 * 1024
+REASONS = {
+    200: "OK",
+    201: "Created",
+    202: "Accepted",
+    204: "No Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    422: "Unprocessable Entity",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+class HTTPError(ValueError):
+    '''
+    Raised for a malformed message.  `status` is the response a server should send back.
+    '''
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+async def read_head(reader):
+    '''
+    Input: `reader` (dtype: asyncio.StreamReader)
+    Returns: `(start_line, headers)` with header names lower-cased, or None if the connection closed cleanly
+        before a new message started
+    '''
+
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HTTPError("Connection closed in the middle of a message")
+    except asyncio.LimitOverrunError:
+        raise HTTPError("Message head is larger than {} bytes".format(MAX_HEAD_BYTES), 413)
+
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        if not separator:
+            raise HTTPError("Malformed header line: {!r}".format(line))
+        headers[name.strip().lower()] = value.strip()
+
+    return lines[0], headers
+
+async def read_body(reader, headers, until_close=False, max_bytes=None):
+    '''
+    Inputs:
+        `reader` (dtype: asyncio.StreamReader)
+        `headers` (dtype: dict): The message's headers
+        `until_close` (dtype: bool): Read until the connection closes if there is no framing (responses only)
+        `max_bytes` (dtype: int): Reject bodies larger than this
+
+    Returns: `body` (dtype: bytes)
+    '''
+
+    if headers.get('transfer-encoding', "").lower() == "chunked":
+        chunks = []
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                ## Skip any trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            total += size
+            if max_bytes is not None and total > max_bytes:
+                raise HTTPError("Body is larger than {} bytes".format(max_bytes), 413)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        if max_bytes is not None and length > max_bytes:
+            raise HTTPError("Body is larger than {} bytes".format(max_bytes), 413)
+        return await reader.readexactly(length) if length else b""
+
+    return await reader.read() if until_close else b""
+
+def keep_alive(version, headers):
+    connection = headers.get('connection', "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+async def read_request(reader, max_bytes=None):
+    '''
+    Inputs:
+        `reader` (dtype: asyncio.StreamReader)
+        `max_bytes` (dtype: int): Reject bodies larger than this
+
+    Returns: `(method, target, headers, body, keep_alive)`, or None if the client closed the connection
+    '''
+
+    message = await read_head(reader)
+    if message is None:
+        return None
+
+    start_line, headers = message
+    parts = start_line.split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HTTPError("Malformed request line: {!r}".format(start_line))
+
+    method, target, version = parts
+    body = await read_body(reader, headers, max_bytes=max_bytes)
+
+    return method, target, headers, body, keep_alive(version, headers)
+
+async def read_response(reader):
+    '''
+    Input: `reader` (dtype: asyncio.StreamReader)
+    Returns: `(status, headers, body, keep_alive)`
+    '''
+
+    message = await read_head(reader)
+    if message is None:
+        raise ConnectionResetError("Connection closed before the response")
+
+    start_line, headers = message
+    version, _, rest = start_line.partition(" ")
+    status = int(rest.split(" ", 1)[0])
+    framed = 'content-length' in headers or 'transfer-encoding' in headers
+    body = await read_body(reader, headers, until_close=not framed and status not in (204, 304))
+
+    return status, headers, body, keep_alive(version, headers) and (framed or status in (204, 304))
+
+def format_request(method, target, host, headers=None, body=b""):
+    '''
+    Returns: `request` (dtype: bytes) A complete HTTP/1.1 request with a Content-Length
+    '''
+
+    lines = ["{} {} HTTP/1.1".format(method, target), "Host: {}".format(host), "Content-Length: {}".format(len(body))]
+    lines.extend("{}: {}".format(name, value) for name, value in (headers or {}).items())
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+def format_response(status, headers=None, body=b"", keep_alive=True):
+    '''
+    Returns: `response` (dtype: bytes) A complete HTTP/1.1 response with a Content-Length
+    '''
+
+    lines = ["HTTP/1.1 {} {}".format(status, REASONS.get(status, "Unknown")), "Content-Length: {}".format(len(body))]
+    if not keep_alive:
+        lines.append("Connection: close")
+    lines.extend("{}: {}".format(name, value) for name, value in (headers or {}).items())
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
@@ -0,0 +1,339 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from collections import defaultdict
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from event_streams import iter_events, parse_timestamp
+from key_layout import partition_path
+from compact_processed import encode_records
+from parallel_generate import encode_csv
+from instrumentation import timer, increment, print_summary
+
+## Keep a local processed dataset up to date by processing only the raw events added since the last run.
+##
+## `simulate_events.py` rebuilds `simulated_processed_events.csv` from every event each run.  `IncrementalUpdate`
+## instead keeps a watermark checkpoint, `<output_dir>/_watermark.checkpoint`, recording how far each raw source has
+## been processed:
+##     - append-only NDJSON files (`.ndjson`/`.jsonl`) by byte offset, so events appended to a file since the last
+##       run are read from where the last run stopped (a partial last line is left for the next run)
+##     - every other raw file (JSON arrays, gzip, `.cdeb`) as a whole, by size and modification time
+## plus the latest event timestamp seen.  New events are flattened and appended as new files in hour partitions:
+##     <output_dir>/dt=2023-04-04/hr=22/part-<slice_id>.csv
+## so a run reads and writes only the new data, however much history is already processed.  `local_query.py` and
+## `processed_data.py` read the partitioned folder directly.
+##
+## Runs are atomic.  The slices to process (source, start offset, end offset) are written to the checkpoint as
+## "pending" before any output, every file is written to a temporary name and renamed into place, and the
+## offsets only advance once every file is in place.  The slice id is a hash of the slices, so a run that was
+## interrupted is finished by the next one, which rewrites exactly the same files instead of adding duplicates.
+## A source that shrinks or is rewritten in place raises a ValueError; `rebuild` (or `--rebuild`) starts over.
+
+INCREMENTAL_ENV_VAR = "CDEVENTS_INCREMENTAL"
+RAW_LOG = "simulated_raw_events.ndjson"
+CHECKPOINT_NAME = "_watermark.checkpoint"
+APPEND_ONLY_EXTENSIONS = (".ndjson", ".jsonl")
+RAW_EXTENSIONS = (".json", ".ndjson", ".jsonl", ".json.gz", ".ndjson.gz", ".jsonl.gz", ".cdeb", ".cdeb.gz")
+FORMATS = ("csv", "parquet", "ndjson")
+HEAD_BYTES = 1024
+
+def atomic_write(path, data):
+    '''
+    Inputs:
+        `path` (dtype: str): The file to write
+        `data` (dtype: bytes): Its full contents
+
+    Function Overview:
+        Writes to a temporary file in the same folder and renames it over `path`, so readers see either the old
+        file or the whole new one, never a partial write.
+    '''
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, ".{}.{}.tmp".format(os.path.basename(path), os.getpid()))
+
+    with open(temporary, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+    return
+
+def encode_processed(records, file_format):
+    '''
+    Inputs:
+        `records` (dtype: list): Normalized processed events
+        `file_format` (dtype: str): "csv", "parquet", or "ndjson"
+
+    Returns: `(body, extension)` The file contents (dtype: bytes) and extension
+    '''
+
+    if file_format == "csv":
+        return encode_csv(records, header=True), ".csv"
+
+    put_args, file_extension = encode_records(records, file_format)
+
+    return put_args['Body'], file_extension
+
+def head_hash(path, length):
+    '''
+    Returns: `digest` (dtype: str) A hash of the first `length` bytes (at most `HEAD_BYTES`), to notice rewritten files
+    '''
+
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(length, HEAD_BYTES))).hexdigest()
+
+def complete_end(path, start, size, chunk_size=1 << 16):
+    '''
+    Inputs:
+        `path` (dtype: str): An NDJSON file
+        `start`/`size` (dtype: int): Look for the end of the last complete line between these offsets
+
+    Returns: `end` (dtype: int) The offset just after the last newline, or `start` if there is no complete line
+    '''
+
+    with open(path, "rb") as f:
+        position = size
+        while position > start:
+            chunk_start = max(start, position - chunk_size)
+            f.seek(chunk_start)
+            chunk = f.read(position - chunk_start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                return chunk_start + newline + 1
+            position = chunk_start
+
+    return start
+
+def read_slice(path, start, end):
+    '''
+    Inputs:
+        `path` (dtype: str): A raw events file
+        `start`/`end` (dtype: int): The byte range to read (the whole file for formats that are not append-only)
+
+    Returns: A generator of raw events
+    '''
+
+    if not path.endswith(APPEND_ONLY_EXTENSIONS):
+        for event in iter_events(path):
+            yield event
+        return
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            line = f.readline(remaining)
+            remaining -= len(line)
+            if line.strip():
+                yield json.loads(line)
+
+class IncrementalUpdate():
+    def __init__(self, sources, output_dir, file_format="csv"):
+        '''
+        Inputs:
+            `sources` (dtype: list): Raw event files or folders of them (i.e. an append-only `raw_events.ndjson`)
+            `output_dir` (dtype: str): The partitioned processed dataset, with the checkpoint at its top level
+            `file_format` (dtype: str): "csv" (like `simulated_processed_events.csv`), "parquet", or "ndjson"
+
+        Returns: object (dtype: IncrementalUpdate) Call `run()` whenever new raw events may have arrived
+        '''
+
+        if file_format not in FORMATS:
+            raise ValueError("file_format {} is not one of {}".format(file_format, FORMATS))
+
+        self.sources = [sources] if isinstance(sources, str) else list(sources)
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.checkpoint_path = os.path.join(output_dir, CHECKPOINT_NAME)
+
+        return
+
+    def source_files(self):
+        files = []
+        for source in self.sources:
+            if os.path.isdir(source):
+                files.extend(name for name in glob.glob(os.path.join(source, "**", "*"), recursive=True)
+                             if name.endswith(RAW_EXTENSIONS) and os.path.isfile(name))
+            else:
+                files.append(source)
+
+        ## The output folder may sit inside a source folder; its own files are never sources
+        output_dir = os.path.join(os.path.abspath(self.output_dir), "")
+
+        return sorted(name for name in map(os.path.abspath, files) if not name.startswith(output_dir))
+
+    def load_state(self):
+        '''
+        Returns: `state` (dtype: dict) The checkpoint, or an empty one before the first run
+        '''
+
+        if not os.path.exists(self.checkpoint_path):
+            return {"sources": {}, "watermark": None, "pending": None, "runs": 0, "events": 0}
+
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        atomic_write(self.checkpoint_path, json.dumps(state, indent=4, sort_keys=True).encode("utf-8"))
+
+    def plan(self, state):
+        '''
+        Input: `state` (dtype: dict) The checkpoint
+        Returns: `slices` (dtype: list) `[path, start, end, size, mtime_ns]` for every source with new events
+
+        Function Overview:
+            Raises a ValueError if an already processed source was truncated or rewritten.
+        '''
+
+        slices = []
+        for path in self.source_files():
+            stat = os.stat(path)
+            seen = state['sources'].get(path)
+
+            if path.endswith(APPEND_ONLY_EXTENSIONS):
+                start = seen['offset'] if seen else 0
+                if seen and (stat.st_size < start or head_hash(path, start) != seen['head']):
+                    raise ValueError("{} was truncated or rewritten since it was processed; rebuild to start over".format(path))
+                end = complete_end(path, start, stat.st_size)
+                if end > start:
+                    slices.append([path, start, end, stat.st_size, stat.st_mtime_ns])
+                continue
+
+            if seen is None:
+                slices.append([path, 0, stat.st_size, stat.st_size, stat.st_mtime_ns])
+            elif seen['size'] != stat.st_size or seen['mtime_ns'] != stat.st_mtime_ns:
+                raise ValueError("{} changed since it was processed; only .ndjson/.jsonl sources may grow".format(path))
+
+        return slices
+
+    def process(self, slices, stats):
+        '''
+        Inputs:
+            `slices` (dtype: list): From `plan`
+            `stats` (dtype: dict): Updated with what was read and written
+
+        Returns: `(watermark, files)` The latest event timestamp in the slices, and the files written
+        '''
+
+        slice_id = hashlib.sha1(json.dumps([s[:3] for s in slices]).encode("utf-8")).hexdigest()[:16]
+        partitions = defaultdict(list)
+        watermark = None
+
+        with timer("incremental_read"):
+            for path, start, end, _, _ in slices:
+                stats['bytes_read'] += end - start
+                for event in read_slice(path, start, end):
+                    try:
+                        record = normalize_processed(flatten_event_entry(event))
+                        timestamp = parse_timestamp(record['context_timestamp'])
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        stats['failed'] += 1
+                        continue
+                    partitions[partition_path(timestamp)].append(record)
+                    watermark = max(watermark, record['context_timestamp']) if watermark else record['context_timestamp']
+
+        files = []
+        with timer("incremental_write"):
+            for partition, records in sorted(partitions.items()):
+                body, file_extension = encode_processed(records, self.file_format)
+                path = os.path.join(self.output_dir, partition, "part-{}{}".format(slice_id, file_extension))
+                atomic_write(path, body)
+                files.append(os.path.relpath(path, self.output_dir))
+                stats['events'] += len(records)
+
+        stats['partitions'] += len(partitions)
+        stats['files_written'] += len(files)
+
+        return watermark, files
+
+    def commit(self, state, slices, watermark):
+        for path, _, end, size, mtime_ns in slices:
+            state['sources'][path] = {"offset": end, "size": size, "mtime_ns": mtime_ns, "head": head_hash(path, end)}
+        if watermark is not None and (state['watermark'] is None or watermark > state['watermark']):
+            state['watermark'] = watermark
+        state['pending'] = None
+
+        return
+
+    def run(self):
+        '''
+        Returns: `stats` (dtype: dict)
+            {
+                "sources": 3,
+                "slices": 1,
+                "bytes_read": 65127,
+                "events": 100,
+                "failed": 0,
+                "partitions": 2,
+                "files_written": 2,
+                "resumed": false,
+                "watermark": "2023-04-04 22:41:13.021950",
+                "seconds": 0.031
+            }
+        '''
+
+        start_time = time.perf_counter()
+        state = self.load_state()
+        stats = {"sources": 0, "slices": 0, "bytes_read": 0, "events": 0, "failed": 0, "partitions": 0,
+                 "files_written": 0, "resumed": False}
+
+        ## Finish a run that stopped after recording its slices, rewriting the same files
+        if state['pending']:
+            stats['resumed'] = True
+            slices = state['pending']
+            watermark, _ = self.process(slices, stats)
+            self.commit(state, slices, watermark)
+            self.save_state(state)
+
+        stats['sources'] = len(self.source_files())
+        slices = self.plan(state)
+        stats['slices'] = len(slices)
+
+        if slices:
+            state['pending'] = slices
+            self.save_state(state)
+
+            watermark, _ = self.process(slices, stats)
+            self.commit(state, slices, watermark)
+            state['runs'] += 1
+            state['events'] += stats['events']
+            self.save_state(state)
+
+        increment("incremental_events", stats['events'])
+        stats['watermark'] = state['watermark']
+        stats['seconds'] = round(time.perf_counter() - start_time, 3)
+
+        return stats
+
+def rebuild(output_dir):
+    '''
+    Input: `output_dir` (dtype: str): An incremental processed dataset
+    Function Overview: Removes the checkpoint and every partition, so the next run processes all sources again
+    '''
+
+    for name in glob.glob(os.path.join(output_dir, "dt=*")):
+        shutil.rmtree(name)
+    if os.path.exists(os.path.join(output_dir, CHECKPOINT_NAME)):
+        os.remove(os.path.join(output_dir, CHECKPOINT_NAME))
+
+    return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process only the raw events added since the last run into hour partitions")
+    parser.add_argument("sources", nargs="+", help="Raw event files or folders (NDJSON files may keep growing)")
+    parser.add_argument("--output", default="processed_incremental")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--rebuild", action="store_true", help="Discard the checkpoint and output and start over")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild(args.output)
+
+    print(json.dumps(IncrementalUpdate(args.sources, args.output, args.format).run(), indent=4))
+    print_summary("incremental_processed.py")
@@ -0,0 +1,344 @@
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from collections import deque
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from validation import raw_event_validator
+from cloud_events import from_http
+from http_protocol import read_request, format_response, HTTPError
+from sketches import TDigest
+from instrumentation import timer, increment, print_summary
+
+## Receive CDEvents over HTTP and write them out flattened, without S3, SQS, or the Lambda.
+##
+## The AWS path (S3 PUT -> notification -> SQS -> `lambda_handler`) takes seconds per event.  `IngestReceiver` is
+## an asyncio HTTP server that accepts CloudEvents-format CDEvents in any content mode (see `cloud_events.py`),
+## checks each one with the same compiled validator the Lambda uses, flattens the valid ones with
+## `flatten_event_entry`, and hands them to a buffered sink from `sinks.py` (i.e. "parquet:live/" with a
+## `max_latency` of half a second), so processed events are written well under a second after they arrive.
+##
+##     POST <any path>  -> 202 {"accepted": 10, "rejected": 0}   (422 if every event is invalid, with the problems)
+##                         503 while writing is failing or too many events are unwritten
+##     GET /healthz     -> 200 (503 while writing is failing)
+##     GET /stats       -> 200 with the stats below
+##
+## Requests are answered as soon as events are validated and queued; a single writer thread feeds the sink, so
+## slow deliveries never hold up the event loop.  When a delivery fails the sink keeps the batch (see `sinks.py`),
+## the writer counts the error and retries with backoff, and until a delivery succeeds again POSTs and /healthz
+## get a 503, as do POSTs while more than `max_queued` events are waiting to be written.  `stop()` raises if any
+## accepted event was never written.  Each event's accept-to-write latency (from accepting the request
+## to the sink delivering the batch holding the event) is tracked in a t-digest:
+##     {"requests": 3171, "accepted": 3171, "rejected": 0, "written": 3171,
+##      "write_latency_ms": {"p50": 280.1, "p95": 492.1, "p99": 519.1, "max": 530.9}, ...}
+
+DEFAULT_MAX_BODY = 10 * 1024 * 1024
+DEFAULT_MAX_QUEUED = 1000000
+
+class IngestReceiver():
+    def __init__(self, sink, host="127.0.0.1", port=8080, validate=True, max_body=DEFAULT_MAX_BODY, poll_interval=0.05,
+                 max_queued=DEFAULT_MAX_QUEUED, retry_interval=0.5):
+        '''
+        Inputs:
+            `sink` (dtype: Sink): Where flattened events go (see `sinks.py`); its `max_latency` bounds write latency
+            `host` (dtype: str): The address to listen on
+            `port` (dtype: int): The port to listen on (0 picks a free port)
+            `validate` (dtype: bool): Reject events that fail the raw event schema
+            `max_body` (dtype: int): The largest request body accepted, in bytes
+            `poll_interval` (dtype: float): How often the writer checks the sink's latency limit when idle
+            `max_queued` (dtype: int): Answer POSTs with a 503 while more accepted events than this are unwritten
+            `retry_interval` (dtype: float): Seconds the writer waits after a failed delivery, doubling (up to 10x)
+                while it keeps failing
+
+        Returns: object (dtype: IngestReceiver)
+        '''
+
+        self.sink = sink
+        self.host = host
+        self.port = port
+        self.validator = raw_event_validator() if validate else None
+        self.max_body = max_body
+        self.poll_interval = poll_interval
+        self.max_queued = max_queued
+        self.retry_interval = retry_interval
+        self.write_error = None
+
+        self.pending = queue.Queue()
+        self.unwritten = deque()
+        self.latencies = TDigest()
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "bad_requests": 0, "unavailable": 0, "accepted": 0, "rejected": 0, "written": 0,
+                       "write_errors": 0}
+
+        self.loop = None
+        self.server = None
+        self.server_thread = None
+        self.writer_thread = None
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+
+        return
+
+    @property
+    def url(self):
+        return "http://{}:{}/events".format(self.host, self.port)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def unavailable(self):
+        '''
+        Returns: `reason` (dtype: str) Why new events can't be taken right now, or None
+        '''
+
+        if self.writer_thread is not None and not self.writer_thread.is_alive() and not self.stopping.is_set():
+            return "The writer has stopped"
+        if self.write_error is not None:
+            return "Writing events is failing: {}".format(self.write_error)
+        with self.lock:
+            if self.counts['accepted'] - self.counts['written'] >= self.max_queued:
+                return "More than {} events are waiting to be written".format(self.max_queued)
+
+        return None
+
+    def accept(self, headers, body):
+        '''
+        Inputs:
+            `headers` (dtype: dict): Request headers
+            `body` (dtype: bytes): Request body
+
+        Returns: `(status, response)` Validates and flattens the events in one request and queues the valid ones
+        '''
+
+        accepted_at = time.monotonic()
+        reason = self.unavailable()
+        if reason:
+            self.count("unavailable")
+            return 503, {"error": reason}
+
+        try:
+            _, events = from_http(headers, body)
+        except ValueError as e:
+            self.count("bad_requests")
+            return 400, {"error": str(e)}
+
+        records = []
+        rejected = []
+        with timer("ingest_accept"):
+            for event in events:
+                problems = self.validator.check(event) if self.validator is not None else []
+                if not problems:
+                    try:
+                        records.append(normalize_processed(flatten_event_entry(event)))
+                        continue
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        problems = [("", "{}: {}".format(type(e).__name__, e))]
+                event_id = event.get('event_id') if isinstance(event, dict) else None
+                rejected.append({"event_id": event_id, "violations": [{"path": p, "error": e} for p, e in problems]})
+
+        if records:
+            self.pending.put((accepted_at, records))
+        self.count("accepted", len(records))
+        self.count("rejected", len(rejected))
+        increment("ingest_events", len(records))
+
+        response = {"accepted": len(records), "rejected": len(rejected)}
+        if rejected:
+            response['problems'] = rejected[:20]
+
+        return (202 if records or not events else 422), response
+
+    def record_written(self):
+        '''
+        Function Overview:
+            Events reach the sink in the order they were accepted, so everything up to the sink's delivered record
+            count has been written.  Their latencies are recorded here.
+        '''
+
+        delivered = self.sink.stats['records']
+        now = time.monotonic()
+
+        while self.unwritten and self.unwritten[0][0] <= delivered:
+            _, accepted_at, count = self.unwritten.popleft()
+            latency = (now - accepted_at) * 1000.0
+            with self.lock:
+                self.latencies.add(latency, count)
+                self.counts['written'] += count
+
+    def write_loop(self):
+        '''
+        Function Overview:
+            Runs on the writer thread: moves queued events into the sink and delivers batches that are due.  A
+            failed delivery is counted and retried after a backoff; the sink still holds the batch, and the
+            records not yet handed to it wait in `records`.  Returns once stopping, when nothing is left to hand
+            over or the sink is failing (`stop()` reports the events left unwritten).
+        '''
+
+        queued = 0
+        failures = 0
+        records = deque()
+        while True:
+            if not records:
+                try:
+                    accepted_at, batch = self.pending.get(timeout=self.poll_interval)
+                    queued += len(batch)
+                    self.unwritten.append((queued, accepted_at, len(batch)))
+                    records.extend(batch)
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        return
+
+            try:
+                while records:
+                    ## `write` buffers the record before delivering, so it is the sink's once `write` is called
+                    self.sink.write(records.popleft())
+                self.sink.flush_if_due()
+            except Exception as e:
+                failures += 1
+                self.write_error = "{}: {}".format(type(e).__name__, e)
+                self.count("write_errors")
+                increment("ingest_write_errors")
+                self.record_written()
+                if self.stopping.wait(min(self.retry_interval * 2 ** (failures - 1), self.retry_interval * 10)):
+                    return
+                continue
+
+            failures = 0
+            self.write_error = None
+            self.record_written()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, max_bytes=self.max_body)
+                except HTTPError as e:
+                    self.count("bad_requests")
+                    writer.write(format_response(e.status, keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                method, target, headers, body, keep_alive = request
+                self.count("requests")
+
+                if method == "GET" and target.startswith("/healthz"):
+                    reason = self.unavailable()
+                    status, response = (503, {"status": "unavailable", "error": reason}) if reason else \
+                        (200, {"status": "ok"})
+                elif method == "GET" and target.startswith("/stats"):
+                    status, response = 200, self.stats()
+                elif method != "POST":
+                    status, response = 405, {"error": "Use POST to send events"}
+                else:
+                    status, response = self.accept(headers, body)
+
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(format_response(status, {"Content-Type": "application/json"}, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def start(self):
+        '''
+        Returns: self, with the server and the writer running on background threads
+        '''
+
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+        self.server_thread = threading.Thread(target=self.serve, daemon=True)
+        self.server_thread.start()
+        self.ready.wait()
+
+        return self
+
+    def stop(self):
+        '''
+        Returns: `stats` (dtype: dict) After closing the server, writing every queued event, and closing the sink.
+            Raises a `RuntimeError` if the sink still can't deliver, so accepted events are never lost silently.
+        '''
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.server_thread.join()
+            self.loop = None
+
+        self.stopping.set()
+        self.writer_thread.join()
+        try:
+            self.sink.close()
+        except Exception as e:
+            self.write_error = "{}: {}".format(type(e).__name__, e)
+            self.count("write_errors")
+        self.record_written()
+
+        stats = self.stats()
+        if stats['queued']:
+            raise RuntimeError("{} accepted events were not written ({} write errors, the last: {})".format(
+                stats['queued'], stats['write_errors'], self.write_error))
+
+        return stats
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['queued'] = stats['accepted'] - stats['written']
+            stats['last_write_error'] = self.write_error
+            stats['write_latency_ms'] = {name: round(self.latencies.quantile(q), 3) if self.latencies.count else None
+                                         for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))}
+        stats['sink'] = {"records": self.sink.stats['records'], "batches": self.sink.stats['batches'],
+                         "flush_reasons": dict(self.sink.stats['flush_reasons'])}
+
+        return stats
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == '__main__':
+    from sinks import sink_from_url
+
+    parser = argparse.ArgumentParser(description="Receive CloudEvents-format CDEvents over HTTP and write them flattened")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--sink", default="ndjson:processed_live.ndjson", help="A sink from `sinks.py` (i.e. parquet:live/)")
+    parser.add_argument("--max-latency", type=float, default=0.5, help="Seconds an event may wait in the sink's buffer")
+    parser.add_argument("--max-records", type=int, default=5000)
+    parser.add_argument("--no-validate", action="store_true")
+    args = parser.parse_args()
+
+    receiver = IngestReceiver(sink_from_url(args.sink, processed=True, max_latency=args.max_latency,
+                                            max_records=args.max_records),
+                              args.host, args.port, validate=not args.no_validate).start()
+    print("Listening on", receiver.url)
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(receiver.stats()))
+    except KeyboardInterrupt:
+        pass
+
+    print(json.dumps(receiver.stop(), indent=4))
+    print_summary("ingest_receiver.py")
@@ -0,0 +1,375 @@
+import os
+import io
+import json
+import time
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+## Lightweight timers, counters, and optional profiling for the simulator and the Lambda.
+##
+## Every stage we care about (generation, deepcopy, JSON, S3 PUT/GET, flattening) is wrapped
+## in a named `timer`, and throughput is tracked with named counters.  At the end of a run
+## `print_summary` shows where the time went, and the Lambda calls `emit_emf` so the same
+## numbers land in CloudWatch as metrics via the Embedded Metric Format (EMF).
+##
+## Profiling is off by default and is toggled with the `CDEVENTS_PROFILE` environment variable:
+##     CDEVENTS_PROFILE=cprofile     -> cProfile stats sorted by cumulative time
+##     CDEVENTS_PROFILE=tracemalloc  -> peak memory and the top allocation sites
+##     CDEVENTS_PROFILE=all          -> both of the above
+## `CDEVENTS_PROFILE_TOP` controls how many rows are printed (default 20).
+
+PROFILE_ENV_VAR = "CDEVENTS_PROFILE"
+PROFILE_TOP_ENV_VAR = "CDEVENTS_PROFILE_TOP"
+EMF_NAMESPACE = "CDEventsSimulation"
+
+class Metrics():
+    def __init__(self):
+        '''
+        Input: None
+        Returns: object (dtype: Metrics) A thread-safe registry of named timers and counters:
+            {
+                "timers": {"s3_put": {"count": 10, "total_ms": 512.3, "mean_ms": 51.23, "max_ms": 90.1}},
+                "counters": {"events_sent": 10}
+            }
+
+        Overview:
+            A single module-level instance (`METRICS`) is shared by everything that imports this module,
+            so timings from `simulation_functions.py` and `lambda_function.py` all end up in one place.
+        '''
+
+        self.lock = threading.Lock()
+        self.reset()
+
+        return
+
+    def reset(self):
+        '''
+        Function Overview:
+            Clears all timers and counters.  The Lambda calls this at the start of every invocation so
+            that metrics from a warm container are not carried into the next invocation.
+        '''
+
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.started_at = time.perf_counter()
+
+        return
+
+    def record(self, name, seconds):
+        '''
+        Inputs:
+            `name` (dtype: str): The name of the stage being timed (i.e. "s3_put")
+            `seconds` (dtype: float): How long one pass through the stage took
+
+        Function Overview:
+            Adds a single timing sample to the timer `name`.
+        '''
+
+        with self.lock:
+            stats = self.timers.get(name)
+            if stats is None:
+                stats = [0, 0.0, 0.0]  ## [count, total seconds, max seconds]
+                self.timers[name] = stats
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+        return
+
+    def increment(self, name, value=1):
+        '''
+        Inputs:
+            `name` (dtype: str): The name of the counter (i.e. "events_sent")
+            `value` (dtype: int/float): How much to add to the counter
+        '''
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        return
+
+    def summary(self):
+        '''
+        Input: None
+        Returns: `summary` (dtype: dict) A snapshot of all timers and counters (see `Metrics.__init__`)
+            plus the wall-clock time since the last reset.
+        '''
+
+        with self.lock:
+            timers = {}
+            for name, (count, total, longest) in self.timers.items():
+                timers[name] = {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total * 1000 / count, 3) if count else 0.0,
+                    "max_ms": round(longest * 1000, 3)
+                }
+
+            summary = {
+                "wall_ms": round((time.perf_counter() - self.started_at) * 1000, 3),
+                "timers": timers,
+                "counters": dict(self.counters)
+            }
+
+        return summary
+
+METRICS = Metrics()
+
+@contextmanager
+def timer(name, metrics=None):
+    '''
+    Inputs:
+        `name` (dtype: str): The name of the stage being timed
+        `metrics` (dtype: Metrics): The registry to record into.  Defaults to the shared `METRICS`.
+
+    Function Overview:
+        Context manager that times the body of a `with` block and records it under `name`:
+            with timer("s3_put"):
+                s3.put_object(...)
+    '''
+
+    if metrics is None:
+        metrics = METRICS
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, time.perf_counter() - start)
+
+def timed(name):
+    '''
+    Input: `name` (dtype: str): The name of the stage being timed
+    Returns: A decorator that records every call of the wrapped function under `name`
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def increment(name, value=1):
+    '''
+    Function Overview:
+        Shortcut for `METRICS.increment` (see `Metrics.increment`).
+    '''
+
+    METRICS.increment(name, value)
+
+    return
+
+def reset():
+    '''
+    Function Overview:
+        Shortcut for `METRICS.reset` (see `Metrics.reset`).
+    '''
+
+    METRICS.reset()
+
+    return
+
+def summary():
+    '''
+    Function Overview:
+        Shortcut for `METRICS.summary` (see `Metrics.summary`).
+    '''
+
+    return METRICS.summary()
+
+def print_summary(title="Run summary", metrics=None):
+    '''
+    Inputs:
+        `title` (dtype: str): A heading for the printed table
+        `metrics` (dtype: Metrics): The registry to summarize.  Defaults to the shared `METRICS`.
+
+    Function Overview:
+        Prints a per-stage table (calls, total, mean, and max time) sorted by total time, followed by
+        all counters.  This is the per-run summary printed at the end of `simulate_events.py`.
+    '''
+
+    if metrics is None:
+        metrics = METRICS
+
+    run_summary = metrics.summary()
+
+    print("\n{} (wall time: {:.1f} ms)".format(title, run_summary['wall_ms']))
+    print("{:<28}{:>10}{:>14}{:>12}{:>12}".format("stage", "calls", "total_ms", "mean_ms", "max_ms"))
+
+    ordered = sorted(run_summary['timers'].items(), key=lambda item: item[1]['total_ms'], reverse=True)
+    for name, stats in ordered:
+        print("{:<28}{:>10}{:>14.1f}{:>12.3f}{:>12.3f}".format(
+            name, stats['count'], stats['total_ms'], stats['mean_ms'], stats['max_ms']))
+
+    for name, value in sorted(run_summary['counters'].items()):
+        print("{:<28}{:>10}".format(name, value))
+
+    return run_summary
+
+def to_emf(dimensions=None, namespace=EMF_NAMESPACE, metrics=None):
+    '''
+    Inputs:
+        `dimensions` (dtype: dict): CloudWatch dimensions for every metric (i.e. {"FunctionName": "processCDEvents"})
+        `namespace` (dtype: str): The CloudWatch namespace the metrics are published under
+        `metrics` (dtype: Metrics): The registry to convert.  Defaults to the shared `METRICS`.
+
+    Returns: `emf` (dtype: dict) A CloudWatch Embedded Metric Format document:
+        {
+            "_aws": {
+                "Timestamp": 1680648713796,
+                "CloudWatchMetrics": [{
+                    "Namespace": "CDEventsSimulation",
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": [{"Name": "s3_get_ms", "Unit": "Milliseconds"}, {"Name": "events_processed", "Unit": "Count"}]
+                }]
+            },
+            "FunctionName": "processCDEvents",
+            "s3_get_ms": 35.2,
+            "events_processed": 1
+        }
+
+    Function Overview:
+        Every timer is published as `<name>_ms` (total milliseconds for the run) and every counter as a Count.
+        Writing this document to stdout from a Lambda is enough for CloudWatch to extract the metrics.
+    '''
+
+    if metrics is None:
+        metrics = METRICS
+    if dimensions is None:
+        dimensions = {}
+
+    run_summary = metrics.summary()
+
+    emf = {}
+    metric_definitions = []
+
+    for name, stats in run_summary['timers'].items():
+        metric_name = "{}_ms".format(name)
+        emf[metric_name] = stats['total_ms']
+        metric_definitions.append({"Name": metric_name, "Unit": "Milliseconds"})
+
+    for name, value in run_summary['counters'].items():
+        emf[name] = value
+        metric_definitions.append({"Name": name, "Unit": "Count"})
+
+    for name, value in dimensions.items():
+        emf[name] = value
+
+    emf['_aws'] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": namespace,
+            "Dimensions": [list(dimensions.keys())],
+            "Metrics": metric_definitions
+        }]
+    }
+
+    return emf
+
+def emit_emf(dimensions=None, namespace=EMF_NAMESPACE, metrics=None):
+    '''
+    Function Overview:
+        Prints the EMF document from `to_emf` as a single JSON line so CloudWatch Logs picks it up.
+    '''
+
+    emf = to_emf(dimensions, namespace, metrics)
+    print(json.dumps(emf))
+
+    return emf
+
+def profile_mode():
+    '''
+    Input: None
+    Returns: `modes` (dtype: set) The profilers enabled by `CDEVENTS_PROFILE` (subset of {"cprofile", "tracemalloc"})
+    '''
+
+    value = os.environ.get(PROFILE_ENV_VAR, "").strip().lower()
+
+    if value in ("", "0", "off", "none", "false"):
+        return set()
+    if value in ("1", "all", "both", "true"):
+        return {"cprofile", "tracemalloc"}
+
+    return {mode.strip() for mode in value.split(",") if mode.strip() in ("cprofile", "tracemalloc")}
+
+class Profiler():
+    def __init__(self, name="run"):
+        '''
+        Input: `name` (dtype: str): A label for the printed profile
+        Returns: object (dtype: Profiler) A profiler that runs cProfile and/or tracemalloc between `start` and `stop`
+            when `CDEVENTS_PROFILE` asks for it.  When profiling is disabled `start` and `stop` do nothing,
+            so it is safe to leave in production code.
+        '''
+
+        self.name = name
+        self.modes = profile_mode()
+        self.top = int(os.environ.get(PROFILE_TOP_ENV_VAR, "20"))
+        self.profiler = None
+        self.started_tracemalloc = False
+
+        return
+
+    def start(self):
+        '''
+        Function Overview:
+            Starts whichever profilers are enabled.
+        '''
+
+        if "cprofile" in self.modes:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        if "tracemalloc" in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+        return self
+
+    def stop(self):
+        '''
+        Function Overview:
+            Stops the profilers started by `start` and prints their results.
+        '''
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(self.top)
+            print("\ncProfile for {}:\n{}".format(self.name, stream.getvalue()))
+            self.profiler = None
+
+        if self.started_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+            print("\ntracemalloc for {}: current={:.1f} KiB, peak={:.1f} KiB".format(self.name, current / 1024, peak / 1024))
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                print(stat)
+
+        return
+
+@contextmanager
+def profile_run(name="run"):
+    '''
+    Input: `name` (dtype: str): A label for the printed profile
+
+    Function Overview:
+        Context manager version of `Profiler` for wrapping a whole run (i.e. one Lambda invocation).
+    '''
+
+    profiler = Profiler(name).start()
+    try:
+        yield
+    finally:
+        profiler.stop()
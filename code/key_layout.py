@@ -0,0 +1,297 @@
+import os
+import json
+import uuid
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from event_streams import event_timestamp, parse_timestamp
+
+## Object key layouts for raw events, and per-batch manifests.
+##
+## The original ("flat") layout writes every event to `raw/<event_id>.json`, so the only way to find
+## events from a given hour is to list the whole prefix.  The "partitioned" layout groups events by
+## the hour of their `context.timestamp` and spreads each hour across a fixed number of shards:
+##     raw/dt=2023-04-04/hr=22/07/609198c9-0d5e-4582-8080-9d26c5a07730.json
+##
+## Every uploaded batch also gets a small manifest listing its keys, event count and time range:
+##     manifests/raw/dt=2023-04-04/hr=22/<batch_id>.json
+## Manifests live outside `raw/` so they never trigger the raw-event notification.  They are filed
+## under the hour of the earliest event in the batch, so readers looking for a time window also check
+## the hour(s) before it (`MANIFEST_LOOKBACK_HOURS`) and then filter on each manifest's time range.
+## That only finds batches spanning at most `MANIFEST_LOOKBACK_HOURS + 1` hours, so producers split their
+## batches at hour boundaries (`split_by_hour`) and `write_manifest` refuses a manifest that spans more.
+
+LAYOUT_ENV_VAR = "CDEVENTS_RAW_LAYOUT"
+SHARDS_ENV_VAR = "CDEVENTS_RAW_SHARDS"
+LAYOUTS = ("flat", "partitioned")
+DEFAULT_SHARDS = 16
+MANIFEST_PREFIX = "manifests/"
+MANIFEST_LOOKBACK_HOURS = 1
+
+def default_layout():
+    '''
+    Input: None
+    Returns: `layout` (dtype: str) The layout selected with `CDEVENTS_RAW_LAYOUT` ("flat" if unset)
+    '''
+
+    layout = os.environ.get(LAYOUT_ENV_VAR, "flat")
+    if layout not in LAYOUTS:
+        raise ValueError("{}={} is not one of {}".format(LAYOUT_ENV_VAR, layout, LAYOUTS))
+
+    return layout
+
+def default_shards():
+    '''
+    Input: None
+    Returns: `shards` (dtype: int) The shard count selected with `CDEVENTS_RAW_SHARDS` (16 if unset)
+    '''
+
+    return int(os.environ.get(SHARDS_ENV_VAR, DEFAULT_SHARDS))
+
+def partition_path(timestamp):
+    '''
+    Input: `timestamp` (dtype: datetime)
+    Returns: `path` (dtype: str) The Hive-style partition for the hour of `timestamp` (i.e. "dt=2023-04-04/hr=22/")
+    '''
+
+    return "dt={}/hr={:02d}/".format(timestamp.strftime("%Y-%m-%d"), timestamp.hour)
+
+def shard_for(event_id, shards):
+    '''
+    Inputs:
+        `event_id` (dtype: str): A UUID event id
+        `shards` (dtype: int): The number of shards per hour
+
+    Returns: `shard` (dtype: str) A two-digit shard name derived from the event id, so events spread evenly
+    '''
+
+    try:
+        number = int(event_id.replace("-", "")[:8], 16)
+    except ValueError:
+        number = sum(event_id.encode("utf-8"))
+
+    return "{:02d}".format(number % shards)
+
+def raw_key(event, prefix="raw/", layout=None, shards=None, extension=".json"):
+    '''
+    Inputs:
+        `event` (dtype: dict): A raw CDEvent entry with an `event_id`
+        `prefix` (dtype: str): The raw folder
+        `layout` (dtype: str): "flat" or "partitioned".  Defaults to `CDEVENTS_RAW_LAYOUT`.
+        `shards` (dtype: int): Shards per hour for the partitioned layout.  Defaults to `CDEVENTS_RAW_SHARDS`.
+        `extension` (dtype: str): The file extension for the object
+
+    Returns: `key` (dtype: str) The object key for the event:
+        flat:        raw/609198c9-0d5e-4582-8080-9d26c5a07730.json
+        partitioned: raw/dt=2023-04-04/hr=22/07/609198c9-0d5e-4582-8080-9d26c5a07730.json
+    '''
+
+    if layout is None:
+        layout = default_layout()
+
+    if layout == "flat":
+        return "{}{}{}".format(prefix, event['event_id'], extension)
+
+    if shards is None:
+        shards = default_shards()
+
+    return "{}{}{}/{}{}".format(prefix, partition_path(event_timestamp(event)), shard_for(event['event_id'], shards),
+                                event['event_id'], extension)
+
+def parse_partition(key):
+    '''
+    Input: `key` (dtype: str): An object key
+    Returns: `partition` (dtype: str) The "dt=YYYY-MM-DD/hr=HH/" part of the key, or None for flat keys
+    '''
+
+    start = key.find("dt=")
+    if start < 0:
+        return None
+
+    end = key.find("/", key.find("hr=", start))
+    if key.find("hr=", start) < 0 or end < 0:
+        return None
+
+    return key[start:end + 1]
+
+def split_by_hour(items, timestamp=event_timestamp):
+    '''
+    Inputs:
+        `items` (dtype: list): Events, or anything `timestamp` can date
+        `timestamp` (dtype: function): Returns the datetime of an item (defaults to `event_timestamp`)
+
+    Returns: `runs` (dtype: list) The items split into lists of consecutive items from the same hour, in order
+    '''
+
+    runs = []
+    current_hour = None
+    for item in items:
+        hour = timestamp(item).replace(minute=0, second=0, microsecond=0)
+        if not runs or hour != current_hour:
+            runs.append([])
+            current_hour = hour
+        runs[-1].append(item)
+
+    return runs
+
+def manifest_key(batch_id, min_timestamp, prefix="raw/"):
+    '''
+    Inputs:
+        `batch_id` (dtype: str): A unique id for the batch
+        `min_timestamp` (dtype: datetime): The earliest event timestamp in the batch
+        `prefix` (dtype: str): The data folder the manifest describes
+
+    Returns: `key` (dtype: str) i.e. "manifests/raw/dt=2023-04-04/hr=22/<batch_id>.json"
+    '''
+
+    return "{}{}{}{}.json".format(MANIFEST_PREFIX, prefix, partition_path(min_timestamp), batch_id)
+
+def build_manifest(entries, layout, batch_id=None):
+    '''
+    Inputs:
+        `entries` (dtype: list): `(key, event, size_in_bytes)` tuples for every event in the batch.  An object
+            holding several events (i.e. from `adaptive.AdaptiveUploader`) has one entry per event and is listed once.
+        `layout` (dtype: str): The key layout the batch was written with
+        `batch_id` (dtype: str): A unique id for the batch (generated if omitted)
+
+    Returns: `manifest` (dtype: dict):
+        {
+            "batch_id": "4f0c...",
+            "created_at": "2023-04-04 22:40:01.123456",
+            "layout": "partitioned",
+            "count": 3,
+            "bytes": 2871,
+            "min_timestamp": "2023-04-04 22:31:53.796517",
+            "max_timestamp": "2023-04-04 22:36:34.827092",
+            "keys": ["raw/dt=2023-04-04/hr=22/07/609198c9-....json", ...]
+        }
+    '''
+
+    timestamps = [event_timestamp(event) for key, event, size in entries]
+
+    manifest = {
+        "batch_id": batch_id or str(uuid.uuid4()),
+        "created_at": str(datetime.now()),
+        "layout": layout,
+        "count": len(entries),
+        "bytes": sum(size for key, event, size in entries),
+        "min_timestamp": str(min(timestamps)) if timestamps else None,
+        "max_timestamp": str(max(timestamps)) if timestamps else None,
+        "keys": list(dict.fromkeys(key for key, event, size in entries))
+    }
+
+    return manifest
+
+def write_manifest(s3, bucket, manifest, prefix="raw/"):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+        `bucket` (dtype: str): The bucket the batch was written to
+        `manifest` (dtype: dict): A manifest from `build_manifest`
+        `prefix` (dtype: str): The data folder the manifest describes
+
+    Returns: `key` (dtype: str) The key the manifest was written to
+
+    Function Overview:
+        Raises a ValueError for a manifest spanning more hours than readers look back (see `split_by_hour`).
+    '''
+
+    min_timestamp = parse_timestamp(manifest['min_timestamp']) if manifest['min_timestamp'] else datetime.now()
+    if manifest['max_timestamp']:
+        max_hour = parse_timestamp(manifest['max_timestamp']).replace(minute=0, second=0, microsecond=0)
+        if max_hour - min_timestamp.replace(minute=0, second=0, microsecond=0) > timedelta(hours=MANIFEST_LOOKBACK_HOURS):
+            raise ValueError("Batch {} spans {} to {}, more than {} hour(s) apart; split it at hour boundaries "
+                             "so its manifest can be found".format(manifest['batch_id'], manifest['min_timestamp'],
+                                                                   manifest['max_timestamp'], MANIFEST_LOOKBACK_HOURS))
+    key = manifest_key(manifest['batch_id'], min_timestamp, prefix)
+
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest), ContentType="application/json")
+
+    return key
+
+def hours_between(start, end):
+    '''
+    Inputs:
+        `start`/`end` (dtype: datetime): A time window (end exclusive)
+
+    Returns: A generator of the start of every hour that overlaps the window
+    '''
+
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        yield hour
+        hour += timedelta(hours=1)
+
+def iter_hour_manifests(s3, bucket, hour, prefix="raw/"):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket to read manifests from
+        `hour` (dtype: datetime): The hour whose manifest partition should be read
+        `prefix` (dtype: str): The data folder the manifests describe
+
+    Returns: A generator of every manifest filed under `hour` (see `manifest_key`)
+    '''
+
+    hour_prefix = "{}{}{}".format(MANIFEST_PREFIX, prefix, partition_path(hour))
+    token = None
+
+    while True:
+        arguments = {"Bucket": bucket, "Prefix": hour_prefix}
+        if token:
+            arguments['ContinuationToken'] = token
+        page = s3.list_objects_v2(**arguments)
+
+        for item in page.get('Contents', []):
+            try:
+                yield json.loads(s3.get_object(Bucket=bucket, Key=item['Key'])['Body'].read())
+            except (ClientError, ValueError):
+                continue
+
+        if not page.get('IsTruncated'):
+            break
+        token = page['NextContinuationToken']
+
+def overlaps(manifest, start, end):
+    '''
+    Returns: `overlaps` (dtype: bool) Whether the manifest's time range overlaps the window `[start, end)`
+    '''
+
+    if manifest['count'] == 0:
+        return False
+
+    return parse_timestamp(manifest['max_timestamp']) >= start and parse_timestamp(manifest['min_timestamp']) < end
+
+def iter_manifests(s3, bucket, start, end, prefix="raw/", lookback_hours=MANIFEST_LOOKBACK_HOURS):
+    '''
+    Inputs:
+        `s3`: A boto3 S3 client or a `LocalS3`
+        `bucket` (dtype: str): The bucket to read manifests from
+        `start`/`end` (dtype: datetime): The time window to find batches for (end exclusive)
+        `prefix` (dtype: str): The data folder the manifests describe
+        `lookback_hours` (dtype: int): How many hours before `start` to check for batches that began earlier
+
+    Returns: A generator of manifests (see `build_manifest`) whose time range overlaps the window
+
+    Function Overview:
+        Only the manifest partitions for the hours in the window are listed, so the cost depends on the size of
+        the window rather than on the total number of raw objects.
+    '''
+
+    for hour in hours_between(start - timedelta(hours=lookback_hours), end):
+        for manifest in iter_hour_manifests(s3, bucket, hour, prefix):
+            if overlaps(manifest, start, end):
+                yield manifest
+
+def keys_for_window(s3, bucket, start, end, prefix="raw/"):
+    '''
+    Inputs: See `iter_manifests`
+    Returns: `keys` (dtype: list) Every raw key from batches that overlap the window, sorted and de-duplicated.
+        Batches can straddle the window edges, so callers that need an exact window should still check each
+        event's timestamp.
+    '''
+
+    keys = set()
+    for manifest in iter_manifests(s3, bucket, start, end, prefix):
+        keys.update(manifest['keys'])
+
+    return sorted(keys)
@@ -0,0 +1,759 @@
+import os
+import sys
+import json
+import time
+import uuid
+import heapq
+import shutil
+import hashlib
+import tempfile
+import threading
+import asyncio
+import importlib
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime
+from botocore.exceptions import ClientError
+from http_protocol import read_request, format_response, HTTPError
+
+## Local stand-ins for the parts of S3 and SQS this project uses.
+##
+## `LocalS3` and `LocalSQS` accept the same keyword arguments and return the same response
+## shapes as the matching boto3 client calls, so any function that takes an `s3`/`sqs` client
+## can be pointed at them for tests, replays, and benchmarks without touching AWS.  Errors are
+## raised as `botocore.exceptions.ClientError` with the same error codes AWS would use.
+##
+## `LocalHTTPReceiver` stands in for a CDEvents webhook receiver, for testing `http_emitter.py`.
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+
+def client_error(code, message, operation):
+    '''
+    Inputs:
+        `code` (dtype: str): The AWS error code (i.e. "NoSuchKey")
+        `message` (dtype: str): A human readable description of the error
+        `operation` (dtype: str): The client method that failed (i.e. "GetObject")
+
+    Returns: `error` (dtype: ClientError) An exception shaped like the ones raised by boto3
+    '''
+
+    status = 404 if code in ("NoSuchKey", "404", "NoSuchBucket") else 503 if code == "SlowDown" else 400
+    response = {
+        "Error": {"Code": code, "Message": message},
+        "ResponseMetadata": {"HTTPStatusCode": status}
+    }
+
+    return ClientError(response, operation)
+
+def ok_response(**fields):
+    '''
+    Returns: `response` (dtype: dict) A successful boto3-style response containing `fields`
+    '''
+
+    response = {"ResponseMetadata": {"HTTPStatusCode": 200, "RequestId": str(uuid.uuid4())}}
+    response.update(fields)
+
+    return response
+
+class LocalStreamingBody():
+    def __init__(self, fileobj, length):
+        '''
+        Inputs:
+            `fileobj` (dtype: file): A binary file object holding the object data
+            `length` (dtype: int): The size of the object in bytes
+
+        Returns: object (dtype: LocalStreamingBody) A stand-in for botocore's `StreamingBody`, supporting
+            `read`, `iter_lines`, `iter_chunks`, and `close`.
+        '''
+
+        self.fileobj = fileobj
+        self.length = length
+
+        return
+
+    def read(self, amt=None):
+        data = self.fileobj.read() if amt is None else self.fileobj.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        pending = b""
+        for chunk in self.iter_chunks(chunk_size):
+            lines = (pending + chunk).splitlines(True)
+            pending = b""
+            for line in lines:
+                if line.endswith((b"\n", b"\r")):
+                    yield line if keepends else line.splitlines()[0]
+                else:
+                    pending = line
+        if pending:
+            yield pending
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class LocalS3():
+    def __init__(self, root=None):
+        '''
+        Input: `root` (dtype: str): The directory that holds the objects.  A temporary directory is used if omitted.
+        Returns: object (dtype: LocalS3) A filesystem-backed stand-in for `boto3.client("s3")`:
+            <root>/<bucket>/<key>            -> object data
+            <root>/.metadata/<bucket>/<key>  -> ContentType, ContentEncoding, and user Metadata for the object
+
+        Overview:
+            Writes are atomic (write to a temporary file, then rename), so concurrent readers never see a
+            partially written object, the same as S3.  Buckets are created on first write.
+        '''
+
+        if root is None:
+            root = tempfile.mkdtemp(prefix="local_s3_")
+
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+        return
+
+    def object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def metadata_path(self, bucket, key):
+        return os.path.join(self.root, ".metadata", bucket, *key.split("/"))
+
+    def write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+    def put_object(self, Bucket, Key, Body=b"", ContentType=None, ContentEncoding=None, Metadata=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+
+        self.write_atomic(self.object_path(Bucket, Key), Body)
+
+        metadata = {
+            "ContentType": ContentType or "binary/octet-stream",
+            "ContentEncoding": ContentEncoding,
+            "Metadata": Metadata or {},
+            "LastModified": datetime.utcnow().isoformat()
+        }
+        self.write_atomic(self.metadata_path(Bucket, Key), json.dumps(metadata).encode("utf-8"))
+
+        return ok_response(ETag='"{}"'.format(hashlib.md5(Body).hexdigest()))
+
+    def read_metadata(self, bucket, key):
+        try:
+            with open(self.metadata_path(bucket, key), "rb") as metadata_file:
+                return json.loads(metadata_file.read())
+        except (IOError, ValueError):
+            return {"ContentType": "binary/octet-stream", "ContentEncoding": None, "Metadata": {}}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self.object_path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise client_error("404", "Not Found", "HeadObject")
+
+        metadata = self.read_metadata(Bucket, Key)
+        response = ok_response(ContentLength=os.path.getsize(path), ContentType=metadata['ContentType'],
+                               Metadata=metadata['Metadata'])
+        if metadata.get('ContentEncoding'):
+            response['ContentEncoding'] = metadata['ContentEncoding']
+
+        return response
+
+    def get_object(self, Bucket, Key, **kwargs):
+        path = self.object_path(Bucket, Key)
+        try:
+            fileobj = open(path, "rb")
+        except IOError:
+            raise client_error("NoSuchKey", "The specified key does not exist.", "GetObject")
+
+        length = os.fstat(fileobj.fileno()).st_size
+        metadata = self.read_metadata(Bucket, Key)
+        response = ok_response(Body=LocalStreamingBody(fileobj, length), ContentLength=length,
+                               ContentType=metadata['ContentType'], Metadata=metadata['Metadata'])
+        if metadata.get('ContentEncoding'):
+            response['ContentEncoding'] = metadata['ContentEncoding']
+
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        for path in (self.object_path(Bucket, Key), self.metadata_path(Bucket, Key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        return ok_response()
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        deleted = []
+        for item in Delete['Objects']:
+            self.delete_object(Bucket, item['Key'])
+            deleted.append({"Key": item['Key']})
+
+        return ok_response(Deleted=deleted)
+
+    def list_keys(self, bucket, prefix=""):
+        '''
+        Inputs:
+            `bucket` (dtype: str): The bucket to list
+            `prefix` (dtype: str): Only keys starting with this prefix are returned
+
+        Returns: `keys` (dtype: list) Every key under `prefix`, sorted the same way S3 sorts them
+            (by UTF-8 byte order)
+        '''
+
+        bucket_root = os.path.join(self.root, bucket)
+
+        ## Only walk the deepest directory that can contain the prefix
+        directory_part = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        start = os.path.join(bucket_root, *directory_part.split("/")) if directory_part else bucket_root
+
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(start):
+            relative = os.path.relpath(dirpath, bucket_root)
+            relative = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                key = relative + filename
+                if key.startswith(prefix):
+                    keys.append(key)
+
+        keys.sort(key=lambda key: key.encode("utf-8"))
+
+        return keys
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None,
+                        Delimiter=None, **kwargs):
+        keys = self.list_keys(Bucket, Prefix)
+        encoded = [key.encode("utf-8") for key in keys]
+
+        after = ContinuationToken or StartAfter
+        start = bisect_right(encoded, after.encode("utf-8")) if after else 0
+
+        contents = []
+        common_prefixes = []
+        seen_prefixes = set()
+        last_key = None
+        index = start
+
+        while index < len(keys) and len(contents) + len(common_prefixes) < MaxKeys:
+            key = keys[index]
+            index += 1
+            last_key = key
+
+            if Delimiter:
+                position = key.find(Delimiter, len(Prefix))
+                if position >= 0:
+                    common_prefix = key[:position + len(Delimiter)]
+                    if common_prefix not in seen_prefixes:
+                        seen_prefixes.add(common_prefix)
+                        common_prefixes.append({"Prefix": common_prefix})
+                    continue
+
+            path = self.object_path(Bucket, key)
+            contents.append({
+                "Key": key,
+                "Size": os.path.getsize(path),
+                "LastModified": datetime.utcfromtimestamp(os.path.getmtime(path))
+            })
+
+        if Delimiter:
+            ## Skip the rest of a common prefix that was cut off by MaxKeys
+            while index < len(keys) and common_prefixes and keys[index].startswith(common_prefixes[-1]['Prefix']):
+                last_key = keys[index]
+                index += 1
+
+        response = ok_response(Name=Bucket, Prefix=Prefix, MaxKeys=MaxKeys, KeyCount=len(contents) + len(common_prefixes),
+                               IsTruncated=index < len(keys))
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = last_key
+
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != "list_objects_v2":
+            raise ValueError("LocalS3 only supports the list_objects_v2 paginator")
+
+        return LocalListObjectsPaginator(self)
+
+    def clear(self):
+        '''
+        Function Overview:
+            Deletes every bucket and object in the store.
+        '''
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+        return
+
+class LocalListObjectsPaginator():
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix="", StartAfter=None, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+        token = None
+
+        while True:
+            arguments = dict(Bucket=Bucket, Prefix=Prefix, MaxKeys=page_size, **kwargs)
+            if token:
+                arguments['ContinuationToken'] = token
+            elif StartAfter:
+                arguments['StartAfter'] = StartAfter
+
+            page = self.client.list_objects_v2(**arguments)
+            yield page
+
+            if not page['IsTruncated']:
+                break
+            token = page['NextContinuationToken']
+
+class LocalSQS():
+    def __init__(self):
+        '''
+        Input: None
+        Returns: object (dtype: LocalSQS) An in-process, thread-safe stand-in for `boto3.client("sqs")`
+
+        Overview:
+            Supports standard (not FIFO) queues with visibility timeouts, long polling, batch calls, and a
+            redrive policy that moves a message to a dead-letter queue once it has been received
+            `maxReceiveCount` times without being deleted.  Like SQS, messages (and whole batches) over
+            256 KiB are refused.
+        '''
+
+        self.lock = threading.Condition()
+        self.queues = {}
+
+        return
+
+    def create_queue(self, QueueName, Attributes=None, **kwargs):
+        Attributes = Attributes or {}
+        queue_url = "https://localhost/sqs/{}".format(QueueName)
+
+        with self.lock:
+            if queue_url not in self.queues:
+                redrive = json.loads(Attributes['RedrivePolicy']) if 'RedrivePolicy' in Attributes else None
+                self.queues[queue_url] = {
+                    "name": QueueName,
+                    "arn": "arn:aws:sqs:local:000000000000:{}".format(QueueName),
+                    "visibility_timeout": float(Attributes.get('VisibilityTimeout', 30)),
+                    "redrive": redrive,
+                    "visible": deque(),
+                    "in_flight": {},
+                    "deadlines": []
+                }
+
+        return ok_response(QueueUrl=queue_url)
+
+    def get_queue_url(self, QueueName, **kwargs):
+        queue_url = "https://localhost/sqs/{}".format(QueueName)
+        if queue_url not in self.queues:
+            raise client_error("AWS.SimpleQueueService.NonExistentQueue", "The specified queue does not exist.", "GetQueueUrl")
+
+        return ok_response(QueueUrl=queue_url)
+
+    def queue(self, queue_url, operation):
+        try:
+            return self.queues[queue_url]
+        except KeyError:
+            raise client_error("AWS.SimpleQueueService.NonExistentQueue", "The specified queue does not exist.", operation)
+
+    def queue_by_arn(self, arn):
+        for queue in self.queues.values():
+            if queue['arn'] == arn:
+                return queue
+        return None
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        with self.lock:
+            queue = self.queue(QueueUrl, "GetQueueAttributes")
+            self.release_expired(queue)
+            attributes = {
+                "QueueArn": queue['arn'],
+                "ApproximateNumberOfMessages": str(len(queue['visible'])),
+                "ApproximateNumberOfMessagesNotVisible": str(len(queue['in_flight'])),
+                "VisibilityTimeout": str(int(queue['visibility_timeout']))
+            }
+            if queue['redrive']:
+                attributes['RedrivePolicy'] = json.dumps(queue['redrive'])
+
+        return ok_response(Attributes=attributes)
+
+    def new_message(self, body, attributes=None):
+        return {
+            "MessageId": str(uuid.uuid4()),
+            "Body": body,
+            "MD5OfBody": hashlib.md5(body.encode("utf-8")).hexdigest(),
+            "MessageAttributes": attributes,
+            "SentTimestamp": str(int(time.time() * 1000)),
+            "ReceiveCount": 0,
+            "ReceiptHandle": None,
+            "Deadline": None
+        }
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        if len(MessageBody.encode("utf-8")) > SQS_MAX_MESSAGE_BYTES:
+            raise client_error("InvalidParameterValue", "One or more parameters are invalid. Reason: Message must be "
+                               "shorter than {} bytes.".format(SQS_MAX_MESSAGE_BYTES), "SendMessage")
+
+        with self.lock:
+            queue = self.queue(QueueUrl, "SendMessage")
+            message = self.new_message(MessageBody, MessageAttributes)
+            queue['visible'].append(message)
+            self.lock.notify_all()
+
+        return ok_response(MessageId=message['MessageId'], MD5OfMessageBody=message['MD5OfBody'])
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        if len(Entries) > 10:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest",
+                               "Maximum number of entries per request are 10.", "SendMessageBatch")
+        if sum(len(entry['MessageBody'].encode("utf-8")) for entry in Entries) > SQS_MAX_MESSAGE_BYTES:
+            raise client_error("AWS.SimpleQueueService.BatchRequestTooLong", "Batch requests cannot be longer than "
+                               "{} bytes.".format(SQS_MAX_MESSAGE_BYTES), "SendMessageBatch")
+
+        successful = []
+        with self.lock:
+            queue = self.queue(QueueUrl, "SendMessageBatch")
+            for entry in Entries:
+                message = self.new_message(entry['MessageBody'], entry.get('MessageAttributes'))
+                queue['visible'].append(message)
+                successful.append({"Id": entry['Id'], "MessageId": message['MessageId'],
+                                   "MD5OfMessageBody": message['MD5OfBody']})
+            self.lock.notify_all()
+
+        return ok_response(Successful=successful, Failed=[])
+
+    def release_expired(self, queue):
+        '''
+        Function Overview:
+            Makes in-flight messages whose visibility timeout has passed visible again, or moves them to the
+            dead-letter queue if they have used up their `maxReceiveCount`.  Must be called with the lock held.
+        '''
+
+        now = time.time()
+        deadlines = queue['deadlines']
+
+        while deadlines and deadlines[0][0] <= now:
+            deadline, receipt_handle = heapq.heappop(deadlines)
+            message = queue['in_flight'].get(receipt_handle)
+            if message is None or message['Deadline'] != deadline:
+                continue  ## Deleted, or its visibility was changed after this entry was pushed
+
+            del queue['in_flight'][receipt_handle]
+            message['ReceiptHandle'] = None
+            message['Deadline'] = None
+
+            redrive = queue['redrive']
+            dead_letter_queue = self.queue_by_arn(redrive['deadLetterTargetArn']) if redrive else None
+            if dead_letter_queue is not None and message['ReceiveCount'] >= int(redrive['maxReceiveCount']):
+                dead_letter_queue['visible'].append(message)
+            else:
+                queue['visible'].appendleft(message)
+
+        return
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None,
+                        AttributeNames=None, MessageAttributeNames=None, **kwargs):
+        if not 1 <= MaxNumberOfMessages <= 10:
+            raise client_error("InvalidParameterValue", "MaxNumberOfMessages must be between 1 and 10.", "ReceiveMessage")
+
+        give_up_at = time.time() + WaitTimeSeconds
+        messages = []
+
+        with self.lock:
+            queue = self.queue(QueueUrl, "ReceiveMessage")
+            timeout = queue['visibility_timeout'] if VisibilityTimeout is None else VisibilityTimeout
+
+            while True:
+                self.release_expired(queue)
+                if queue['visible'] or time.time() >= give_up_at:
+                    break
+
+                ## Wake up for new messages or for the next in-flight message to expire
+                wait = give_up_at - time.time()
+                if queue['deadlines']:
+                    wait = min(wait, max(queue['deadlines'][0][0] - time.time(), 0.001))
+                self.lock.wait(wait)
+
+            while queue['visible'] and len(messages) < MaxNumberOfMessages:
+                message = queue['visible'].popleft()
+                message['ReceiveCount'] += 1
+                message['ReceiptHandle'] = str(uuid.uuid4())
+                message['Deadline'] = time.time() + timeout
+                queue['in_flight'][message['ReceiptHandle']] = message
+                heapq.heappush(queue['deadlines'], (message['Deadline'], message['ReceiptHandle']))
+
+                received = {
+                    "MessageId": message['MessageId'],
+                    "ReceiptHandle": message['ReceiptHandle'],
+                    "MD5OfBody": message['MD5OfBody'],
+                    "Body": message['Body'],
+                    "Attributes": {
+                        "ApproximateReceiveCount": str(message['ReceiveCount']),
+                        "SentTimestamp": message['SentTimestamp']
+                    }
+                }
+                if message['MessageAttributes']:
+                    received['MessageAttributes'] = message['MessageAttributes']
+                messages.append(received)
+
+        response = ok_response()
+        if messages:
+            response['Messages'] = messages
+
+        return response
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        with self.lock:
+            queue = self.queue(QueueUrl, "DeleteMessage")
+            message = queue['in_flight'].pop(ReceiptHandle, None)
+            if message is None:
+                raise client_error("ReceiptHandleIsInvalid", "The receipt handle is not valid.", "DeleteMessage")
+
+        return ok_response()
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        if len(Entries) > 10:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest",
+                               "Maximum number of entries per request are 10.", "DeleteMessageBatch")
+
+        successful = []
+        failed = []
+        with self.lock:
+            queue = self.queue(QueueUrl, "DeleteMessageBatch")
+            for entry in Entries:
+                if queue['in_flight'].pop(entry['ReceiptHandle'], None) is None:
+                    failed.append({"Id": entry['Id'], "Code": "ReceiptHandleIsInvalid", "SenderFault": True,
+                                   "Message": "The receipt handle is not valid."})
+                else:
+                    successful.append({"Id": entry['Id']})
+
+        return ok_response(Successful=successful, Failed=failed)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        with self.lock:
+            queue = self.queue(QueueUrl, "ChangeMessageVisibility")
+            message = queue['in_flight'].get(ReceiptHandle)
+            if message is None:
+                raise client_error("ReceiptHandleIsInvalid", "The receipt handle is not valid.", "ChangeMessageVisibility")
+
+            message['Deadline'] = time.time() + VisibilityTimeout
+            heapq.heappush(queue['deadlines'], (message['Deadline'], ReceiptHandle))
+            self.lock.notify_all()
+
+        return ok_response()
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        successful = []
+        failed = []
+        for entry in Entries:
+            try:
+                self.change_message_visibility(QueueUrl, entry['ReceiptHandle'], entry['VisibilityTimeout'])
+                successful.append({"Id": entry['Id']})
+            except ClientError as e:
+                failed.append({"Id": entry['Id'], "Code": e.response['Error']['Code'], "SenderFault": True,
+                               "Message": e.response['Error']['Message']})
+
+        return ok_response(Successful=successful, Failed=failed)
+
+    def purge_queue(self, QueueUrl, **kwargs):
+        with self.lock:
+            queue = self.queue(QueueUrl, "PurgeQueue")
+            queue['visible'].clear()
+            queue['in_flight'].clear()
+            queue['deadlines'] = []
+
+        return ok_response()
+
+class LocalHTTPReceiver():
+    def __init__(self, status=202, delay=0.0, max_requests_per_connection=None):
+        '''
+        Inputs:
+            `status` (dtype: int): The status to answer every request with
+            `delay` (dtype: float): Seconds to wait before answering (a slow receiver)
+            `max_requests_per_connection` (dtype: int): Close each connection after this many requests (unlimited
+                if None), like servers that limit keep-alive reuse
+
+        Returns: object (dtype: LocalHTTPReceiver) An HTTP server on 127.0.0.1, run on its own thread and event loop
+            by `start`, that records every request:
+                with LocalHTTPReceiver() as receiver:
+                    HTTPEmitter(receiver.url).run(events)
+                    receiver.requests  -> [{"method": "POST", "target": "/events", "headers": {...}, "body": b"..."}]
+        '''
+
+        self.status = status
+        self.delay = delay
+        self.max_requests_per_connection = max_requests_per_connection
+        self.requests = []
+        self.connections = 0
+        self.port = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+
+        return
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/events".format(self.port)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        handled = 0
+
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    writer.write(format_response(e.status, keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                method, target, headers, body, keep_alive = request
+                self.requests.append({"method": method, "target": target, "headers": headers, "body": body})
+                handled += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+
+                if self.max_requests_per_connection is not None and handled >= self.max_requests_per_connection:
+                    keep_alive = False
+                writer.write(format_response(self.status, keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = None
+
+    def events(self):
+        '''
+        Returns: `events` (dtype: list) Every CDEvent received, in the order the requests arrived
+        '''
+
+        from cloud_events import from_http
+
+        events = []
+        for request in list(self.requests):
+            events.extend(from_http(request['headers'], request['body'])[1])
+
+        return events
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def s3_notification(bucket, key):
+    '''
+    Inputs:
+        `bucket` (dtype: str): The bucket an object was written to
+        `key` (dtype: str): The key of the new object
+
+    Returns: `notification` (dtype: dict) The body of the S3 "ObjectCreated" event notification that S3
+        sends to the SQS queue (and that `get_event_body` in `lambda_function.py` unpacks)
+    '''
+
+    return {
+        "Records": [{
+            "eventSource": "aws:s3",
+            "eventName": "ObjectCreated:Put",
+            "eventTime": datetime.utcnow().isoformat() + "Z",
+            "s3": {
+                "bucket": {"name": bucket},
+                "object": {"key": key}
+            }
+        }]
+    }
+
+def sqs_lambda_event(bodies):
+    '''
+    Input: `bodies` (dtype: list): Message bodies (dtype: dict or str) to deliver to the Lambda
+    Returns: `event` (dtype: dict) The event the Lambda runtime passes to `lambda_handler` for an SQS trigger
+    '''
+
+    records = []
+    for body in bodies:
+        records.append({
+            "messageId": str(uuid.uuid4()),
+            "eventSource": "aws:sqs",
+            "body": body if isinstance(body, str) else json.dumps(body)
+        })
+
+    return {"Records": records}
+
+def load_lambda(s3_client, bucket):
+    '''
+    Inputs:
+        `s3_client`: The client the Lambda should read and write objects with (i.e. a `LocalS3`)
+        `bucket` (dtype: str): The bucket the Lambda should use
+
+    Returns: `lambda_function` (dtype: module) The Lambda module from `lambda/`, pointed at `s3_client` and `bucket`
+
+    Function Overview:
+        This lets local tools call `lambda_function.lambda_handler` directly without any AWS credentials.
+    '''
+
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+
+    os.environ.setdefault("CDEVENT_BUCKET", bucket)
+    lambda_function = importlib.import_module("lambda_function")
+    lambda_function.configure(s3_client=s3_client, bucket=bucket)
+
+    return lambda_function
@@ -0,0 +1,469 @@
+import os
+import re
+import csv
+import glob
+import json
+import time
+import sqlite3
+import argparse
+from compression import detect_codec, decompress
+from key_layout import parse_partition
+from schemas import PROCESSED_COLUMNS, normalize_processed
+from instrumentation import timer, increment, print_summary
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Query processed CDEvents locally with SQL, using the same tables Athena sees.
+##
+## Every query against Glue + Athena costs money per byte scanned and takes seconds to start, which makes it a
+## slow way to try out query shapes and file layouts.  `LocalCatalog` registers local copies of processed data
+## (CSV, NDJSON, or Parquet; one file, a flat folder, or `dt=YYYY-MM-DD/hr=HH/` partitions) as tables with the
+## schema the Glue crawler produces: every processed column as a string, plus `dt` and `hr` string partition
+## columns when the data is partitioned.
+##
+## Queries run on DuckDB when it is installed and on the standard library's sqlite3 otherwise.  Before a query
+## runs, simple `dt`/`hr` predicates in its WHERE clause (=, <, <=, >, >=, BETWEEN, IN) are used to skip
+## partitions, the same way Athena prunes partitions, and `last_stats` reports how many files were scanned:
+##     catalog = LocalCatalog()
+##     catalog.register("processed", "../processed/")
+##     columns, rows = catalog.query("SELECT run_outcome, count(*) FROM processed WHERE dt = '2023-04-04' GROUP BY 1")
+##     catalog.last_stats  -> {"engine": "sqlite", "files": 24, "files_pruned": 696, "rows_loaded": 3171, ...}
+## A predicate is only used when every returned row has to satisfy it: it must be one of the AND-ed terms of the
+## WHERE clause of a single SELECT over a single table.  Anything else (OR at the top of the WHERE clause, NOT,
+## CASE, subqueries, CTEs, UNIONs, joins, or predicates in the SELECT list, ON, or HAVING) is never pruned.
+
+ENGINES = ("duckdb", "sqlite")
+PARTITION_COLUMNS = ["dt", "hr"]
+SOURCE_EXTENSIONS = (".csv", ".ndjson", ".json", ".parquet", ".gz", ".zst")
+SQL_TOKEN = re.compile(r"\s+|--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|[A-Za-z_][A-Za-z0-9_$]*|"
+                       r"\d+(?:\.\d*)?|<=|>=|<>|!=|\|\||.", re.DOTALL)
+COMPARISONS = ("=", "<", "<=", ">", ">=")
+CLAUSE_ENDS = ("GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET", "WINDOW")
+
+def default_engine():
+    '''
+    Input: None
+    Returns: `engine` (dtype: str) "duckdb" if it is installed, otherwise "sqlite"
+    '''
+
+    return "duckdb" if duckdb is not None else "sqlite"
+
+def sql_tokens(sql):
+    '''
+    Input: `sql` (dtype: str): A query
+    Returns: `tokens` (dtype: list) `(kind, text, depth)` tuples, where kind is "word" (a keyword or identifier),
+        "name" (a quoted identifier), "string" (a literal, unquoted) or "symbol", and depth is the parenthesis depth.
+        Whitespace and comments are dropped.
+    '''
+
+    tokens = []
+    depth = 0
+    for match in SQL_TOKEN.finditer(sql):
+        text = match.group(0)
+        if text.isspace() or text.startswith("--") or text.startswith("/*"):
+            continue
+
+        if text == ")":
+            depth -= 1
+        if text.startswith("'") and len(text) > 1:
+            tokens.append(("string", text[1:-1].replace("''", "'"), depth))
+        elif text.startswith('"') and len(text) > 1:
+            tokens.append(("name", text[1:-1].replace('""', '"'), depth))
+        elif text[0].isalpha() or text[0] == "_":
+            tokens.append(("word", text, depth))
+        else:
+            tokens.append(("symbol", text, depth))
+        if text == "(":
+            depth += 1
+
+    return tokens
+
+def is_keyword(token, *keywords):
+    return token[0] == "word" and token[1].upper() in keywords
+
+def parenthesized(tokens):
+    return len(tokens) >= 2 and tokens[0][1] == "(" and tokens[-1][1] == ")" and \
+        all(token[2] > tokens[0][2] for token in tokens[1:-1])
+
+def split_conjuncts(tokens):
+    '''
+    Input: `tokens` (dtype: list): The tokens of a boolean expression (see `sql_tokens`)
+    Returns: `conjuncts` (dtype: list) The token lists of its top-level AND-ed terms (with enclosing parentheses
+        removed), or None when the expression is an OR at the top level
+    '''
+
+    if not tokens:
+        return []
+    depth = tokens[0][2]
+    conjuncts = [[]]
+    between = False
+    for token in tokens:
+        if token[2] == depth and is_keyword(token, "OR"):
+            return None
+        if token[2] == depth and is_keyword(token, "BETWEEN"):
+            between = True
+        elif token[2] == depth and is_keyword(token, "AND"):
+            if between:
+                between = False
+            else:
+                conjuncts.append([])
+                continue
+        conjuncts[-1].append(token)
+
+    terms = []
+    for conjunct in conjuncts:
+        if not parenthesized(conjunct):
+            terms.append(conjunct)
+            continue
+        ## An OR inside an AND-ed term can't be pruned on, but the other terms still can
+        terms.extend(split_conjuncts(conjunct[1:-1]) or [])
+
+    return terms
+
+def predicate_conditions(tokens, qualifiers):
+    '''
+    Inputs:
+        `tokens` (dtype: list): One AND-ed term of a WHERE clause (see `split_conjuncts`)
+        `qualifiers` (dtype: set): The table name and alias a column may be qualified with
+
+    Returns: `(column, conditions)` for a `dt`/`hr` comparison with string literals, otherwise `(None, [])`
+    '''
+
+    if len(tokens) > 2 and tokens[1][1] == "." and tokens[0][0] in ("word", "name"):
+        if tokens[0][1].lower() not in qualifiers:
+            return None, []
+        tokens = tokens[2:]
+    if not tokens or tokens[0][0] not in ("word", "name") or tokens[0][1].lower() not in PARTITION_COLUMNS:
+        return None, []
+
+    column, rest = tokens[0][1].lower(), tokens[1:]
+    kinds = [token[0] for token in rest]
+
+    if kinds == ["symbol", "string"] and rest[0][1] in COMPARISONS:
+        return column, [(rest[0][1], rest[1][1])]
+
+    if kinds == ["word", "string", "word", "string"] and is_keyword(rest[0], "BETWEEN") and is_keyword(rest[2], "AND"):
+        return column, [(">=", rest[1][1]), ("<=", rest[3][1])]
+
+    if len(rest) >= 4 and is_keyword(rest[0], "IN") and rest[1][1] == "(" and rest[-1][1] == ")":
+        values = rest[2:-1]
+        if all(token[0] == "string" for token in values[::2]) and all(token[1] == "," for token in values[1::2]) \
+                and len(values) % 2 == 1:
+            return column, [("in", [token[1] for token in values[::2]])]
+
+    return None, []
+
+def partition_filters(sql):
+    '''
+    Input: `sql` (dtype: str): A query
+    Returns: `filters` (dtype: dict) Partition column -> list of `(operator, value)` conditions that every
+        matching row must satisfy, i.e. {"dt": [(">=", "2023-04-04")], "hr": [("in", ["21", "22"])]}.
+        Empty unless the query is a single SELECT over a single table whose WHERE clause ANDs partition
+        predicates with other terms (see the module comment).
+    '''
+
+    tokens = sql_tokens(sql)
+    top = [(index, token) for index, token in enumerate(tokens) if token[2] == 0]
+
+    if any(is_keyword(token, "SELECT") for token in tokens if token[2] > 0):
+        return {}  ## A subquery
+    if any(is_keyword(token, "WITH", "UNION", "INTERSECT", "EXCEPT") for index, token in top):
+        return {}
+    if [token[1].upper() for index, token in top if is_keyword(token, "SELECT", "FROM", "WHERE")] \
+            != ["SELECT", "FROM", "WHERE"]:
+        return {}
+
+    start = next(index for index, token in top if is_keyword(token, "FROM"))
+    where = next(index for index, token in top if is_keyword(token, "WHERE"))
+    end = next((index for index, token in top if index > where and (is_keyword(token, *CLAUSE_ENDS) or token[1] == ";")),
+               len(tokens))
+
+    ## Only `table`, `table alias`, or `table AS alias`, so a predicate can't belong to another table in a join
+    source = [token for token in tokens[start + 1:where] if not is_keyword(token, "AS")]
+    if not 1 <= len(source) <= 2 or any(token[0] not in ("word", "name") for token in source):
+        return {}
+    qualifiers = {token[1].lower() for token in source}
+
+    conjuncts = split_conjuncts(tokens[where + 1:end])
+    if conjuncts is None:
+        return {}
+
+    filters = {}
+    for conjunct in conjuncts:
+        column, conditions = predicate_conditions(conjunct, qualifiers)
+        if column is not None:
+            filters.setdefault(column, []).extend(conditions)
+
+    return filters
+
+def matches(value, conditions):
+    '''
+    Inputs:
+        `value` (dtype: str): A partition value from a file's path (i.e. "2023-04-04")
+        `conditions` (dtype: list): `(operator, value)` conditions from `partition_filters`
+
+    Returns: `matches` (dtype: bool) Whether rows in the partition could satisfy every condition
+    '''
+
+    for operator, expected in conditions:
+        if operator == "in":
+            if value not in expected:
+                return False
+        elif operator == "=" and value != expected:
+            return False
+        elif operator == "<" and not value < expected:
+            return False
+        elif operator == "<=" and not value <= expected:
+            return False
+        elif operator == ">" and not value > expected:
+            return False
+        elif operator == ">=" and not value >= expected:
+            return False
+
+    return True
+
+def file_partition(name):
+    '''
+    Input: `name` (dtype: str): A file path
+    Returns: `partition` (dtype: dict) i.e. {"dt": "2023-04-04", "hr": "22"}, or {} for unpartitioned files
+    '''
+
+    partition = parse_partition(name.replace(os.sep, "/"))
+    if partition is None:
+        return {}
+
+    return dict(part.split("=", 1) for part in partition.strip("/").split("/"))
+
+def iter_rows(name):
+    '''
+    Input: `name` (dtype: str): A processed CSV, NDJSON/JSON (optionally .gz or .zst), or Parquet file
+    Returns: A generator of processed events as dictionaries with exactly `PROCESSED_COLUMNS`
+    '''
+
+    if name.endswith(".parquet"):
+        if pyarrow is None:
+            raise ValueError("Reading Parquet requires the `pyarrow` package (pip install pyarrow)")
+        for batch in pyarrow.parquet.ParquetFile(name).iter_batches():
+            for record in batch.to_pylist():
+                yield normalize_processed(record)
+        return
+
+    with open(name, "rb") as infile:
+        data = infile.read()
+    text = decompress(data, detect_codec(data, key=name)).decode("utf-8")
+
+    if ".csv" in name:
+        for record in csv.DictReader(text.splitlines()):
+            yield normalize_processed({k: (v if v != "" else None) for k, v in record.items()})
+        return
+
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            yield normalize_processed(json.loads(line))
+
+class LocalCatalog():
+    def __init__(self, engine=None, database=":memory:"):
+        '''
+        Inputs:
+            `engine` (dtype: str): "duckdb" or "sqlite" (defaults to DuckDB when it is installed)
+            `database` (dtype: str): The database file for the engine (in memory by default)
+
+        Returns: object (dtype: LocalCatalog) A set of local tables mirroring the Glue catalog
+        '''
+
+        self.engine = engine or default_engine()
+        if self.engine not in ENGINES:
+            raise ValueError("engine {} is not one of {}".format(self.engine, ENGINES))
+        if self.engine == "duckdb" and duckdb is None:
+            raise ValueError("The duckdb engine requires the `duckdb` package (pip install duckdb)")
+
+        self.connection = duckdb.connect(database) if self.engine == "duckdb" else sqlite3.connect(database)
+        self.tables = {}
+        self.loaded = {}
+        self.last_stats = {}
+
+        return
+
+    def register(self, name, path):
+        '''
+        Inputs:
+            `name` (dtype: str): The table name (i.e. "processed", like the Glue table)
+            `path` (dtype: str): A processed file, or a folder of them (searched recursively)
+
+        Returns: `columns` (dtype: list) The table's columns, with `dt` and `hr` last for partitioned data
+
+        Function Overview:
+            Only the file list is recorded here.  Files are read when a query first needs them.
+        '''
+
+        if os.path.isdir(path):
+            files = sorted(f for f in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+                           if f.endswith(SOURCE_EXTENSIONS) and os.path.isfile(f)
+                           and "_commits" not in f and os.sep + ".cache" + os.sep not in f)
+        else:
+            files = [path]
+
+        if not files:
+            raise ValueError("No processed files found under {}".format(path))
+
+        partitions = [file_partition(f) for f in files]
+        partitioned = all(partitions)
+        columns = PROCESSED_COLUMNS + (PARTITION_COLUMNS if partitioned else [])
+
+        self.tables[name] = {"files": list(zip(files, partitions)), "columns": columns, "partitioned": partitioned}
+        self.loaded[name] = set()
+
+        if self.engine == "sqlite":
+            self.connection.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+            self.connection.execute('CREATE TABLE "{}" ({})'.format(name, ", ".join('"{}" TEXT'.format(c) for c in columns)))
+
+        return columns
+
+    def select_files(self, name, filters):
+        '''
+        Inputs:
+            `name` (dtype: str): A registered table
+            `filters` (dtype: dict): Partition filters from `partition_filters`
+
+        Returns: `files` (dtype: list) The `(path, partition)` pairs the query has to read
+        '''
+
+        table = self.tables[name]
+        if not table['partitioned'] or not filters:
+            return table['files']
+
+        return [(f, partition) for f, partition in table['files']
+                if all(matches(partition[column], filters.get(column, [])) for column in PARTITION_COLUMNS)]
+
+    def load_sqlite(self, name, files):
+        '''
+        Function Overview:
+            Inserts the files the query needs that are not loaded yet.  Rows loaded for earlier queries stay in
+            the table, which is safe because the query's own WHERE clause still filters them out.
+        '''
+
+        table = self.tables[name]
+        placeholders = ", ".join("?" for _ in table['columns'])
+        insert = 'INSERT INTO "{}" VALUES ({})'.format(name, placeholders)
+        rows_loaded = 0
+
+        for f, partition in files:
+            if f in self.loaded[name]:
+                continue
+            extra = [partition.get(column) for column in PARTITION_COLUMNS] if table['partitioned'] else []
+            rows = [list(record.values()) + extra for record in iter_rows(f)]
+            self.connection.executemany(insert, rows)
+            self.loaded[name].add(f)
+            rows_loaded += len(rows)
+
+        self.connection.commit()
+
+        return rows_loaded
+
+    def load_duckdb(self, name, files):
+        '''
+        Function Overview:
+            Points a view at exactly the files the query needs, read as strings with the partition columns taken
+            from the paths, so DuckDB scans them directly.
+        '''
+
+        table = self.tables[name]
+        hive = "true" if table['partitioned'] else "false"
+        string_columns = "{" + ", ".join("'{}': 'VARCHAR'".format(c) for c in PROCESSED_COLUMNS + ["run_run_errors"]) + "}"
+        projection = ", ".join(PROCESSED_COLUMNS[:-1] + ["coalesce(run_errors, run_run_errors) AS run_errors"])
+        partitions = ", dt, hr" if table['partitioned'] else ""
+        scans = []
+
+        for kind in ("csv", "json", "parquet"):
+            paths = [f for f, _ in files if (".parquet" in f if kind == "parquet" else ".csv" in f if kind == "csv"
+                                             else ".parquet" not in f and ".csv" not in f)]
+            if not paths:
+                continue
+            listing = "[" + ", ".join("'{}'".format(p.replace("'", "''")) for p in paths) + "]"
+            if kind == "csv":
+                source = "read_csv({}, all_varchar = true, union_by_name = true, hive_partitioning = {}, hive_types_autocast = false)".format(listing, hive)
+                scans.append("SELECT {}{} FROM {}".format(", ".join(PROCESSED_COLUMNS), partitions, source))
+            elif kind == "json":
+                source = "read_json({}, format = 'newline_delimited', columns = {}, hive_partitioning = {}, hive_types_autocast = false)".format(listing, string_columns, hive)
+                scans.append("SELECT {}{} FROM {}".format(projection, partitions, source))
+            else:
+                source = "read_parquet({}, union_by_name = true, hive_partitioning = {}, hive_types_autocast = false)".format(listing, hive)
+                scans.append("SELECT {}{} FROM {}".format(", ".join(PROCESSED_COLUMNS), partitions, source))
+
+        if not scans:
+            empty = ", ".join("CAST(NULL AS VARCHAR) AS {}".format(c) for c in table['columns'])
+            scans.append("SELECT {} WHERE false".format(empty))
+
+        self.connection.execute('CREATE OR REPLACE VIEW "{}" AS {}'.format(name, " UNION ALL BY NAME ".join(scans)))
+
+        return 0
+
+    def query(self, sql, parameters=()):
+        '''
+        Inputs:
+            `sql` (dtype: str): A query over registered tables
+            `parameters` (dtype: tuple): Query parameters
+
+        Returns: `(columns, rows)` The result's column names and a list of row tuples.  `last_stats` holds the
+            files scanned and pruned, rows loaded, and time spent loading and querying.
+        '''
+
+        filters = partition_filters(sql)
+        referenced = [name for name in self.tables if re.search(r'\b{}\b'.format(re.escape(name)), sql)]
+        stats = {"engine": self.engine, "files": 0, "files_pruned": 0, "rows_loaded": 0,
+                 "partition_filters": filters}
+
+        start = time.perf_counter()
+        with timer("local_query_load"):
+            for name in referenced:
+                files = self.select_files(name, filters)
+                stats['files'] += len(files)
+                stats['files_pruned'] += len(self.tables[name]['files']) - len(files)
+                load = self.load_duckdb if self.engine == "duckdb" else self.load_sqlite
+                stats['rows_loaded'] += load(name, files)
+        stats['load_seconds'] = round(time.perf_counter() - start, 4)
+
+        start = time.perf_counter()
+        with timer("local_query"):
+            cursor = self.connection.execute(sql, parameters)
+            rows = cursor.fetchall()
+            columns = [description[0] for description in cursor.description or []]
+        stats['query_seconds'] = round(time.perf_counter() - start, 4)
+        stats['rows'] = len(rows)
+
+        increment("local_query_files_pruned", stats['files_pruned'])
+        self.last_stats = stats
+
+        return columns, rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run SQL over local processed CDEvents with the Glue/Athena table schema")
+    parser.add_argument("sql", help="i.e. \"SELECT run_outcome, count(*) FROM processed GROUP BY 1\"")
+    parser.add_argument("--table", action="append", default=[], metavar="NAME=PATH",
+                        help="Register a table (default: processed=../simulated_data/simulated_processed_events.csv)")
+    parser.add_argument("--engine", choices=ENGINES, default=None)
+    parser.add_argument("--repeat", type=int, default=1, help="Run the query this many times and report each run")
+    args = parser.parse_args()
+
+    catalog = LocalCatalog(args.engine)
+    for table in args.table or ["processed=../simulated_data/simulated_processed_events.csv"]:
+        name, path = table.split("=", 1)
+        catalog.register(name, path)
+
+    for _ in range(args.repeat):
+        columns, rows = catalog.query(args.sql)
+        print(json.dumps(catalog.last_stats))
+
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+    print_summary("local_query.py")
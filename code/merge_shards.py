@@ -0,0 +1,195 @@
+import os
+import json
+import gzip
+import heapq
+import shutil
+import argparse
+import tempfile
+from itertools import islice
+from event_streams import iter_events
+from instrumentation import timer, increment, print_summary
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Merge shards of events into one stream in `context.timestamp` order.
+##
+## Generator shards (and the per-hour or per-worker files written downstream) are each in their own order, and
+## concatenating them gives lifecycle order, not time order.  `merge_shards` streams every shard at once and
+## merges them with a heap (`heapq.merge`), so only one event per shard is in memory at a time:
+##     for event in merge_shards(["shard-0.ndjson.gz", "shard-1.ndjson.gz", "part-00000.parquet"]):
+##         ...
+##
+## Shards are NDJSON or JSON arrays (optionally .gz), or Parquet, holding raw events (`context.timestamp`)
+## or processed events (`context_timestamp`).  A shard that is not already sorted is external-sorted first: it
+## is read in runs of `run_size` events, each run is sorted and spilled to a temporary NDJSON.gz file, and the
+## runs are merged along with the other shards, so memory stays bounded by `run_size` however big the shard is.
+## Timestamps are compared as strings, which sorts correctly for the `YYYY-MM-DD HH:MM:SS.ffffff` format.
+
+DEFAULT_RUN_SIZE = 100000
+
+def timestamp_key(event):
+    '''
+    Input: `event` (dtype: dict) A raw or processed event
+    Returns: `timestamp` (dtype: str) Its `context.timestamp` (raw) or `context_timestamp` (processed)
+    '''
+
+    context = event.get('context')
+    if context is not None:
+        return context['timestamp']
+
+    return event['context_timestamp']
+
+def iter_shard(path):
+    '''
+    Input: `path` (dtype: str): An NDJSON or JSON array file (optionally .gz), or a Parquet file
+    Returns: A generator of the shard's events, in file order
+    '''
+
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ValueError("Reading Parquet requires the `pyarrow` package (pip install pyarrow)")
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            for event in batch.to_pylist():
+                yield event
+        return
+
+    for event in iter_events(path):
+        yield event
+
+def is_sorted(events, key=timestamp_key):
+    '''
+    Inputs:
+        `events` (dtype: iterable): A stream of events
+        `key` (dtype: function): The sort key
+
+    Returns: `is_sorted` (dtype: bool) Whether the stream is already in order (stops at the first event out of order)
+    '''
+
+    previous = None
+    for event in events:
+        current = key(event)
+        if previous is not None and current < previous:
+            return False
+        previous = current
+
+    return True
+
+def spill_runs(events, directory, key=timestamp_key, run_size=DEFAULT_RUN_SIZE):
+    '''
+    Inputs:
+        `events` (dtype: iterable): A stream of events in any order
+        `directory` (dtype: str): Where to write the sorted runs
+        `key` (dtype: function): The sort key
+        `run_size` (dtype: int): Events per run (the most held in memory at once)
+
+    Returns: `paths` (dtype: list) The sorted NDJSON.gz run files
+    '''
+
+    events = iter(events)
+    paths = []
+
+    while True:
+        run = list(islice(events, run_size))
+        if not run:
+            break
+
+        run.sort(key=key)
+        handle, path = tempfile.mkstemp(suffix=".ndjson.gz", dir=directory)
+        os.close(handle)
+        ## Fast compression: the runs are read back once and deleted
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as outfile:
+            for event in run:
+                outfile.write(json.dumps(event, default=str))
+                outfile.write("\n")
+        paths.append(path)
+        increment("merge_runs_spilled")
+
+    return paths
+
+def merge_shards(paths, key=timestamp_key, presorted=None, run_size=DEFAULT_RUN_SIZE, temp_dir=None, stats=None):
+    '''
+    Inputs:
+        `paths` (dtype: list): Shard files (see `iter_shard`)
+        `key` (dtype: function): The sort key (defaults to the event timestamp)
+        `presorted` (dtype: bool): True if every shard is already sorted, False to external-sort every shard, or
+            None to check each shard with one streaming pass and only sort the ones that need it
+        `run_size` (dtype: int): Events per sorted run when a shard has to be sorted
+        `temp_dir` (dtype: str): Where to spill sorted runs (defaults to the system temp folder)
+        `stats` (dtype: dict): If given, filled in with {"shards", "sorted_shards", "runs_spilled", "events"}
+
+    Returns: A generator of every event from every shard, in `key` order.  Events with equal keys keep shard
+        order, then file order.
+    '''
+
+    stats = stats if stats is not None else {}
+    stats.update({"shards": len(paths), "sorted_shards": 0, "runs_spilled": 0, "events": 0})
+    spill_directory = None
+
+    try:
+        streams = []
+        for path in paths:
+            with timer("merge_check_sorted"):
+                shard_sorted = presorted if presorted is not None else is_sorted(iter_shard(path), key)
+
+            if shard_sorted:
+                stats['sorted_shards'] += 1
+                streams.append(iter_shard(path))
+                continue
+
+            if spill_directory is None:
+                spill_directory = tempfile.mkdtemp(prefix="cdevents-merge-", dir=temp_dir)
+            with timer("merge_spill"):
+                runs = spill_runs(iter_shard(path), spill_directory, key, run_size)
+            stats['runs_spilled'] += len(runs)
+            streams.extend(iter_events(run) for run in runs)
+
+        for event in heapq.merge(*streams, key=key):
+            stats['events'] += 1
+            yield event
+
+        increment("merge_events", stats['events'])
+
+    finally:
+        if spill_directory is not None:
+            shutil.rmtree(spill_directory, ignore_errors=True)
+
+def write_ndjson(events, path):
+    '''
+    Inputs:
+        `events` (dtype: iterable): A stream of events
+        `path` (dtype: str): The output file (gzip-compressed if it ends in .gz)
+
+    Returns: `count` (dtype: int) How many events were written
+    '''
+
+    count = 0
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as outfile:
+        for event in events:
+            outfile.write(json.dumps(event, default=str))
+            outfile.write("\n")
+            count += 1
+
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge event shards into one NDJSON stream in timestamp order")
+    parser.add_argument("shards", nargs="+", help="NDJSON/JSON (optionally .gz) or Parquet shard files")
+    parser.add_argument("--output", "-o", required=True, help="The merged NDJSON file (i.e. merged.ndjson.gz)")
+    parser.add_argument("--presorted", action="store_true", help="Skip the sortedness check (every shard is sorted)")
+    parser.add_argument("--sort-all", action="store_true", help="External-sort every shard without checking")
+    parser.add_argument("--run-size", type=int, default=DEFAULT_RUN_SIZE)
+    parser.add_argument("--temp-dir", default=None)
+    args = parser.parse_args()
+
+    presorted = True if args.presorted else False if args.sort_all else None
+    stats = {}
+    with timer("merge_total"):
+        write_ndjson(merge_shards(args.shards, presorted=presorted, run_size=args.run_size,
+                                  temp_dir=args.temp_dir, stats=stats), args.output)
+
+    print(json.dumps(stats, indent=4))
+    print_summary("merge_shards.py")
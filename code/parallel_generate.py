@@ -0,0 +1,364 @@
+import io
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from simulation_functions import create_events, flatten_event_entry
+from schemas import normalize_processed, PROCESSED_COLUMNS
+from instrumentation import timer, increment, print_summary
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Generate events in several processes and write them to disk from one, without pickling the events.
+##
+## `pipeline.py` overlaps generation with uploads using threads, but generation itself is CPU bound and the GIL
+## keeps it on one core.  `run_parallel` starts `processes` generator processes instead.  Sending millions of event
+## dicts back through a `multiprocessing.Queue` would pickle and unpickle every one of them, which costs more than
+## generating them, so each worker encodes its batch once, straight into a `multiprocessing.shared_memory`
+## segment laid out as:
+##     [raw JSON fragment][processed CSV rows][Arrow IPC stream of the processed columns (only with a Parquet path)]
+## and sends only the segment's name and section sizes.  The parent is the single writer: it copies the raw and
+## CSV sections from shared memory straight into the output files, reads the Arrow section in place (the record
+## batch's buffers point into the segment) for the Parquet writer, then unlinks the segment (see `SegmentWriter`).
+##
+## The outputs match what `simulate_events.py` writes: `simulated_raw_events.json` is a JSON array formatted
+## exactly like `json.dumps(all_events)`, and `simulated_processed_events.csv` has the `PROCESSED_COLUMNS` quoted
+## the way pandas quotes them.  Batches are written in the order they finish, not in the order they were started.
+##
+## At most `queue_size` segments wait for the writer at once; workers block on a full queue (backpressure), so
+## shared memory use stays bounded.  In the returned stats:
+##     `generate_seconds`/`encode_seconds` - summed over workers, so they grow with `processes`
+##     `producer_stall_seconds`            - time workers spent waiting for room on the queue (the writer is slower)
+##     `writer_stall_seconds`              - time the writer spent waiting for a batch (generation is slower)
+##     `handoff_bytes`                     - bytes passed through shared memory
+
+PROCESSES_ENV_VAR = "CDEVENTS_PROCESSES"
+PROCESSED_SCHEMA = pyarrow.schema([(column, pyarrow.string()) for column in PROCESSED_COLUMNS]) if pyarrow else None
+
+def encode_raw(events_list):
+    '''
+    Input: `events_list` (dtype: list) Raw events
+    Returns: `fragment` (dtype: bytes) The events as they appear inside `json.dumps(all_events)`, without the brackets
+    '''
+
+    return json.dumps(events_list)[1:-1].encode("utf-8")
+
+def encode_csv(records, header=False):
+    '''
+    Inputs:
+        `records` (dtype: list): Processed records with `PROCESSED_COLUMNS`
+        `header` (dtype: bool): Start with the header row
+
+    Returns: `rows` (dtype: bytes) CSV rows formatted like `DataFrame.to_csv(index=False)`
+    '''
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(PROCESSED_COLUMNS)
+    writer.writerows([record[column] for column in PROCESSED_COLUMNS] for record in records)
+
+    return buffer.getvalue().encode("utf-8")
+
+def processed_batch(records):
+    '''
+    Input: `records` (dtype: list) Processed records with `PROCESSED_COLUMNS`
+    Returns: `batch` (dtype: pyarrow.RecordBatch) The records as string columns
+
+    Function Overview:
+        Builds each column from a list; `RecordBatch.from_pylist` is roughly ten times slower for small batches.
+    '''
+
+    columns = [pyarrow.array([record[column] for record in records], pyarrow.string()) for column in PROCESSED_COLUMNS]
+
+    return pyarrow.RecordBatch.from_arrays(columns, schema=PROCESSED_SCHEMA)
+
+def write_ipc(view, batch):
+    '''
+    Inputs:
+        `view` (dtype: memoryview): Exactly the IPC stream's size, i.e. a slice of a shared memory segment
+        `batch` (dtype: pyarrow.RecordBatch)
+
+    Function Overview:
+        Writes the batch as an Arrow IPC stream in place.  Nothing that points into `view` outlives the call,
+        so the segment can be closed afterwards.
+    '''
+
+    target = pyarrow.FixedSizeBufferWriter(pyarrow.py_buffer(view))
+    with pyarrow.ipc.new_stream(target, batch.schema) as stream:
+        stream.write_batch(batch)
+    target.close()
+
+    return
+
+def publish(events_list, arrow=False):
+    '''
+    Inputs:
+        `events_list` (dtype: list): One generated batch of raw events
+        `arrow` (dtype: bool): Also write the processed columns as an Arrow IPC stream (for Parquet output)
+
+    Returns: `(name, raw_size, csv_size, ipc_size)` The shared memory segment holding the encoded batch
+
+    Function Overview:
+        Encodes the batch straight into a new shared memory segment.  The caller keeps the segment alive until
+        the writer unlinks it.
+    '''
+
+    records = [normalize_processed(flatten_event_entry(event)) for event in events_list]
+    raw = encode_raw(events_list)
+    rows = encode_csv(records)
+
+    batch = None
+    ipc_size = 0
+    if arrow:
+        batch = processed_batch(records)
+        sizer = pyarrow.MockOutputStream()
+        with pyarrow.ipc.new_stream(sizer, batch.schema) as stream:
+            stream.write_batch(batch)
+        ipc_size = sizer.size()
+
+    segment = shared_memory.SharedMemory(create=True, size=max(len(raw) + len(rows) + ipc_size, 1))
+    try:
+        segment.buf[:len(raw)] = raw
+        segment.buf[len(raw):len(raw) + len(rows)] = rows
+        if batch is not None:
+            write_ipc(segment.buf[len(raw) + len(rows):len(raw) + len(rows) + ipc_size], batch)
+        name = segment.name
+    except BaseException:
+        segment.close()
+        segment.unlink()
+        raise
+    segment.close()
+
+    return name, len(raw), len(rows), ipc_size
+
+def generator_process(worker, processes, num_batches, lifecycles_per_batch, arrow, handoff):
+    '''
+    Function Overview:
+        Runs in each worker process: generates and publishes batches `worker`, `worker + processes`, ... and
+        reports each one on `handoff`, then sends a final ("done", ...) message.
+    '''
+
+    stalled = 0.0
+    try:
+        for _ in range(worker, num_batches, processes):
+            start = time.perf_counter()
+            events_list, _ = create_events(lifecycles_per_batch)
+            generated = time.perf_counter()
+            name, raw_size, csv_size, ipc_size = publish(events_list, arrow)
+            encoded = time.perf_counter()
+
+            handoff.put(("batch", name, raw_size, csv_size, ipc_size, len(events_list), generated - start, encoded - generated))
+            stalled += time.perf_counter() - encoded
+    except Exception as e:
+        handoff.put(("error", worker, "{}: {}".format(type(e).__name__, e)))
+        return
+
+    handoff.put(("done", worker, stalled))
+
+class SegmentWriter():
+    def __init__(self, raw_path, processed_path, parquet_path=None, row_group_rows=100000, max_held=256):
+        '''
+        Inputs:
+            `raw_path` (dtype: str): Where to write the raw events as a JSON array
+            `processed_path` (dtype: str): Where to write the processed events as CSV
+            `parquet_path` (dtype: str): Also write the processed events to this Parquet file
+            `row_group_rows` (dtype: int): Rows per Parquet row group
+            `max_held` (dtype: int): Write a smaller row group once this many segments are held (each holds a file
+                descriptor open)
+
+        Returns: object (dtype: SegmentWriter) The single writer for segments from `publish`
+        '''
+
+        self.raw_file = open(raw_path, "wb")
+        self.csv_file = open(processed_path, "wb")
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(parquet_path, PROCESSED_SCHEMA) if parquet_path else None
+        self.row_group_rows = row_group_rows
+        self.max_held = max_held
+
+        ## Segments whose Arrow batches have not been written to Parquet yet, with the batches read from them
+        self.held = []
+        self.held_batches = []
+        self.held_rows = 0
+        self.first = True
+
+        self.raw_file.write(b"[")
+        self.csv_file.write(encode_csv([], header=True))
+
+        return
+
+    def write(self, name, raw_size, csv_size, ipc_size):
+        '''
+        Function Overview:
+            Copies the raw and CSV sections of a segment straight into the output files.  Without Parquet output
+            the segment is freed right away; otherwise its Arrow batch is read in place and the segment is held
+            until a full row group has been gathered, since tiny row groups make slow, bloated Parquet files.
+        '''
+
+        segment = shared_memory.SharedMemory(name=name)
+
+        if raw_size:
+            if not self.first:
+                self.raw_file.write(b", ")
+            self.raw_file.write(segment.buf[:raw_size])
+            self.first = False
+        self.csv_file.write(segment.buf[raw_size:raw_size + csv_size])
+
+        if self.parquet_writer is None or not ipc_size:
+            self.free(segment)
+            return
+
+        self.held.append(segment)
+        self.held_batches.extend(pyarrow.ipc.open_stream(pyarrow.py_buffer(segment.buf[raw_size + csv_size:raw_size + csv_size + ipc_size])))
+        self.held_rows = sum(batch.num_rows for batch in self.held_batches)
+
+        if self.held_rows >= self.row_group_rows or len(self.held) >= self.max_held:
+            self.write_row_group()
+
+        return
+
+    def write_row_group(self):
+        if self.held_batches:
+            self.parquet_writer.write_table(pyarrow.Table.from_batches(self.held_batches, PROCESSED_SCHEMA),
+                                            row_group_size=max(self.held_rows, 1))
+
+        ## Every Arrow buffer points into the held segments, so they must be gone before the segments are closed
+        self.held_batches = []
+        self.held_rows = 0
+        for segment in self.held:
+            self.free(segment)
+        self.held = []
+
+    def free(self, segment):
+        segment.close()
+        segment.unlink()
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.write_row_group()
+            self.parquet_writer.close()
+        self.raw_file.write(b"]")
+        self.raw_file.close()
+        self.csv_file.close()
+
+        return
+
+def run_parallel(num_batches, lifecycles_per_batch=5, processes=None, raw_path="simulated_raw_events.json",
+                 processed_path="simulated_processed_events.csv", parquet_path=None, queue_size=None):
+    '''
+    Inputs:
+        `num_batches` (dtype: int): How many batches to generate
+        `lifecycles_per_batch` (dtype: int): Event lifecycles per batch (the `num_events` of `create_events`)
+        `processes` (dtype: int): Number of generator processes (defaults to the number of CPUs)
+        `raw_path` (dtype: str): Where to write the raw events as a JSON array
+        `processed_path` (dtype: str): Where to write the processed events as CSV
+        `parquet_path` (dtype: str): Also write the processed events to this Parquet file (requires `pyarrow`)
+        `queue_size` (dtype: int): The most published batches waiting for the writer (defaults to 2 per process)
+
+    Returns: `stats` (dtype: dict)
+        {
+            "processes": 4,
+            "batches": 100,
+            "events": 2480,
+            "wall_seconds": 0.41,
+            "events_per_second": 6048.8,
+            "generate_seconds": 1.02,
+            "encode_seconds": 0.33,
+            "write_seconds": 0.02,
+            "producer_stall_seconds": 0.0,
+            "writer_stall_seconds": 0.35,
+            "handoff_bytes": 2095317
+        }
+    '''
+
+    if parquet_path is not None and pyarrow is None:
+        raise ValueError("Parquet output requires the `pyarrow` package (pip install pyarrow)")
+
+    processes = processes or os.cpu_count() or 1
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    handoff = context.Queue(maxsize=queue_size or 2 * processes)
+    stats = {"processes": processes, "batches": 0, "events": 0, "generate_seconds": 0.0, "encode_seconds": 0.0,
+             "write_seconds": 0.0, "producer_stall_seconds": 0.0, "writer_stall_seconds": 0.0, "handoff_bytes": 0}
+    errors = []
+
+    ## Workers must share the parent's resource tracker; their own would unlink segments still waiting on the queue
+    resource_tracker.ensure_running()
+    if parquet_path is not None:
+        ## The first `pyarrow.array` call imports pandas; do it once here so forked workers inherit it
+        processed_batch([])
+
+    wall_start = time.perf_counter()
+    workers = [context.Process(target=generator_process,
+                               args=(worker, processes, num_batches, lifecycles_per_batch, parquet_path is not None, handoff))
+               for worker in range(processes)]
+    for process in workers:
+        process.start()
+
+    writer = SegmentWriter(raw_path, processed_path, parquet_path)
+    with timer("parallel_generate"):
+        running = processes
+        while running:
+            start = time.perf_counter()
+            message = handoff.get()
+            stats['writer_stall_seconds'] += time.perf_counter() - start
+
+            if message[0] == "done":
+                stats['producer_stall_seconds'] += message[2]
+                running -= 1
+                continue
+            if message[0] == "error":
+                errors.append("worker {}: {}".format(message[1], message[2]))
+                running -= 1
+                continue
+
+            _, name, raw_size, csv_size, ipc_size, events, generate_seconds, encode_seconds = message
+            start = time.perf_counter()
+            writer.write(name, raw_size, csv_size, ipc_size)
+            stats['write_seconds'] += time.perf_counter() - start
+            stats['batches'] += 1
+            stats['events'] += events
+            stats['generate_seconds'] += generate_seconds
+            stats['encode_seconds'] += encode_seconds
+            stats['handoff_bytes'] += raw_size + csv_size + ipc_size
+
+        start = time.perf_counter()
+        writer.close()
+        stats['write_seconds'] += time.perf_counter() - start
+
+    for process in workers:
+        process.join()
+
+    if errors:
+        raise RuntimeError("Event generation failed in {} process(es): {}".format(len(errors), "; ".join(errors)))
+
+    wall_seconds = time.perf_counter() - wall_start
+    increment("parallel_batches", stats['batches'])
+
+    stats['wall_seconds'] = round(wall_seconds, 3)
+    stats['events_per_second'] = round(stats['events'] / wall_seconds, 1) if wall_seconds > 0 else 0.0
+    for name in ("generate_seconds", "encode_seconds", "write_seconds", "producer_stall_seconds", "writer_stall_seconds"):
+        stats[name] = round(stats[name], 3)
+
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate simulated CDEvents in several processes and write them to local files")
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--lifecycles-per-batch", type=int, default=5)
+    parser.add_argument("--processes", type=int, default=None, help="Generator processes (defaults to the number of CPUs)")
+    parser.add_argument("--raw", default="simulated_raw_events.json")
+    parser.add_argument("--processed", default="simulated_processed_events.csv")
+    parser.add_argument("--parquet", default=None, help="Also write the processed events to this Parquet file")
+    args = parser.parse_args()
+
+    stats = run_parallel(args.batches, args.lifecycles_per_batch, args.processes, args.raw, args.processed, args.parquet)
+    print(json.dumps(stats, indent=4))
+    print_summary("parallel_generate.py")
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from simulation_functions import create_events, send_events
+from instrumentation import timer, increment, print_summary
+
+## Overlap event generation with uploading.
+##
+## `create_and_send_events` generates a whole batch and only then uploads it, so the CPU sits idle during
+## uploads and the network sits idle during generation.  `run_pipeline` runs generator threads that put
+## batches on a bounded queue and uploader threads that take them off, so both happen at the same time and
+## a run takes roughly max(generate, upload) instead of generate + upload.
+##
+## When the uploaders fall behind, the queue fills up and generators block on `put` (backpressure), so
+## memory use is bounded by `queue_size` batches.  The returned stats show which side is the bottleneck:
+##     `producer_stall_seconds` - time generators spent waiting for room on the queue (uploads are slower)
+##     `consumer_stall_seconds` - time uploaders spent waiting for a batch (generation is slower)
+##     `max_queue_depth`/`mean_queue_depth` - queue depth seen by each put
+## `batches` and `events` only count uploads that succeeded.  A failed upload doesn't stop the run (so generators
+## are never left blocked), but once it finishes `run_pipeline` raises a RuntimeError naming how many batches
+## failed, chained to the first error.
+
+STOP = object()
+
+def s3_uploader(bucket_name=None, **send_options):
+    '''
+    Inputs:
+        `bucket_name` (dtype: str): The bucket to send to (defaults to `simulation_functions.get_bucket_name()`)
+        `send_options`: Extra keyword arguments for `send_events` (i.e. `layout`, `compression`)
+
+    Returns: `upload` (dtype: function) Uploads one batch with `send_events`
+    '''
+
+    def upload(events_list, ids_list):
+        if bucket_name is None:
+            return send_events(events_list, ids_list, **send_options)
+        return send_events(events_list, ids_list, bucket_name, **send_options)
+
+    return upload
+
+def sink_uploader(sink):
+    '''
+    Input: `sink` (dtype: Sink) Any sink from `sinks.py`
+    Returns: `upload` (dtype: function) Writes one batch to the sink.  Call `sink.close()` after the pipeline.
+    '''
+
+    def upload(events_list, ids_list):
+        for event in events_list:
+            sink.write(event)
+
+    return upload
+
+def run_pipeline(num_batches, lifecycles_per_batch=5, upload=None, generator_workers=1, uploader_workers=4,
+                 queue_size=8, collect=False, generate=create_events):
+    '''
+    Inputs:
+        `num_batches` (dtype: int): How many batches to generate
+        `lifecycles_per_batch` (dtype: int): Event lifecycles per batch (the `num_events` of `create_events`)
+        `upload` (dtype: function): Called as `upload(events_list, ids_list)` for each batch (defaults to
+            `s3_uploader()`)
+        `generator_workers` (dtype: int): Number of generator threads
+        `uploader_workers` (dtype: int): Number of uploader threads
+        `queue_size` (dtype: int): The most batches waiting to be uploaded at once
+        `collect` (dtype: bool): Also return every generated event (i.e. to write the local JSON/CSV files)
+        `generate` (dtype: function): The batch generator, called as `generate(lifecycles_per_batch)`
+
+    Returns: `(stats, events)` where `events` is the list of generated events if `collect` is set, otherwise None:
+        {
+            "batches": 100,
+            "events": 2480,
+            "wall_seconds": 31.2,
+            "events_per_second": 79.5,
+            "generate_seconds": 4.1,
+            "upload_seconds": 118.3,
+            "producer_stall_seconds": 27.0,
+            "consumer_stall_seconds": 0.3,
+            "max_queue_depth": 8,
+            "mean_queue_depth": 7.6,
+            "upload_errors": 0
+        }
+        `generate_seconds` and `upload_seconds` are summed over all threads.  Raises a RuntimeError if any batch
+        failed to upload.
+    '''
+
+    if upload is None:
+        upload = s3_uploader()
+
+    batches = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    remaining = [num_batches]
+    collected = []
+    errors = []
+    upload_failures = []
+    stats = {"batches": 0, "events": 0, "generate_seconds": 0.0, "upload_seconds": 0.0,
+             "producer_stall_seconds": 0.0, "consumer_stall_seconds": 0.0, "max_queue_depth": 0,
+             "queue_depth_total": 0, "upload_errors": 0}
+
+    def add(name, amount):
+        with lock:
+            stats[name] += amount
+
+    def generator():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            start = time.perf_counter()
+            try:
+                events_list, ids_list = generate(lifecycles_per_batch)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+            generated = time.perf_counter()
+
+            batches.put((events_list, ids_list))
+            stalled = time.perf_counter() - generated
+
+            depth = batches.qsize()
+            with lock:
+                stats['generate_seconds'] += generated - start
+                stats['producer_stall_seconds'] += stalled
+                stats['max_queue_depth'] = max(stats['max_queue_depth'], depth)
+                stats['queue_depth_total'] += depth
+                if collect:
+                    collected.extend(events_list)
+
+    def uploader():
+        while True:
+            start = time.perf_counter()
+            batch = batches.get()
+
+            ## The final wait for the STOP marker is not a real stall
+            if batch is STOP:
+                return
+            add("consumer_stall_seconds", time.perf_counter() - start)
+
+            events_list, ids_list = batch
+            start = time.perf_counter()
+            try:
+                upload(events_list, ids_list)
+            except Exception as e:
+                ## Keep draining so generators are never left blocked on a full queue
+                print("Upload failed:", e)
+                with lock:
+                    upload_failures.append((e, len(events_list)))
+                add("upload_errors", 1)
+                increment("pipeline_upload_errors")
+                add("upload_seconds", time.perf_counter() - start)
+                continue
+            add("upload_seconds", time.perf_counter() - start)
+            add("batches", 1)
+            add("events", len(events_list))
+
+    wall_start = time.perf_counter()
+
+    with timer("pipeline"):
+        generators = [threading.Thread(target=generator) for _ in range(generator_workers)]
+        uploaders = [threading.Thread(target=uploader) for _ in range(uploader_workers)]
+        for thread in generators + uploaders:
+            thread.start()
+
+        for thread in generators:
+            thread.join()
+        for _ in uploaders:
+            batches.put(STOP)
+        for thread in uploaders:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    if upload_failures:
+        raise RuntimeError("{} of {} batches ({} events) failed to upload; the first error: {}".format(
+            len(upload_failures), num_batches, sum(count for _, count in upload_failures),
+            upload_failures[0][0])) from upload_failures[0][0]
+
+    wall_seconds = time.perf_counter() - wall_start
+    increment("pipeline_batches", stats['batches'])
+
+    stats['mean_queue_depth'] = round(stats.pop('queue_depth_total') / float(num_batches), 2) if num_batches else 0.0
+    stats['wall_seconds'] = round(wall_seconds, 3)
+    stats['events_per_second'] = round(stats['events'] / wall_seconds, 1) if wall_seconds > 0 else 0.0
+    for name in ("generate_seconds", "upload_seconds", "producer_stall_seconds", "consumer_stall_seconds"):
+        stats[name] = round(stats[name], 3)
+
+    return stats, (collected if collect else None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate and upload simulated CDEvents with overlapping generation and I/O")
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--lifecycles-per-batch", type=int, default=5)
+    parser.add_argument("--generators", type=int, default=1)
+    parser.add_argument("--uploaders", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--sink", default=os.environ.get("CDEVENTS_SINK"),
+                        help="Write to a sink from `sinks.py` (i.e. ndjson:raw.ndjson) instead of one S3 object per event")
+    args = parser.parse_args()
+
+    sink = None
+    if args.sink:
+        from sinks import sink_from_url
+        sink = sink_from_url(args.sink)
+
+    stats, _ = run_pipeline(args.batches, args.lifecycles_per_batch,
+                            upload=sink_uploader(sink) if sink is not None else s3_uploader(),
+                            generator_workers=args.generators, uploader_workers=args.uploaders,
+                            queue_size=args.queue_size)
+    if sink is not None:
+        sink.close()
+
+    print(json.dumps(stats, indent=4))
+    print_summary("pipeline.py")
@@ -0,0 +1,295 @@
+import os
+import glob
+import time
+import hashlib
+import argparse
+import numpy
+import pandas as pd
+from pandas.api.types import union_categoricals
+from schemas import PROCESSED_COLUMNS, normalize_processed
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+## Load processed (flattened) CDEvents with explicit types.
+##
+## `pd.read_csv` on `simulated_processed_events.csv` infers an `object` column for everything, so every UUID and
+## every repeated source, type, task, and pipeline name is stored as its own Python string.  `load_processed`
+## reads CSV, NDJSON, or Parquet (a file or a folder of them) in chunks with a fixed schema:
+##     categoricals - the low-cardinality columns (versions, sources, types, tasks, pipelines, outcomes, errors)
+##     strings      - the id columns (Arrow-backed when pyarrow is installed)
+##     datetime64   - `context_timestamp`
+## and adds the `environment`, `user`, and `event_state` columns the notebook derives by hand, as categoricals.
+##
+## The typed result is cached next to the source as Feather (or Parquet) under `.cache/`, keyed on the source's
+## path, size, and modification time, so the next load is a single columnar read and any change to the source
+## invalidates the copy.  The copy holds the typed columns only; the derived columns are added after every load
+## (they take one pass over the categories), so loads with and without `derive` or `columns` share one copy:
+##     events = load_processed("../simulated_data/simulated_processed_events.csv")
+
+CATEGORICAL_COLUMNS = [
+    "context_version",
+    "context_source",
+    "context_type",
+    "subject_type",
+    "content_task",
+    "content_url",
+    "run_source",
+    "run_type",
+    "run_pipelineName",
+    "run_url",
+    "run_outcome",
+    "run_errors"
+]
+ID_COLUMNS = ["event_id", "context_id", "subject_id", "run_id"]
+TIMESTAMP_COLUMNS = ["context_timestamp"]
+DERIVED_COLUMNS = ["environment", "user", "event_state"]
+DERIVED_FROM = ["context_type", "context_source"]
+
+SOURCE_EXTENSIONS = (".csv", ".ndjson", ".json", ".parquet", ".ndjson.gz", ".json.gz", ".csv.gz")
+CACHE_FORMATS = {"feather": ".feather", "parquet": ".parquet"}
+
+def string_dtype():
+    return "string[pyarrow]" if pyarrow is not None else "string"
+
+def source_files(path):
+    '''
+    Input: `path` (dtype: str): A processed file, or a folder of them (searched recursively, i.e. partitioned output)
+    Returns: `files` (dtype: list) The files to read, sorted
+    '''
+
+    if os.path.isdir(path):
+        files = [name for name in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+                 if name.endswith(SOURCE_EXTENSIONS) and os.sep + ".cache" + os.sep not in name]
+        return sorted(files)
+
+    return [path]
+
+def fingerprint(files):
+    '''
+    Input: `files` (dtype: list): The source files
+    Returns: `fingerprint` (dtype: str) A short hash of every file's path, size, and modification time
+    '''
+
+    digest = hashlib.sha1()
+    for name in files:
+        stat = os.stat(name)
+        digest.update("{}|{}|{}\n".format(os.path.abspath(name), stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+
+    return digest.hexdigest()[:16]
+
+def apply_types(chunk, columns=None):
+    '''
+    Inputs:
+        `chunk` (dtype: pd.DataFrame): Processed events with any dtypes
+        `columns` (dtype: list): The columns to keep (defaults to every processed column)
+
+    Returns: `chunk` (dtype: pd.DataFrame) The chunk with the processed schema's dtypes
+    '''
+
+    columns = columns or PROCESSED_COLUMNS
+
+    for column in columns:
+        if column not in chunk.columns:
+            chunk[column] = None
+
+    chunk = chunk[columns].copy()
+
+    for column in columns:
+        if column in TIMESTAMP_COLUMNS:
+            chunk[column] = pd.to_datetime(chunk[column], format="mixed")
+        elif column in ID_COLUMNS:
+            chunk[column] = chunk[column].astype(string_dtype())
+        elif column in CATEGORICAL_COLUMNS and not isinstance(chunk[column].dtype, pd.CategoricalDtype):
+            chunk[column] = chunk[column].astype("category")
+
+    return chunk
+
+def derive_from_categories(column, function):
+    '''
+    Inputs:
+        `column` (dtype: pd.Series): A categorical column
+        `function` (dtype: function): Maps one category to a new value
+
+    Returns: `derived` (dtype: pd.Series) A categorical column, computed once per category rather than once per row
+    '''
+
+    mapped = [function(category) for category in column.cat.categories]
+    categories = pd.Index(mapped).unique()
+    code_map = numpy.append(categories.get_indexer(mapped), -1)  ## Missing values (code -1) stay missing
+
+    return pd.Series(pd.Categorical.from_codes(code_map[column.cat.codes.to_numpy()], categories=categories),
+                     index=column.index)
+
+def derive_columns(events):
+    '''
+    Input: `events` (dtype: pd.DataFrame): Typed processed events
+    Returns: `events` (dtype: pd.DataFrame) With `environment` and `event_state` (from `context_type`) and `user`
+        (from `context_source`) added as categoricals
+    '''
+
+    if "context_type" in events.columns:
+        events['environment'] = derive_from_categories(events['context_type'], lambda value: value.split(".")[0])
+        events['event_state'] = derive_from_categories(events['context_type'], lambda value: value.split(".")[-1])
+    if "context_source" in events.columns:
+        events['user'] = derive_from_categories(events['context_source'], lambda value: value.strip("/").split("/")[-1])
+
+    return events
+
+def read_chunks(path, chunksize=100000, columns=None):
+    '''
+    Inputs:
+        `path` (dtype: str): A processed CSV, NDJSON (optionally .gz), or Parquet file, or a folder of them
+        `chunksize` (dtype: int): Rows per chunk
+        `columns` (dtype: list): The columns to read (defaults to every processed column)
+
+    Returns: A generator of typed DataFrames of up to `chunksize` rows, so datasets larger than memory can be
+        aggregated one chunk at a time
+    '''
+
+    columns = columns or PROCESSED_COLUMNS
+
+    for name in source_files(path):
+        if name.endswith(".parquet"):
+            if pyarrow is None:
+                raise ValueError("Reading Parquet requires the `pyarrow` package (pip install pyarrow)")
+            parquet_file = pyarrow.parquet.ParquetFile(name)
+            available = [column for column in columns if column in parquet_file.schema_arrow.names]
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=available):
+                yield apply_types(batch.to_pandas(), columns)
+
+        elif ".csv" in name:
+            dtypes = {column: "category" for column in CATEGORICAL_COLUMNS if column in columns}
+            dtypes.update({column: "string" for column in ID_COLUMNS if column in columns})
+            for chunk in pd.read_csv(name, usecols=lambda column: column in columns, dtype=dtypes, chunksize=chunksize):
+                yield apply_types(chunk, columns)
+
+        else:
+            for chunk in pd.read_json(name, lines=True, dtype=False, chunksize=chunksize):
+                ## The Lambda writes `run_run_errors`, which `normalize_processed` folds into `run_errors`
+                if "run_run_errors" in chunk.columns:
+                    chunk = pd.DataFrame([normalize_processed(record) for record in chunk.to_dict("records")])
+                yield apply_types(chunk, columns)
+
+def select_columns(events, columns=None, derive=True):
+    '''
+    Inputs:
+        `events` (dtype: pd.DataFrame): Typed processed events, as read from the source or the cache
+        `columns`/`derive`: See `load_processed`
+
+    Returns: `events` (dtype: pd.DataFrame) With the derived columns added and only the requested columns kept
+    '''
+
+    if derive:
+        events = derive_columns(events)
+    if columns:
+        events = events[[column for column in columns + (DERIVED_COLUMNS if derive else []) if column in events.columns]]
+
+    return events
+
+def concat_chunks(chunks):
+    '''
+    Input: `chunks` (dtype: list): Typed DataFrames from `read_chunks`
+    Returns: `events` (dtype: pd.DataFrame) One DataFrame, with categorical columns kept categorical even when the
+        chunks saw different categories
+    '''
+
+    if not chunks:
+        return apply_types(pd.DataFrame(columns=PROCESSED_COLUMNS))
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+
+    combined = {}
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            combined[column] = pd.Series(union_categoricals([chunk[column] for chunk in chunks]))
+        else:
+            combined[column] = pd.concat([chunk[column] for chunk in chunks], ignore_index=True)
+
+    return pd.DataFrame(combined)
+
+def cache_path(path, files, cache_format="feather", cache_dir=None):
+    '''
+    Returns: `cache_path` (dtype: str) i.e. "../simulated_data/.cache/simulated_processed_events.csv-<fingerprint>.feather"
+    '''
+
+    source = os.path.abspath(path.rstrip(os.sep))
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(source) if not os.path.isdir(source) else source, ".cache")
+
+    return os.path.join(cache_dir, "{}-{}{}".format(os.path.basename(source), fingerprint(files), CACHE_FORMATS[cache_format]))
+
+def load_processed(path, columns=None, derive=True, cache=True, cache_format="feather", cache_dir=None, chunksize=100000):
+    '''
+    Inputs:
+        `path` (dtype: str): A processed CSV, NDJSON, or Parquet file, or a folder of them
+        `columns` (dtype: list): The processed columns to load (defaults to all of them)
+        `derive` (dtype: bool): Add the `environment`, `user`, and `event_state` columns
+        `cache` (dtype: bool): Read from, and write, a typed columnar copy (needs pyarrow)
+        `cache_format` (dtype: str): "feather" or "parquet"
+        `cache_dir` (dtype: str): Where to keep the copy (defaults to `.cache/` next to the source)
+        `chunksize` (dtype: int): Rows per chunk when reading the source
+
+    Returns: `events` (dtype: pd.DataFrame) The typed events.  `events.attrs['loaded_from']` is "cache" or "source".
+    '''
+
+    files = source_files(path)
+    cache = cache and pyarrow is not None
+
+    if cache:
+        cached = cache_path(path, files, cache_format, cache_dir)
+        if os.path.exists(cached):
+            read_columns = list(dict.fromkeys(columns + (DERIVED_FROM if derive else []))) if columns else None
+            if cache_format == "feather":
+                events = pyarrow.feather.read_table(cached, columns=read_columns).to_pandas()
+            else:
+                events = pd.read_parquet(cached, columns=read_columns)
+            events = select_columns(events, columns, derive)
+            events.attrs['loaded_from'] = "cache"
+            return events
+
+    events = concat_chunks(list(read_chunks(path, chunksize=chunksize)))
+
+    if cache:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+
+        ## Remove copies made from older versions of the source
+        stale_pattern = cached.rsplit("-", 1)[0] + "-*" + CACHE_FORMATS[cache_format]
+        for stale in glob.glob(stale_pattern):
+            os.remove(stale)
+
+        temp_path = cached + ".tmp"
+        if cache_format == "feather":
+            pyarrow.feather.write_feather(events, temp_path, compression="zstd")
+        else:
+            events.to_parquet(temp_path, index=False)
+        os.replace(temp_path, cached)
+
+    events = select_columns(events, columns, derive)
+    events.attrs['loaded_from'] = "source"
+
+    return events
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load processed CDEvents with explicit types and compare against pd.read_csv")
+    parser.add_argument("path", nargs="?", default="../simulated_data/simulated_processed_events.csv")
+    parser.add_argument("--cache-format", choices=list(CACHE_FORMATS), default="feather")
+    args = parser.parse_args()
+
+    def timed_load(label, function):
+        start = time.perf_counter()
+        frame = function()
+        print("{:<28}{:>10.3f} s {:>10.2f} MB".format(label, time.perf_counter() - start,
+                                                       frame.memory_usage(deep=True).sum() / 1e6))
+        return frame
+
+    if ".csv" in args.path and os.path.isfile(args.path):
+        timed_load("pd.read_csv (inferred)", lambda: pd.read_csv(args.path))
+    timed_load("load_processed (no cache)", lambda: load_processed(args.path, cache=False))
+    timed_load("load_processed (cold cache)", lambda: load_processed(args.path, cache_format=args.cache_format))
+    events = timed_load("load_processed (warm cache)", lambda: load_processed(args.path, cache_format=args.cache_format))
+    print(events.dtypes)
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from backfill_raw import fetch_raw_events, fetch_manifest
+from sqs_worker import message_references, SQS_BATCH_LIMIT
+from compression import put_arguments, extension, default_codec
+from key_layout import parse_partition, MANIFEST_PREFIX
+from validation import raw_event_validator
+from instrumentation import timer, increment, print_summary
+
+## Drain the dead-letter queue: reprocess what can be recovered and quarantine the rest.
+##
+## Messages that fail in `lambda_handler` (or `SQSWorker`) are retried until SQS moves them to the DLQ.
+## `DLQRedrive` empties it with several poller threads, fetching the raw objects on a shared thread pool, and
+## classifies every event each message refers to:
+##     recovered        - the event was fetched, passed validation, and was flattened
+##     missing_object   - the raw object (or batch manifest) no longer exists
+##     parse_error      - the message body, manifest, or raw object is not valid JSON / CDEvent binary, or the
+##                        event could not be flattened
+##     schema_violation - the event does not match the raw schema (see `validation.py`)
+##     no_events        - the message refers to nothing (i.e. S3's "s3:TestEvent"), so it is just deleted
+## Recovered events are buffered per poller and written as one NDJSON object per partition, like `SQSWorker`:
+##     processed/<partition>redrive-<run_id>-<n>.ndjson
+## and everything else is parked with the message it came from and the reason, one NDJSON object per class:
+##     quarantine/dlq/<classification>/redrive-<run_id>-<n>.ndjson
+## A message is only deleted from the DLQ once every outcome of it is written, so an interrupted run loses
+## nothing; its messages reappear once their visibility timeout runs out.  The run finishes with a report
+## (counts per class and the most common errors) written to `quarantine/dlq/report-<run_id>.json`.
+## `dry_run` classifies and reports without writing or deleting anything.  Each message is handled once per run,
+## so messages a poller has already seen (i.e. left behind by a dry run or a failed write) are not redriven again.
+## SQS can answer a receive with nothing while a large backlog is still queued, so a poller only stops once the
+## queue reports no visible messages, or after `empty_receives` receives in a row brought nothing new.
+
+CLASSIFICATIONS = ("recovered", "missing_object", "parse_error", "schema_violation", "no_events")
+MISSING_CODES = ("NoSuchKey", "(404)", "NoSuchBucket")
+
+def classify_error(error):
+    '''
+    Input: `error` (dtype: str) An error from `fetch_raw_events` or `fetch_manifest`
+    Returns: `classification` (dtype: str) "missing_object" or "parse_error"
+    '''
+
+    return "missing_object" if any(code in error for code in MISSING_CODES) else "parse_error"
+
+class DLQRedrive():
+    def __init__(self, sqs, s3, queue_url, bucket, pollers=8, fetch_workers=32, batch_size=1000,
+                 visibility_timeout=300, output_prefix="processed/", quarantine_prefix="quarantine/dlq/",
+                 compression=None, validate=True, dry_run=False, run_id=None, empty_receives=5):
+        '''
+        Inputs:
+            `sqs`: A boto3 SQS client or a `LocalSQS` (see `local_aws.py`)
+            `s3`: A boto3 S3 client or a `LocalS3`
+            `queue_url` (dtype: str): The dead-letter queue
+            `bucket` (dtype: str): The CDEvents bucket
+            `pollers` (dtype: int): Number of threads receiving from the DLQ
+            `fetch_workers` (dtype: int): Number of concurrent GETs, shared by all pollers
+            `batch_size` (dtype: int): Events each poller buffers before writing them and deleting their messages
+            `visibility_timeout` (dtype: int): How long received messages stay hidden while they are handled
+            `output_prefix` (dtype: str): The processed folder
+            `quarantine_prefix` (dtype: str): Where unrecoverable events and the report are written
+            `compression` (dtype: str): "none", "gzip", or "zstd" for the processed files (defaults to `CDEVENTS_COMPRESSION`)
+            `validate` (dtype: bool): Check events against the raw schema before flattening them
+            `dry_run` (dtype: bool): Only classify; write nothing and leave every message in the DLQ
+            `run_id` (dtype: str): Names the output files (a new uuid by default)
+            `empty_receives` (dtype: int): Stop a poller after this many receives in a row with no new messages
+
+        Returns: object (dtype: DLQRedrive) Call `run()` to drain the queue
+        '''
+
+        self.sqs = sqs
+        self.s3 = s3
+        self.queue_url = queue_url
+        self.bucket = bucket
+        self.pollers = pollers
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.output_prefix = output_prefix
+        self.quarantine_prefix = quarantine_prefix
+        self.compression = compression or default_codec()
+        self.validator = raw_event_validator() if validate else None
+        self.dry_run = dry_run
+        self.run_id = run_id or str(uuid.uuid4())
+        self.empty_receives = empty_receives
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.part_number = 0
+        self.seen = set()
+        self.errors = Counter()
+        self.stats = {"messages_received": 0, "messages_deleted": 0, "objects_written": 0, "write_failures": 0}
+        self.stats.update((name, 0) for name in CLASSIFICATIONS)
+
+        return
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+        increment("redrive_" + name, amount)
+
+    def next_part(self):
+        with self.lock:
+            self.part_number += 1
+            return self.part_number
+
+    def outcome(self, message, classification, error=None, key=None, event=None, violations=None):
+        '''
+        Returns: `outcome` (dtype: dict) A quarantine line for one event (or message) that could not be recovered
+        '''
+
+        with self.lock:
+            self.errors["{}: {}".format(classification, (error or "")[:200])] += 1
+
+        line = {"message_id": message['MessageId'], "classification": classification, "error": error, "key": key,
+                "receive_count": int(message.get('Attributes', {}).get('ApproximateReceiveCount', 0))}
+        if violations is not None:
+            line['violations'] = violations
+        if event is not None:
+            line['event'] = event
+        else:
+            line['body'] = message['Body']
+
+        return line
+
+    def expand(self, message):
+        '''
+        Input: `message` (dtype: dict) A DLQ message
+        Returns: `(keys, events, failures)` The raw keys and inline events the message refers to (with manifests
+            read), and quarantine lines for whatever could not be read
+        '''
+
+        try:
+            keys, events = message_references(message['Body'])
+        except (ValueError, KeyError, TypeError) as e:
+            return [], [], [self.outcome(message, "parse_error", "{}: {}".format(type(e).__name__, e))]
+
+        expanded = []
+        failures = []
+        for key in keys:
+            if not key.startswith(MANIFEST_PREFIX):
+                expanded.append(key)
+                continue
+
+            manifest, error = fetch_manifest(self.s3, self.bucket, key)
+            if error is not None:
+                failures.append(self.outcome(message, classify_error(error), error, key=key))
+            else:
+                expanded.extend(manifest['keys'])
+
+        return expanded, events, failures
+
+    def recover(self, message, key, event):
+        '''
+        Returns: `(record, failure)` The flattened event, or a quarantine line explaining why it was not recovered
+        '''
+
+        if self.validator is not None:
+            problems = self.validator.check(event)
+            if problems:
+                violations = [{"path": path, "error": error} for path, error in problems]
+                return None, self.outcome(message, "schema_violation", problems[0][1], key=key, event=event,
+                                          violations=violations)
+
+        try:
+            return normalize_processed(flatten_event_entry(event)), None
+        except (KeyError, TypeError, AttributeError) as e:
+            return None, self.outcome(message, "parse_error", "{}: {}".format(type(e).__name__, e), key=key, event=event)
+
+    def handle(self, messages, buffer):
+        '''
+        Inputs:
+            `messages` (dtype: list): Messages from one `receive_message` call
+            `buffer` (dtype: dict): The poller's buffer, added to in place:
+                {"processed": {partition: [records]}, "quarantine": {classification: [lines]}, "receipts": [...], "events": 0}
+        '''
+
+        expanded = [(message,) + self.expand(message) for message in messages]
+
+        all_keys = [key for _, keys, _, _ in expanded for key in keys]
+        fetched = dict((key, (key_events, error)) for key, key_events, error in
+                       self.executor.map(lambda key: fetch_raw_events(self.s3, self.bucket, key), all_keys))
+
+        for message, keys, events, failures in expanded:
+            ## A raw object may hold a whole batch of events, each recovered or quarantined on its own
+            results = []
+            for key in keys:
+                key_events, error = fetched[key]
+                if error is not None:
+                    failures.append(self.outcome(message, classify_error(error), error, key=key))
+                else:
+                    results.extend((key, event) for event in key_events)
+            results.extend((None, event) for event in events)
+
+            if not results and not failures:
+                self.count("no_events")
+
+            for key, event in results:
+                record, failure = self.recover(message, key, event)
+                if failure is not None:
+                    failures.append(failure)
+                    continue
+
+                buffer['processed'].setdefault((parse_partition(key) if key else None) or "", []).append(record)
+                buffer['events'] += 1
+                self.count("recovered")
+
+            for failure in failures:
+                buffer['quarantine'].setdefault(failure['classification'], []).append(failure)
+                buffer['events'] += 1
+                self.count(failure['classification'])
+
+            buffer['receipts'].append(message['ReceiptHandle'])
+
+        return
+
+    def write_ndjson(self, key, lines, compression):
+        with timer("json_dumps"):
+            body = "".join(json.dumps(line) + "\n" for line in lines)
+        put_args = put_arguments(body, compression, content_type="application/x-ndjson")
+
+        with timer("s3_put_batch"):
+            self.s3.put_object(Bucket=self.bucket, Key=key, **put_args)
+        self.count("objects_written")
+        increment("bytes_written", len(put_args['Body']))
+
+        return
+
+    def flush(self, buffer):
+        '''
+        Function Overview:
+            Writes the poller's recovered events and quarantine lines, then deletes the messages they came from.
+            If a write fails, the messages are left for their visibility timeout to run out.
+        '''
+
+        receipts = buffer['receipts']
+        processed, quarantine = buffer['processed'], buffer['quarantine']
+        buffer.update({"processed": {}, "quarantine": {}, "receipts": [], "events": 0})
+
+        if not receipts or self.dry_run:
+            return
+
+        part = self.next_part()
+        try:
+            for partition, records in processed.items():
+                self.write_ndjson("{}{}redrive-{}-{:05d}.ndjson{}".format(
+                    self.output_prefix, partition, self.run_id, part, extension(self.compression)), records, self.compression)
+            for classification, lines in quarantine.items():
+                self.write_ndjson("{}{}/redrive-{}-{:05d}.ndjson".format(
+                    self.quarantine_prefix, classification, self.run_id, part), lines, "none")
+        except (ClientError, OSError) as e:
+            print("Failed to write redrive part {}: {}".format(part, e))
+            self.count("write_failures")
+            return
+
+        for offset in range(0, len(receipts), SQS_BATCH_LIMIT):
+            entries = [{"Id": str(i), "ReceiptHandle": handle}
+                       for i, handle in enumerate(receipts[offset:offset + SQS_BATCH_LIMIT])]
+            with timer("sqs_delete_batch"):
+                response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            self.count("messages_deleted", len(response.get('Successful', [])))
+
+        return
+
+    def queue_empty(self):
+        attributes = self.sqs.get_queue_attributes(QueueUrl=self.queue_url,
+                                                   AttributeNames=["ApproximateNumberOfMessages"])['Attributes']
+
+        return attributes.get('ApproximateNumberOfMessages') == "0"
+
+    def poll(self):
+        buffer = {"processed": {}, "quarantine": {}, "receipts": [], "events": 0}
+        empty = 0
+
+        while True:
+            with timer("sqs_receive"):
+                response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=SQS_BATCH_LIMIT,
+                                                    WaitTimeSeconds=1, VisibilityTimeout=self.visibility_timeout,
+                                                    AttributeNames=["ApproximateReceiveCount"])
+            with self.lock:
+                messages = [message for message in response.get('Messages', []) if message['MessageId'] not in self.seen]
+                self.seen.update(message['MessageId'] for message in messages)
+            if not messages:
+                empty += 1
+                if empty >= self.empty_receives or self.queue_empty():
+                    break
+                continue
+            empty = 0
+
+            self.count("messages_received", len(messages))
+            self.handle(messages, buffer)
+            if buffer['events'] >= self.batch_size:
+                self.flush(buffer)
+
+        self.flush(buffer)
+
+        return
+
+    def report(self, seconds):
+        '''
+        Returns: `report` (dtype: dict) The run's counts and most common errors, also written to the quarantine prefix
+        '''
+
+        report = dict(self.stats)
+        report.update({"run_id": self.run_id, "dry_run": self.dry_run, "seconds": round(seconds, 3),
+                       "messages_per_second": round(self.stats['messages_received'] / seconds, 1) if seconds > 0 else 0.0,
+                       "top_errors": dict(self.errors.most_common(20))})
+
+        if not self.dry_run:
+            self.s3.put_object(Bucket=self.bucket, Key="{}report-{}.json".format(self.quarantine_prefix, self.run_id),
+                               Body=json.dumps(report, indent=4), ContentType="application/json")
+
+        return report
+
+    def run(self):
+        '''
+        Returns: `report` (dtype: dict)
+            {
+                "messages_received": 200000, "messages_deleted": 200000, "objects_written": 412, "write_failures": 0,
+                "recovered": 184211, "missing_object": 10230, "parse_error": 3310, "schema_violation": 2249,
+                "no_events": 0, "run_id": "...", "dry_run": false, "seconds": 61.2, "messages_per_second": 3267.9,
+                "top_errors": {"missing_object: ClientError: An error occurred (NoSuchKey) ...": 10230, ...}
+            }
+        '''
+
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            self.executor = executor
+            pollers = [threading.Thread(target=self.poll) for _ in range(self.pollers)]
+            for poller in pollers:
+                poller.start()
+            for poller in pollers:
+                poller.join()
+
+        return self.report(time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drain the CDEvents dead-letter queue: reprocess recoverable events and quarantine the rest")
+    parser.add_argument("--queue-url", required=True, help="The dead-letter queue")
+    parser.add_argument("--bucket", default=os.environ.get("CDEVENT_BUCKET"))
+    parser.add_argument("--pollers", type=int, default=8)
+    parser.add_argument("--fetch-workers", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--visibility-timeout", type=int, default=300)
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default=None)
+    parser.add_argument("--no-validate", action="store_true", help="Flatten events without checking the raw schema")
+    parser.add_argument("--dry-run", action="store_true", help="Classify and report without writing or deleting anything")
+    args = parser.parse_args()
+
+    import boto3
+
+    redrive = DLQRedrive(boto3.client("sqs"), boto3.client("s3"), args.queue_url, args.bucket, pollers=args.pollers,
+                         fetch_workers=args.fetch_workers, batch_size=args.batch_size,
+                         visibility_timeout=args.visibility_timeout, compression=args.compression,
+                         validate=not args.no_validate, dry_run=args.dry_run)
+
+    print(json.dumps(redrive.run(), indent=4))
+    print_summary("redrive_dlq.py")
@@ -0,0 +1,278 @@
+import json
+import time
+import heapq
+import argparse
+from event_streams import iter_events, event_timestamp
+from compression import put_arguments, extension
+from local_aws import LocalS3, s3_notification, sqs_lambda_event, load_lambda
+from instrumentation import timer, increment
+
+## Replay a captured raw dataset (i.e. `simulated_data/simulated_raw_events.json`) back into the
+## pipeline at a multiple of its original speed.
+##
+## Events are streamed from the file one at a time.  Captured files are not sorted (the simulator writes
+## whole lifecycles, which interleave in time), so events are reordered by timestamp through a heap that holds
+## up to `reorder_window` events, the same way `Scenario.timeline` in `scenarios.py` orders lifecycles.  Each
+## event is scheduled at `start + (timestamp - first_timestamp) / speed`, so the original inter-arrival times
+## are kept (speed=1) or compressed (speed=10, 100, 1000, ...).  Only events more than `reorder_window`
+## positions out of place are still out of order, and those are sent immediately.  The same file and speed
+## always produce the same schedule, which makes replays usable as repeatable ingest throughput tests.
+
+DEFAULT_REORDER_WINDOW = 10000
+
+def reorder(events, window):
+    '''
+    Inputs:
+        `events` (dtype: iterable): Raw CDEvent dictionaries
+        `window` (dtype: int): The most events to hold back (0 keeps file order)
+
+    Returns: A generator of `(timestamp, event)` pairs, sorted by timestamp within the window
+    '''
+
+    waiting = []
+    for sequence, event in enumerate(events):
+        heapq.heappush(waiting, (event_timestamp(event), sequence, event))
+        if len(waiting) > window:
+            timestamp, _, event = heapq.heappop(waiting)
+            yield timestamp, event
+
+    while waiting:
+        timestamp, _, event = heapq.heappop(waiting)
+        yield timestamp, event
+
+class ObjectStoreReplaySink():
+    def __init__(self, s3_client, bucket, prefix="raw/", compression="none"):
+        '''
+        Inputs:
+            `s3_client`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The bucket to write raw events to
+            `prefix` (dtype: str): The folder raw events are written under
+            `compression` (dtype: str): "none", "gzip", or "zstd" (see `compression.py`)
+
+        Overview:
+            Writes each replayed event as `<prefix><event_id>.json`, exactly like `send_events` in
+            `simulation_functions.py`, which in turn triggers the S3 -> SQS -> Lambda path.
+        '''
+
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.compression = compression
+
+        return
+
+    def write(self, event):
+        key = "{}{}.json{}".format(self.prefix, event['event_id'], extension(self.compression))
+        put_args = put_arguments(json.dumps(event), self.compression)
+
+        with timer("s3_put"):
+            self.s3.put_object(Bucket=self.bucket, Key=key, **put_args)
+
+        return key
+
+    def close(self):
+        return
+
+class QueueReplaySink():
+    def __init__(self, sqs_client, queue_url, batch_size=10):
+        '''
+        Inputs:
+            `sqs_client`: A boto3 SQS client or a `LocalSQS` (see `local_aws.py`)
+            `queue_url` (dtype: str): The queue to send events to
+            `batch_size` (dtype: int): How many events to send per `send_message_batch` call (max 10)
+
+        Overview:
+            Sends each replayed event as the body of an SQS message, batching up to 10 per request.
+        '''
+
+        self.sqs = sqs_client
+        self.queue_url = queue_url
+        self.batch_size = min(batch_size, 10)
+        self.pending = []
+
+        return
+
+    def write(self, event):
+        self.pending.append({"Id": str(len(self.pending)), "MessageBody": json.dumps(event)})
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with timer("sqs_send_batch"):
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=self.pending)
+
+        if response.get('Failed'):
+            increment("replay_send_failures", len(response['Failed']))
+        self.pending = []
+
+        return
+
+    def close(self):
+        self.flush()
+
+        return
+
+class LambdaReplaySink():
+    def __init__(self, s3_client, bucket, prefix="raw/", compression="none"):
+        '''
+        Inputs:
+            `s3_client`: The object store the Lambda reads raw events from (usually a `LocalS3`)
+            `bucket` (dtype: str): The bucket to use
+            `prefix` (dtype: str): The folder raw events are written under
+            `compression` (dtype: str): "none", "gzip", or "zstd" for the raw objects
+
+        Overview:
+            Writes each raw event to the object store, then calls `lambda_handler` directly with the same
+            SQS-wrapped S3 notification it would receive in AWS.  This exercises the whole Lambda path
+            (GET, flatten, PUT) in-process, with no AWS services involved.
+        '''
+
+        self.raw_sink = ObjectStoreReplaySink(s3_client, bucket, prefix, compression)
+        self.bucket = bucket
+        self.lambda_function = load_lambda(s3_client, bucket)
+
+        return
+
+    def write(self, event):
+        key = self.raw_sink.write(event)
+        lambda_event = sqs_lambda_event([s3_notification(self.bucket, key)])
+
+        return self.lambda_function.lambda_handler(lambda_event, None)
+
+    def close(self):
+        return
+
+def replay_events(events, sink, speed=1.0, limit=None, clock=time.monotonic, sleep=time.sleep,
+                  reorder_window=DEFAULT_REORDER_WINDOW):
+    '''
+    Inputs:
+        `events` (dtype: iterable): Raw CDEvent dictionaries, usually from `iter_events`
+        `sink`: Any object with `write(event)` and `close()` methods (see the `*ReplaySink` classes above)
+        `speed` (dtype: float): The replay speed multiple.  `1` keeps the original inter-arrival times,
+            `100` replays 100x faster, and `None` or `0` sends events as fast as the sink accepts them.
+        `limit` (dtype: int): Stop after this many events (optional)
+        `clock`/`sleep`: Time functions, replaceable for testing
+        `reorder_window` (dtype: int): How many events to hold back to send them in timestamp order
+
+    Returns: `stats` (dtype: dict) A summary of the replay:
+        {
+            "events": 500,
+            "wall_seconds": 1.52,
+            "events_per_second": 328.9,
+            "dataset_seconds": 151.3,
+            "max_lag_seconds": 0.004,
+            "late_events": 3,
+            "out_of_order_events": 120
+        }
+        `max_lag_seconds` is how far behind schedule the sink fell at its worst, and `late_events` counts
+        events that were sent more than 10 ms after their scheduled time.  `dataset_seconds` is the span from
+        the earliest to the latest timestamp, and `out_of_order_events` counts events that were still sent
+        after a later one (more than `reorder_window` positions out of place).
+
+    Function Overview:
+        This function paces events according to their `context.timestamp` (see the module comment above) and
+        hands each one to `sink.write`.
+    '''
+
+    throttled = bool(speed)
+
+    first_timestamp = None
+    previous_timestamp = None
+    earliest = latest = None
+    start = clock()
+
+    sent = 0
+    max_lag = 0.0
+    late_events = 0
+    out_of_order = 0
+
+    try:
+        for timestamp, event in reorder(events, reorder_window):
+            if limit is not None and sent >= limit:
+                break
+
+            if first_timestamp is None:
+                first_timestamp = earliest = latest = timestamp
+            if previous_timestamp is not None and timestamp < previous_timestamp:
+                out_of_order += 1
+            previous_timestamp = timestamp
+            earliest, latest = min(earliest, timestamp), max(latest, timestamp)
+
+            if throttled:
+                target = start + max((timestamp - first_timestamp).total_seconds(), 0.0) / speed
+                delay = target - clock()
+
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+                    if -delay > 0.01:
+                        late_events += 1
+
+            sink.write(event)
+            sent += 1
+            increment("events_replayed")
+    finally:
+        sink.close()
+
+    wall_seconds = clock() - start
+    dataset_seconds = (latest - earliest).total_seconds() if sent else 0.0
+
+    stats = {
+        "events": sent,
+        "wall_seconds": round(wall_seconds, 3),
+        "events_per_second": round(sent / wall_seconds, 1) if wall_seconds > 0 else float(sent),
+        "dataset_seconds": round(dataset_seconds, 3),
+        "max_lag_seconds": round(max_lag, 4),
+        "late_events": late_events,
+        "out_of_order_events": out_of_order
+    }
+
+    return stats
+
+def build_sink(args):
+    '''
+    Input: `args` (dtype: argparse.Namespace) The parsed command line arguments
+    Returns: The sink selected with `--sink`
+    '''
+
+    if args.sink == "local-s3":
+        return ObjectStoreReplaySink(LocalS3(args.root), args.bucket, args.prefix, args.compression)
+
+    if args.sink == "lambda":
+        return LambdaReplaySink(LocalS3(args.root), args.bucket, args.prefix, args.compression)
+
+    import boto3
+
+    if args.sink == "s3":
+        return ObjectStoreReplaySink(boto3.client("s3"), args.bucket, args.prefix, args.compression)
+
+    return QueueReplaySink(boto3.client("sqs"), args.queue_url)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay raw CDEvents into the pipeline at N times their original speed")
+    parser.add_argument("path", nargs="?", default="../simulated_data/simulated_raw_events.json",
+                        help="A raw events file (JSON array or NDJSON, optionally .gz)")
+    parser.add_argument("--speed", default="100", help="Replay speed multiple, or 'max' to send as fast as possible")
+    parser.add_argument("--sink", choices=["local-s3", "lambda", "s3", "sqs"], default="local-s3")
+    parser.add_argument("--root", default=None, help="Directory for the local object store (local-s3 and lambda sinks)")
+    parser.add_argument("--bucket", default="cdevents-local")
+    parser.add_argument("--prefix", default="raw/")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none")
+    parser.add_argument("--queue-url", default=None, help="SQS queue URL (sqs sink)")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--reorder-window", type=int, default=DEFAULT_REORDER_WINDOW,
+                        help="Events held back to send them in timestamp order (0 keeps file order)")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    stats = replay_events(iter_events(args.path), build_sink(args), speed=speed, limit=args.limit,
+                          reorder_window=args.reorder_window)
+
+    print(json.dumps(stats, indent=4))
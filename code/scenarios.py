@@ -0,0 +1,420 @@
+import json
+import time
+import heapq
+import random
+import argparse
+import threading
+from copy import deepcopy
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+from simulation_functions import create_event_lifecycle
+from event_streams import parse_timestamp
+from local_aws import LocalS3, LocalSQS
+from sqs_worker import SQSWorker
+from sketches import TDigest
+from instrumentation import timer, increment, print_summary
+
+## Failure scenarios for stress-testing the ingest path.
+##
+## `PipelineRun`/`TaskRun` draw every outcome independently, so generated data never has correlated incidents,
+## and every generated event is well-formed and delivered once.  A `Scenario` spreads event lifecycles over a
+## simulated time span (`duration` seconds starting at `start`, with Poisson arrivals at `lifecycles_per_second`),
+## yields the events in timestamp order, and injects:
+##     storms     - `FailureStorm`s: for a time window, finished runs matching a pipeline/environment/run type get
+##                  the same outcome and error (i.e. "Timeout during execution" on pipeline3 for 10 minutes)
+##     malformed  - payloads the ingest path has to reject: a required field missing, a field of the wrong type,
+##                  a value outside its enum, an unparseable timestamp, or truncated JSON (`MALFORMED_KINDS`)
+##     oversized  - events padded past SQS's 256 KiB message limit (`oversized_bytes`)
+##     duplicates - the same event delivered again a few deliveries later
+## Scenarios can be written as JSON for the CLI:
+##     {"duration": 3600, "lifecycles_per_second": 0.5, "malformed_rate": 0.01, "duplicate_rate": 0.05,
+##      "storms": [{"start": 600, "duration": 600, "pipeline": "pipeline3", "error": "Timeout during execution"}]}
+##
+## `run_stress` pushes a scenario's deliveries through the local SQS path (a queue with a dead-letter queue and
+## an `SQSWorker`) and reports how throughput, latency, retries, quarantining, and dead-lettering change against a
+## clean run.  Malformed payloads that parse are quarantined by the worker's schema validation; truncated ones
+## can't be parsed, so they are retried until they are dead-lettered.
+
+MALFORMED_KINDS = ("missing_field", "wrong_type", "bad_enum", "bad_timestamp", "truncated")
+DEFAULT_OVERSIZED_BYTES = 300 * 1024
+
+def run_entry(event):
+    '''
+    Input: `event` (dtype: dict) A raw CDEvent entry
+    Returns: `run` (dtype: dict) Its `pipelineRun` or `taskRun` section, or None
+    '''
+
+    content = event['subject']['content']
+
+    return content.get('pipelineRun') or content.get('taskRun')
+
+class FailureStorm():
+    def __init__(self, start, duration, error="Timeout during execution", outcome="error", pipeline=None,
+                 environment=None, run_type=None, probability=1.0):
+        '''
+        Inputs:
+            `start` (dtype: float): Seconds after the scenario's start when the storm begins
+            `duration` (dtype: float): How long it lasts, in seconds
+            `error` (dtype: str): The `run_errors` every affected run gets
+            `outcome` (dtype: str): The outcome every affected run gets ("error" or "failure")
+            `pipeline`/`environment`/`run_type` (dtype: str): Only affect matching runs (all runs if None)
+            `probability` (dtype: float): The share of matching finished runs that are affected
+
+        Returns: object (dtype: FailureStorm)
+        '''
+
+        self.start = start
+        self.duration = duration
+        self.error = error
+        self.outcome = outcome
+        self.pipeline = pipeline
+        self.environment = environment
+        self.run_type = run_type
+        self.probability = probability
+
+        return
+
+    def matches(self, event, offset):
+        '''
+        Inputs:
+            `event` (dtype: dict): A raw CDEvent entry
+            `offset` (dtype: float): Seconds between the scenario's start and the event's timestamp
+
+        Returns: `matches` (dtype: bool) Whether the event is a finished run inside this storm
+        '''
+
+        if not self.start <= offset < self.start + self.duration:
+            return False
+
+        run = run_entry(event)
+        if run is None or 'outcome' not in run:
+            return False
+
+        return ((self.pipeline is None or run['pipelineName'] == self.pipeline) and
+                (self.environment is None or event['context']['source'].split("/")[1] == self.environment) and
+                (self.run_type is None or run['type'] == self.run_type))
+
+    def apply(self, event):
+        run = run_entry(event)
+        run['outcome'] = self.outcome
+        run['run_errors'] = self.error
+
+        return
+
+class Scenario():
+    def __init__(self, duration=3600, lifecycles_per_second=0.5, start=None, storms=(), malformed_rate=0.0,
+                 oversized_rate=0.0, duplicate_rate=0.0, malformed_kinds=MALFORMED_KINDS,
+                 oversized_bytes=DEFAULT_OVERSIZED_BYTES, duplicate_delay=50, seed=None):
+        '''
+        Inputs:
+            `duration` (dtype: float): The simulated time span, in seconds
+            `lifecycles_per_second` (dtype: float): The mean rate event lifecycles start at, in simulated time
+            `start` (dtype: datetime): When the simulated span starts (defaults to now)
+            `storms` (dtype: list): `FailureStorm`s
+            `malformed_rate`/`oversized_rate`/`duplicate_rate` (dtype: float): The share of deliveries affected
+            `malformed_kinds` (dtype: list): The kinds of malformed payload to pick from (see `MALFORMED_KINDS`)
+            `oversized_bytes` (dtype: int): How much padding oversized events get
+            `duplicate_delay` (dtype: int): Duplicates are delivered up to this many deliveries after the original
+            `seed` (dtype: int): Makes the generated events and injected faults repeatable (except for the ids)
+
+        Returns: object (dtype: Scenario) Iterate over `deliveries()`; `faults` counts what was injected
+        '''
+
+        self.duration = duration
+        self.lifecycles_per_second = lifecycles_per_second
+        self.start = start or datetime.now()
+        self.storms = list(storms)
+        self.malformed_rate = malformed_rate
+        self.oversized_rate = oversized_rate
+        self.duplicate_rate = duplicate_rate
+        self.malformed_kinds = list(malformed_kinds)
+        self.oversized_bytes = oversized_bytes
+        self.duplicate_delay = duplicate_delay
+        self.seed = seed
+
+        self.faults = Counter()
+        self.faulty_ids = {}    ## event_id -> the faults injected into that event
+
+        return
+
+    @classmethod
+    def from_dict(cls, spec):
+        '''
+        Input: `spec` (dtype: dict) Scenario settings, with `storms` as a list of `FailureStorm` settings
+        Returns: object (dtype: Scenario)
+        '''
+
+        spec = dict(spec)
+        spec['storms'] = [FailureStorm(**storm) for storm in spec.get('storms', [])]
+        if isinstance(spec.get('start'), str):
+            spec['start'] = parse_timestamp(spec['start'])
+
+        return cls(**spec)
+
+    def timeline(self, rng):
+        '''
+        Input: `rng` (dtype: random.Random)
+        Returns: A generator of raw events in timestamp order, with lifecycles moved onto the simulated span
+        '''
+
+        waiting = []
+        sequence = 0
+        offset = 0.0
+
+        while True:
+            offset += rng.expovariate(self.lifecycles_per_second)
+            if offset >= self.duration:
+                break
+
+            lifecycle, _ = create_event_lifecycle([], [])
+            begins = self.start + timedelta(seconds=offset)
+            first = parse_timestamp(lifecycle[0]['context']['timestamp'])
+
+            ## Everything that happened before this lifecycle started can go out now
+            while waiting and waiting[0][0] <= begins:
+                yield heapq.heappop(waiting)[2]
+
+            for event in lifecycle:
+                timestamp = begins + (parse_timestamp(event['context']['timestamp']) - first)
+                event['context']['timestamp'] = str(timestamp)
+                heapq.heappush(waiting, (timestamp, sequence, event))
+                sequence += 1
+
+        while waiting:
+            yield heapq.heappop(waiting)[2]
+
+    def record(self, event_id, fault):
+        self.faults[fault] += 1
+        self.faulty_ids.setdefault(event_id, []).append(fault)
+
+    def malformed(self, event, kind):
+        '''
+        Inputs:
+            `event` (dtype: dict): A raw CDEvent entry
+            `kind` (dtype: str): One of `MALFORMED_KINDS`
+
+        Returns: `payload` A broken copy of the event (dtype: dict), or for "truncated", its JSON cut short (dtype: str)
+        '''
+
+        if kind == "truncated":
+            body = json.dumps(event)
+            return body[:len(body) // 2]
+
+        broken = deepcopy(event)
+        if kind == "missing_field":
+            del broken['context']['timestamp']
+        elif kind == "wrong_type":
+            broken['context']['version'] = 2
+        elif kind == "bad_enum":
+            broken['subject']['type'] = "jobRun"
+        elif kind == "bad_timestamp":
+            broken['context']['timestamp'] = "yesterday"
+        else:
+            raise ValueError("Unknown malformed kind {}".format(kind))
+
+        return broken
+
+    def deliveries(self):
+        '''
+        Returns: A generator of payloads to deliver: raw events (dtype: dict), or broken JSON (dtype: str) for
+            "truncated" malformed payloads.  Duplicates are the same event yielded again.
+        '''
+
+        rng = random.Random(self.seed)
+        if self.seed is not None:
+            random.seed(self.seed)
+            np.random.seed(self.seed)
+
+        delivered = 0
+        duplicates = []
+
+        for event in self.timeline(rng):
+            offset = (parse_timestamp(event['context']['timestamp']) - self.start).total_seconds()
+            for storm in self.storms:
+                if storm.matches(event, offset) and rng.random() < storm.probability:
+                    storm.apply(event)
+                    self.record(event['event_id'], "storm")
+                    break
+
+            if self.oversized_rate and rng.random() < self.oversized_rate:
+                event['subject']['content']['logs'] = "x" * self.oversized_bytes
+                self.record(event['event_id'], "oversized")
+
+            if self.malformed_rate and rng.random() < self.malformed_rate:
+                kind = rng.choice(self.malformed_kinds)
+                self.record(event['event_id'], "malformed_" + kind)
+                payload = self.malformed(event, kind)
+            else:
+                payload = event
+
+            if self.duplicate_rate and rng.random() < self.duplicate_rate:
+                heapq.heappush(duplicates, (delivered + rng.randint(1, self.duplicate_delay), delivered, payload))
+                self.record(event['event_id'], "duplicate")
+
+            while duplicates and duplicates[0][0] <= delivered:
+                yield heapq.heappop(duplicates)[2]
+            yield payload
+            delivered += 1
+
+        while duplicates:
+            yield heapq.heappop(duplicates)[2]
+
+class RecordingS3():
+    '''
+    Passes every call through to an S3 client, noting when each processed event is first written.
+    '''
+
+    def __init__(self, s3, prefix="processed/"):
+        self.s3 = s3
+        self.prefix = prefix
+        self.written_at = {}
+        self.lock = threading.Lock()
+
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+    def put_object(self, **kwargs):
+        response = self.s3.put_object(**kwargs)
+        if not kwargs['Key'].startswith(self.prefix):
+            return response
+
+        now = time.time()
+        body = kwargs.get('Body', b"")
+        with self.lock:
+            for line in (body.decode("utf-8") if isinstance(body, bytes) else body).splitlines():
+                if line.strip():
+                    self.written_at.setdefault(json.loads(line)['event_id'], now)
+
+        return response
+
+def delivery_body(payload):
+    return payload if isinstance(payload, str) else json.dumps(payload)
+
+def run_stress(deliveries, max_receive_count=3, visibility_timeout=1, poller_threads=4, batch_size=500,
+               max_batch_wait=0.5, timeout=300):
+    '''
+    Inputs:
+        `deliveries` (dtype: iterable): Payloads from `Scenario.deliveries()` (or any raw events)
+        `max_receive_count` (dtype: int): Receives before a message is moved to the dead-letter queue
+        `visibility_timeout` (dtype: float): How long a failed message stays hidden before its retry
+        `poller_threads`/`batch_size`/`max_batch_wait`: `SQSWorker` settings
+        `timeout` (dtype: float): Give up waiting for the queue to drain after this many seconds
+
+    Returns: `stats` (dtype: dict)
+        {
+            "deliveries": 1210, "send_rejected": 12, "messages_sent": 1198, "send_seconds": 0.09,
+            "drain_seconds": 4.31, "events_written": 1154, "unique_events_written": 1100,
+            "duplicates_written": 54, "events_quarantined": 18, "messages_failed": 132, "dead_lettered": 44,
+            "events_per_second": 267.7, "latency_ms": {"p50": 512.0, "p95": 1031.2, "p99": 3210.9, "max": 3544.0}
+        }
+        `send_rejected` counts payloads SQS refused (too large); `messages_failed` counts every failed receive,
+        so a message that is retried until it is dead-lettered counts `max_receive_count` times.
+    '''
+
+    from botocore.exceptions import ClientError
+
+    sqs = LocalSQS()
+    dead_letter_url = sqs.create_queue(QueueName="cdevents-dlq")['QueueUrl']
+    dead_letter_arn = sqs.get_queue_attributes(QueueUrl=dead_letter_url)['Attributes']['QueueArn']
+    queue_url = sqs.create_queue(QueueName="cdevents", Attributes={
+        "VisibilityTimeout": str(visibility_timeout),
+        "RedrivePolicy": json.dumps({"deadLetterTargetArn": dead_letter_arn, "maxReceiveCount": str(max_receive_count)})
+    })['QueueUrl']
+    s3 = RecordingS3(LocalS3())
+
+    stats = {"deliveries": 0, "send_rejected": 0, "messages_sent": 0}
+    sent_at = {}
+
+    worker = SQSWorker(sqs, s3, queue_url, "bucket", poller_threads=poller_threads, wait_time=1,
+                       visibility_timeout=visibility_timeout, batch_size=batch_size, max_batch_wait=max_batch_wait,
+                       compression="none")
+    worker_stats = {}
+    worker_thread = threading.Thread(target=lambda: worker_stats.update(worker.run()))
+
+    start = time.perf_counter()
+    worker_thread.start()
+
+    with timer("stress_send"):
+        for payload in deliveries:
+            stats['deliveries'] += 1
+            try:
+                sqs.send_message(QueueUrl=queue_url, MessageBody=delivery_body(payload))
+            except ClientError:
+                stats['send_rejected'] += 1
+                continue
+            stats['messages_sent'] += 1
+            if isinstance(payload, dict) and 'event_id' in payload:
+                sent_at.setdefault(payload['event_id'], time.time())
+    stats['send_seconds'] = round(time.perf_counter() - start, 3)
+
+    ## Wait until every message was deleted or dead-lettered
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)['Attributes']
+        if attributes['ApproximateNumberOfMessages'] == "0" and attributes['ApproximateNumberOfMessagesNotVisible'] == "0":
+            break
+        time.sleep(0.05)
+    worker.stop()
+    worker_thread.join()
+    drain_seconds = time.perf_counter() - start
+
+    latencies = TDigest()
+    for event_id, written in s3.written_at.items():
+        if event_id in sent_at:
+            latencies.add((written - sent_at[event_id]) * 1000.0)
+
+    dead_lettered = int(sqs.get_queue_attributes(QueueUrl=dead_letter_url)['Attributes']['ApproximateNumberOfMessages'])
+    increment("stress_deliveries", stats['deliveries'])
+
+    stats.update({
+        "drain_seconds": round(drain_seconds, 3),
+        "events_written": worker_stats.get('events_written', 0),
+        "unique_events_written": len(s3.written_at),
+        "duplicates_written": worker_stats.get('events_written', 0) - len(s3.written_at),
+        "events_quarantined": worker_stats.get('events_quarantined', 0),
+        "messages_failed": worker_stats.get('messages_failed', 0),
+        "dead_lettered": dead_lettered,
+        "events_per_second": round(worker_stats.get('events_written', 0) / drain_seconds, 1) if drain_seconds > 0 else 0.0,
+        "latency_ms": {name: round(latencies.quantile(q), 3) if latencies.count else None
+                       for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))}
+    })
+
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a failure scenario and measure how the local ingest path copes")
+    parser.add_argument("--scenario", help="A JSON file of `Scenario` settings (see the module overview)")
+    parser.add_argument("--duration", type=float, default=600, help="Simulated seconds (without --scenario)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Lifecycles per simulated second (without --scenario)")
+    parser.add_argument("--write", help="Write the deliveries to this NDJSON file instead of running the stress test")
+    parser.add_argument("--no-baseline", action="store_true", help="Skip the clean comparison run")
+    args = parser.parse_args()
+
+    if args.scenario:
+        with open(args.scenario) as f:
+            spec = json.load(f)
+    else:
+        spec = {"duration": args.duration, "lifecycles_per_second": args.rate, "malformed_rate": 0.02,
+                "oversized_rate": 0.005, "duplicate_rate": 0.05,
+                "storms": [{"start": args.duration / 3, "duration": args.duration / 6, "pipeline": "pipeline3"}]}
+    spec.setdefault('seed', 7)
+
+    if args.write:
+        scenario = Scenario.from_dict(spec)
+        with open(args.write, "w") as f:
+            f.writelines(delivery_body(payload) + "\n" for payload in scenario.deliveries())
+        print(json.dumps(dict(scenario.faults), indent=4))
+    else:
+        results = {}
+        if not args.no_baseline:
+            clean = dict(spec, storms=[], malformed_rate=0.0, oversized_rate=0.0, duplicate_rate=0.0)
+            results['baseline'] = run_stress(Scenario.from_dict(clean).deliveries())
+        scenario = Scenario.from_dict(spec)
+        results['scenario'] = run_stress(scenario.deliveries())
+        results['faults'] = dict(scenario.faults)
+        print(json.dumps(results, indent=4))
+
+    print_summary("scenarios.py")
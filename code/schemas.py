@@ -0,0 +1,115 @@
+## Column layout of processed (flattened) CDEvents.
+##
+## This is the schema the Glue crawler infers for `processed/` and the column order of
+## `simulated_processed_events.csv`.  Every value is a string (or null).  Every writer of processed events (the
+## Lambda, `sqs_worker.py`, `backfill_raw.py`, `redrive_dlq.py`, `ingest_receiver.py`, ...) passes its records
+## through `normalize_processed`, so they all have exactly these columns whichever flattener produced them;
+## readers normalize too, for objects written before that.
+
+PROCESSED_COLUMNS = [
+    "event_id",
+    "context_version",
+    "context_id",
+    "context_source",
+    "context_type",
+    "context_timestamp",
+    "subject_id",
+    "subject_type",
+    "content_task",
+    "content_url",
+    "run_id",
+    "run_source",
+    "run_type",
+    "run_pipelineName",
+    "run_url",
+    "run_outcome",
+    "run_errors"
+]
+
+def normalize_processed(record):
+    '''
+    Input: `record` (dtype: dict) A flattened event from `flatten_event_entry` or the Lambda's `flatten_event`
+    Returns: `normalized` (dtype: dict) The record with exactly `PROCESSED_COLUMNS`, in order, missing columns set to None
+
+    Function Overview:
+        The Lambda's `flatten_event` prefixes every run field with "run_", so errors written by it arrive as
+        `run_run_errors` next to an empty `run_errors`.  Those are folded back into `run_errors` here.
+    '''
+
+    normalized = {column: record.get(column) for column in PROCESSED_COLUMNS}
+
+    if normalized['run_errors'] is None and record.get('run_run_errors') is not None:
+        normalized['run_errors'] = record['run_run_errors']
+
+    return normalized
+
+## Field specifications for raw and processed CDEvents, compiled into fast checks by `validation.py`.
+##
+## Each field maps to a spec with:
+##     "type"     - the Python type the value must have (dict for nested objects)
+##     "fields"   - the nested field specs, for dict values
+##     "required" - whether the field must be present (default True)
+##     "nullable" - whether the value may be None (default False)
+##     "enum"     - the allowed values
+##     "pattern"  - a regular expression the value must match in full
+##     "format"   - "uuid" or "timestamp" (`YYYY-MM-DD HH:MM:SS.ffffff`)
+
+CONTEXT_VERSIONS = ["0.0.1", "0.0.2", "0.1.0"]
+RUN_TYPES = ["taskRun", "pipelineRun"]
+EVENT_STATES = ["queued", "started", "finished"]
+OUTCOMES = ["success", "error", "failure"]
+
+SOURCE_PATTERN = r"/[\w.-]+/[\w.-]+/"
+CONTEXT_TYPE_PATTERN = r"[\w-]+\.simulated_events\.(taskRun|pipelineRun)\.(queued|started|finished)"
+
+RUN_SCHEMA = {
+    "id": {"type": str, "format": "uuid"},
+    "source": {"type": str, "pattern": SOURCE_PATTERN},
+    "type": {"type": str, "enum": RUN_TYPES},
+    "pipelineName": {"type": str},
+    "url": {"type": str},
+    "outcome": {"type": str, "enum": OUTCOMES, "required": False, "nullable": True},
+    "run_errors": {"type": str, "required": False, "nullable": True},
+    "errors": {"type": str, "required": False, "nullable": True}  ## Written by older versions of `TaskRun`/`PipelineRun`
+}
+
+CONTEXT_SCHEMA = {
+    "version": {"type": str, "enum": CONTEXT_VERSIONS},
+    "id": {"type": str, "format": "uuid"},
+    "source": {"type": str, "pattern": SOURCE_PATTERN},
+    "type": {"type": str, "pattern": CONTEXT_TYPE_PATTERN},
+    "timestamp": {"type": str, "format": "timestamp"}
+}
+
+CONTENT_SCHEMA = {
+    "task": {"type": str},
+    "url": {"type": str},
+    "taskRun": {"type": dict, "fields": RUN_SCHEMA, "required": False},
+    "pipelineRun": {"type": dict, "fields": RUN_SCHEMA, "required": False}
+}
+
+SUBJECT_SCHEMA = {
+    "id": {"type": str, "format": "uuid"},
+    "type": {"type": str, "enum": RUN_TYPES},
+    "content": {"type": dict, "fields": CONTENT_SCHEMA}
+}
+
+RAW_EVENT_SCHEMA = {
+    "event_id": {"type": str, "format": "uuid"},
+    "context": {"type": dict, "fields": CONTEXT_SCHEMA},
+    "subject": {"type": dict, "fields": SUBJECT_SCHEMA}
+}
+
+PROCESSED_EVENT_SCHEMA = {column: {"type": str} for column in PROCESSED_COLUMNS}
+PROCESSED_EVENT_SCHEMA.update({
+    "event_id": {"type": str, "format": "uuid"},
+    "context_version": {"type": str, "enum": CONTEXT_VERSIONS},
+    "context_id": {"type": str, "format": "uuid"},
+    "context_type": {"type": str, "pattern": CONTEXT_TYPE_PATTERN},
+    "context_timestamp": {"type": str, "format": "timestamp"},
+    "subject_type": {"type": str, "enum": RUN_TYPES},
+    "run_type": {"type": str, "enum": RUN_TYPES},
+    "run_outcome": {"type": str, "enum": OUTCOMES, "required": False, "nullable": True},
+    "run_errors": {"type": str, "required": False, "nullable": True},
+    "run_run_errors": {"type": str, "required": False, "nullable": True}  ## Written by the Lambda's `flatten_event`
+})
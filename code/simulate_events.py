@@ -3,7 +3,14 @@ import boto3
 import uuid
 import time
 import json
-from simulation_functions import flatten_event_entry, create_and_send_events
+import os
+from simulation_functions import flatten_event_entry, create_and_send_events, create_events, get_s3, get_bucket_name
+from instrumentation import timer, Profiler, print_summary
+from sinks import sink_from_url, SINK_ENV_VAR
+from pipeline import run_pipeline, s3_uploader, sink_uploader
+from parallel_generate import run_parallel, PROCESSES_ENV_VAR
+from incremental_processed import IncrementalUpdate, INCREMENTAL_ENV_VAR, RAW_LOG
+from adaptive import AdaptiveUploader, ADAPTIVE_ENV_VAR
 import pandas as pd
 
 # Step 0: Create a test event to make sure that CDEvent, PipelineRun, and TaskRun
@@ -13,22 +20,66 @@ test_event = CDEvent()
 test_event.to_string()
 
 # Step 1: Create and send raw CDEvents to S3 and save locally to JSON
+# (set CDEVENTS_PROFILE=cprofile/tracemalloc/all to profile the whole run)
+run_profiler = Profiler("simulate_events").start()
+
+## Set CDEVENTS_PROCESSES=<n> to generate with n processes straight to the local JSON/CSV files, without
+## uploading anything (see `parallel_generate.py`)
+if os.environ.get(PROCESSES_ENV_VAR):
+    parallel_stats = run_parallel(100, lifecycles_per_batch=5, processes=int(os.environ[PROCESSES_ENV_VAR]))
+    print("Parallel generation:\n", json.dumps(parallel_stats, indent=4))
+    run_profiler.stop()
+    print_summary("simulate_events.py")
+    raise SystemExit(0)
+
 all_events = []
 
-for i in range(100):
-    
-    events_list, ids_list, responses_map = create_and_send_events(num_events=5)
-    
-    all_events.extend(events_list)
-    time.sleep(0.5)
+## Set CDEVENTS_SINK (i.e. "ndjson:raw.ndjson", "s3://<bucket>/batches/", "stdout") to write batches
+## to another destination instead of one S3 object per event (see `sinks.py`)
+sink = sink_from_url(os.environ[SINK_ENV_VAR]) if os.environ.get(SINK_ENV_VAR) else None
+
+## Set CDEVENTS_PIPELINE=1 to generate and upload at the same time, as fast as possible (see `pipeline.py`)
+if os.environ.get("CDEVENTS_PIPELINE"):
+    pipeline_stats, all_events = run_pipeline(100, lifecycles_per_batch=5, collect=True,
+                                              upload=sink_uploader(sink) if sink is not None else s3_uploader())
+    print("Pipeline:\n", json.dumps(pipeline_stats, indent=4))
+## Set CDEVENTS_ADAPTIVE=1 to upload multi-event objects whose size and concurrency adapt to S3 (see `adaptive.py`)
+elif os.environ.get(ADAPTIVE_ENV_VAR):
+    uploader = AdaptiveUploader(get_s3(), get_bucket_name())
+    for i in range(100):
+        events_list, ids_list = create_events(5)
+        uploader.submit(events_list)
+        all_events.extend(events_list)
+    adaptive_stats = uploader.close()
+    adaptive_stats['keys'] = len(adaptive_stats['keys'])
+    print("Adaptive upload:\n", json.dumps(adaptive_stats, indent=4))
+else:
+    for i in range(100):
+        
+        events_list, ids_list, responses_map = create_and_send_events(num_events=5, sink=sink)
+        
+        all_events.extend(events_list)
+        time.sleep(0.5)
+
+if sink is not None:
+    sink.close()
 
 
 # Serializing json
-json_object = json.dumps(all_events)
+with timer("json_dumps_all"):
+    json_object = json.dumps(all_events)
  
 # Writing to sample.json
 with open("simulated_raw_events.json", "w") as outfile:
     outfile.write(json_object)
+
+## Set CDEVENTS_INCREMENTAL=<folder> to also append this run's events to `simulated_raw_events.ndjson` and process
+## only those into hour partitions under the folder, instead of relying on the rebuilt CSV (see `incremental_processed.py`)
+if os.environ.get(INCREMENTAL_ENV_VAR):
+    with open(RAW_LOG, "a") as outfile:
+        outfile.writelines(json.dumps(event) + "\n" for event in all_events)
+    incremental_stats = IncrementalUpdate(RAW_LOG, os.environ[INCREMENTAL_ENV_VAR]).run()
+    print("Incremental update:\n", json.dumps(incremental_stats, indent=4))
     
 # Step 2: Flatten Events and save locally (Lambda will flatten them from S3)    
 # Step 2a: Show how flatten_event will flatten a single event
@@ -46,4 +97,10 @@ print("All columns:\n", processed_df.columns, '\n')
 print(processed_df.head())
 
 ## Step 2d: Save to CSV for later analysis and reporting
-processed_df.to_csv("simulated_processed_events.csv", index=False)
+with timer("write_csv"):
+    processed_df.to_csv("simulated_processed_events.csv", index=False)
+
+## Step 3: Show where the time went for this run
+run_profiler.stop()
+print_summary("simulate_events.py")
+
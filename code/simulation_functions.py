@@ -1,9 +1,15 @@
 from CDEvent import CDEvent
+import os
 import boto3
 import json
 import uuid
 import time
 from copy import deepcopy
+from instrumentation import timer, timed, increment
+from key_layout import raw_key, build_manifest, write_manifest, default_layout, split_by_hour
+from event_streams import event_timestamp
+from compression import put_arguments, default_codec, extension
+from wire_format import encode_event, default_encoding, EXTENSION as BINARY_EXTENSION, CONTENT_TYPE as BINARY_CONTENT_TYPE
 
 ## Brainstorming
 
@@ -22,14 +28,47 @@ from copy import deepcopy
 ## SQS instead.
 
 ## Step 1: Create clients for Parameter store and S3
+## The client and the bucket are only looked up when something is sent, so importing this module (i.e. for
+## `create_events` or `flatten_event_entry`) needs no AWS credentials.  Set `s3` to use another client (i.e. a
+## `LocalS3` from `local_aws.py`).
 
-s3 = boto3.client("s3")
-ssm = boto3.client("ssm")
+s3 = None
 
-## Step 2: Grab S3 bucket info from ssm
+def get_s3():
+    '''
+    Input: None
+    Returns: s3 (dtype: S3 client) The module's S3 client, created on first use
+    '''
+
+    global s3
+
+    if s3 is None:
+        s3 = boto3.client("s3")
+
+    return s3
+
+## Step 2: Grab S3 bucket info from the `CDEVENT_BUCKET` environment variable if it is set
+## (i.e. for local runs and tests), otherwise from ssm
+
+bucket_name = None
+
+def get_bucket_name():
+    '''
+    Input: None
+    Returns: bucket_name (dtype: str) The CDEvents bucket, looked up on first use
+    '''
+
+    global bucket_name
+
+    if bucket_name is None:
+        bucket_name = os.environ.get("CDEVENT_BUCKET")
+    if bucket_name is None:
+        ssm = boto3.client("ssm")
+        bucket_parameter = ssm.get_parameter(Name="CDEVENT_BUCKET")
+        bucket_name = bucket_parameter['Parameter']['Value']
+
+    return bucket_name
 
-bucket_parameter = ssm.get_parameter(Name="CDEVENT_BUCKET")
-bucket_name = bucket_parameter['Parameter']['Value']
 s3_folder = "raw/"
 
 ## Step 3: Create records and send them to S3
@@ -86,23 +125,31 @@ def create_event_lifecycle(events_list, ids_list):
     event_entry = {}
     event_id = str(uuid.uuid4())
     
-    original_event = CDEvent()
+    with timer("generate_event"):
+        original_event = CDEvent()
     event_entry = original_event.entry
     event_entry['event_id'] = event_id
     
     events_list.append(event_entry)
     ids_list.append(event_id)
+    increment("events_created")
     
     while True:
         next_event_id = str(uuid.uuid4())
-        next_event = CDEvent(kwargs=deepcopy(original_event))
+        
+        with timer("deepcopy"):
+            previous_event = deepcopy(original_event)
+        with timer("generate_event"):
+            next_event = CDEvent(kwargs=previous_event)
         next_event_entry = next_event.entry
         next_event_entry['event_id'] = next_event_id
         
-        original_event = deepcopy(next_event)
+        with timer("deepcopy"):
+            original_event = deepcopy(next_event)
         
         events_list.append(next_event_entry)
         ids_list.append(next_event_id)
+        increment("events_created")
         
         if next_event.event_state == "finished":
             break    
@@ -110,6 +157,7 @@ def create_event_lifecycle(events_list, ids_list):
     return events_list, ids_list
 
 
+@timed("create_events")
 def create_events(num_events):
     '''
     Input:
@@ -160,18 +208,32 @@ def create_events(num_events):
     
     for i in range(num_events):
         events_list, ids_list = create_event_lifecycle(events_list, ids_list)
+        increment("lifecycles_created")
     
     return events_list, ids_list
 
-def send_events(events_list, ids_list, bucket_name=bucket_name, responses_map=None):
+@timed("send_events")
+def send_events(events_list, ids_list, bucket_name=None, responses_map=None, layout=None, manifest=True,
+                compression=None, encoding=None):
     '''
     Inputs:
         `events_list` (dtype: list): This is a list of event dictionaries from `create_events`
         `ids_list` (dtype: list): This a list of event_id strings from `create_events`
         `bucket_name` (dtype: str): This is a string value for the name of the S3 bucket you
-            intend to send your JSON files to
+            intend to send your JSON files to (defaults to `get_bucket_name()`)
         `responses_map` (dtype: dict): This is a dictionary that will store all of the responses
             from each event sent to S3, using their event_id as the name of the JSON file.
+        `layout` (dtype: str): The raw key layout, either "flat" (`raw/<event_id>.json`) or
+            "partitioned" (`raw/dt=YYYY-MM-DD/hr=HH/<shard>/<event_id>.json`).  Defaults to the
+            `CDEVENTS_RAW_LAYOUT` environment variable, or "flat" if it is unset (see `key_layout.py`).
+        `manifest` (dtype: bool): Whether to write a manifest object listing the keys, count, and
+            time range of this batch under `manifests/raw/...`
+        `compression` (dtype: str): "none", "gzip", or "zstd".  Compressed events are written with the
+            matching `ContentEncoding` and a `.json.gz`/`.json.zst` extension.  Defaults to the
+            `CDEVENTS_COMPRESSION` environment variable, or "none" if it is unset (see `compression.py`).
+        `encoding` (dtype: str): "json", or "binary" for the compact wire format (`.cdeb` objects, see
+            `wire_format.py`).  Defaults to the `CDEVENTS_ENCODING` environment variable, or "json" if it is unset.
+            Events that do not fit the binary schema are still sent as JSON.
         
     Function Overview:
         This function will take the events and ids created and stored from `create_events`
@@ -181,31 +243,70 @@ def send_events(events_list, ids_list, bucket_name=bucket_name, responses_map=No
         responses_map (dtype: dict): See input parameter `responses_map`
     '''
     
+    if bucket_name is None:
+        bucket_name = get_bucket_name()
     if responses_map is None:
         responses_map = {}
+    if layout is None:
+        layout = default_layout()
+    if compression is None:
+        compression = default_codec()
+    if encoding is None:
+        encoding = default_encoding()
+    
+    manifest_entries = []
     
     for i, event in enumerate(events_list):
         
         event_id = ids_list[i]
-        json_filename = "{}.json".format(event_id)
-        json_event = json.dumps(event)
+        body = None
+        if encoding == "binary":
+            try:
+                with timer("encode_binary"):
+                    body = encode_event(event)
+                file_extension, content_type = BINARY_EXTENSION, BINARY_CONTENT_TYPE
+            except ValueError as e:
+                print("Sending event {} as JSON: {}".format(event_id, e))
+                increment("binary_fallbacks")
+        if body is None:
+            with timer("json_dumps"):
+                body = json.dumps(event)
+            file_extension, content_type = ".json", "application/json"
+        
+        key = raw_key(event, prefix=s3_folder, layout=layout, extension=file_extension + extension(compression))
+        with timer("compress"):
+            put_args = put_arguments(body, compression, content_type=content_type)
         
-        response = s3.put_object(
-            Bucket=bucket_name, 
-            Key=s3_folder + json_filename, 
-            Body=json_event
-        )
+        with timer("s3_put"):
+            response = get_s3().put_object(
+                Bucket=bucket_name, 
+                Key=key, 
+                **put_args
+            )
         
         responses_map[event_id] = response
+        manifest_entries.append((key, event, len(put_args['Body'])))
+        increment("events_sent")
+        increment("bytes_sent", len(put_args['Body']))
+        increment("bytes_uncompressed", len(body))
+    
+    ## Step 3b: Record what was uploaded in this batch so readers don't need to list `raw/`, one manifest per
+    ## hour the batch covers so each one is filed where readers look for it
+    if manifest and manifest_entries:
+        for entries in split_by_hour(manifest_entries, lambda entry: event_timestamp(entry[1])):
+            with timer("s3_put_manifest"):
+                write_manifest(get_s3(), bucket_name, build_manifest(entries, layout), prefix=s3_folder)
     
     return responses_map
     
-def create_and_send_events(num_events, bucket_name=bucket_name):
+def create_and_send_events(num_events, bucket_name=None, sink=None):
     '''
     Inputs:
         `events_list` (dtype: list): This is a list of event dictionaries from `create_events`
         `bucket_name` (dtype: str): This is a string value for the name of the S3 bucket you
             intend to send your JSON files to
+        `sink` (dtype: Sink): Write the events to this sink instead of sending them to S3 one
+            object at a time (optional, see `sinks.py`)
     
     Function Overview:
         This function will call `create_events` and `send_events` to create `num_events` number
@@ -221,11 +322,17 @@ def create_and_send_events(num_events, bucket_name=bucket_name):
     responses_map = {}
     
     events_list, ids_list = create_events(num_events)
-    responses_map = send_events(events_list, ids_list, bucket_name, responses_map)
+    
+    if sink is not None:
+        for event in events_list:
+            sink.write(event)
+    else:
+        responses_map = send_events(events_list, ids_list, bucket_name, responses_map)
     
     return events_list, ids_list, responses_map
     
 ## Step 4: Create function to flatten event entries and save locally
+@timed("flatten_event_entry")
 def flatten_event_entry(event_entry):
     '''
     Input: `event_entry` (dtype: dict) A dictionary from CDEvent.entry that is 
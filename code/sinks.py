@@ -0,0 +1,450 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from compression import put_arguments, extension, compress, check_codec
+from schemas import PROCESSED_COLUMNS, RAW_EVENT_SCHEMA, normalize_processed
+from instrumentation import timer, increment
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Pluggable destinations for generated (or processed) events.
+##
+## Every sink buffers events and delivers them in batches, the same way Kinesis Firehose buffers by size
+## and interval.  A batch is delivered as soon as any one of these limits is reached:
+##     `max_records` - number of buffered events
+##     `max_bytes`   - serialized size of the buffered events
+##     `max_latency` - seconds since the oldest buffered event was written
+## The latency limit is only checked on `write` and by `flush_if_due()`; nothing flushes in the background, so a
+## caller whose writes can pause (i.e. `ingest_receiver.py`) must call `flush_if_due()` on a timer itself.
+## `close()` delivers whatever is left.
+##
+## When `deliver` raises, the batch goes back to the front of the buffer and the error is re-raised, so a later
+## `flush` (or `close`) retries it instead of the events being lost.  A `deliver` that gets part of a batch out
+## before failing removes the delivered items from `batch` first, so only the rest is retried.  Every sink has the same `write(event)`/`close()`
+## interface as the replay sinks in `replay_events.py`, so any of them can be used there too.
+##
+## Implementations:
+##     `NDJSONFileSink`  - appends to a local NDJSON file (optionally gzip, one gzip member per batch)
+##     `ParquetFileSink` - writes a row group per batch, starting a new Parquet file every `rows_per_file` rows
+##     `ObjectStoreSink` - one NDJSON object per batch in S3 (or a `LocalS3`)
+##     `QueueSink`       - SQS messages, sent 10 per `send_message_batch` call
+##     `StdoutSink`      - NDJSON lines on stdout (or any text stream)
+## `sink_from_url` builds one from a short description (i.e. "ndjson:events.ndjson" or "s3://bucket/raw-batches/").
+
+SINK_ENV_VAR = "CDEVENTS_SINK"
+
+class Sink():
+    def __init__(self, max_records=500, max_bytes=5 * 1024 * 1024, max_latency=60.0, clock=time.monotonic):
+        '''
+        Inputs:
+            `max_records` (dtype: int): Deliver a batch once this many events are buffered
+            `max_bytes` (dtype: int): ...or once the buffered events take up this many serialized bytes
+            `max_latency` (dtype: float): ...or once the oldest buffered event is this many seconds old (None to disable)
+            `clock` (dtype: function): The time function, replaceable for testing
+
+        Returns: object (dtype: Sink) The shared buffering logic.  Subclasses implement `deliver(batch)` (and
+            optionally `encode(event)`, `size(item)`, and `finish()`).
+        '''
+
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffer_started = None
+
+        self.stats = {"records": 0, "bytes": 0, "batches": 0, "delivery_errors": 0, "flush_seconds": 0.0,
+                      "max_flush_seconds": 0.0, "max_buffer_seconds": 0.0, "flush_reasons": {"records": 0, "bytes": 0, "latency": 0, "close": 0}}
+
+        return
+
+    def encode(self, event):
+        '''
+        Input: `event` (dtype: dict)
+        Returns: The buffered form of the event (by default one NDJSON line, as bytes)
+        '''
+
+        return (json.dumps(event, default=str) + "\n").encode("utf-8")
+
+    def size(self, item):
+        return len(item)
+
+    def deliver(self, batch):
+        raise NotImplementedError
+
+    def finish(self):
+        return
+
+    def due(self):
+        '''
+        Returns: `reason` (dtype: str) Which limit has been reached ("records", "bytes", or "latency"), or None.
+            Must be called with the lock held.
+        '''
+
+        if len(self.buffer) >= self.max_records:
+            return "records"
+        if self.buffered_bytes >= self.max_bytes:
+            return "bytes"
+        if self.max_latency is not None and self.buffer_started is not None and \
+                self.clock() - self.buffer_started >= self.max_latency:
+            return "latency"
+
+        return None
+
+    def write(self, event):
+        item = self.encode(event)
+
+        with self.lock:
+            if self.buffer_started is None:
+                self.buffer_started = self.clock()
+            self.buffer.append(item)
+            self.buffered_bytes += self.size(item)
+            reason = self.due()
+
+        if reason:
+            self.flush(reason)
+
+        return
+
+    def flush_if_due(self):
+        with self.lock:
+            reason = self.due() if self.buffer else None
+
+        if reason:
+            self.flush(reason)
+
+        return reason
+
+    def flush(self, reason="close"):
+        '''
+        Input: `reason` (dtype: str) Why the batch is being delivered (counted in `stats['flush_reasons']`)
+
+        Function Overview:
+            Takes everything buffered so far and hands it to `deliver` as one batch.  If `deliver` raises, the
+            undelivered part of the batch is put back in front of anything written since and the error is re-raised.
+        '''
+
+        with self.flush_lock:
+            with self.lock:
+                batch, size, started = self.buffer, self.buffered_bytes, self.buffer_started
+                self.buffer, self.buffered_bytes, self.buffer_started = [], 0, None
+
+            if not batch:
+                return
+
+            start = self.clock()
+            count = len(batch)
+            try:
+                with timer("sink_deliver"):
+                    self.deliver(batch)
+            except Exception:
+                remaining = sum(self.size(item) for item in batch)
+                with self.lock:
+                    self.buffer = batch + self.buffer
+                    self.buffered_bytes += remaining
+                    self.buffer_started = started
+                    self.stats['records'] += count - len(batch)
+                    self.stats['bytes'] += size - remaining
+                    self.stats['delivery_errors'] += 1
+                increment("sink_delivery_errors")
+                raise
+            elapsed = self.clock() - start
+
+            with self.lock:
+                self.stats['records'] += count
+                self.stats['bytes'] += size
+                self.stats['batches'] += 1
+                self.stats['flush_seconds'] += elapsed
+                self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], elapsed)
+                self.stats['max_buffer_seconds'] = max(self.stats['max_buffer_seconds'], start - started)
+                self.stats['flush_reasons'][reason] += 1
+            increment("sink_records", count)
+            increment("sink_batches")
+
+        return
+
+    def close(self):
+        try:
+            self.flush("close")
+        finally:
+            self.finish()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+        return False
+
+class NDJSONFileSink(Sink):
+    def __init__(self, path, compression="none", **buffering):
+        '''
+        Inputs:
+            `path` (dtype: str): The file to append events to
+            `compression` (dtype: str): "none", "gzip", or "zstd".  Each batch is appended as its own compressed
+                frame, which `gzip`/`zstd` readers (and `event_streams.open_text` for gzip) read as one stream.
+            `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`)
+        '''
+
+        Sink.__init__(self, **buffering)
+        check_codec(compression)
+        self.path = path
+        self.compression = compression
+
+        return
+
+    def deliver(self, batch):
+        with open(self.path, "ab") as outfile:
+            outfile.write(compress(b"".join(batch), self.compression))
+
+        return
+
+def arrow_type(spec):
+    '''
+    Input: `spec` (dtype: dict): A field from a schema in `schemas.py`
+    Returns: The Arrow type for it: a struct for nested objects, otherwise a string
+    '''
+
+    if spec.get('type') is dict:
+        return pyarrow.struct([(name, arrow_type(field)) for name, field in spec['fields'].items()])
+
+    return pyarrow.string()
+
+class ParquetFileSink(Sink):
+    def __init__(self, directory, prefix="part", rows_per_file=1000000, processed=True, **buffering):
+        '''
+        Inputs:
+            `directory` (dtype: str): Where Parquet files are written (`<prefix>-00000.parquet`, `<prefix>-00001.parquet`, ...)
+            `prefix` (dtype: str): The file name prefix
+            `rows_per_file` (dtype: int): Start a new file once the current one holds this many rows
+            `processed` (dtype: bool): Write flattened events with the processed schema (see `schemas.py`).  With
+                False, nested raw events are written with `RAW_EVENT_SCHEMA` as Arrow structs, so every batch keeps
+                both the taskRun and pipelineRun fields whichever came first.
+            `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`).  Each batch becomes one row group.
+        '''
+
+        if pyarrow is None:
+            raise ValueError("ParquetFileSink requires the `pyarrow` package (pip install pyarrow)")
+
+        Sink.__init__(self, **buffering)
+        self.directory = directory
+        self.prefix = prefix
+        self.rows_per_file = rows_per_file
+        if processed:
+            self.schema = pyarrow.schema([(column, pyarrow.string()) for column in PROCESSED_COLUMNS])
+        else:
+            self.schema = pyarrow.schema([(name, arrow_type(field)) for name, field in RAW_EVENT_SCHEMA.items()])
+        self.processed = processed
+
+        self.writer = None
+        self.file_rows = 0
+        self.files = []
+
+        os.makedirs(directory, exist_ok=True)
+
+        return
+
+    def encode(self, event):
+        return normalize_processed(event) if self.processed else event
+
+    def size(self, item):
+        ## A cheap estimate; the real size depends on Parquet's encoding and compression
+        return sum(len(str(value)) for value in item.values() if value is not None)
+
+    def deliver(self, batch):
+        table = pyarrow.Table.from_pylist(batch, schema=self.schema)
+
+        if self.writer is None:
+            path = os.path.join(self.directory, "{}-{:05d}.parquet".format(self.prefix, len(self.files)))
+            self.writer = pyarrow.parquet.ParquetWriter(path, table.schema, compression="snappy")
+            self.schema = table.schema
+            self.files.append(path)
+
+        self.writer.write_table(table)
+        self.file_rows += len(batch)
+
+        if self.file_rows >= self.rows_per_file:
+            self.finish()
+
+        return
+
+    def finish(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.file_rows = 0
+
+        return
+
+class ObjectStoreSink(Sink):
+    def __init__(self, s3, bucket, prefix="batches/", compression="none", **buffering):
+        '''
+        Inputs:
+            `s3`: A boto3 S3 client or a `LocalS3` (see `local_aws.py`)
+            `bucket` (dtype: str): The bucket to write to
+            `prefix` (dtype: str): The folder batch objects are written under
+            `compression` (dtype: str): "none", "gzip", or "zstd" (see `compression.py`)
+            `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`)
+
+        Overview:
+            Writes each batch as one object, `<prefix><timestamp>-<uuid>.ndjson`, instead of one object per event.
+        '''
+
+        Sink.__init__(self, **buffering)
+        check_codec(compression)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.compression = compression
+        self.keys = []
+
+        return
+
+    def deliver(self, batch):
+        key = "{}{}-{}.ndjson{}".format(self.prefix, time.strftime("%Y%m%dT%H%M%S"), str(uuid.uuid4())[:8],
+                                        extension(self.compression))
+        put_args = put_arguments(b"".join(batch), self.compression, content_type="application/x-ndjson")
+
+        with timer("s3_put"):
+            self.s3.put_object(Bucket=self.bucket, Key=key, **put_args)
+        self.keys.append(key)
+
+        return
+
+class QueueSink(Sink):
+    def __init__(self, sqs, queue_url, max_attempts=5, backoff=0.1, **buffering):
+        '''
+        Inputs:
+            `sqs`: A boto3 SQS client or a `LocalSQS` (see `local_aws.py`)
+            `queue_url` (dtype: str): The queue to send events to
+            `max_attempts` (dtype: int): How many times an entry SQS reports as failed is sent before giving up
+            `backoff` (dtype: float): Seconds to wait before the first resend, doubling after each one
+            `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`)
+
+        Overview:
+            Sends one message per event, 10 per `send_message_batch` call (the SQS limit).  Entries that fail on
+            the SQS side are resent; entries SQS rejects as the sender's fault (i.e. a body that is too big) can
+            never succeed, so they are counted in `failed` and dropped.
+        '''
+
+        Sink.__init__(self, **buffering)
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.failed = 0
+
+        return
+
+    def encode(self, event):
+        return json.dumps(event, default=str)
+
+    def deliver(self, batch):
+        '''
+        Input: `batch` (dtype: list) Encoded events; each group of 10 is removed once it is sent, so a failure
+            part way through leaves only the unsent events for `Sink.flush` to put back
+
+        Function Overview:
+            Sends the batch 10 entries at a time, resending the entries SQS fails with backoff.  Raises a
+            `RuntimeError` if some are still failing after `max_attempts` sends.
+        '''
+
+        while batch:
+            entries = [{"Id": str(i), "MessageBody": body} for i, body in enumerate(batch[:10])]
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                with timer("sqs_send_batch"):
+                    response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+                failed = response.get('Failed', [])
+                rejected = {entry['Id'] for entry in failed if entry.get('SenderFault')}
+                retry = {entry['Id'] for entry in failed} - rejected
+                self.failed += len(rejected)
+                entries = [entry for entry in entries if entry['Id'] in retry]
+                if not entries:
+                    break
+                increment("sqs_send_retries", len(entries))
+            else:
+                batch[:10] = [entry['MessageBody'] for entry in entries]
+                raise RuntimeError("{} of {} messages could not be sent to {} after {} attempts".format(
+                    len(entries), min(len(batch), 10), self.queue_url, self.max_attempts))
+            del batch[:10]
+
+        return
+
+class StdoutSink(Sink):
+    def __init__(self, stream=None, **buffering):
+        '''
+        Inputs:
+            `stream`: A text stream (defaults to `sys.stdout`)
+            `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`)
+        '''
+
+        Sink.__init__(self, **buffering)
+        self.stream = stream
+
+        return
+
+    def deliver(self, batch):
+        stream = self.stream or sys.stdout
+        stream.write(b"".join(batch).decode("utf-8"))
+        stream.flush()
+
+        return
+
+def sink_from_url(url, s3=None, sqs=None, processed=False, **buffering):
+    '''
+    Inputs:
+        `url` (dtype: str): One of
+            "stdout"
+            "ndjson:<path>"                  (".gz" or ".zst" at the end of the path selects compression)
+            "parquet:<directory>"            (nested raw events, or flattened ones with `processed`)
+            "s3://<bucket>/<prefix>"         (uses `s3`, i.e. a `LocalS3`, or a boto3 client)
+            "sqs:<queue url>"                (uses `sqs`, or a boto3 client)
+        `s3`/`sqs`: Clients to use instead of boto3 (optional)
+        `processed` (dtype: bool): Whether the events written are flattened (only changes the Parquet schema)
+        `buffering`: `max_records`, `max_bytes`, `max_latency` (see `Sink`)
+
+    Returns: `sink` (dtype: Sink)
+    '''
+
+    if url == "stdout":
+        return StdoutSink(**buffering)
+
+    scheme, _, location = url.partition(":")
+
+    if scheme == "ndjson":
+        codec = "gzip" if location.endswith(".gz") else "zstd" if location.endswith(".zst") else "none"
+        return NDJSONFileSink(location, compression=codec, **buffering)
+
+    if scheme == "parquet":
+        return ParquetFileSink(location, processed=processed, **buffering)
+
+    if scheme == "s3":
+        bucket, _, prefix = location.lstrip("/").partition("/")
+        if s3 is None:
+            import boto3
+            s3 = boto3.client("s3")
+        return ObjectStoreSink(s3, bucket, prefix, **buffering)
+
+    if scheme == "sqs":
+        if sqs is None:
+            import boto3
+            sqs = boto3.client("sqs")
+        return QueueSink(sqs, location, **buffering)
+
+    raise ValueError("Unknown sink {!r}".format(url))
@@ -0,0 +1,497 @@
+import math
+import json
+import base64
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from event_streams import parse_timestamp
+from instrumentation import timer, increment, print_summary
+
+## Constant-memory summaries of processed events for dashboards.
+##
+## Counting unique runs and users per window, or finding p95 task durations, exactly means keeping every run id
+## and sorting every duration.  `WindowSketches` keeps, for each (environment, pipelineName, task, time bucket):
+##     HyperLogLog - distinct runs and distinct users (about 1.6% error at the default precision, 4 KB each)
+##     t-digest    - task and pipeline run durations, accurate to a fraction of a percent near p50/p95/p99
+## Both are fixed-size no matter how many events go in, and both merge with another sketch of the same kind
+## (HyperLogLog exactly, t-digest with a little extra error), so each partition or shard is summarized
+## separately and the results are combined:
+##     hour_sketches = [WindowSketches.from_dict(json.load(open(name))) for name in names]
+##     total = WindowSketches.merged(hour_sketches)
+##     total.query(environment="prod")  -> {"events": 3171, "distinct_runs": 1478, "task_p95": 152.2, ...}
+##
+## Durations come from pairing each run's `started` and `finished` events by `run_id`.  A run whose two events
+## land in different shards is kept as an open start or an unmatched finish, and paired when the shards merge.
+
+DEFAULT_BUCKET_SECONDS = 3600
+QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+def stable_hash(value):
+    '''
+    Input: `value` (dtype: str)
+    Returns: `hash` (dtype: int) A 64-bit hash that is the same in every process (unlike `hash()`), so sketches
+        built on different machines can be merged
+    '''
+
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HyperLogLog():
+    def __init__(self, precision=12):
+        '''
+        Input: `precision` (dtype: int): Uses 2**precision registers (standard error about 1.04 / sqrt(2**precision))
+        Returns: object (dtype: HyperLogLog) An estimate of how many distinct values were added
+        '''
+
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18, got {}".format(precision))
+
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+        return
+
+    def add(self, value):
+        hashed = stable_hash(value)
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        '''
+        Input: `other` (dtype: HyperLogLog): A sketch with the same precision
+        Returns: self, now estimating the distinct values added to either sketch
+        '''
+
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches with precision {} and {}".format(self.precision, other.precision))
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+        return self
+
+    def count(self):
+        '''
+        Returns: `count` (dtype: int) The estimated number of distinct values
+        '''
+
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+
+        ## Small cardinalities are estimated more accurately from the number of empty registers
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / float(zeros))
+
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['precision'])
+        sketch.registers = bytearray(base64.b64decode(data['registers']))
+        return sketch
+
+class TDigest():
+    def __init__(self, compression=100):
+        '''
+        Input: `compression` (dtype: int): Roughly how many centroids to keep (more is more accurate)
+        Returns: object (dtype: TDigest) A merging t-digest of added values, for estimating quantiles
+
+        Overview:
+            Values are buffered and periodically merged into sorted centroids.  Centroid sizes are limited by the
+            k1 scale function, so centroids near the tails stay small and p99 stays accurate.
+        '''
+
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+        return
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def inverse_scale(self, k):
+        if k >= self.compression / 4.0:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        '''
+        Function Overview:
+            Merges the buffer into the centroids, combining neighbours while the combined centroid stays within one
+            unit of the scale function.
+        '''
+
+        points = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        if not points:
+            return
+
+        total = float(sum(weight for _, weight in points))
+        means, weights = [], []
+        current_mean, current_weight = points[0]
+        before = 0.0
+        limit = total * self.inverse_scale(self.scale(0.0) + 1)
+
+        for mean, weight in points[1:]:
+            if before + current_weight + weight <= limit:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                means.append(current_mean)
+                weights.append(current_weight)
+                before += current_weight
+                limit = total * self.inverse_scale(self.scale(before / total) + 1)
+                current_mean, current_weight = mean, weight
+
+        means.append(current_mean)
+        weights.append(current_weight)
+        self.means, self.weights = means, weights
+
+    def merge(self, other):
+        '''
+        Input: `other` (dtype: TDigest)
+        Returns: self, now summarizing the values added to either digest
+        '''
+
+        self.buffer.extend(zip(other.means, other.weights))
+        self.buffer.extend(other.buffer)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+        return self
+
+    def quantile(self, q):
+        '''
+        Input: `q` (dtype: float): Between 0 and 1 (i.e. 0.95)
+        Returns: `value` (dtype: float) The estimated value at that quantile, or None if nothing was added
+
+        Function Overview:
+            Interpolates between centroid centres, and between the outer centroids and the exact min and max.
+        '''
+
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1 or q <= 0:
+            return self.means[0] if q > 0 else self.min
+        if q >= 1:
+            return self.max
+
+        target = q * self.count
+        first_center = self.weights[0] / 2.0
+        if target < first_center:
+            return self.min + (self.means[0] - self.min) * target / first_center
+
+        center = first_center
+        for index in range(len(self.means) - 1):
+            next_center = center + (self.weights[index] + self.weights[index + 1]) / 2.0
+            if target <= next_center:
+                fraction = (target - center) / (next_center - center)
+                return self.means[index] + fraction * (self.means[index + 1] - self.means[index])
+            center = next_center
+
+        remaining = self.count - center
+        return self.means[-1] + (self.max - self.means[-1]) * min(1.0, (target - center) / remaining)
+
+    def to_dict(self):
+        self.compress()
+        return {"compression": self.compression, "count": self.count,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "centroids": [[mean, weight] for mean, weight in zip(self.means, self.weights)]}
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data['compression'])
+        digest.count = data['count']
+        digest.min = data['min'] if data['min'] is not None else math.inf
+        digest.max = data['max'] if data['max'] is not None else -math.inf
+        digest.means = [mean for mean, _ in data['centroids']]
+        digest.weights = [weight for _, weight in data['centroids']]
+        return digest
+
+def window_key(event, bucket_seconds):
+    '''
+    Inputs:
+        `event` (dtype: dict): A processed (flattened) event
+        `bucket_seconds` (dtype: int): The window length
+
+    Returns: `key` (dtype: tuple) (environment, pipelineName, task, bucket start), i.e.
+        ("prod", "pipeline3", "task1", "2023-04-04 22:00:00")
+    '''
+
+    timestamp = parse_timestamp(event['context_timestamp'])
+    epoch = datetime(1970, 1, 1)
+    seconds = int((timestamp - epoch).total_seconds())
+    bucket = epoch + timedelta(seconds=seconds - seconds % bucket_seconds)
+
+    return (event['context_type'].split(".")[0], event.get('run_pipelineName'), event.get('content_task'),
+            bucket.strftime("%Y-%m-%d %H:%M:%S"))
+
+class WindowSketches():
+    def __init__(self, bucket_seconds=DEFAULT_BUCKET_SECONDS, precision=12, compression=100):
+        '''
+        Inputs:
+            `bucket_seconds` (dtype: int): The time bucket length (an hour by default)
+            `precision` (dtype: int): HyperLogLog precision
+            `compression` (dtype: int): t-digest compression
+
+        Returns: object (dtype: WindowSketches) Sketches per (environment, pipelineName, task, time bucket)
+        '''
+
+        self.bucket_seconds = bucket_seconds
+        self.precision = precision
+        self.compression = compression
+        self.windows = {}
+        self.open_runs = {}
+        self.unmatched_finishes = {}
+
+        return
+
+    def window(self, key):
+        window = self.windows.get(key)
+        if window is None:
+            window = {"events": 0, "runs": HyperLogLog(self.precision), "users": HyperLogLog(self.precision),
+                      "task_durations": TDigest(self.compression), "pipeline_durations": TDigest(self.compression)}
+            self.windows[key] = window
+
+        return window
+
+    def add_duration(self, key, run_type, seconds):
+        digest = "task_durations" if run_type == "taskRun" else "pipeline_durations"
+        self.window(key)[digest].add(seconds)
+
+    def add(self, event):
+        '''
+        Input: `event` (dtype: dict) A processed (flattened) event, i.e. from `flatten_event_entry` or a processed CSV
+        Returns: None
+        '''
+
+        key = window_key(event, self.bucket_seconds)
+        window = self.window(key)
+        window['events'] += 1
+
+        run_id = event.get('run_id')
+        if run_id:
+            window['runs'].add(run_id)
+        if event.get('context_source'):
+            window['users'].add(event['context_source'].strip("/").split("/")[-1])
+
+        state = event['context_type'].split(".")[-1]
+        run_type = event.get('run_type') or event.get('subject_type')
+        if not run_id or state not in ("started", "finished"):
+            return
+
+        timestamp = parse_timestamp(event['context_timestamp'])
+        if state == "started":
+            finish = self.unmatched_finishes.pop(run_id, None)
+            if finish is None:
+                self.open_runs[run_id] = timestamp
+            else:
+                self.add_duration(finish[1], finish[2], (finish[0] - timestamp).total_seconds())
+        else:
+            start = self.open_runs.pop(run_id, None)
+            if start is None:
+                self.unmatched_finishes[run_id] = (timestamp, key, run_type)
+            else:
+                self.add_duration(key, run_type, (timestamp - start).total_seconds())
+
+    def update(self, events):
+        '''
+        Input: `events` (dtype: iterable) Processed events
+        Returns: self
+        '''
+
+        count = 0
+        with timer("sketch_update"):
+            for event in events:
+                self.add(event)
+                count += 1
+        increment("sketch_events", count)
+
+        return self
+
+    def merge(self, other):
+        '''
+        Input: `other` (dtype: WindowSketches): Sketches of another partition or shard, with the same settings
+        Returns: self, now summarizing both.  Runs started in one and finished in the other are paired here.
+        '''
+
+        if (other.bucket_seconds, other.precision, other.compression) != (self.bucket_seconds, self.precision, self.compression):
+            raise ValueError("Cannot merge sketches built with different bucket_seconds, precision, or compression")
+
+        for key, theirs in other.windows.items():
+            window = self.window(key)
+            window['events'] += theirs['events']
+            for name in ("runs", "users", "task_durations", "pipeline_durations"):
+                window[name].merge(theirs[name])
+
+        for run_id, start in other.open_runs.items():
+            finish = self.unmatched_finishes.pop(run_id, None)
+            if finish is None:
+                self.open_runs[run_id] = start
+            else:
+                self.add_duration(finish[1], finish[2], (finish[0] - start).total_seconds())
+
+        for run_id, finish in other.unmatched_finishes.items():
+            start = self.open_runs.pop(run_id, None)
+            if start is None:
+                self.unmatched_finishes[run_id] = finish
+            else:
+                self.add_duration(finish[1], finish[2], (finish[0] - start).total_seconds())
+
+        return self
+
+    @classmethod
+    def merged(cls, sketches):
+        '''
+        Input: `sketches` (dtype: list): WindowSketches built with the same settings
+        Returns: `merged` (dtype: WindowSketches) One sketch summarizing all of them
+        '''
+
+        sketches = list(sketches)
+        if not sketches:
+            return cls()
+
+        first = sketches[0]
+        merged = cls(first.bucket_seconds, first.precision, first.compression)
+        for sketch in sketches:
+            merged.merge(sketch)
+
+        return merged
+
+    def query(self, environment=None, pipeline=None, task=None, start=None, end=None):
+        '''
+        Inputs:
+            `environment`, `pipeline`, `task` (dtype: str): Only include windows with these values (all if None)
+            `start`, `end` (dtype: str): Only include buckets starting in [start, end), as "YYYY-MM-DD HH:MM:SS"
+
+        Returns: `summary` (dtype: dict) The merged answer for every matching window:
+            {"windows": 36, "events": 3171, "distinct_runs": 1478, "distinct_users": 3,
+             "task_runs_timed": 1010, "task_p50": 119.111, "task_p95": 152.203, "task_p99": 165.889,
+             "pipeline_runs_timed": 490, "pipeline_p50": ..., ...}
+        '''
+
+        selected = [window for (env, pipe, name, bucket), window in self.windows.items()
+                    if (environment is None or env == environment) and (pipeline is None or pipe == pipeline)
+                    and (task is None or name == task) and (start is None or bucket >= start)
+                    and (end is None or bucket < end)]
+
+        runs, users = HyperLogLog(self.precision), HyperLogLog(self.precision)
+        task_durations, pipeline_durations = TDigest(self.compression), TDigest(self.compression)
+        for window in selected:
+            runs.merge(window['runs'])
+            users.merge(window['users'])
+            task_durations.merge(window['task_durations'])
+            pipeline_durations.merge(window['pipeline_durations'])
+
+        summary = {"windows": len(selected), "events": sum(window['events'] for window in selected),
+                   "distinct_runs": runs.count(), "distinct_users": users.count()}
+        for prefix, digest in (("task", task_durations), ("pipeline", pipeline_durations)):
+            summary["{}_runs_timed".format(prefix)] = digest.count
+            for name, q in QUANTILES.items():
+                value = digest.quantile(q)
+                summary["{}_{}".format(prefix, name)] = round(value, 3) if value is not None else None
+
+        return summary
+
+    def to_dict(self):
+        '''
+        Returns: `data` (dtype: dict) A JSON-serializable copy of the sketches, read back with `from_dict`
+        '''
+
+        return {
+            "bucket_seconds": self.bucket_seconds,
+            "precision": self.precision,
+            "compression": self.compression,
+            "windows": [{"key": list(key), "events": window['events'],
+                         "runs": window['runs'].to_dict(), "users": window['users'].to_dict(),
+                         "task_durations": window['task_durations'].to_dict(),
+                         "pipeline_durations": window['pipeline_durations'].to_dict()}
+                        for key, window in self.windows.items()],
+            "open_runs": {run_id: str(start) for run_id, start in self.open_runs.items()},
+            "unmatched_finishes": {run_id: [str(finish), list(key), run_type]
+                                   for run_id, (finish, key, run_type) in self.unmatched_finishes.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls(data['bucket_seconds'], data['precision'], data['compression'])
+
+        for entry in data['windows']:
+            sketches.windows[tuple(entry['key'])] = {
+                "events": entry['events'],
+                "runs": HyperLogLog.from_dict(entry['runs']),
+                "users": HyperLogLog.from_dict(entry['users']),
+                "task_durations": TDigest.from_dict(entry['task_durations']),
+                "pipeline_durations": TDigest.from_dict(entry['pipeline_durations'])
+            }
+        sketches.open_runs = {run_id: parse_timestamp(start) for run_id, start in data['open_runs'].items()}
+        sketches.unmatched_finishes = {run_id: (parse_timestamp(finish), tuple(key), run_type)
+                                       for run_id, (finish, key, run_type) in data['unmatched_finishes'].items()}
+
+        return sketches
+
+def processed_events(path):
+    '''
+    Input: `path` (dtype: str): A processed CSV, or a raw events file (JSON array or NDJSON, optionally .gz)
+    Returns: A generator of processed events
+    '''
+
+    if ".csv" in path:
+        from validation import iter_processed_csv
+        return iter_processed_csv(path)
+
+    from event_streams import iter_events
+    from simulation_functions import flatten_event_entry
+    return (flatten_event_entry(event) if 'context' in event else event for event in iter_events(path))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build, merge, and query per-window sketches of processed CDEvents")
+    parser.add_argument("paths", nargs="+", help="Processed CSVs, raw event files, or saved sketches (*.sketch.json)")
+    parser.add_argument("--bucket-seconds", type=int, default=DEFAULT_BUCKET_SECONDS)
+    parser.add_argument("--output", help="Save the merged sketches here (i.e. hour.sketch.json)")
+    parser.add_argument("--environment")
+    parser.add_argument("--pipeline")
+    parser.add_argument("--task")
+    args = parser.parse_args()
+
+    sketches = []
+    for path in args.paths:
+        if path.endswith(".sketch.json"):
+            with open(path) as infile:
+                sketches.append(WindowSketches.from_dict(json.load(infile)))
+        else:
+            sketches.append(WindowSketches(args.bucket_seconds).update(processed_events(path)))
+
+    merged = WindowSketches.merged(sketches)
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(merged.to_dict(), outfile)
+
+    with timer("sketch_query"):
+        summary = merged.query(args.environment, args.pipeline, args.task)
+    print(json.dumps(summary, indent=4))
+    print_summary("sketches.py")
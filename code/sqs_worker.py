@@ -0,0 +1,500 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from backfill_raw import fetch_raw_events, fetch_manifest
+from compression import put_arguments, extension, default_codec
+from key_layout import parse_partition, MANIFEST_PREFIX
+from dedup import event_id_from_key
+from validation import raw_event_validator
+from instrumentation import timer, increment, print_summary
+
+## A long-running SQS consumer, as an alternative to running `lambda_handler` once per message.
+##
+## Several poller threads long-poll the queue for up to 10 messages at a time.  Each message is an S3
+## notification for a raw object (one event or a batch of them) or a batch manifest, or a raw CDEvent sent
+## straight to the queue (i.e. by `replay_events.py --sink sqs`).  Raw objects are fetched on a shared thread
+## pool and flattened with
+## `flatten_event_entry`, and the flattened events from every poller are buffered together and written as one
+## NDJSON object per partition:
+##     processed/<partition>worker-<batch_id>.ndjson
+## The buffer is written once it holds `batch_size` events or its oldest event is `max_batch_wait` seconds old.
+## Messages are only deleted (with `delete_message_batch`) after the object holding their events is written,
+## so a crash never loses an event; it is redelivered instead.  If one of a batch's objects fails to write, the
+## objects already written for it are deleted, so the redelivered messages don't write their events twice.  An
+## event that two messages in the same buffer both carry is only written once.  While messages wait in the buffer, a
+## housekeeping thread keeps extending their visibility timeout so slow batches are not redelivered.
+## Messages that fail (missing object, bad JSON) are left alone, so SQS retries them and eventually
+## moves them to the dead-letter queue.  Events that parse but fail schema validation are quarantined the same way
+## the Lambda quarantines them, `quarantine/<partition><event_id>.json` with the source key and the violations,
+## and their message is deleted with the rest of its batch.
+
+SQS_BATCH_LIMIT = 10
+
+def message_references(body):
+    '''
+    Input: `body` (dtype: str) The body of an SQS message
+    Returns: `(keys, events)` The raw object keys the message points to, and any CDEvents it carries directly
+
+    Function Overview:
+        S3 notification bodies hold URL-encoded keys in `Records`; S3's "s3:TestEvent" message holds neither.
+        Raises a ValueError if the body is not JSON.
+    '''
+
+    payload = json.loads(body)
+
+    if isinstance(payload, dict) and 'Records' in payload:
+        keys = [unquote_plus(record['s3']['object']['key']) for record in payload['Records'] if 's3' in record]
+        return keys, []
+
+    if isinstance(payload, dict) and 'context' in payload:
+        return [], [payload]
+
+    return [], []
+
+class SQSWorker():
+    def __init__(self, sqs, s3, queue_url, bucket, poller_threads=4, fetch_workers=32, wait_time=20,
+                 visibility_timeout=60, batch_size=1000, max_batch_wait=5.0, output_prefix="processed/",
+                 compression=None, deduplicator=None, validate=True, quarantine_prefix="quarantine/"):
+        '''
+        Inputs:
+            `sqs`: A boto3 SQS client or a `LocalSQS` (see `local_aws.py`)
+            `s3`: A boto3 S3 client or a `LocalS3`
+            `queue_url` (dtype: str): The queue receiving the raw event notifications
+            `bucket` (dtype: str): The CDEvents bucket
+            `poller_threads` (dtype: int): Number of threads calling `receive_message`
+            `fetch_workers` (dtype: int): Number of concurrent GETs, shared by all pollers
+            `wait_time` (dtype: int): Long polling wait, in seconds (max 20)
+            `visibility_timeout` (dtype: int): Visibility timeout requested on receive, and extended to while a
+                message is still being processed
+            `batch_size` (dtype: int): Write the buffered events once there are this many
+            `max_batch_wait` (dtype: float): ...or once the oldest buffered event is this many seconds old
+            `output_prefix` (dtype: str): The processed folder
+            `compression` (dtype: str): "none", "gzip", or "zstd" (defaults to `CDEVENTS_COMPRESSION`)
+            `deduplicator` (dtype: Deduplicator): Skips events that were already processed (optional, see `dedup.py`)
+            `validate` (dtype: bool): Check events against the raw schema before flattening them
+            `quarantine_prefix` (dtype: str): Where events that fail validation are written
+
+        Returns: object (dtype: SQSWorker) A worker; call `run()` to start it and `stop()` to stop it
+        '''
+
+        self.sqs = sqs
+        self.s3 = s3
+        self.queue_url = queue_url
+        self.bucket = bucket
+        self.poller_threads = poller_threads
+        self.fetch_workers = fetch_workers
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.batch_size = batch_size
+        self.max_batch_wait = max_batch_wait
+        self.output_prefix = output_prefix
+        self.compression = compression or default_codec()
+        self.deduplicator = deduplicator
+        self.validator = raw_event_validator() if validate else None
+        self.quarantine_prefix = quarantine_prefix
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.executor = None
+
+        self.pending = {}           ## partition -> flattened events waiting to be written
+        self.pending_count = 0
+        self.pending_since = None
+        self.pending_receipts = []  ## receipt handles to delete once the pending events are written
+        self.pending_event_ids = []
+        self.pending_records = set() ## event ids of the buffered records, so an event is only buffered once
+        self.in_flight = {}         ## receipt handle -> when its visibility was last set
+
+        self.stats = {"messages_received": 0, "messages_deleted": 0, "messages_failed": 0, "events_written": 0,
+                      "duplicates_skipped": 0, "events_quarantined": 0, "objects_written": 0,
+                      "visibility_extensions": 0}
+
+        return
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+        increment("worker_" + name, amount)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def receive(self):
+        with timer("sqs_receive"):
+            response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=SQS_BATCH_LIMIT,
+                                                WaitTimeSeconds=self.wait_time, VisibilityTimeout=self.visibility_timeout)
+
+        messages = response.get('Messages', [])
+        if messages:
+            now = time.time()
+            with self.lock:
+                for message in messages:
+                    self.in_flight[message['ReceiptHandle']] = now
+            self.count("messages_received", len(messages))
+
+        return messages
+
+    def fail(self, message, error):
+        '''
+        Function Overview:
+            Stops tracking a message that could not be processed, so its visibility timeout runs out and SQS
+            redelivers it (or moves it to the dead-letter queue).
+        '''
+
+        print("Failed to process message {}: {}".format(message['MessageId'], error))
+        with self.lock:
+            self.in_flight.pop(message['ReceiptHandle'], None)
+        self.count("messages_failed")
+
+        return
+
+    def expand_keys(self, keys):
+        expanded = []
+        for key in keys:
+            if key.startswith(MANIFEST_PREFIX):
+                manifest, error = fetch_manifest(self.s3, self.bucket, key)
+                if error is not None:
+                    raise ValueError(error)
+                expanded.extend(manifest['keys'])
+            else:
+                expanded.append(key)
+
+        return expanded
+
+    def handle_messages(self, messages):
+        '''
+        Input: `messages` (dtype: list) Messages from one `receive_message` call
+
+        Function Overview:
+            Fetches and flattens the events every message refers to, and adds them to the write buffer.  A message
+            is only buffered if all of its events were processed.
+        '''
+
+        parsed = []
+        for message in messages:
+            try:
+                keys, events = message_references(message['Body'])
+                keys = self.expand_keys(keys)
+            except (ValueError, KeyError, TypeError) as e:
+                self.fail(message, "{}: {}".format(type(e).__name__, e))
+                continue
+
+            if self.deduplicator is not None:
+                fresh = [key for key in keys if not self.deduplicator.is_duplicate(event_id_from_key(key))]
+                self.count("duplicates_skipped", len(keys) - len(fresh))
+                keys = fresh
+
+            parsed.append((message, keys, events))
+
+        ## Fetch the keys of every message in the batch at once
+        all_keys = [key for _, keys, _ in parsed for key in keys]
+        fetched = dict((key, (key_events, error)) for key, key_events, error in
+                       self.executor.map(lambda key: fetch_raw_events(self.s3, self.bucket, key), all_keys))
+
+        for message, keys, events in parsed:
+            records = []
+            try:
+                for key in keys:
+                    key_events, error = fetched[key]
+                    if error is not None:
+                        raise ValueError(error)
+                    partition = parse_partition(key)
+                    records.extend((partition, normalize_processed(flatten_event_entry(event)))
+                                   for event in self.valid(self.fresh(key_events), key, partition))
+                for event in self.valid(self.fresh(events), None, None, message['MessageId']):
+                    records.append((None, normalize_processed(flatten_event_entry(event))))
+            except (ValueError, KeyError, TypeError, AttributeError, ClientError, OSError) as e:
+                self.fail(message, "{}: {}".format(type(e).__name__, e))
+                continue
+
+            self.buffer(message['ReceiptHandle'], records, [event_id_from_key(key) for key in keys])
+
+        return
+
+    def fresh(self, events):
+        '''
+        Input: `events` (dtype: list) Raw events from one object or message
+        Returns: `events` (dtype: list) The events the deduplicator has not seen (a batch object may repeat events
+            that were already processed on their own)
+        '''
+
+        if self.deduplicator is None:
+            return events
+
+        fresh = [event for event in events
+                 if not (isinstance(event, dict) and self.deduplicator.is_duplicate(event.get('event_id')))]
+        self.count("duplicates_skipped", len(events) - len(fresh))
+
+        return fresh
+
+    def valid(self, events, key, partition, fallback_id=None):
+        '''
+        Inputs:
+            `events` (dtype: list): Raw events from one object (`key`) or message (`key` is None)
+            `partition` (dtype: str): The partition of the raw object, if any
+            `fallback_id` (dtype: str): Names the quarantine object of an event without an id (defaults to the
+                object's name)
+
+        Returns: `events` (dtype: list) The events that pass schema validation; the rest are quarantined
+        '''
+
+        if self.validator is None:
+            return events
+
+        valid = []
+        for event in events:
+            with timer("validate"):
+                problems = self.validator.check(event)
+            if problems:
+                self.quarantine(event, problems, key, partition, fallback_id)
+            else:
+                valid.append(event)
+
+        return valid
+
+    def quarantine(self, event, problems, key, partition, fallback_id=None):
+        event_id = event.get('event_id') if isinstance(event, dict) else None
+        if not isinstance(event_id, str) or not event_id:
+            event_id = fallback_id or event_id_from_key(key)
+        violations = [{"path": path, "error": error} for path, error in problems]
+        quarantine_key = "{}{}{}.json".format(self.quarantine_prefix, partition or "", event_id)
+
+        with timer("s3_put_quarantine"):
+            self.s3.put_object(Bucket=self.bucket, Key=quarantine_key, ContentType="application/json",
+                               Body=json.dumps({"source_key": key, "violations": violations, "event": event}))
+        self.count("events_quarantined")
+
+        return
+
+    def buffer(self, receipt_handle, records, object_ids=()):
+        '''
+        Inputs:
+            `receipt_handle` (dtype: str): The message the records came from
+            `records` (dtype: list): `(partition, flattened event)` pairs
+            `object_ids` (dtype: list): The names of the raw objects read (see `event_id_from_key`), marked as
+                processed along with the events so a redelivered batch object is skipped before it is fetched
+        '''
+
+        duplicates = 0
+        with self.lock:
+            for partition, record in records:
+                if record['event_id'] in self.pending_records:
+                    duplicates += 1
+                    continue
+                self.pending_records.add(record['event_id'])
+                self.pending.setdefault(partition or "", []).append(record)
+                self.pending_event_ids.append(record['event_id'])
+            self.pending_event_ids.extend(object_ids)
+            self.pending_count += len(records) - duplicates
+            self.pending_receipts.append(receipt_handle)
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            full = self.pending_count >= self.batch_size
+
+        if duplicates:
+            self.count("duplicates_skipped", duplicates)
+        if full:
+            self.flush()
+
+        return
+
+    def flush(self):
+        '''
+        Function Overview:
+            Writes the buffered events (one NDJSON object per partition), then deletes the messages they came from.
+            If any object fails to write, the ones already written are deleted and the messages are left to be
+            redelivered, so the batch is written whole or not at all.
+        '''
+
+        with self.flush_lock:
+            with self.lock:
+                pending, receipts, event_ids = self.pending, self.pending_receipts, self.pending_event_ids
+                self.pending, self.pending_receipts, self.pending_event_ids = {}, [], []
+                self.pending_records = set()
+                self.pending_count = 0
+                self.pending_since = None
+
+            if not receipts:
+                return
+
+            batch_id = str(uuid.uuid4())
+            written = []
+            try:
+                for partition, records in pending.items():
+                    key = "{}{}worker-{}.ndjson{}".format(self.output_prefix, partition, batch_id, extension(self.compression))
+                    with timer("json_dumps"):
+                        body = "".join(json.dumps(record) + "\n" for record in records)
+                    put_args = put_arguments(body, self.compression, content_type="application/x-ndjson")
+
+                    with timer("s3_put_batch"):
+                        self.s3.put_object(Bucket=self.bucket, Key=key, **put_args)
+                    written.append((key, len(records)))
+                    increment("bytes_written", len(put_args['Body']))
+            except (ClientError, OSError) as e:
+                ## Leave the messages to time out and be redelivered
+                print("Failed to write batch {}: {}".format(batch_id, e))
+                self.remove_partial(written)
+                with self.lock:
+                    for handle in receipts:
+                        self.in_flight.pop(handle, None)
+                self.count("messages_failed", len(receipts))
+                return
+
+            self.count("objects_written", len(written))
+            self.count("events_written", sum(count for _, count in written))
+            if self.deduplicator is not None:
+                for event_id in event_ids:
+                    self.deduplicator.mark(event_id)
+
+            self.delete(receipts)
+
+        return
+
+    def remove_partial(self, written):
+        '''
+        Input: `written` (dtype: list) `(key, record count)` of the objects a failed flush did write
+
+        Function Overview:
+            Deletes them, since their messages will be redelivered and written again.  A key that can't be deleted
+            is reported; its events are then written twice, which the downstream dedup/compaction tolerates.
+        '''
+
+        for key, _ in written:
+            try:
+                with timer("s3_delete_partial"):
+                    self.s3.delete_object(Bucket=self.bucket, Key=key)
+            except (ClientError, OSError) as e:
+                print("Failed to remove {} from a failed batch: {}".format(key, e))
+
+        return
+
+    def delete(self, receipts):
+        for offset in range(0, len(receipts), SQS_BATCH_LIMIT):
+            chunk = receipts[offset:offset + SQS_BATCH_LIMIT]
+            entries = [{"Id": str(i), "ReceiptHandle": handle} for i, handle in enumerate(chunk)]
+
+            with timer("sqs_delete_batch"):
+                response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+            ## A failed delete means the message was already redelivered; its events are written again under a
+            ## new batch id, which the downstream dedup/compaction tolerates
+            self.count("messages_deleted", len(response.get('Successful', [])))
+            with self.lock:
+                for handle in chunk:
+                    self.in_flight.pop(handle, None)
+
+        return
+
+    def extend_visibility(self):
+        '''
+        Function Overview:
+            Extends the visibility timeout of every message that has been in flight for half of it.
+        '''
+
+        now = time.time()
+        with self.lock:
+            due = [handle for handle, since in self.in_flight.items() if now - since >= self.visibility_timeout / 2.0]
+            for handle in due:
+                self.in_flight[handle] = now
+
+        for offset in range(0, len(due), SQS_BATCH_LIMIT):
+            entries = [{"Id": str(i), "ReceiptHandle": handle, "VisibilityTimeout": self.visibility_timeout}
+                       for i, handle in enumerate(due[offset:offset + SQS_BATCH_LIMIT])]
+            with timer("sqs_change_visibility"):
+                self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            self.count("visibility_extensions", len(entries))
+
+        return
+
+    def housekeeping(self, interval):
+        while not self.stop_event.wait(interval):
+            self.extend_visibility()
+
+            with self.lock:
+                stale = self.pending_since is not None and time.time() - self.pending_since >= self.max_batch_wait
+            if stale:
+                self.flush()
+
+        return
+
+    def poll(self, stop_when_idle):
+        while not self.stop_event.is_set():
+            messages = self.receive()
+
+            if not messages:
+                if stop_when_idle:
+                    return
+                continue
+
+            self.handle_messages(messages)
+
+        return
+
+    def run(self, stop_when_idle=False):
+        '''
+        Input: `stop_when_idle` (dtype: bool) Return once a receive comes back empty instead of polling until `stop()`
+        Returns: `stats` (dtype: dict) Counts of messages and events handled
+        '''
+
+        self.stop_event.clear()
+        interval = max(min(self.visibility_timeout / 4.0, self.max_batch_wait / 2.0, 1.0), 0.05)
+        housekeeper = threading.Thread(target=self.housekeeping, args=(interval,), daemon=True)
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            self.executor = executor
+            housekeeper.start()
+
+            pollers = [threading.Thread(target=self.poll, args=(stop_when_idle,)) for _ in range(self.poller_threads)]
+            for poller in pollers:
+                poller.start()
+            try:
+                for poller in pollers:
+                    poller.join()
+            except KeyboardInterrupt:
+                ## Finish the messages already received, then write and delete them before exiting
+                self.stop()
+                for poller in pollers:
+                    poller.join()
+
+            self.stop_event.set()
+            housekeeper.join()
+            self.flush()
+
+        if self.deduplicator is not None:
+            self.deduplicator.flush()
+
+        return dict(self.stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process raw CDEvent notifications from SQS with a long-running worker")
+    parser.add_argument("--queue-url", required=True)
+    parser.add_argument("--bucket", default=os.environ.get("CDEVENT_BUCKET"))
+    parser.add_argument("--pollers", type=int, default=4)
+    parser.add_argument("--fetch-workers", type=int, default=32)
+    parser.add_argument("--visibility-timeout", type=int, default=60)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--max-batch-wait", type=float, default=5.0)
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default=None)
+    parser.add_argument("--drain", action="store_true", help="Exit once the queue is empty instead of running until interrupted")
+    parser.add_argument("--no-validate", action="store_true", help="Flatten events without checking the raw schema")
+    args = parser.parse_args()
+
+    import boto3
+
+    worker = SQSWorker(boto3.client("sqs"), boto3.client("s3"), args.queue_url, args.bucket,
+                       poller_threads=args.pollers, fetch_workers=args.fetch_workers,
+                       visibility_timeout=args.visibility_timeout, batch_size=args.batch_size,
+                       max_batch_wait=args.max_batch_wait, compression=args.compression, validate=not args.no_validate)
+
+    stats = worker.run(stop_when_idle=args.drain)
+    print(json.dumps(stats, indent=4))
+    print_summary("sqs_worker.py")
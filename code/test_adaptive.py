@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import threading
+import unittest
+from unittest import mock
+from collections import Counter
+from copy import deepcopy
+from itertools import islice
+import adaptive
+from adaptive import AIMDController, AdaptiveUploader, is_throttle
+from event_streams import iter_events, iter_body
+from compression import open_body
+from local_aws import LocalS3, LocalSQS, client_error, s3_notification, sqs_lambda_event, load_lambda
+from backfill_raw import Backfill
+from sqs_worker import SQSWorker
+from dedup import Deduplicator
+from datetime import datetime
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class ThrottlingS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose puts take `delay` seconds, and that answers 503 SlowDown when more than `limit` puts
+        are in flight, or to the first `fail_first` puts.
+    '''
+    def __init__(self, limit=None, fail_first=0, delay=0):
+        LocalS3.__init__(self)
+        self.delay = delay
+        self.limit = limit
+        self.fail_first = fail_first
+        self.in_flight = 0
+        self.puts = 0
+        self.throttled = 0
+        self.counter_lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, **kwargs):
+        with self.counter_lock:
+            self.puts += 1
+            self.in_flight += 1
+            throttle = self.puts <= self.fail_first or (self.limit is not None and self.in_flight > self.limit)
+            if throttle:
+                self.throttled += 1
+        try:
+            time.sleep(self.delay)
+            if throttle:
+                raise client_error("SlowDown", "Please reduce your request rate.", "PutObject")
+            return LocalS3.put_object(self, Bucket, Key, **kwargs)
+        finally:
+            with self.counter_lock:
+                self.in_flight -= 1
+
+class TestAdaptive(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the AIMD controller and adaptive uploader in `adaptive.py`,
+        and the adaptive part writes in `lambda_function.py`.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 1500))
+
+    def test_controller(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the batch size grows until calls get slower than the target and then saws below it, that
+            throttling halves the concurrency once per round, and that both stay within their bounds.
+        '''
+
+        controller = AIMDController(initial_batch=10, batch_step=10, max_batch=1000, initial_concurrency=1,
+                                    max_concurrency=1, target_latency=1.0)
+        sizes = []
+        for _ in range(200):
+            size = controller.batch_size
+            sizes.append(size)
+            controller.record(size / 100.0, items=size)  ## A backend that slows down past 100 items per call
+
+        self.assertGreater(controller.stats()['decreases_latency'], 2)
+        self.assertTrue(all(10 <= size <= 150 for size in sizes))
+        self.assertGreater(max(sizes[100:]), 80)
+
+        controller = AIMDController(initial_concurrency=8, max_concurrency=8, min_concurrency=2)
+        controller.record(0.01, throttled=True)
+        self.assertEqual(controller.concurrency, 4)
+        for _ in range(3):
+            controller.record(0.01, throttled=True)
+        self.assertEqual(controller.concurrency, 4)
+        controller.record(0.01, throttled=True)
+        self.assertEqual(controller.concurrency, 2)
+        for _ in range(20):
+            controller.record(0.01, throttled=True)
+        self.assertEqual(controller.concurrency, 2)
+        self.assertEqual(controller.batch_size, 100)
+
+        self.assertTrue(is_throttle(client_error("SlowDown", "Please reduce your request rate.", "PutObject")))
+        self.assertFalse(is_throttle(client_error("NoSuchKey", "The specified key does not exist.", "GetObject")))
+
+    def test_uploader(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every event is uploaded exactly once when S3 throttles, and that the controller shrinks
+            the concurrency when it does.
+        '''
+
+        store = ThrottlingS3(fail_first=6, delay=0.005)
+        controller = AIMDController(initial_batch=50, max_batch=200, initial_concurrency=8, max_concurrency=16)
+        uploader = AdaptiveUploader(store, "bucket", controller, layout="partitioned", compression="gzip",
+                                    max_attempts=10)
+        with mock.patch.object(adaptive, "backoff", lambda attempt: 0.001):
+            for start in range(0, len(self.events), 100):
+                uploader.submit(self.events[start:start + 100])
+            stats = uploader.close()
+
+        self.assertEqual((stats['events'], stats['failed_events']), (len(self.events), 0))
+        self.assertEqual(store.throttled, 6)
+        self.assertGreater(stats['controller']['decreases_throttled'], 0)
+
+        uploaded = Counter()
+        for key in store.list_keys("bucket", "raw/"):
+            self.assertRegex(key, r"^raw/dt=\d{4}-\d{2}-\d{2}/hr=\d{2}/\d{2}/batch-[0-9a-f-]+\.ndjson\.gz$")
+            body = open_body(store.get_object(Bucket="bucket", Key=key), key)
+            uploaded.update(event['event_id'] for event in iter_body(body, key))
+        self.assertEqual(uploaded, Counter(event['event_id'] for event in self.events))
+
+    def test_uploader_bounds_batches_in_flight(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that `submit` blocks once `max_concurrency` batches are waiting or uploading, instead of queueing
+            every batch a fast producer hands it.
+        '''
+
+        gate = threading.Event()
+
+        class GatedS3(LocalS3):
+            def put_object(self, **kwargs):
+                gate.wait()
+                return LocalS3.put_object(self, **kwargs)
+
+        store = GatedS3()
+        controller = AIMDController(initial_batch=10, max_batch=10, initial_concurrency=2, max_concurrency=2)
+        uploader = AdaptiveUploader(store, "bucket", controller, layout="flat", compression="none")
+        producer = threading.Thread(target=lambda: [uploader.submit(self.events[start:start + 10])
+                                                    for start in range(0, 100, 10)], daemon=True)
+        producer.start()
+        try:
+            time.sleep(0.2)
+            self.assertEqual(len(uploader.futures), 2)
+            self.assertTrue(producer.is_alive())
+        finally:
+            gate.set()
+        producer.join()
+        stats = uploader.close()
+        self.assertEqual((stats['events'], stats['objects']), (100, 10))
+
+    def test_batches_end_at_hour_boundaries(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the uploader ends a batch when the next event is from another hour, so every object and
+            manifest holds events from a single hour.
+        '''
+
+        events = deepcopy(self.events[:250])
+        for event in events[120:]:
+            event['context']['timestamp'] = event['context']['timestamp'].replace(" 22:", " 23:")
+
+        store = LocalS3()
+        uploader = AdaptiveUploader(store, "bucket", AIMDController(initial_batch=100), layout="partitioned",
+                                    compression="none")
+        uploader.submit(events[:110])
+        uploader.submit(events[110:])
+        stats = uploader.close()
+
+        self.assertEqual(stats['events'], 250)
+        for key in stats['keys']:
+            body = open_body(store.get_object(Bucket="bucket", Key=key), key)
+            hours = {event['context']['timestamp'][:13] for event in iter_body(body, key)}
+            self.assertEqual(hours, {key.split("/")[1][3:] + " " + key.split("/")[2][3:]})
+        self.assertEqual(len(store.list_keys("bucket", "manifests/raw/dt=2023-04-04/hr=23/")), 2)
+
+    def test_uploaded_batches_are_readable(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the batch objects written by the uploader are listed in manifests, and that a manifest-driven
+            backfill, the SQS worker, and the Lambda all read every event in them and skip a redelivered batch.
+        '''
+
+        store = LocalS3()
+        uploader = AdaptiveUploader(store, "bucket", AIMDController(initial_batch=100), layout="partitioned",
+                                    compression="gzip")
+        uploader.submit(self.events[:500])
+        keys = uploader.close()['keys']
+        expected = sorted(event['event_id'] for event in self.events[:500])
+
+        manifested = [key for manifest in (json.loads(store.get_object(Bucket="bucket", Key=manifest_key)['Body'].read())
+                                           for manifest_key in store.list_keys("bucket", "manifests/raw/"))
+                      for key in manifest['keys']]
+        self.assertEqual(sorted(manifested), sorted(keys))
+
+        report = Backfill(store, "bucket", run_id="window", start=datetime(2023, 4, 4, 0), end=datetime(2023, 4, 6)).run()
+        self.assertEqual((report['records'], report['failed']), (500, 0))
+
+        sqs = LocalSQS()
+        queue_url = sqs.create_queue(QueueName="cdevents")['QueueUrl']
+        for key in keys:
+            sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(s3_notification("bucket", key)))
+        stats = SQSWorker(sqs, store, queue_url, "bucket", wait_time=0, compression="none", output_prefix="worker/",
+                          deduplicator=Deduplicator()).run(stop_when_idle=True)
+        self.assertEqual((stats['messages_failed'], stats['events_written']), (0, 500))
+
+        lambda_function = load_lambda(store, "bucket")
+        notification = sqs_lambda_event([s3_notification("bucket", keys[0])])
+        self.assertEqual(lambda_function.lambda_handler(notification, None)['events'], 100)
+        self.assertEqual(lambda_function.lambda_handler(notification, None)['skipped'], "duplicate")
+
+        written = []
+        for key in store.list_keys("bucket", "worker/"):
+            body = open_body(store.get_object(Bucket="bucket", Key=key), key)
+            written.extend(event['event_id'] for event in iter_body(body, key))
+        self.assertEqual(sorted(written), expected)
+
+    def test_lambda_parts(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the Lambda retries parts that are throttled, and that parts keep a fixed size so a
+            retried object writes the same parts.
+        '''
+
+        store = ThrottlingS3(fail_first=2)
+        keys = ["raw/batch-{}.ndjson".format(n) for n in range(2)]
+        for n, key in enumerate(keys):
+            body = "".join(json.dumps(event) + "\n" for event in self.events[n * 750:(n + 1) * 750])
+            LocalS3.put_object(store, Bucket="bucket", Key=key, Body=body.encode("utf-8"))
+        store.puts = 0
+
+        lambda_function = load_lambda(store, "bucket")
+        with mock.patch.object(lambda_function, "PART_SIZE", 300), mock.patch.object(adaptive, "backoff", lambda attempt: 0):
+            lambda_function.configure()
+            first = lambda_function.lambda_handler(sqs_lambda_event([s3_notification("bucket", keys[0])]), None)
+            second = lambda_function.lambda_handler(sqs_lambda_event([s3_notification("bucket", keys[1])]), None)
+
+        self.assertEqual((first['events'], second['events']), (750, 750))
+        self.assertEqual([len(response['parts']) for response in (first, second)], [3, 3])
+        self.assertEqual(lambda_function.get_part_controller().stats()['throttled'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
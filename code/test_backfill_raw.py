@@ -0,0 +1,206 @@
+import os
+from local_aws import LocalS3
+from event_streams import iter_events
+from backfill_raw import Backfill
+from key_layout import raw_key, build_manifest, write_manifest
+from compression import compress
+from wire_format import encode_stream
+from datetime import datetime
+import unittest
+import json
+import sys
+import subprocess
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class FlakyS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` that fails every GET after the first `fail_after`, to simulate a backfill being interrupted.
+    '''
+    def __init__(self, root, fail_after):
+        LocalS3.__init__(self, root)
+        self.fail_after = fail_after
+        self.gets = 0
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if "_checkpoints" not in Key:
+            self.gets += 1
+            if self.gets > self.fail_after:
+                raise RuntimeError("simulated interruption")
+        return LocalS3.get_object(self, Bucket, Key, **kwargs)
+
+class TestBackfillRaw(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the parallel reprocessing job in `backfill_raw.py`
+        against the local object store from `local_aws.py`.
+    '''
+
+    def setUp(self):
+        self.store = LocalS3()
+        self.events = list(islice(iter_events(raw_events_path), 60))
+        for event in self.events:
+            self.store.put_object(Bucket="bucket", Key="raw/{}.json".format(event['event_id']), Body=json.dumps(event))
+        self.store.put_object(Bucket="bucket", Key="raw/0-not-json.json", Body="{not json")
+
+    def read_output(self, report):
+        records = []
+        for key in self.store.list_keys("bucket", report['output']):
+            if key.endswith(".ndjson"):
+                body = self.store.get_object(Bucket="bucket", Key=key)['Body'].read().decode("utf-8")
+                records.extend(json.loads(line) for line in body.splitlines())
+        return records
+
+    def test_backfill_flattens_everything(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will reprocess every raw object and make sure each event is flattened exactly once,
+            and that the malformed object is reported as a failure instead of stopping the run.
+        '''
+        report = Backfill(self.store, "bucket", run_id="full", part_size=7, fetch_workers=4, page_size=5).run()
+        records = self.read_output(report)
+
+        self.assertEqual(report['records'], len(self.events))
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(sorted(record['event_id'] for record in records), sorted(event['event_id'] for event in self.events))
+
+        return
+
+    def test_backfill_resumes_from_checkpoint(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will interrupt a backfill part way through, then rerun it with the same run id and check
+            that the resumed run finishes without losing or duplicating any events.
+        '''
+        flaky = FlakyS3(self.store.root, fail_after=25)
+        with self.assertRaises(RuntimeError):
+            Backfill(flaky, "bucket", run_id="resume", part_size=3, fetch_workers=1, range_workers=1, page_size=4).run()
+
+        report = Backfill(self.store, "bucket", run_id="resume", part_size=3, fetch_workers=4, page_size=4).run()
+        event_ids = [record['event_id'] for record in self.read_output(report)]
+
+        self.assertEqual(len(event_ids), len(set(event_ids)))
+        self.assertEqual(set(event_ids), set(event['event_id'] for event in self.events))
+
+        return
+
+    def test_backfill_time_window_from_manifests(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will upload a partitioned batch with a manifest and reprocess just its hour, making sure the
+            events come from the manifest (the flat objects written in `setUp` are not picked up).
+        '''
+        entries = []
+        for event in self.events[:10]:
+            key = raw_key(event, layout="partitioned", shards=4)
+            self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+            entries.append((key, event, 0))
+        write_manifest(self.store, "bucket", build_manifest(entries, "partitioned"))
+
+        report = Backfill(self.store, "bucket", run_id="window", start=datetime(2023, 4, 4, 22),
+                          end=datetime(2023, 4, 4, 23)).run()
+
+        self.assertEqual(report['records'], 10)
+        self.assertEqual(sorted(record['event_id'] for record in self.read_output(report)),
+                         sorted(event['event_id'] for event in self.events[:10]))
+
+        return
+
+    def test_backfill_batch_objects(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will backfill raw objects that each hold a batch of events (gzipped NDJSON, a JSON array, and
+            a `.cdeb` stream) and check that every event in them is flattened.
+        '''
+        store = LocalS3()
+        batches = {
+            "raw/batch-a.ndjson.gz": compress("".join(json.dumps(event) + "\n" for event in self.events[:20]), "gzip"),
+            "raw/batch-b.json": json.dumps(self.events[20:40]),
+            "raw/batch-c.cdeb": encode_stream(self.events[40:])
+        }
+        for key, body in batches.items():
+            store.put_object(Bucket="bucket", Key=key, Body=body)
+
+        self.store = store
+        report = Backfill(store, "bucket", run_id="batches", part_size=7).run()
+
+        self.assertEqual((report['records'], report['failed']), (len(self.events), 0))
+        self.assertEqual(sorted(record['event_id'] for record in self.read_output(report)),
+                         sorted(event['event_id'] for event in self.events))
+
+        return
+
+    def test_backfill_splits_partitioned_keys(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will backfill events in the partitioned layout and check that they are spread over several
+            key ranges (instead of all landing in the range holding `raw/dt=`), and that the boundaries are saved
+            so a resumed run keeps its ranges after new partitions appear.
+        '''
+        store = LocalS3()
+        for event in self.events:
+            store.put_object(Bucket="bucket", Key=raw_key(event, layout="partitioned", shards=16), Body=json.dumps(event))
+
+        backfill = Backfill(store, "bucket", run_id="partitioned", part_size=1000)
+        report = backfill.run()
+        busy_ranges = [name for name, checkpoint in report['ranges'].items() if checkpoint['records']]
+
+        self.assertEqual(report['records'], len(self.events))
+        self.assertGreater(len(busy_ranges), 4)
+
+        moved = dict(self.events[0], event_id="0" + self.events[0]['event_id'][1:])
+        moved['context'] = dict(moved['context'], timestamp="2030-01-01 00:00:00.000000")
+        store.put_object(Bucket="bucket", Key=raw_key(moved, layout="partitioned", shards=16), Body=json.dumps(moved))
+        self.assertEqual(Backfill(store, "bucket", run_id="partitioned").load_boundaries(), backfill.boundaries)
+
+        return
+
+    def test_cli_without_aws(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will run `backfill_raw.py --local-root` with no bucket variable and no AWS credentials, which
+            must not look anything up in AWS (importing `simulation_functions` used to call ssm).
+        '''
+        environment = {name: value for name, value in os.environ.items()
+                       if name != "CDEVENT_BUCKET" and not name.startswith("AWS_")}
+        environment.update({"AWS_SHARED_CREDENTIALS_FILE": os.devnull, "AWS_CONFIG_FILE": os.devnull,
+                            "AWS_EC2_METADATA_DISABLED": "true"})
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backfill_raw.py")
+
+        result = subprocess.run([sys.executable, script, "--local-root", self.store.root, "--bucket", "bucket",
+                                 "--run-id", "cli"], env=environment, capture_output=True, text=True, timeout=120)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('"records": {}'.format(len(self.events)), result.stdout)
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
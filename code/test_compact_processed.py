@@ -0,0 +1,138 @@
+import os
+from local_aws import LocalS3
+from event_streams import iter_events, event_timestamp
+from key_layout import partition_path
+from simulation_functions import flatten_event_entry
+from compact_processed import Compaction
+from unittest import mock
+import compact_processed
+from compression import decode_body
+from datetime import timedelta
+import unittest
+import json
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class FailingDeleteS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose batch deletes fail, to simulate a compaction being interrupted after it committed.
+    '''
+    def delete_objects(self, Bucket, Delete):
+        raise RuntimeError("simulated interruption")
+
+class SecondDeleteFailsS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose second batch delete fails, to simulate a compaction interrupted part way through its deletes.
+    '''
+    def __init__(self, root=None):
+        super().__init__(root)
+        self.delete_calls = 0
+
+    def delete_objects(self, Bucket, Delete):
+        self.delete_calls += 1
+        if self.delete_calls == 2:
+            raise RuntimeError("simulated interruption")
+        return super().delete_objects(Bucket=Bucket, Delete=Delete)
+
+class TestCompactProcessed(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the small-file compaction in `compact_processed.py`
+        against the local object store from `local_aws.py`.
+    '''
+
+    def setUp(self):
+        self.root = LocalS3().root
+        self.store = LocalS3(self.root)
+        self.events = list(islice(iter_events(raw_events_path), 40))
+        for event in self.events:
+            key = "processed/{}{}.json".format(partition_path(event_timestamp(event)), event['event_id'])
+            self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(flatten_event_entry(event)))
+
+        timestamps = sorted(event_timestamp(event) for event in self.events)
+        self.start = timestamps[0].replace(minute=0, second=0, microsecond=0)
+        self.end = timestamps[-1].replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+    def read_ndjson(self, commit):
+        records = []
+        for file in commit['files']:
+            response = self.store.get_object(Bucket="bucket", Key=file['key'])
+            records.extend(json.loads(line) for line in decode_body(response, file['key']).decode("utf-8").splitlines())
+        return records
+
+    def test_compaction_merges_and_deletes(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every event ends up in sorted merged files and that the small objects are deleted.
+        '''
+
+        commit = Compaction(self.store, "bucket", file_format="ndjson", max_rows_per_file=15).run(self.start, self.end)
+        records = self.read_ndjson(commit)
+
+        self.assertEqual(commit['status'], "cleaned")
+        self.assertEqual(sorted(r['event_id'] for r in records), sorted(e['event_id'] for e in self.events))
+        for file in commit['files']:
+            self.assertLessEqual(file['rows'], 15)
+        self.assertEqual(self.store.list_keys("bucket", "processed/"), [])
+
+    def test_interrupted_compaction_resumes(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that no originals are lost when deletion fails after the commit, and that a rerun finishes it.
+        '''
+
+        with self.assertRaises(RuntimeError):
+            Compaction(FailingDeleteS3(self.root), "bucket", file_format="ndjson").run(self.start, self.end)
+        self.assertEqual(len(self.store.list_keys("bucket", "processed/")), len(self.events))
+
+        commit = Compaction(self.store, "bucket", file_format="ndjson").run(self.start, self.end)
+        self.assertEqual(commit['status'], "cleaned")
+        self.assertEqual(self.store.list_keys("bucket", "processed/"), [])
+        self.assertEqual(len(self.read_ndjson(commit)), len(self.events))
+
+    def test_partial_delete_is_finished_before_new_sources(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Interrupts the deletes after the first batch, adds new sources, and checks that the rerun finishes
+            the old commit first, so every event is compacted exactly once.
+        '''
+
+        with mock.patch.object(compact_processed, "DELETE_BATCH_SIZE", 10):
+            with self.assertRaises(RuntimeError):
+                Compaction(SecondDeleteFailsS3(self.root), "bucket", file_format="ndjson").run(self.start, self.end)
+
+            extra = list(islice(iter_events(raw_events_path), 40, 50))
+            for event in extra:
+                key = "processed/{}{}.json".format(partition_path(event_timestamp(event)), event['event_id'])
+                self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(flatten_event_entry(event)))
+            end = max(self.end, max(event_timestamp(event) for event in extra).replace(minute=0, second=0,
+                                                                                       microsecond=0) + timedelta(hours=1))
+
+            Compaction(self.store, "bucket", file_format="ndjson").run(self.start, end)
+
+        commits = [json.loads(self.store.get_object(Bucket="bucket", Key=key)['Body'].read())
+                   for key in self.store.list_keys("bucket", "compacted/_commits/") if key.endswith(".json")]
+        records = [record for commit in commits for record in self.read_ndjson(commit)]
+
+        self.assertEqual(sorted(r['event_id'] for r in records), sorted(e['event_id'] for e in self.events + extra))
+        self.assertEqual([commit['status'] for commit in commits], ["cleaned", "cleaned"])
+        self.assertEqual(self.store.list_keys("bucket", "processed/"), [])
+        self.assertEqual(self.store.list_keys("bucket", "compacted/_commits/_pending/"), [])
+
+if __name__ == '__main__':
+    unittest.main()
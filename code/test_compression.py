@@ -0,0 +1,113 @@
+from compression import compress, decompress, detect_codec, put_arguments, decode_body, zstandard
+from local_aws import LocalS3
+from replay_events import replay_events, LambdaReplaySink
+from event_streams import iter_events
+import unittest
+import os
+import json
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestCompression(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the optional object compression in `compression.py`,
+        and the Lambda's transparent decompression of raw events.
+    '''
+
+    def test_round_trip_and_detection(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will compress an event with gzip and make sure it round trips, shrinks, and is detected from
+            its ContentEncoding, its extension, or its magic bytes alone.
+        '''
+        event = next(iter_events(raw_events_path))
+        body = json.dumps(event).encode("utf-8")
+
+        compressed = compress(body, "gzip")
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(decompress(compressed, "gzip"), body)
+
+        self.assertEqual(detect_codec(compressed, content_encoding="gzip"), "gzip")
+        self.assertEqual(detect_codec(compressed, key="raw/x.json.gz"), "gzip")
+        self.assertEqual(detect_codec(compressed), "gzip")
+        self.assertEqual(detect_codec(body), "none")
+
+        store = LocalS3()
+        store.put_object(Bucket="bucket", Key="raw/x.json.gz", **put_arguments(body, "gzip"))
+        response = store.get_object(Bucket="bucket", Key="raw/x.json.gz")
+        self.assertEqual(response['ContentEncoding'], "gzip")
+        self.assertEqual(decode_body(response, "raw/x.json.gz"), body)
+
+        return
+
+    def test_concatenated_bodies(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure a body of several gzip members or zstd frames (one per batch appended by
+            `NDJSONFileSink`) decompresses in full, and that a truncated one raises a ValueError.
+        '''
+        batches = [json.dumps(event).encode("utf-8") + b"\n" for event in islice(iter_events(raw_events_path), 3)]
+
+        for codec in ("gzip", "zstd"):
+            if codec == "zstd" and zstandard is None:
+                continue
+            compressed = b"".join(compress(batch, codec) for batch in batches)
+            self.assertEqual(decompress(compressed, codec), b"".join(batches))
+            with self.assertRaises(ValueError):
+                decompress(compressed[:-5], codec)
+
+        return
+
+    @unittest.skipIf(zstandard is None, "zstd needs the optional zstandard package")
+    def test_zstd_round_trip(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will compress an event with zstd and make sure it round trips and is detected from its
+            magic bytes.
+        '''
+        body = json.dumps(next(iter_events(raw_events_path))).encode("utf-8")
+
+        compressed = compress(body, "zstd")
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(decompress(compressed, "zstd"), body)
+        self.assertEqual(detect_codec(compressed), "zstd")
+
+        return
+
+    def test_lambda_reads_compressed_raw_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will replay gzip-compressed raw events through `lambda_handler` and make sure every one is
+            decompressed and flattened.
+        '''
+        events = list(islice(iter_events(raw_events_path), 5))
+        store = LocalS3()
+
+        replay_events(events, LambdaReplaySink(store, "bucket", compression="gzip"), speed=None)
+
+        self.assertTrue(all(key.endswith(".json.gz") for key in store.list_keys("bucket", "raw/")))
+        self.assertEqual(len(store.list_keys("bucket", "processed/")), len(events))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
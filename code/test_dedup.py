@@ -0,0 +1,135 @@
+from dedup import Deduplicator, LRUSet, BloomFilter, BloomFilterStore, MarkerStore, event_id_from_key
+from local_aws import LocalS3, s3_notification, sqs_lambda_event, load_lambda
+from event_streams import iter_events
+import unittest
+import os
+import json
+import tempfile
+from unittest import mock
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestDedup(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the duplicate-event detection in `dedup.py` and its use in
+        `lambda_handler`.
+    '''
+
+    def test_lru_and_bloom_filter(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will check that the LRU forgets the oldest id when full, and that a Bloom filter saved to disk
+            still contains everything that was added and has a false-positive rate near its target.
+        '''
+        recent = LRUSet(2)
+        recent.add("a")
+        recent.add("b")
+        recent.add("c")
+        self.assertNotIn("a", recent)
+        self.assertIn("c", recent)
+
+        path = os.path.join(tempfile.mkdtemp(), "dedup.bloom")
+        store = BloomFilterStore(path, capacity=1000, error_rate=0.01, save_every=10)
+        for i in range(1000):
+            store.add("event-{}".format(i))
+        store.flush()
+
+        reloaded = BloomFilterStore(path)
+        self.assertTrue(all("event-{}".format(i) in reloaded for i in range(1000)))
+        false_positives = sum("other-{}".format(i) in reloaded for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+        merged = BloomFilter(1000, 0.01)
+        merged.merge(reloaded.bloom_filter)
+        self.assertIn("event-5", merged)
+
+        return
+
+    def test_deduplicator_counts_hits_and_misses(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure a marked id is found in memory, that a fresh deduplicator (a new Lambda container)
+            still finds it in the persistent marker store, and that every lookup is counted.
+        '''
+        store = MarkerStore(LocalS3(), "bucket")
+
+        first = Deduplicator(store=store)
+        self.assertFalse(first.is_duplicate("abc"))
+        first.mark("abc")
+        self.assertTrue(first.is_duplicate("abc"))
+
+        second = Deduplicator(store=store)
+        self.assertTrue(second.is_duplicate("abc"))
+        self.assertTrue(second.is_duplicate("abc"))
+
+        self.assertEqual(first.stats, {"hits_memory": 1, "hits_store": 0, "misses": 1})
+        self.assertEqual(second.stats, {"hits_memory": 1, "hits_store": 1, "misses": 0})
+        self.assertEqual(event_id_from_key("raw/dt=2023-04-04/hr=22/07/abc-123.json.gz"), "abc-123")
+
+        return
+
+    def test_lambda_skips_redelivered_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will deliver the same notification to `lambda_handler` twice and make sure the second delivery
+            is skipped without writing the processed event again.
+        '''
+        event = next(iter_events(raw_events_path))
+        store = LocalS3()
+        key = "raw/{}.json".format(event['event_id'])
+        store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+
+        lambda_function = load_lambda(store, "bucket")
+        notification = sqs_lambda_event([s3_notification("bucket", key)])
+
+        first = lambda_function.lambda_handler(notification, None)
+        second = lambda_function.lambda_handler(notification, None)
+
+        self.assertEqual(first['ResponseMetadata']['HTTPStatusCode'], 200)
+        self.assertEqual(second, {"skipped": "duplicate", "event_id": event['event_id']})
+
+        return
+
+    def test_lambda_flushes_bloom_store(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure the Lambda saves its Bloom filter store at the end of an invocation, so an
+            event marked there is still skipped after the container's deduplicator is rebuilt.
+        '''
+        event = next(iter_events(raw_events_path))
+        store = LocalS3()
+        key = "raw/{}.json".format(event['event_id'])
+        store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+        path = os.path.join(tempfile.mkdtemp(), "dedup.bloom")
+        notification = sqs_lambda_event([s3_notification("bucket", key)])
+
+        with mock.patch.dict(os.environ, {"CDEVENTS_DEDUP_STORE": "bloom:" + path}):
+            lambda_function = load_lambda(store, "bucket")
+            lambda_function.lambda_handler(notification, None)
+            self.assertIn(event['event_id'], BloomFilterStore(path))
+
+            lambda_function = load_lambda(store, "bucket")
+            self.assertEqual(lambda_function.lambda_handler(notification, None),
+                             {"skipped": "duplicate", "event_id": event['event_id']})
+
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from collections import defaultdict
+from itertools import islice
+import event_store
+from event_streams import iter_events
+from event_store import EventStore, event_keys, JOURNAL_NAME
+from sketches import stable_hash
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestEventStore(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the indexed raw event store in `event_store.py`.
+    '''
+
+    def setUp(self):
+        self.events = list(iter_events(raw_events_path))
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, "store")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def lifecycles(self, events):
+        runs = defaultdict(list)
+        for event in events:
+            runs[dict(event_keys(event))['run']].append(event)
+        return runs
+
+    def test_lookups(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that events and lifecycles are found before and after the index is built, across segments,
+            after the store is reopened, and when more events are appended later.
+        '''
+
+        store = EventStore(self.root, segment_bytes=256 * 1024)
+        self.assertEqual(store.append(self.events[:2000]), 2000)
+        self.assertEqual(store.get(self.events[5]['event_id']), self.events[5])
+
+        stats = store.build_index()
+        self.assertEqual(stats['locations'], 3 * 2000)
+        self.assertGreater(store.stats()['segments'], 1)
+        store.close()
+
+        runs = self.lifecycles(self.events[:2000])
+        with EventStore(self.root, segment_bytes=256 * 1024) as store:
+            self.assertEqual(store.stats()['unindexed_records'], 0)
+            for event in self.events[:2000:37]:
+                self.assertEqual(store.get(event['event_id']), event)
+
+            run_id, events = next(iter(runs.items()))
+            expected = sorted(events, key=lambda event: event['context']['timestamp'])
+            self.assertEqual(store.lifecycle(run_id), expected)
+            self.assertEqual(store.lifecycle(events[0]['context']['id']), expected)
+            self.assertIsNone(store.get("not-an-event"))
+            self.assertEqual(store.lifecycle("not-a-run"), [])
+
+            store.append(self.events[2000:])
+            self.assertEqual(store.get(self.events[-1]['event_id']), self.events[-1])
+
+        with EventStore(self.root) as store:
+            self.assertEqual(store.stats()['journal_records'], 3 * len(self.events))
+            self.assertEqual(store.get(self.events[-1]['event_id']), self.events[-1])
+
+    def test_hash_collisions(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that lookups stay correct when many keys share a hash, so the table is probed and events have
+            to be checked against the key.
+        '''
+
+        events = list(islice(self.events, 300))
+        with mock.patch.object(event_store, "key_hash", lambda kind, value: stable_hash(value) % 7 + 1):
+            with EventStore(self.root) as store:
+                store.append(events)
+                store.build_index()
+
+                for event in events[::13]:
+                    self.assertEqual(store.get(event['event_id']), event)
+                for run_id, run_events in list(self.lifecycles(events).items())[:10]:
+                    self.assertEqual(len(store.lifecycle(run_id)), len(run_events))
+
+    def test_torn_write(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a write cut short (segment data without its journal records, half a journal record) is
+            rolled back when the store is reopened.
+        '''
+
+        with EventStore(self.root) as store:
+            store.append(self.events[:100])
+
+        segment = os.path.join(self.root, "segment-00000.ndjson")
+        size = os.path.getsize(segment)
+        with open(segment, "ab") as f:
+            f.write(b'{"event_id": "half-writ')
+        with open(os.path.join(self.root, JOURNAL_NAME), "ab") as f:
+            f.write(b"\x01\x02\x03")
+
+        with EventStore(self.root) as store:
+            self.assertEqual(os.path.getsize(segment), size)
+            self.assertEqual(store.stats()['journal_records'], 300)
+            store.append(self.events[100:110])
+            self.assertEqual(store.get(self.events[105]['event_id']), self.events[105])
+            self.assertEqual(store.get(self.events[99]['event_id']), self.events[99])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import json
+import asyncio
+import unittest
+from itertools import islice
+from event_streams import iter_events
+from local_aws import LocalHTTPReceiver
+from http_emitter import HTTPEmitter
+from cloud_events import to_http, from_http
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TruncatingReceiver(LocalHTTPReceiver):
+    '''
+    Class Overview:
+        A `LocalHTTPReceiver` that promises a 10 byte body and closes the connection after 3 bytes.
+    '''
+    async def handle(self, reader, writer):
+        self.connections += 1
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 202 Accepted\r\nContent-Length: 10\r\n\r\nabc")
+        await writer.drain()
+        writer.close()
+
+class TestHTTPEmitter(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the CloudEvents HTTP emitter in `http_emitter.py` against the
+        `LocalHTTPReceiver` stand-in.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 300))
+
+    def test_content_modes(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every content mode delivers every event once over reused keep-alive connections.
+        '''
+
+        for mode, requests in (("binary", 300), ("structured", 300), ("batch", 6)):
+            with LocalHTTPReceiver() as receiver:
+                stats = HTTPEmitter(receiver.url, mode=mode, concurrency=8, batch_size=50).run(self.events)
+
+            self.assertEqual(stats['errors'], 0)
+            self.assertEqual(stats['requests'], requests)
+            self.assertEqual(stats['status_counts'], {"202": requests})
+            self.assertLessEqual(receiver.connections, 8)
+            self.assertEqual(sorted(event['event_id'] for event in receiver.events()),
+                             sorted(event['event_id'] for event in self.events))
+
+        headers = receiver.requests[0]['headers']
+        self.assertEqual(headers['content-type'], "application/cloudevents-batch+json")
+        self.assertIsNotNone(stats['latency_ms']['p99'])
+
+    def test_binary_mode_headers(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks the CloudEvents attributes sent as headers in binary mode, and that they decode back.
+        '''
+
+        headers, body = to_http(self.events[:1], "binary")
+        self.assertEqual(headers['ce-id'], self.events[0]['event_id'])
+        self.assertEqual(headers['ce-type'], self.events[0]['context']['type'])
+        self.assertEqual(headers['ce-time'], self.events[0]['context']['timestamp'].replace(" ", "T") + "Z")
+        self.assertEqual(from_http({k.lower(): v for k, v in headers.items()}, body), ("binary", self.events[:1]))
+
+        with self.assertRaises(ValueError):
+            from_http({"content-type": "application/json"}, json.dumps(self.events[0]).encode("utf-8"))
+        with self.assertRaises(ValueError):
+            to_http(self.events[:2], "structured")
+
+    def test_reconnects_and_errors(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that connections the receiver closes are replaced without errors, and that error statuses and
+            unreachable receivers are counted as errors instead of raising.
+        '''
+
+        with LocalHTTPReceiver(max_requests_per_connection=10) as receiver:
+            stats = HTTPEmitter(receiver.url, concurrency=4).run(self.events)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(len(receiver.requests), len(self.events))
+        self.assertGreaterEqual(stats['connections_opened'], len(self.events) // 10)
+
+        with LocalHTTPReceiver(status=503) as receiver:
+            stats = HTTPEmitter(receiver.url, concurrency=4).run(self.events[:20])
+        self.assertEqual(stats['errors'], 20)
+        self.assertEqual(stats['status_counts'], {"503": 20})
+
+        port = receiver.port
+        stats = HTTPEmitter("http://127.0.0.1:{}/events".format(port), concurrency=2, timeout=2).run(self.events[:3])
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['status_counts'], {"ConnectionRefusedError": 3})
+
+    def test_truncated_responses_and_dead_workers(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that responses cut short are counted as errors, and that a worker failing on an unexpected
+            exception stops the run instead of leaving it blocked on a full queue.
+        '''
+
+        with TruncatingReceiver() as receiver:
+            emitter = HTTPEmitter(receiver.url, concurrency=2)
+            stats = asyncio.run(asyncio.wait_for(emitter.emit(self.events[:20]), 30))
+        self.assertEqual(stats['requests'], 20)
+        self.assertEqual(stats['errors'], 20)
+        self.assertEqual(stats['status_counts'], {"IncompleteReadError": 20})
+
+        events = [dict(self.events[0], unserializable=object())] + self.events
+        with LocalHTTPReceiver() as receiver:
+            emitter = HTTPEmitter(receiver.url, concurrency=1)
+            with self.assertRaises(TypeError):
+                asyncio.run(asyncio.wait_for(emitter.emit(events), 30))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import json
+import glob
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from itertools import islice
+from event_streams import iter_events
+from incremental_processed import IncrementalUpdate, rebuild
+from local_query import LocalCatalog
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class InterruptedUpdate(IncrementalUpdate):
+    '''
+    Stops the first run after its files are written but before its offsets are committed.
+    '''
+
+    def commit(self, state, slices, watermark):
+        raise KeyboardInterrupt()
+
+class TestIncrementalProcessed(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the watermark-based incremental processing in
+        `incremental_processed.py`.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 300))
+        self.directory = tempfile.mkdtemp()
+        self.raw_log = os.path.join(self.directory, "raw.ndjson")
+        self.output = os.path.join(self.directory, "processed")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, events, partial=""):
+        with open(self.raw_log, "a") as f:
+            f.writelines(json.dumps(event) + "\n" for event in events)
+            f.write(partial)
+
+    def processed_ids(self):
+        files = glob.glob(os.path.join(self.output, "dt=*", "hr=*", "*.csv"))
+        return sorted(pd.concat([pd.read_csv(name, dtype=str) for name in files])['event_id'])
+
+    def test_only_new_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that each run processes only what was appended since the last one, leaves a partial last line
+            for later, and advances the watermark.
+        '''
+
+        update = IncrementalUpdate(self.raw_log, self.output)
+
+        self.append(self.events[:100])
+        stats = update.run()
+        self.assertEqual((stats['events'], stats['bytes_read']), (100, os.path.getsize(self.raw_log)))
+
+        line = json.dumps(self.events[100])
+        self.append(self.events[101:200], partial=line[:50])
+        stats = update.run()
+        self.assertEqual(stats['events'], 99)
+
+        with open(self.raw_log, "a") as f:
+            f.write(line[50:] + "\n")
+        stats = update.run()
+        self.assertEqual(stats['events'], 1)
+        self.assertLessEqual(stats['bytes_read'], len(line) + 1)
+
+        stats = update.run()
+        self.assertEqual((stats['slices'], stats['files_written']), (0, 0))
+        self.assertEqual(stats['watermark'], max(event['context']['timestamp'] for event in self.events[:200]))
+
+        self.assertEqual(self.processed_ids(), sorted(event['event_id'] for event in self.events[:200]))
+
+        catalog = LocalCatalog(engine="sqlite")
+        self.assertIn("dt", catalog.register("processed", self.output))
+        self.assertEqual(catalog.query("SELECT COUNT(*) FROM processed")[1], [(200,)])
+
+    def test_interrupted_run(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a run interrupted before its checkpoint is finished by the next run without duplicates.
+        '''
+
+        self.append(self.events[:150])
+        with self.assertRaises(KeyboardInterrupt):
+            InterruptedUpdate(self.raw_log, self.output).run()
+
+        self.append(self.events[150:])
+        stats = IncrementalUpdate(self.raw_log, self.output).run()
+
+        self.assertTrue(stats['resumed'])
+        self.assertEqual(stats['events'], 300)
+        self.assertEqual(self.processed_ids(), sorted(event['event_id'] for event in self.events))
+
+    def test_changed_sources(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that whole-file sources are processed once, that rewritten sources are refused, and that a
+            rebuild starts over.
+        '''
+
+        array_path = os.path.join(self.directory, "batch.json")
+        with open(array_path, "w") as f:
+            json.dump(self.events[:20], f)
+        self.append(self.events[20:40])
+
+        update = IncrementalUpdate([self.directory], self.output, file_format="ndjson")
+        self.assertEqual(update.run()['events'], 40)
+        self.assertEqual(update.run()['events'], 0)
+
+        with open(self.raw_log, "w") as f:
+            f.write(json.dumps(self.events[0]) + "\n")
+        with self.assertRaises(ValueError):
+            update.run()
+
+        rebuild(self.output)
+        self.assertEqual(update.run()['events'], 21)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from itertools import islice
+from event_streams import iter_events
+from simulation_functions import flatten_event_entry
+from schemas import normalize_processed
+from sinks import NDJSONFileSink, sink_from_url
+from local_aws import LocalS3
+from cloud_events import to_http
+from http_emitter import HTTPEmitter, ConnectionPool
+from ingest_receiver import IngestReceiver
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class BrokenS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose puts raise while `broken` is set, like an outage would.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.broken = True
+
+    def put_object(self, **kwargs):
+        if self.broken:
+            raise ConnectionError("connection refused")
+        return super().put_object(**kwargs)
+
+class TestIngestReceiver(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the HTTP ingest receiver in `ingest_receiver.py`, fed by the
+        CloudEvents emitter in `http_emitter.py`.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 200))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def post(self, url, headers, body):
+        async def send():
+            pool = ConnectionPool(url, size=1)
+            try:
+                return await pool.request("POST", headers, body)
+            finally:
+                await pool.close()
+
+        status, _, response = asyncio.run(send())
+
+        return status, json.loads(response)
+
+    def test_content_modes(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that events sent in every content mode are written flattened, exactly as `flatten_event_entry`
+            flattens them, with accept-to-write latencies recorded.
+        '''
+
+        expected = sorted((normalize_processed(flatten_event_entry(event)) for event in self.events),
+                          key=lambda record: record['event_id'])
+
+        for mode in ("binary", "structured", "batch"):
+            path = os.path.join(self.directory, mode + ".ndjson")
+            receiver = IngestReceiver(NDJSONFileSink(path, max_records=50, max_latency=0.1), port=0)
+            with receiver:
+                stats = HTTPEmitter(receiver.url, mode=mode, concurrency=8, batch_size=40).run(self.events)
+            self.assertEqual(stats['errors'], 0)
+
+            received = receiver.stats()
+            self.assertEqual(received['accepted'], len(self.events))
+            self.assertEqual(received['written'], len(self.events))
+            self.assertEqual(received['queued'], 0)
+            self.assertIsNotNone(received['write_latency_ms']['p99'])
+            self.assertEqual(sorted(self.read(path), key=lambda record: record['event_id']), expected)
+
+    def test_latency_flush(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a partial batch is written once the sink's latency limit passes, without waiting for close.
+        '''
+
+        path = os.path.join(self.directory, "live.ndjson")
+        with IngestReceiver(NDJSONFileSink(path, max_records=1000, max_latency=0.1), port=0) as receiver:
+            HTTPEmitter(receiver.url, mode="batch", batch_size=10).run(self.events[:10])
+            for _ in range(100):
+                if receiver.stats()['written'] == 10:
+                    break
+                time.sleep(0.02)
+
+            self.assertEqual(receiver.stats()['written'], 10)
+            self.assertEqual(len(self.read(path)), 10)
+            self.assertEqual(receiver.stats()['sink']['flush_reasons']['latency'], 1)
+
+    def test_rejections(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that invalid events are rejected and reported while the valid events in the same batch are
+            written, and that malformed requests and other methods get error statuses.
+        '''
+
+        path = os.path.join(self.directory, "rejected.ndjson")
+        invalid = json.loads(json.dumps(self.events[0]))
+        invalid['context']['timestamp'] = "yesterday"
+
+        with IngestReceiver(NDJSONFileSink(path), port=0) as receiver:
+            headers, body = to_http([invalid] + self.events[1:5], "batch")
+            status, response = self.post(receiver.url, headers, body)
+            self.assertEqual(status, 202)
+            self.assertEqual((response['accepted'], response['rejected']), (4, 1))
+            self.assertEqual(response['problems'][0]['event_id'], invalid['event_id'])
+
+            headers, body = to_http([invalid], "structured")
+            status, response = self.post(receiver.url, headers, body)
+            self.assertEqual(status, 422)
+
+            status, _ = self.post(receiver.url, {"Content-Type": "application/json"}, b"{}")
+            self.assertEqual(status, 400)
+
+        self.assertEqual(sorted(record['event_id'] for record in self.read(path)),
+                         sorted(event['event_id'] for event in self.events[1:5]))
+        self.assertEqual(receiver.stats()['rejected'], 2)
+        self.assertEqual(receiver.stats()['bad_requests'], 1)
+
+    def test_write_failures(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that failed deliveries are counted and retried, that POSTs and /healthz get a 503 until writing
+            works again, that every accepted event is written once it does, and that `stop()` raises when events
+            can't be written.
+        '''
+
+        store = BrokenS3()
+        sink = sink_from_url("s3://bucket/live/", s3=store, processed=True, max_records=5, max_latency=0.05)
+        with IngestReceiver(sink, port=0, retry_interval=0.02) as receiver:
+            headers, body = to_http(self.events[:10], "batch")
+            self.assertEqual(self.post(receiver.url, headers, body)[0], 202)
+            for _ in range(100):
+                if receiver.stats()['write_errors'] >= 2:
+                    break
+                time.sleep(0.02)
+            self.assertGreaterEqual(receiver.stats()['write_errors'], 2)
+            status, response = self.post(receiver.url, headers, body)
+            self.assertEqual(status, 503)
+            self.assertIn("ConnectionError", response['error'])
+
+            store.broken = False
+            for _ in range(100):
+                if receiver.stats()['written'] == 10:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(receiver.stats()['written'], 10)
+            self.assertIsNone(receiver.stats()['last_write_error'])
+            self.assertEqual(self.post(receiver.url, headers, body)[0], 202)
+
+        self.assertEqual(receiver.stats()['written'], 20)
+        self.assertEqual(receiver.stats()['unavailable'], 1)
+
+        store = BrokenS3()
+        receiver = IngestReceiver(sink_from_url("s3://bucket/live/", s3=store, processed=True), port=0,
+                                  retry_interval=0.02).start()
+        headers, body = to_http(self.events[:10], "batch")
+        self.assertEqual(self.post(receiver.url, headers, body)[0], 202)
+        with self.assertRaises(RuntimeError):
+            receiver.stop()
+
+        receiver = IngestReceiver(NDJSONFileSink(os.path.join(self.directory, "bounded.ndjson"), max_records=1000),
+                                  port=0, max_queued=10).start()
+        self.assertEqual(self.post(receiver.url, headers, body)[0], 202)
+        self.assertEqual(self.post(receiver.url, headers, body)[0], 503)
+        self.assertEqual(receiver.stop()['written'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
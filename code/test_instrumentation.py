@@ -0,0 +1,91 @@
+from instrumentation import Metrics, timer, to_emf, profile_mode
+import unittest
+import os
+
+class TestInstrumentation(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the timers, counters, and EMF output
+        from `instrumentation.py`.
+    '''
+
+    def test_timers_and_counters(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure that every pass through a `timer` block is recorded, and that
+            counters add up across calls.
+        '''
+        metrics = Metrics()
+
+        for i in range(3):
+            with timer("stage", metrics=metrics):
+                pass
+        metrics.increment("events", 2)
+        metrics.increment("events")
+
+        run_summary = metrics.summary()
+        self.assertEqual(run_summary['timers']['stage']['count'], 3)
+        self.assertEqual(run_summary['counters']['events'], 3)
+
+        metrics.reset()
+        self.assertEqual(metrics.summary()['timers'], {})
+
+        return
+
+    def test_emf_format(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will validate that `to_emf` declares every timer and counter under `_aws.CloudWatchMetrics`
+            and puts their values and dimensions at the top level of the document.
+        '''
+        metrics = Metrics()
+        with timer("s3_get", metrics=metrics):
+            pass
+        metrics.increment("events_processed")
+
+        emf = to_emf(dimensions={"FunctionName": "test"}, metrics=metrics)
+        directive = emf['_aws']['CloudWatchMetrics'][0]
+        names = [metric['Name'] for metric in directive['Metrics']]
+
+        self.assertEqual(directive['Dimensions'], [["FunctionName"]])
+        self.assertIn("s3_get_ms", names)
+        self.assertIn("events_processed", names)
+        self.assertEqual(emf['events_processed'], 1)
+        self.assertEqual(emf['FunctionName'], "test")
+
+        return
+
+    def test_profile_mode(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure the `CDEVENTS_PROFILE` environment variable toggles the right profilers.
+        '''
+        original = os.environ.pop("CDEVENTS_PROFILE", None)
+        try:
+            self.assertEqual(profile_mode(), set())
+            os.environ["CDEVENTS_PROFILE"] = "all"
+            self.assertEqual(profile_mode(), {"cprofile", "tracemalloc"})
+            os.environ["CDEVENTS_PROFILE"] = "tracemalloc"
+            self.assertEqual(profile_mode(), {"tracemalloc"})
+        finally:
+            os.environ.pop("CDEVENTS_PROFILE", None)
+            if original is not None:
+                os.environ["CDEVENTS_PROFILE"] = original
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+from local_aws import LocalS3, s3_notification, sqs_lambda_event, load_lambda
+from event_streams import iter_events
+from key_layout import raw_key, build_manifest, write_manifest, keys_for_window, parse_partition
+import simulation_functions
+import unittest
+import os
+import json
+from copy import deepcopy
+from datetime import datetime
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestKeyLayout(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the raw key layouts and batch manifests in `key_layout.py`.
+    '''
+
+    def setUp(self):
+        self.store = LocalS3()
+        self.events = list(islice(iter_events(raw_events_path), 30))
+
+    def upload_batch(self, events):
+        entries = []
+        for event in events:
+            key = raw_key(event, layout="partitioned", shards=4)
+            body = json.dumps(event)
+            self.store.put_object(Bucket="bucket", Key=key, Body=body)
+            entries.append((key, event, len(body)))
+        return write_manifest(self.store, "bucket", build_manifest(entries, "partitioned"))
+
+    def test_raw_key_layouts(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will check the flat and partitioned key formats, and that the partition can be read back out of a key.
+        '''
+        event = self.events[0]
+
+        self.assertEqual(raw_key(event, layout="flat"), "raw/{}.json".format(event['event_id']))
+
+        key = raw_key(event, layout="partitioned", shards=4)
+        self.assertTrue(key.startswith("raw/dt=2023-04-04/hr=22/"))
+        self.assertTrue(key.endswith("/{}.json".format(event['event_id'])))
+        self.assertEqual(parse_partition(key), "dt=2023-04-04/hr=22/")
+        self.assertIsNone(parse_partition(raw_key(event, layout="flat")))
+
+        return
+
+    def test_keys_for_window_uses_manifests(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will upload two batches and make sure `keys_for_window` finds every key from batches that overlap
+            the window, and nothing from a window with no batches.
+        '''
+        self.upload_batch(self.events[:15])
+        self.upload_batch(self.events[15:])
+
+        keys = keys_for_window(self.store, "bucket", datetime(2023, 4, 4, 22), datetime(2023, 4, 4, 23))
+        expected = sorted(raw_key(event, layout="partitioned", shards=4) for event in self.events)
+        self.assertEqual(keys, expected)
+
+        self.assertEqual(keys_for_window(self.store, "bucket", datetime(2023, 4, 5, 10), datetime(2023, 4, 5, 11)), [])
+
+        return
+
+    def test_batches_spanning_hours(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will send a batch spanning three hours and make sure it gets a manifest per hour, so a window
+            over the last hour still finds its events, and that a manifest spanning too many hours is refused.
+        '''
+        events = deepcopy(self.events[:9])
+        for i, event in enumerate(events):
+            event['context']['timestamp'] = "2023-04-04 {}:{:02d}:00.000001".format(21 + i // 3, 50 - i)
+
+        with self.assertRaises(ValueError):
+            self.upload_batch(events)
+
+        original_s3 = simulation_functions.s3
+        simulation_functions.s3 = self.store
+        try:
+            simulation_functions.send_events(events, [event['event_id'] for event in events], "bucket",
+                                             layout="partitioned", compression="none", encoding="json")
+        finally:
+            simulation_functions.s3 = original_s3
+
+        self.assertEqual(len(self.store.list_keys("bucket", "manifests/raw/")), 3)
+        keys = keys_for_window(self.store, "bucket", datetime(2023, 4, 4, 23), datetime(2023, 4, 5))
+        self.assertEqual(keys, sorted(raw_key(event, layout="partitioned") for event in events[6:]))
+
+        return
+
+    def test_lambda_processes_manifest(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will trigger `lambda_handler` with a notification for a manifest (URL-encoded like real S3
+            notifications) and check that every event in the batch is flattened into the matching processed partition.
+        '''
+        manifest_key = self.upload_batch(self.events[:6])
+        lambda_function = load_lambda(self.store, "bucket")
+
+        encoded_key = manifest_key.replace("=", "%3D")
+        responses = lambda_function.lambda_handler(sqs_lambda_event([s3_notification("bucket", encoded_key)]), None)
+
+        self.assertEqual(len(responses), 6)
+        processed = self.store.list_keys("bucket", "processed/dt=2023-04-04/hr=22/")
+        self.assertEqual(sorted(processed), sorted("processed/dt=2023-04-04/hr=22/{}.json".format(event['event_id'])
+                                                   for event in self.events[:6]))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
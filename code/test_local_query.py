@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from local_query import LocalCatalog, partition_filters, pyarrow
+from schemas import PROCESSED_COLUMNS
+
+def processed_event(number, outcome=None):
+    event = {column: None for column in PROCESSED_COLUMNS}
+    event.update({"event_id": "event-{}".format(number), "context_type": "prod.simulated_events.taskRun.finished",
+                  "run_outcome": outcome})
+    return event
+
+class TestLocalQuery(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the local SQL tables in `local_query.py`.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cdevents-query-")
+
+        ## Four hours of partitioned NDJSON, three events an hour, one written by the Lambda with `run_run_errors`
+        number = 0
+        for dt, hr in [("2023-04-04", "22"), ("2023-04-04", "23"), ("2023-04-05", "00"), ("2023-04-05", "01")]:
+            folder = os.path.join(self.directory, "processed", "dt=" + dt, "hr=" + hr)
+            os.makedirs(folder)
+            with open(os.path.join(folder, "worker-1.ndjson"), "w") as outfile:
+                for outcome in ("success", "error", None):
+                    event = processed_event(number, outcome)
+                    if outcome == "error":
+                        event['run_run_errors'] = "Task failed"
+                    outfile.write(json.dumps(event) + "\n")
+                    number += 1
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_partition_filters(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that partition predicates are extracted from WHERE clauses, and ignored when the query uses OR.
+        '''
+
+        self.assertEqual(partition_filters("SELECT * FROM processed WHERE dt = '2023-04-04' AND hr IN ('22', '23')"),
+                         {"dt": [("=", "2023-04-04")], "hr": [("in", ["22", "23"])]})
+        self.assertEqual(partition_filters("SELECT * FROM processed WHERE dt BETWEEN '2023-04-04' AND '2023-04-05'"),
+                         {"dt": [(">=", "2023-04-04"), ("<=", "2023-04-05")]})
+        self.assertEqual(partition_filters("SELECT * FROM processed WHERE dt = '2023-04-04' OR run_outcome = 'error'"), {})
+        self.assertEqual(partition_filters("SELECT * FROM processed p WHERE (p.dt = '2023-04-04' AND hr > '22') "
+                                           "AND (run_outcome = 'error' OR run_outcome IS NULL) ORDER BY event_id"),
+                         {"dt": [("=", "2023-04-04")], "hr": [(">", "22")]})
+        self.assertEqual(partition_filters("SELECT * FROM processed WHERE run_outcome = 'dt = ''2023-04-04''' -- dt = 'x'"), {})
+        self.assertEqual(partition_filters("SELECT * FROM processed WHERE dt NOT IN ('2023-04-04')"), {})
+
+    def test_non_conjunct_predicates_are_not_pruned(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that partition predicates under NOT, in CASE expressions, in subqueries, or in joins don't
+            prune partitions, so the answers match an unpruned scan.
+        '''
+
+        catalog = LocalCatalog("sqlite")
+        catalog.register("processed", os.path.join(self.directory, "processed"))
+
+        columns, rows = catalog.query("SELECT count(*) FROM processed WHERE NOT dt = '2023-04-04' AND hr = '01'")
+        self.assertEqual(rows, [(3,)])
+        self.assertEqual(catalog.last_stats['partition_filters'], {"hr": [("=", "01")]})
+
+        columns, rows = catalog.query("SELECT sum(CASE WHEN dt = '2023-04-04' THEN 1 ELSE 0 END), count(*) FROM processed")
+        self.assertEqual(rows, [(6, 12)])
+        self.assertEqual(catalog.last_stats['files_pruned'], 0)
+
+        columns, rows = catalog.query("SELECT count(*) FROM processed WHERE run_outcome = 'error' AND event_id NOT IN "
+                                      "(SELECT event_id FROM processed WHERE dt = '2023-04-05')")
+        self.assertEqual(rows, [(2,)])
+
+        columns, rows = catalog.query("SELECT count(*) FROM processed a JOIN processed b USING (event_id) "
+                                      "WHERE a.dt = '2023-04-04'")
+        self.assertEqual(rows, [(6,)])
+
+    def test_partitioned_query_is_pruned(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a partitioned folder gets `dt`/`hr` columns, that a `dt` predicate skips the other
+            partitions, and that pruning does not change the answer.
+        '''
+
+        catalog = LocalCatalog("sqlite")
+        columns = catalog.register("processed", os.path.join(self.directory, "processed"))
+        self.assertEqual(columns, PROCESSED_COLUMNS + ["dt", "hr"])
+
+        columns, rows = catalog.query("SELECT hr, count(*) FROM processed WHERE dt = '2023-04-05' AND hr > '00' GROUP BY hr")
+        self.assertEqual(rows, [("01", 3)])
+        self.assertEqual(catalog.last_stats['files'], 1)
+        self.assertEqual(catalog.last_stats['files_pruned'], 3)
+
+        columns, rows = catalog.query("SELECT dt, count(*) FROM processed GROUP BY dt ORDER BY dt")
+        self.assertEqual(rows, [("2023-04-04", 6), ("2023-04-05", 6)])
+        self.assertEqual(catalog.last_stats['files_pruned'], 0)
+        self.assertEqual(catalog.last_stats['rows_loaded'], 9)
+
+        columns, rows = catalog.query("SELECT run_errors FROM processed WHERE run_outcome = 'error' AND dt = '2023-04-04' AND hr = '22'")
+        self.assertEqual(rows, [("Task failed",)])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_and_csv_tables(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that an unpartitioned Parquet file and CSV file are registered without partition columns.
+        '''
+
+        import csv
+        import pyarrow.parquet
+
+        events = [processed_event(number, "success") for number in range(5)]
+        parquet_path = os.path.join(self.directory, "events.parquet")
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(events), parquet_path)
+        csv_path = os.path.join(self.directory, "events.csv")
+        with open(csv_path, "w", newline="") as outfile:
+            writer = csv.DictWriter(outfile, PROCESSED_COLUMNS)
+            writer.writeheader()
+            writer.writerows(events[:2])
+
+        catalog = LocalCatalog("sqlite")
+        self.assertEqual(catalog.register("compacted", parquet_path), PROCESSED_COLUMNS)
+        catalog.register("local", csv_path)
+
+        columns, rows = catalog.query("SELECT count(*) FROM compacted JOIN local USING (event_id) WHERE local.run_outcome = 'success'")
+        self.assertEqual(rows, [(2,)])
+        self.assertEqual(catalog.last_stats['files'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from event_streams import iter_events
+from merge_shards import merge_shards, write_ndjson, timestamp_key, pyarrow
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+processed_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_processed_events.csv")
+
+class TestMergeShards(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the k-way timestamp merge in `merge_shards.py`.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cdevents-shards-")
+        self.spill_directory = os.path.join(self.directory, "spill")
+        os.makedirs(self.spill_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sorted_and_unsorted_shards(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Merges one sorted and two unsorted (lifecycle order) raw shards, with runs small enough that the
+            unsorted shards spill several runs, and checks the result is every event in timestamp order.
+        '''
+
+        events = list(iter_events(raw_events_path))
+        shards = [sorted(events[0::3], key=timestamp_key), events[1::3], events[2::3]]
+        paths = []
+        for index, shard in enumerate(shards):
+            paths.append(os.path.join(self.directory, "shard-{}.ndjson.gz".format(index)))
+            write_ndjson(shard, paths[-1])
+
+        stats = {}
+        merged = list(merge_shards(paths, run_size=200, temp_dir=self.spill_directory, stats=stats))
+
+        self.assertEqual([timestamp_key(event) for event in merged], sorted(timestamp_key(event) for event in events))
+        self.assertEqual(sorted(event['event_id'] for event in merged), sorted(event['event_id'] for event in events))
+        self.assertEqual(stats['sorted_shards'], 1)
+        self.assertGreater(stats['runs_spilled'], 2)
+        self.assertEqual(stats['events'], len(events))
+        self.assertEqual(os.listdir(self.spill_directory), [])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_processed_shards(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that processed events in Parquet shards are merged on `context_timestamp`.
+        '''
+
+        import pyarrow.parquet
+
+        with open(processed_events_path, newline="") as infile:
+            events = list(csv.DictReader(infile))
+
+        paths = []
+        for index in range(4):
+            paths.append(os.path.join(self.directory, "part-{:05d}.parquet".format(index)))
+            shard = sorted(events[index::4], key=timestamp_key)
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(shard), paths[-1])
+
+        merged = list(merge_shards(paths, presorted=True))
+        self.assertEqual([event['context_timestamp'] for event in merged],
+                         sorted(event['context_timestamp'] for event in events))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from itertools import islice
+from event_streams import iter_events
+from simulation_functions import flatten_event_entry
+from parallel_generate import run_parallel, publish, SegmentWriter
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestParallelGenerate(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the multi-process generator in `parallel_generate.py`, which hands
+        batches to the writer through shared memory.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.raw_path = os.path.join(self.directory, "raw.json")
+        self.processed_path = os.path.join(self.directory, "processed.csv")
+        self.parquet_path = os.path.join(self.directory, "processed.parquet")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_outputs(self, events):
+        '''
+        Function Overview:
+            Checks the output files are exactly what `simulate_events.py` writes for `events`.
+        '''
+
+        with open(self.raw_path) as f:
+            self.assertEqual(f.read(), json.dumps(events))
+
+        expected = io.StringIO()
+        pd.DataFrame([flatten_event_entry(event) for event in events]).to_csv(expected, index=False)
+        with open(self.processed_path) as f:
+            self.assertEqual(f.read(), expected.getvalue())
+
+    def test_segment_round_trip(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that batches published to shared memory are written out unchanged, in Parquet too, and that
+            every segment is freed.
+        '''
+
+        events = list(islice(iter_events(raw_events_path), 300))
+        segments = [publish(events[start:start + 40], arrow=True) for start in range(0, len(events), 40)]
+
+        writer = SegmentWriter(self.raw_path, self.processed_path, self.parquet_path, row_group_rows=100)
+        for segment in segments:
+            writer.write(*segment)
+        writer.close()
+
+        self.assert_outputs(events)
+        table = pd.read_parquet(self.parquet_path)
+        self.assertEqual(table['event_id'].tolist(), [event['event_id'] for event in events])
+        if os.path.isdir("/dev/shm"):
+            self.assertFalse(set(os.listdir("/dev/shm")) & set(name.lstrip("/") for name, _, _, _ in segments))
+
+    def test_run_parallel(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that several generator processes produce the same files as a serial run would for the same
+            events, and that the stats add up.
+        '''
+
+        stats = run_parallel(12, lifecycles_per_batch=2, processes=3, raw_path=self.raw_path,
+                             processed_path=self.processed_path, parquet_path=self.parquet_path)
+
+        with open(self.raw_path) as f:
+            events = json.load(f)
+
+        self.assertEqual(stats['batches'], 12)
+        self.assertEqual(stats['events'], len(events))
+        self.assertGreater(stats['handoff_bytes'], 0)
+        self.assert_outputs(events)
+        self.assertEqual(len(pd.read_parquet(self.parquet_path)), len(events))
+
+    def test_empty_run(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a run with no batches still writes valid, empty outputs.
+        '''
+
+        stats = run_parallel(0, processes=2, raw_path=self.raw_path, processed_path=self.processed_path)
+
+        self.assertEqual(stats['events'], 0)
+        with open(self.raw_path) as f:
+            self.assertEqual(json.load(f), [])
+        with open(self.processed_path) as f:
+            self.assertEqual(f.read().count("\n"), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from local_aws import LocalS3
+from pipeline import run_pipeline, s3_uploader
+import simulation_functions
+import unittest
+import time
+
+class TestPipeline(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the overlapping generate/upload pipeline in `pipeline.py`.
+    '''
+
+    def test_pipeline_uploads_every_batch(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every generated event is uploaded through `send_events` and collected.
+        '''
+
+        store = LocalS3()
+        original_s3 = simulation_functions.s3
+        simulation_functions.s3 = store
+        try:
+            stats, events = run_pipeline(6, lifecycles_per_batch=2, upload=s3_uploader("bucket", layout="flat", compression="none"),
+                                         uploader_workers=3, collect=True)
+        finally:
+            simulation_functions.s3 = original_s3
+
+        raw_keys = store.list_keys("bucket", "raw/")
+        self.assertEqual(stats['batches'], 6)
+        self.assertEqual(stats['events'], len(events))
+        self.assertEqual(len(raw_keys), len(events))
+
+    def test_slow_uploads_apply_backpressure(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that generation overlaps with slow uploads, and that generators stall on a full queue.
+        '''
+
+        def generate(count):
+            time.sleep(0.02)
+            return [{"n": i} for i in range(count)], [str(i) for i in range(count)]
+
+        def upload(events_list, ids_list):
+            time.sleep(0.05)
+
+        stats, _ = run_pipeline(20, lifecycles_per_batch=1, upload=upload, uploader_workers=1, queue_size=2,
+                                generate=generate)
+
+        ## Run serially, generating and uploading would take as long as both together; overlapped, the run is
+        ## noticeably shorter, however slow the machine is
+        overlap = (stats['generate_seconds'] + stats['upload_seconds']) / stats['wall_seconds']
+        self.assertGreater(overlap, 1.15)
+        self.assertGreater(stats['producer_stall_seconds'], 0.2)
+        self.assertLessEqual(stats['max_queue_depth'], 2)
+
+    def test_failed_uploads_are_reported(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the pipeline still drains every batch when uploads fail, then raises instead of counting
+            the failed batches as uploaded.
+        '''
+
+        calls = []
+
+        def generate(count):
+            return [{"n": i} for i in range(count)], [str(i) for i in range(count)]
+
+        def upload(events_list, ids_list):
+            calls.append(len(events_list))
+            if len(calls) % 3 == 0:
+                raise ConnectionError("connection reset")
+
+        with self.assertRaises(RuntimeError) as raised:
+            run_pipeline(9, lifecycles_per_batch=2, upload=upload, uploader_workers=1, queue_size=2, generate=generate)
+
+        self.assertEqual(len(calls), 9)
+        self.assertIn("3 of 9 batches (6 events)", str(raised.exception))
+        self.assertIsInstance(raised.exception.__cause__, ConnectionError)
+
+if __name__ == '__main__':
+    unittest.main()
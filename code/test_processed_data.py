@@ -0,0 +1,101 @@
+import os
+import unittest
+import tempfile
+import shutil
+import time
+import pandas as pd
+from processed_data import load_processed, read_chunks
+
+processed_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_processed_events.csv")
+
+class TestProcessedData(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the typed loader and cached columnar copy in `processed_data.py`.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cdevents-processed-")
+        self.path = os.path.join(self.directory, "events.csv")
+        shutil.copy(processed_events_path, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_types_match_untyped_read(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the typed load has categorical and datetime columns and the same values as `pd.read_csv`.
+        '''
+
+        events = load_processed(self.path, cache=False)
+        untyped = pd.read_csv(self.path)
+
+        self.assertIsInstance(events['run_pipelineName'].dtype, pd.CategoricalDtype)
+        self.assertIsInstance(events['user'].dtype, pd.CategoricalDtype)
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(events['context_timestamp']))
+        self.assertEqual(len(events), len(untyped))
+        self.assertEqual(events['run_outcome'].astype(object).fillna("").tolist(), untyped['run_outcome'].fillna("").tolist())
+        self.assertEqual(sorted(events['environment'].unique()), sorted(untyped['context_type'].str.split(".").str[0].unique()))
+
+        chunks = list(read_chunks(self.path, chunksize=1000))
+        self.assertEqual(sum(len(chunk) for chunk in chunks), len(untyped))
+        self.assertGreater(len(chunks), 1)
+
+    def test_cache_is_invalidated_on_change(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the second load comes from the cache and that changing the source reloads it.
+        '''
+
+        first = load_processed(self.path)
+        second = load_processed(self.path)
+        self.assertEqual(first.attrs['loaded_from'], "source")
+        self.assertEqual(second.attrs['loaded_from'], "cache")
+        self.assertTrue(second.equals(first))
+
+        with open(self.path) as infile:
+            lines = infile.readlines()
+        with open(self.path, "w") as outfile:
+            outfile.writelines(lines[:11])
+        os.utime(self.path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+
+        third = load_processed(self.path)
+        self.assertEqual(third.attrs['loaded_from'], "source")
+        self.assertEqual(len(third), 10)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, ".cache"))), 1)
+
+    def test_cache_serves_derive_and_columns(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a copy cached by a load without derived columns still gives them to a later load, and
+            that a load of a few columns from the cache matches the same load from the source.
+        '''
+
+        underived = load_processed(self.path, derive=False)
+        self.assertNotIn("environment", underived.columns)
+
+        derived = load_processed(self.path)
+        self.assertEqual(derived.attrs['loaded_from'], "cache")
+        self.assertTrue(derived.equals(load_processed(self.path, cache=False)))
+
+        columns = ["event_id", "run_outcome"]
+        from_cache = load_processed(self.path, columns=columns)
+        self.assertEqual(from_cache.attrs['loaded_from'], "cache")
+        self.assertEqual(list(from_cache.columns), columns + ["environment", "user", "event_state"])
+        self.assertTrue(from_cache.equals(load_processed(self.path, columns=columns, cache=False)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import os
+from local_aws import LocalS3, LocalSQS, s3_notification, sqs_lambda_event, load_lambda
+from schemas import PROCESSED_COLUMNS
+from event_streams import iter_events
+from redrive_dlq import DLQRedrive
+import unittest
+import json
+from copy import deepcopy
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class SporadicSQS(LocalSQS):
+    '''
+    Class Overview:
+        A `LocalSQS` that answers two receives out of every three with nothing, like SQS sometimes does while a
+        backlog is still queued.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.receives = 0
+
+    def receive_message(self, **kwargs):
+        with self.lock:
+            self.receives += 1
+            answer = self.receives % 3 == 0
+        if not answer:
+            return {"Messages": []}
+        return super().receive_message(**kwargs)
+
+class TestDLQRedrive(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the dead-letter queue redrive in `redrive_dlq.py` against the
+        local S3 and SQS stand-ins from `local_aws.py`.
+    '''
+
+    def setUp(self):
+        self.store = LocalS3()
+        self.sqs = LocalSQS()
+        self.queue_url = self.sqs.create_queue(QueueName="cdevents-dlq")['QueueUrl']
+        self.events = list(islice(iter_events(raw_events_path), 60))
+
+        ## 40 recoverable objects, 5 deleted objects, 5 schema violations, 5 inline events, and 3 broken bodies
+        for event in self.events[:50]:
+            key = "raw/dt=2023-04-04/hr=22/{}.json".format(event['event_id'])
+            if event in self.events[45:50]:
+                event = deepcopy(event)
+                event['context']['timestamp'] = "yesterday"
+            if event not in self.events[40:45]:
+                self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+            self.send(s3_notification("bucket", key))
+        for event in self.events[50:55]:
+            self.send(event)
+        for body in ("not json", '{"Records": [{"s3": {}}]}', "[1, 2"):
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)
+        self.send({"Service": "Amazon S3", "Event": "s3:TestEvent"})
+
+    def send(self, body):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+
+    def read_ndjson(self, prefix):
+        lines = []
+        for key in self.store.list_keys("bucket", prefix):
+            body = self.store.get_object(Bucket="bucket", Key=key)['Body'].read().decode("utf-8")
+            lines.extend(json.loads(line) for line in body.splitlines())
+        return lines
+
+    def queue_depth(self):
+        attributes = self.sqs.get_queue_attributes(QueueUrl=self.queue_url)['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']) + int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def test_redrive(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every message is classified, recoverable events are written in batches, the rest are
+            quarantined with their reason, a report is written, and the DLQ is emptied.
+        '''
+
+        report = DLQRedrive(self.sqs, self.store, self.queue_url, "bucket", pollers=3, batch_size=20,
+                            compression="none", run_id="test").run()
+
+        self.assertEqual((report['recovered'], report['missing_object'], report['schema_violation'],
+                          report['parse_error'], report['no_events']), (45, 5, 5, 3, 1))
+        self.assertEqual(report['messages_deleted'], 59)
+        self.assertEqual(self.queue_depth(), 0)
+
+        processed = self.read_ndjson("processed/")
+        self.assertEqual(sorted(record['event_id'] for record in processed),
+                         sorted(event['event_id'] for event in self.events[:40] + self.events[50:55]))
+        self.assertTrue(self.store.list_keys("bucket", "processed/dt=2023-04-04/hr=22/redrive-test-"))
+        self.assertLess(report['objects_written'], 59)
+
+        quarantined = self.read_ndjson("quarantine/dlq/schema_violation/")
+        self.assertEqual(len(quarantined), 5)
+        self.assertEqual(quarantined[0]['event']['context']['timestamp'], "yesterday")
+        self.assertTrue(quarantined[0]['violations'])
+        missing = self.read_ndjson("quarantine/dlq/missing_object/")
+        self.assertEqual(sorted(line['key'] for line in missing),
+                         sorted("raw/dt=2023-04-04/hr=22/{}.json".format(e['event_id']) for e in self.events[40:45]))
+        self.assertIn("not json", [line['body'] for line in self.read_ndjson("quarantine/dlq/parse_error/")])
+
+        written = json.loads(self.store.get_object(Bucket="bucket", Key="quarantine/dlq/report-test.json")['Body'].read())
+        self.assertEqual(written['recovered'], 45)
+
+    def test_batch_object(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the events of a raw object holding a batch are recovered or quarantined one by one,
+            instead of the whole object being a parse error.
+        '''
+
+        self.sqs.purge_queue(QueueUrl=self.queue_url)
+        events = deepcopy(self.events[:10])
+        events[3]['context']['timestamp'] = "yesterday"
+        key = "raw/dt=2023-04-04/hr=22/batch-0001.ndjson"
+        self.store.put_object(Bucket="bucket", Key=key, Body="".join(json.dumps(event) + "\n" for event in events))
+        self.send(s3_notification("bucket", key))
+
+        report = DLQRedrive(self.sqs, self.store, self.queue_url, "bucket", compression="none", run_id="batch").run()
+
+        self.assertEqual((report['recovered'], report['schema_violation'], report['parse_error']), (9, 1, 0))
+        self.assertEqual(len(self.read_ndjson("processed/dt=2023-04-04/hr=22/")), 9)
+        self.assertEqual(self.read_ndjson("quarantine/dlq/schema_violation/")[0]['key'], key)
+
+    def test_flat_keys_and_empty_receives(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that events from flat `raw/<event_id>.json` keys are written at the top of `processed/`, and that
+            empty receives while messages are still queued don't stop the redrive early.
+        '''
+
+        sqs = SporadicSQS()
+        queue_url = sqs.create_queue(QueueName="cdevents-dlq")['QueueUrl']
+        for event in self.events[:30]:
+            key = "raw/{}.json".format(event['event_id'])
+            self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+            sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(s3_notification("bucket", key)))
+
+        report = DLQRedrive(sqs, self.store, queue_url, "bucket", pollers=1, compression="none", run_id="flat").run()
+
+        self.assertEqual(report['recovered'], 30)
+        self.assertEqual(self.store.list_keys("bucket", "processed/"), ["processed/redrive-flat-00001.ndjson"])
+
+    def test_records_match_the_lambda(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that an event with run errors is written with exactly the processed columns, and the same values,
+            whether the redrive or the Lambda flattens it.
+        '''
+
+        self.sqs.purge_queue(QueueUrl=self.queue_url)
+        event = next(event for event in iter_events(raw_events_path) if 'run_errors' in json.dumps(event))
+        key = "raw/dt=2023-04-04/hr=22/{}.json".format(event['event_id'])
+        self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+        self.send(s3_notification("bucket", key))
+        DLQRedrive(self.sqs, self.store, self.queue_url, "bucket", compression="none", run_id="errors").run()
+        redriven = self.read_ndjson("processed/")
+
+        lambda_store = LocalS3()
+        lambda_store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+        load_lambda(lambda_store, "bucket").lambda_handler(sqs_lambda_event([s3_notification("bucket", key)]), None)
+        processed_key = "processed/dt=2023-04-04/hr=22/{}.json".format(event['event_id'])
+        from_lambda = json.loads(lambda_store.get_object(Bucket="bucket", Key=processed_key)['Body'].read())
+
+        self.assertEqual(list(from_lambda), PROCESSED_COLUMNS)
+        self.assertEqual(redriven, [from_lambda])
+        self.assertEqual(from_lambda['run_errors'], "pipelineRun cancelled by user")
+
+    def test_dry_run(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a dry run classifies every message but writes and deletes nothing.
+        '''
+
+        report = DLQRedrive(self.sqs, self.store, self.queue_url, "bucket", pollers=2, visibility_timeout=0.5,
+                            dry_run=True).run()
+
+        self.assertEqual(report['messages_received'], 59)
+        self.assertEqual(report['recovered'], 45)
+        self.assertEqual(report['messages_deleted'], 0)
+        self.assertFalse(self.store.list_keys("bucket", "processed/"))
+        self.assertFalse(self.store.list_keys("bucket", "quarantine/"))
+        self.assertEqual(self.queue_depth(), 59)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+from event_streams import iter_events, iter_json_array, event_timestamp
+from local_aws import LocalS3, LocalSQS
+from replay_events import replay_events, ObjectStoreReplaySink, QueueReplaySink, LambdaReplaySink
+import unittest
+import io
+import os
+import json
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class FakeClock():
+    '''
+    Class Overview:
+        A clock whose `sleep` advances time instantly, so replay schedules can be checked without waiting.
+    '''
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestReplayEvents(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the streaming readers in `event_streams.py` and the
+        replay tool in `replay_events.py`, using the local S3/SQS stand-ins from `local_aws.py`.
+    '''
+
+    def test_stream_matches_json_load(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will make sure that streaming the raw dataset with a tiny chunk size (so almost every
+            event is split across reads) produces exactly the same events as `json.load`.
+        '''
+        with open(raw_events_path) as raw_file:
+            expected = json.load(raw_file)
+
+        with open(raw_events_path) as raw_file:
+            streamed = list(iter_json_array(raw_file, chunk_size=97))
+
+        self.assertEqual(streamed, expected)
+        self.assertEqual(list(iter_json_array(io.StringIO(" [ ] "))), [])
+
+        return
+
+    def test_replay_scales_inter_arrival_times(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will replay two events that are 10 seconds apart at 100x speed, and check that the
+            replay waits 0.1 seconds between them and writes both to the object store.
+        '''
+        events = [
+            {"event_id": "a", "context": {"timestamp": "2023-04-04 22:31:50.000000"}},
+            {"event_id": "b", "context": {"timestamp": "2023-04-04 22:32:00.000000"}}
+        ]
+        store = LocalS3()
+        fake = FakeClock()
+
+        stats = replay_events(events, ObjectStoreReplaySink(store, "bucket"), speed=100, clock=fake.clock, sleep=fake.sleep)
+
+        self.assertEqual(stats['events'], 2)
+        self.assertAlmostEqual(sum(fake.sleeps), 0.1)
+        self.assertEqual(store.list_keys("bucket", "raw/"), ["raw/a.json", "raw/b.json"])
+
+        return
+
+    def test_replay_reorders_unsorted_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will replay the unsorted raw dataset at 1000x speed, and check that events are sent in
+            timestamp order on schedule, and that `dataset_seconds` spans the earliest to the latest event.
+        '''
+        events = list(islice(iter_events(raw_events_path), 2000))
+        timestamps = sorted(event_timestamp(event) for event in events)
+        store = LocalS3()
+        fake = FakeClock()
+
+        stats = replay_events(events, ObjectStoreReplaySink(store, "bucket"), speed=1000, clock=fake.clock, sleep=fake.sleep)
+
+        self.assertEqual(stats['events'], len(events))
+        self.assertEqual(stats['late_events'], 0)
+        self.assertEqual(stats['out_of_order_events'], 0)
+        self.assertAlmostEqual(stats['dataset_seconds'], (timestamps[-1] - timestamps[0]).total_seconds(), places=3)
+        self.assertAlmostEqual(sum(fake.sleeps), stats['dataset_seconds'] / 1000, places=3)
+
+        stats = replay_events(events, ObjectStoreReplaySink(store, "bucket"), speed=None, reorder_window=0)
+        self.assertGreater(stats['out_of_order_events'], 0)
+
+        return
+
+    def test_replay_to_queue_and_lambda(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            This test will replay the first lifecycles of the raw dataset unthrottled into a local queue and
+            directly into `lambda_handler`, and check that every event arrives and gets flattened.
+        '''
+        events = list(islice(iter_events(raw_events_path), 12))
+
+        sqs = LocalSQS()
+        queue_url = sqs.create_queue(QueueName="raw-events")['QueueUrl']
+        replay_events(events, QueueReplaySink(sqs, queue_url), speed=None)
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)['Attributes']
+        self.assertEqual(attributes['ApproximateNumberOfMessages'], str(len(events)))
+
+        store = LocalS3()
+        replay_events(events, LambdaReplaySink(store, "bucket"), speed=None)
+        processed = store.list_keys("bucket", "processed/")
+        self.assertEqual(len(processed), len(events))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import unittest
+from datetime import datetime
+from event_streams import parse_timestamp
+from scenarios import Scenario, FailureStorm, run_entry, run_stress
+from local_aws import LocalSQS, SQS_MAX_MESSAGE_BYTES
+
+class TestScenarios(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the failure scenario generator and stress runner in `scenarios.py`.
+    '''
+
+    def test_timeline_and_storm(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that deliveries come in timestamp order within the simulated span, and that every finished run
+            inside a storm gets the storm's outcome and error.
+        '''
+
+        start = datetime(2023, 4, 4, 12)
+        storm = FailureStorm(start=600, duration=600, error="Timeout during execution")
+        scenario = Scenario(duration=1800, lifecycles_per_second=0.1, start=start, storms=[storm], seed=3)
+        events = list(scenario.deliveries())
+
+        timestamps = [parse_timestamp(event['context']['timestamp']) for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertGreaterEqual(timestamps[0], start)
+
+        stormed = 0
+        for event, timestamp in zip(events, timestamps):
+            run = run_entry(event)
+            if run is None or 'outcome' not in run or not 600 <= (timestamp - start).total_seconds() < 1200:
+                continue
+            self.assertEqual((run['outcome'], run['run_errors']), ("error", "Timeout during execution"))
+            stormed += 1
+
+        self.assertGreater(stormed, 0)
+        self.assertEqual(scenario.faults['storm'], stormed)
+
+    def test_injected_faults(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that malformed, oversized, and duplicate deliveries are injected, recorded, and repeatable.
+        '''
+
+        spec = {"duration": 1200, "lifecycles_per_second": 0.2, "malformed_rate": 0.1, "oversized_rate": 0.05,
+                "duplicate_rate": 0.1, "oversized_bytes": SQS_MAX_MESSAGE_BYTES + 1, "seed": 11}
+        scenario = Scenario.from_dict(spec)
+        deliveries = list(scenario.deliveries())
+
+        truncated = [payload for payload in deliveries if isinstance(payload, str)]
+        self.assertTrue(all(not payload.endswith("}") for payload in truncated))
+
+        events = [payload for payload in deliveries if isinstance(payload, dict)]
+        oversized = [event for event in events if len(json.dumps(event)) > SQS_MAX_MESSAGE_BYTES]
+
+        self.assertGreater(scenario.faults['oversized'], 0)
+        self.assertEqual(len({event['event_id'] for event in oversized}), scenario.faults['oversized'])
+        self.assertEqual(len(deliveries) - len({id(payload) for payload in deliveries}), scenario.faults['duplicate'])
+        self.assertEqual(len(set(truncated)), scenario.faults['malformed_truncated'])
+
+        repeat = Scenario.from_dict(spec)
+        self.assertEqual(len(list(repeat.deliveries())), len(deliveries))
+        self.assertEqual(repeat.faults, scenario.faults)
+
+        sqs = LocalSQS()
+        queue_url = sqs.create_queue(QueueName="limits")['QueueUrl']
+        with self.assertRaises(Exception):
+            sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(oversized[0]))
+
+    def test_run_stress(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a stress run drains the queue, refuses oversized messages, dead-letters payloads that
+            cannot be parsed, and reports latency.
+        '''
+
+        scenario = Scenario(duration=120, lifecycles_per_second=0.5, oversized_rate=0.05, malformed_rate=0.05,
+                            malformed_kinds=["truncated"], seed=5)
+        stats = run_stress(scenario.deliveries(), max_receive_count=2, visibility_timeout=0.2, max_batch_wait=0.1)
+
+        self.assertEqual(stats['deliveries'], stats['messages_sent'] + stats['send_rejected'])
+        self.assertEqual(stats['send_rejected'], scenario.faults['oversized'])
+        self.assertEqual(stats['dead_lettered'], scenario.faults['malformed_truncated'])
+        self.assertEqual(stats['events_written'], stats['messages_sent'] - stats['dead_lettered'])
+        self.assertIsNotNone(stats['latency_ms']['p50'])
+
+    def test_run_stress_quarantines_invalid_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that malformed payloads that still parse are quarantined by the worker's schema validation
+            instead of being flattened into processed events.
+        '''
+
+        kinds = ["missing_field", "wrong_type", "bad_enum", "bad_timestamp"]
+        scenario = Scenario(duration=120, lifecycles_per_second=0.5, malformed_rate=0.2, malformed_kinds=kinds, seed=5)
+        stats = run_stress(scenario.deliveries(), max_receive_count=2, visibility_timeout=0.2, max_batch_wait=0.1)
+
+        malformed = sum(scenario.faults["malformed_" + kind] for kind in kinds)
+        self.assertGreater(malformed, 0)
+        self.assertEqual(stats['events_quarantined'], malformed)
+        self.assertEqual(stats['events_written'], stats['messages_sent'] - malformed)
+        self.assertEqual(stats['dead_lettered'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import os
+from local_aws import LocalS3, LocalSQS
+from event_streams import iter_events
+from simulation_functions import flatten_event_entry
+from sinks import NDJSONFileSink, ParquetFileSink, QueueSink, sink_from_url
+import unittest
+import tempfile
+import gzip
+import json
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FlakyS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose first `failures` puts raise, like a network error would.
+    '''
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def put_object(self, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("connection reset")
+        return super().put_object(**kwargs)
+
+class FlakySQS(LocalSQS):
+    '''
+    Class Overview:
+        A `LocalSQS` that fails the first entry of each of its first `failures` batch sends on the SQS side.
+    '''
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        if not self.failures:
+            return super().send_message_batch(QueueUrl=QueueUrl, Entries=Entries, **kwargs)
+        self.failures -= 1
+        response = super().send_message_batch(QueueUrl=QueueUrl, Entries=Entries[1:], **kwargs)
+        response['Failed'] = [{"Id": Entries[0]['Id'], "SenderFault": False, "Code": "InternalError"}]
+        return response
+
+class TestSinks(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the buffered sinks in `sinks.py`.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 25))
+        self.directory = tempfile.mkdtemp(prefix="cdevents-sinks-")
+
+    def test_buffering_limits(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that batches are delivered by record count, byte size, and latency.
+        '''
+
+        clock = FakeClock()
+        path = os.path.join(self.directory, "events.ndjson.gz")
+        sink = NDJSONFileSink(path, compression="gzip", max_records=10, max_bytes=10 ** 9, max_latency=5, clock=clock)
+
+        for event in self.events[:12]:
+            sink.write(event)
+        self.assertEqual(sink.stats['flush_reasons']['records'], 1)
+
+        clock.now = 6
+        self.assertEqual(sink.flush_if_due(), "latency")
+
+        sink.max_bytes = 1
+        sink.write(self.events[12])
+        self.assertEqual(sink.stats['flush_reasons']['bytes'], 1)
+
+        for event in self.events[13:]:
+            sink.write(event)
+        sink.close()
+
+        with gzip.open(path, "rt") as infile:
+            written = [json.loads(line) for line in infile]
+        self.assertEqual([e['event_id'] for e in written], [e['event_id'] for e in self.events])
+
+    def test_object_store_and_queue_sinks(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the object store sink writes one object per batch and the queue sink one message per event.
+        '''
+
+        store = LocalS3()
+        with sink_from_url("s3://bucket/batches/", s3=store, max_records=10) as sink:
+            for event in self.events:
+                sink.write(event)
+        self.assertEqual(len(store.list_keys("bucket", "batches/")), 3)
+
+        sqs = LocalSQS()
+        queue_url = sqs.create_queue(QueueName="events")['QueueUrl']
+        with QueueSink(sqs, queue_url, max_records=7) as sink:
+            for event in self.events:
+                sink.write(event)
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)['Attributes']
+        self.assertEqual(int(attributes['ApproximateNumberOfMessages']), len(self.events))
+
+    def test_failed_deliveries_are_kept(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a batch whose delivery raises stays buffered and is delivered by the next flush, and that
+            the queue sink resends the entries SQS fails instead of dropping them.
+        '''
+
+        store = FlakyS3(failures=1)
+        sink = sink_from_url("s3://bucket/batches/", s3=store, max_records=10)
+        with self.assertRaises(ConnectionError):
+            for event in self.events[:10]:
+                sink.write(event)
+        self.assertEqual((len(sink.buffer), sink.stats['records'], sink.stats['delivery_errors']), (10, 0, 1))
+        for event in self.events[10:]:
+            sink.write(event)
+        sink.close()
+        body = b"".join(store.get_object(Bucket="bucket", Key=key)['Body'].read()
+                        for key in store.list_keys("bucket", "batches/"))
+        self.assertEqual(len(body.splitlines()), len(self.events))
+        self.assertEqual(sink.stats['records'], len(self.events))
+
+        sqs = FlakySQS(failures=3)
+        queue_url = sqs.create_queue(QueueName="events")['QueueUrl']
+        with QueueSink(sqs, queue_url, backoff=0, max_records=100) as sink:
+            for event in self.events:
+                sink.write(event)
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)['Attributes']
+        self.assertEqual(int(attributes['ApproximateNumberOfMessages']), len(self.events))
+        self.assertEqual(sink.failed, 0)
+
+        sqs = FlakySQS(failures=100)
+        queue_url = sqs.create_queue(QueueName="events")['QueueUrl']
+        sink = QueueSink(sqs, queue_url, max_attempts=2, backoff=0, max_records=100)
+        for event in self.events:
+            sink.write(event)
+        with self.assertRaises(RuntimeError):
+            sink.flush()
+        self.assertEqual(len(sink.buffer), 1 + len(self.events) - 10)
+        sqs.failures = 0
+        sink.close()
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)['Attributes']
+        self.assertEqual(int(attributes['ApproximateNumberOfMessages']), len(self.events))
+
+    def test_parquet_sink_rotates(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the Parquet sink starts a new file every `rows_per_file` rows.
+        '''
+
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        with ParquetFileSink(self.directory, rows_per_file=10, max_records=5) as sink:
+            for event in self.events:
+                sink.write(flatten_event_entry(event))
+
+        self.assertEqual(len(sink.files), 3)
+        rows = sum(pyarrow.parquet.read_metadata(path).num_rows for path in sink.files)
+        self.assertEqual(rows, len(self.events))
+
+    def test_parquet_url_keeps_raw_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a "parquet:" sink writes raw events with their nested fields, so reading the file back
+            gives the events that were written, whichever run type each batch started with.
+        '''
+
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        def without_nulls(value):
+            if isinstance(value, dict):
+                return {key: without_nulls(item) for key, item in value.items() if item is not None}
+            return value
+
+        with sink_from_url("parquet:" + self.directory, max_records=5) as sink:
+            for event in self.events:
+                sink.write(event)
+
+        table = pyarrow.parquet.read_table(sink.files[0])
+        self.assertEqual(table.column("event_id").null_count, 0)
+        self.assertEqual(table.column("context").null_count, 0)
+        self.assertEqual(table.column("subject").null_count, 0)
+        self.assertEqual([without_nulls(row) for row in table.to_pylist()],
+                         [without_nulls(event) for event in self.events])
+
+        with sink_from_url("parquet:" + os.path.join(self.directory, "processed"), processed=True) as sink:
+            for event in self.events:
+                sink.write(flatten_event_entry(event))
+        table = pyarrow.parquet.read_table(sink.files[0])
+        self.assertEqual(table.column("event_id").null_count, 0)
+        self.assertEqual(table.column("context_timestamp").null_count, 0)
+
+if __name__ == '__main__':
+    unittest.main()
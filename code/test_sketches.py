@@ -0,0 +1,97 @@
+import os
+import json
+import random
+import unittest
+from sketches import HyperLogLog, TDigest, WindowSketches
+from validation import iter_processed_csv
+
+processed_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_processed_events.csv")
+
+class TestSketches(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the HyperLogLog, t-digest, and window sketches in `sketches.py`.
+    '''
+
+    def test_hyperloglog_merge(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that distinct counts are within a few percent, and that merging overlapping sketches counts the
+            union once.
+        '''
+
+        first, second = HyperLogLog(), HyperLogLog()
+        for number in range(20000):
+            first.add("run-{}".format(number))
+        for number in range(10000, 30000):
+            second.add("run-{}".format(number))
+
+        self.assertAlmostEqual(first.count(), 20000, delta=20000 * 0.05)
+        merged = HyperLogLog.from_dict(json.loads(json.dumps(first.to_dict()))).merge(second)
+        self.assertAlmostEqual(merged.count(), 30000, delta=30000 * 0.05)
+
+    def test_tdigest_quantiles(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks the quantiles of merged digests against the exact quantiles of the same values.
+        '''
+
+        generator = random.Random(7)
+        values = [generator.lognormvariate(4, 0.5) for _ in range(20000)]
+        digests = [TDigest() for _ in range(4)]
+        for index, value in enumerate(values):
+            digests[index % 4].add(value)
+
+        merged = TDigest.from_dict(digests[0].to_dict())
+        for digest in digests[1:]:
+            merged.merge(digest)
+
+        values.sort()
+        for q in (0.5, 0.95, 0.99):
+            exact = values[int(q * len(values))]
+            self.assertAlmostEqual(merged.quantile(q), exact, delta=exact * 0.02)
+        self.assertEqual(merged.quantile(1), values[-1])
+
+    def test_shards_merge_to_the_whole(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Splits the simulated dataset into shards, so many runs start in one shard and finish in another, and
+            checks that merging the shards' sketches matches one sketch of the whole dataset.
+        '''
+
+        events = list(iter_processed_csv(processed_events_path))
+        whole = WindowSketches().update(events)
+
+        shards = [WindowSketches().update(events[index::3]) for index in range(3)]
+        restored = [WindowSketches.from_dict(json.loads(json.dumps(shard.to_dict()))) for shard in shards]
+        merged = WindowSketches.merged(restored)
+
+        self.assertFalse(merged.open_runs)
+        self.assertFalse(merged.unmatched_finishes)
+        merged_summary, whole_summary = merged.query(), whole.query()
+        for name, value in whole_summary.items():
+            if name.endswith(("_p50", "_p95", "_p99")):
+                self.assertAlmostEqual(merged_summary[name], value, delta=value * 0.01)
+            else:
+                self.assertEqual(merged_summary[name], value)
+
+        summary = whole.query(environment="prod")
+        prod = [event for event in events if event['context_type'].startswith("prod.")]
+        self.assertEqual(summary['events'], len(prod))
+        self.assertAlmostEqual(summary['distinct_runs'], len(set(event['run_id'] for event in prod)), delta=len(prod) * 0.05)
+        self.assertEqual(summary['task_runs_timed'], sum(1 for event in prod if event['context_type'].endswith("taskRun.finished")))
+
+if __name__ == '__main__':
+    unittest.main()
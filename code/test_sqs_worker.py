@@ -0,0 +1,192 @@
+import os
+from local_aws import LocalS3, LocalSQS, s3_notification
+from event_streams import iter_events
+from sqs_worker import SQSWorker
+from dedup import Deduplicator
+import unittest
+import json
+import time
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class SlowS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose GETs take `delay` seconds, to simulate a batch that outlasts the visibility timeout.
+    '''
+    def __init__(self, root, delay):
+        LocalS3.__init__(self, root)
+        self.delay = delay
+
+    def get_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.delay)
+        return LocalS3.get_object(self, Bucket, Key, **kwargs)
+
+class PartialS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose second processed object put fails once, so a batch is only partly written.
+    '''
+    def __init__(self, root):
+        LocalS3.__init__(self, root)
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, **kwargs):
+        if Key.startswith("processed/"):
+            self.puts += 1
+            if self.puts == 2:
+                raise OSError("connection reset")
+        return LocalS3.put_object(self, Bucket=Bucket, Key=Key, **kwargs)
+
+class TestSQSWorker(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the long-running SQS consumer in `sqs_worker.py`
+        against the local S3 and SQS stand-ins from `local_aws.py`.
+    '''
+
+    def setUp(self):
+        self.store = LocalS3()
+        self.sqs = LocalSQS()
+        self.queue_url = self.sqs.create_queue(QueueName="cdevents")['QueueUrl']
+        self.events = list(islice(iter_events(raw_events_path), 45))
+
+        for event in self.events[:40]:
+            key = "raw/{}.json".format(event['event_id'])
+            self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(s3_notification("bucket", key)))
+        for event in self.events[40:]:
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(event))
+
+    def written_records(self):
+        records = []
+        for key in self.store.list_keys("bucket", "processed/"):
+            body = self.store.get_object(Bucket="bucket", Key=key)['Body'].read().decode("utf-8")
+            records.extend(json.loads(line) for line in body.splitlines())
+        return records
+
+    def queue_depth(self):
+        attributes = self.sqs.get_queue_attributes(QueueUrl=self.queue_url)['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']) + int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def test_worker_drains_queue(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every event is written in batches and every message is deleted.
+        '''
+
+        worker = SQSWorker(self.sqs, self.store, self.queue_url, "bucket", poller_threads=3, wait_time=0,
+                           batch_size=20, compression="none")
+        stats = worker.run(stop_when_idle=True)
+
+        self.assertEqual(sorted(r['event_id'] for r in self.written_records()), sorted(e['event_id'] for e in self.events))
+        self.assertEqual(stats['messages_deleted'], len(self.events))
+        self.assertLess(stats['objects_written'], len(self.events))
+        self.assertEqual(self.queue_depth(), 0)
+
+    def test_missing_object_is_not_deleted(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a message pointing at a missing object is left on the queue to be retried.
+        '''
+
+        self.sqs.purge_queue(QueueUrl=self.queue_url)
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(s3_notification("bucket", "raw/missing.json")))
+
+        stats = SQSWorker(self.sqs, self.store, self.queue_url, "bucket", wait_time=0, compression="none").run(stop_when_idle=True)
+
+        self.assertEqual(stats['messages_failed'], 1)
+        self.assertEqual(self.queue_depth(), 1)
+
+    def test_batch_objects(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a raw object holding a batch of events is flattened event by event, and that the batch is
+            skipped before it is fetched when its notification is delivered again.
+        '''
+
+        self.sqs.purge_queue(QueueUrl=self.queue_url)
+        key = "raw/dt=2023-04-04/hr=22/batch-0001.ndjson"
+        self.store.put_object(Bucket="bucket", Key=key, Body="".join(json.dumps(event) + "\n" for event in self.events))
+        notification = json.dumps(s3_notification("bucket", key))
+
+        deduplicator = Deduplicator()
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=notification)
+        first = SQSWorker(self.sqs, self.store, self.queue_url, "bucket", wait_time=0, compression="none",
+                          deduplicator=deduplicator).run(stop_when_idle=True)
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=notification)
+        second = SQSWorker(self.sqs, self.store, self.queue_url, "bucket", wait_time=0, compression="none",
+                           deduplicator=deduplicator).run(stop_when_idle=True)
+
+        self.assertEqual((first['messages_failed'], first['events_written']), (0, len(self.events)))
+        self.assertEqual((second['duplicates_skipped'], second['events_written']), (1, 0))
+        self.assertEqual(sorted(r['event_id'] for r in self.written_records()), sorted(e['event_id'] for e in self.events))
+        self.assertTrue(self.store.list_keys("bucket", "processed/dt=2023-04-04/hr=22/worker-"))
+        self.assertEqual(self.queue_depth(), 0)
+
+    def test_failed_batches_are_not_written_twice(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a batch that is only partly written is removed so its redelivered messages don't duplicate
+            events, and that an event two messages in one batch both carry is written once.
+        '''
+
+        self.sqs.purge_queue(QueueUrl=self.queue_url)
+        for hour, events in (("22", self.events[:10]), ("23", self.events[10:20])):
+            for event in events:
+                key = "raw/dt=2023-04-04/hr={}/{}.json".format(hour, event['event_id'])
+                self.store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+                self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(s3_notification("bucket", key)))
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(self.events[0]))
+
+        first = SQSWorker(self.sqs, PartialS3(self.store.root), self.queue_url, "bucket", poller_threads=1,
+                          wait_time=0, visibility_timeout=1, batch_size=1000, compression="none").run(stop_when_idle=True)
+        self.assertEqual((first['messages_failed'], first['objects_written']), (21, 0))
+        self.assertEqual(self.written_records(), [])
+
+        time.sleep(1.1)
+        second = SQSWorker(self.sqs, self.store, self.queue_url, "bucket", poller_threads=1, wait_time=0,
+                           batch_size=1000, compression="none").run(stop_when_idle=True)
+        self.assertEqual((second['events_written'], second['duplicates_skipped']), (20, 1))
+        self.assertEqual(sorted(r['event_id'] for r in self.written_records()),
+                         sorted(e['event_id'] for e in self.events[:20]))
+        self.assertEqual(self.queue_depth(), 0)
+
+    def test_visibility_is_extended_for_slow_batches(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that messages are not redelivered while a batch takes longer than the visibility timeout.
+        '''
+
+        slow_store = SlowS3(self.store.root, delay=0.15)
+        worker = SQSWorker(self.sqs, slow_store, self.queue_url, "bucket", poller_threads=1, fetch_workers=1,
+                           wait_time=0, visibility_timeout=1, batch_size=1000, max_batch_wait=60, compression="none")
+        stats = worker.run(stop_when_idle=True)
+
+        self.assertGreater(stats['visibility_extensions'], 0)
+        self.assertEqual(stats['messages_received'], len(self.events))
+        self.assertEqual(len(self.written_records()), len(self.events))
+
+if __name__ == '__main__':
+    unittest.main()
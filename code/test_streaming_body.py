@@ -0,0 +1,228 @@
+import os
+import io
+import gzip
+import json
+import unittest
+from contextlib import redirect_stdout
+from copy import deepcopy
+from itertools import islice
+from event_streams import iter_events, iter_body
+from compression import DecompressingReader, open_body, compress, zstandard
+from local_aws import LocalS3, s3_notification, sqs_lambda_event, load_lambda
+from wire_format import encode_event, encode_stream
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class RecordingS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` that records the size of every read from an object body.
+    '''
+    def __init__(self):
+        LocalS3.__init__(self)
+        self.reads = []
+
+    def get_object(self, Bucket, Key, **kwargs):
+        response = LocalS3.get_object(self, Bucket, Key, **kwargs)
+        body = response['Body']
+        original_read = body.read
+
+        def read(amt=None):
+            data = original_read(amt)
+            self.reads.append(len(data))
+            return data
+
+        body.read = read
+        return response
+
+class FailingPartS3(LocalS3):
+    '''
+    Class Overview:
+        A `LocalS3` whose first put to a key containing `fail_key` fails, to simulate a Lambda dying part way
+        through a batch.
+    '''
+    def __init__(self, fail_key):
+        LocalS3.__init__(self)
+        self.fail_key = fail_key
+        self.failed = False
+
+    def put_object(self, Bucket, Key, **kwargs):
+        if self.fail_key in Key and not self.failed:
+            self.failed = True
+            raise RuntimeError("simulated crash writing " + Key)
+        return LocalS3.put_object(self, Bucket, Key, **kwargs)
+
+class TestStreamingBody(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the streaming object body decoding in `compression.py` and
+        `event_streams.py`, and its use in `lambda_function.py` for objects holding many events.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 2500))
+
+    def test_decompressing_reader(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that gzip bodies (including concatenated members) decompress in small reads, and that a
+            truncated body raises a ValueError.
+        '''
+
+        data = "".join(json.dumps(event) + "\n" for event in self.events[:300]).encode("utf-8")
+        compressed = gzip.compress(data[:len(data) // 2]) + gzip.compress(data[len(data) // 2:])
+
+        reader = DecompressingReader(io.BytesIO(compressed), "gzip", chunk_size=512)
+        chunks = iter(lambda: reader.read(1000), b"")
+        self.assertEqual(b"".join(chunks), data)
+        self.assertEqual(reader.tell(), len(data))
+
+        body = open_body({"Body": io.BytesIO(compressed)}, chunk_size=512)
+        self.assertEqual(body.read(), data)
+
+        with self.assertRaises(ValueError):
+            DecompressingReader(io.BytesIO(compressed[:len(compressed) // 3]), "gzip", chunk_size=512).read()
+
+    @unittest.skipIf(zstandard is None, "zstd needs the optional zstandard package")
+    def test_decompressing_reader_zstd(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that zstd bodies of several frames (one per appended batch) decompress in full in small reads,
+            without a read holding more than `16 * chunk_size` bytes plus one zstd block, and that a truncated body
+            raises a ValueError.
+        '''
+
+        data = "".join(json.dumps(event) + "\n" for event in self.events[:300]).encode("utf-8")
+        thirds = [data[:len(data) // 3], data[len(data) // 3:2 * len(data) // 3], data[2 * len(data) // 3:]]
+        compressed = b"".join(compress(part, "zstd") for part in thirds)
+
+        reader = DecompressingReader(io.BytesIO(compressed), "zstd", chunk_size=512)
+        sizes = []
+        while not reader.eof:
+            reader.fill()
+            sizes.append(len(reader.buffer))
+            reader.read(len(reader.buffer))
+        self.assertEqual(reader.tell(), len(data))
+        self.assertLessEqual(max(sizes), 16 * 512 + zstandard.BLOCKSIZE_MAX)
+
+        body = open_body({"Body": io.BytesIO(compressed)}, chunk_size=512)
+        self.assertEqual(body.read(), data)
+
+        with self.assertRaises(ValueError):
+            DecompressingReader(io.BytesIO(compressed[:-10]), "zstd", chunk_size=512).read()
+
+    def test_iter_body_formats(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every raw object format decodes to the same events, with buffers smaller than an event.
+        '''
+
+        events = self.events[:50]
+        bodies = {
+            "raw/batch.json": json.dumps(events).encode("utf-8"),
+            "raw/batch.ndjson": "".join(json.dumps(event) + "\n" for event in events).encode("utf-8"),
+            "raw/batch.cdeb": encode_stream(events)
+        }
+
+        for key, data in bodies.items():
+            for codec in ("none", "gzip"):
+                body = open_body({"Body": io.BytesIO(compress(data, codec))}, key, chunk_size=256)
+                self.assertEqual(list(iter_body(body, key, chunk_size=256)), events)
+
+        single = json.dumps(events[0], indent=4).encode("utf-8")
+        self.assertEqual(list(iter_body(io.BytesIO(b"\n  " + single), "raw/a.json", chunk_size=64)), events[:1])
+        self.assertEqual(list(iter_body(io.BytesIO(encode_event(events[0])), "raw/a.cdeb")), events[:1])
+        self.assertEqual(list(iter_body(io.BytesIO(b"  \n"), "raw/empty.json")), [])
+
+        with self.assertRaises(ValueError):
+            list(iter_body(io.BytesIO(bodies["raw/batch.ndjson"][:-100]), "raw/batch.ndjson"))
+
+    def test_lambda_batch_object(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the Lambda processes a compressed object of thousands of events in parts, reading the body
+            a chunk at a time, quarantining invalid events, and skipping the batch when it is delivered again,
+            without printing every event.
+        '''
+
+        events = deepcopy(self.events)
+        events[10]['context']['timestamp'] = "yesterday"
+        key = "raw/dt=2023-04-04/hr=22/batch-0001.ndjson.gz"
+        data = "".join(json.dumps(event) + "\n" for event in events)
+
+        store = RecordingS3()
+        store.put_object(Bucket="bucket", Key=key, Body=compress(data, "gzip"), ContentEncoding="gzip")
+
+        lambda_function = load_lambda(store, "bucket")
+        notification = sqs_lambda_event([s3_notification("bucket", key)])
+        output = io.StringIO()
+        with redirect_stdout(output):
+            response = lambda_function.lambda_handler(notification, None)
+        second = lambda_function.lambda_handler(notification, None)
+
+        self.assertEqual((response['events'], response['quarantined'], response['skipped']), (2499, 1, 0))
+        self.assertEqual(response['parts'], ["processed/dt=2023-04-04/hr=22/batch-0001-part-{:05d}.ndjson".format(n)
+                                             for n in range(3)])
+        self.assertEqual(second['skipped'], "duplicate")
+        self.assertLessEqual(max(store.reads), 1 << 16)
+        self.assertGreater(len(store.reads), 1)
+        self.assertNotIn("Flattened Event", output.getvalue())
+        self.assertLess(len(output.getvalue().splitlines()), 100)
+
+        written = []
+        for part in response['parts']:
+            body = store.get_object(Bucket="bucket", Key=part)['Body'].read().decode("utf-8")
+            written.extend(json.loads(line)['event_id'] for line in body.splitlines())
+        self.assertEqual(written, [event['event_id'] for i, event in enumerate(events) if i != 10])
+        self.assertEqual(len(store.list_keys("bucket", "quarantine/")), 1)
+
+    def test_lambda_batch_retry(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that a batch object whose second part fails to write loses nothing when it is delivered again
+            to the same warm container: the retry rewrites the same parts with the same events.
+        '''
+
+        key = "raw/batch-0002.ndjson"
+        store = FailingPartS3(fail_key="batch-0002-part-00001")
+        store.put_object(Bucket="bucket", Key=key,
+                         Body="".join(json.dumps(event) + "\n" for event in self.events).encode("utf-8"))
+
+        lambda_function = load_lambda(store, "bucket")
+        notification = sqs_lambda_event([s3_notification("bucket", key)])
+        with self.assertRaises(RuntimeError):
+            lambda_function.lambda_handler(notification, None)
+        response = lambda_function.lambda_handler(notification, None)
+
+        self.assertEqual(response['events'], len(self.events))
+        self.assertEqual(len(store.list_keys("bucket", "processed/")), 3)
+
+        written = []
+        for part in store.list_keys("bucket", "processed/"):
+            body = store.get_object(Bucket="bucket", Key=part)['Body'].read().decode("utf-8")
+            written.extend(json.loads(line)['event_id'] for line in body.splitlines())
+        self.assertEqual(sorted(written), sorted(event['event_id'] for event in self.events))
+        self.assertEqual(lambda_function.lambda_handler(notification, None)['skipped'], "duplicate")
+
+if __name__ == '__main__':
+    unittest.main()
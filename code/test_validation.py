@@ -0,0 +1,88 @@
+import os
+from local_aws import LocalS3, load_lambda, s3_notification, sqs_lambda_event
+from event_streams import iter_events
+from simulation_functions import flatten_event_entry
+from validation import raw_event_validator, processed_event_validator
+import unittest
+import json
+from copy import deepcopy
+from itertools import islice
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestValidation(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the compiled batch validator in `validation.py`
+        and the Lambda's quarantine of invalid events.
+    '''
+
+    def setUp(self):
+        self.events = list(islice(iter_events(raw_events_path), 50))
+
+    def test_valid_dataset(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that simulated raw events and their flattened versions pass validation.
+        '''
+
+        self.assertTrue(raw_event_validator().validate(self.events).ok)
+        self.assertTrue(processed_event_validator().validate(flatten_event_entry(e) for e in self.events).ok)
+
+    def test_collects_every_violation(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that all problems are reported with their event ids instead of stopping at the first one.
+        '''
+
+        bad = deepcopy(self.events[:3])
+        bad[0]['context']['timestamp'] = "yesterday"
+        bad[0]['context']['version'] = "9.9.9"
+        del bad[1]['subject']['id']
+        bad[2]['subject']['type'] = "taskRun" if bad[2]['subject']['type'] == "pipelineRun" else "pipelineRun"
+
+        report = raw_event_validator().validate(bad + self.events[3:])
+
+        self.assertEqual(report.checked, len(self.events))
+        self.assertEqual(report.invalid, 3)
+        found = {(v['event_id'], v['path']) for v in report.violations}
+        self.assertIn((bad[0]['event_id'], "context.timestamp"), found)
+        self.assertIn((bad[0]['event_id'], "context.version"), found)
+        self.assertIn((bad[1]['event_id'], "subject.id"), found)
+        self.assertIn((bad[2]['event_id'], "subject.content"), found)
+
+    def test_lambda_quarantines_invalid_events(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that the Lambda writes an invalid raw event to `quarantine/` instead of `processed/`.
+        '''
+
+        store = LocalS3()
+        lambda_function = load_lambda(store, "bucket")
+
+        event = deepcopy(self.events[0])
+        event['context']['timestamp'] = "not a timestamp"
+        key = "raw/{}.json".format(event['event_id'])
+        store.put_object(Bucket="bucket", Key=key, Body=json.dumps(event))
+
+        response = lambda_function.lambda_handler(sqs_lambda_event([s3_notification("bucket", key)]), None)
+
+        self.assertEqual(response['quarantined'], "quarantine/{}.json".format(event['event_id']))
+        self.assertEqual(store.list_keys("bucket", "processed/"), [])
+        quarantined = json.loads(store.get_object(Bucket="bucket", Key=response['quarantined'])['Body'].read())
+        self.assertEqual(quarantined['violations'][0]['path'], "context.timestamp")
+
+if __name__ == '__main__':
+    unittest.main()
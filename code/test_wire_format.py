@@ -0,0 +1,127 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from copy import deepcopy
+from itertools import islice
+import simulation_functions
+from event_streams import iter_events
+from local_aws import LocalS3, s3_notification, sqs_lambda_event, load_lambda
+from wire_format import encode_event, decode_event, loads_event, encode_stream, VERSION_CODES, MAGIC
+
+raw_events_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulated_data", "simulated_raw_events.json")
+
+class TestWireFormat(unittest.TestCase):
+    '''
+    Class Overview:
+        This is a class dedicated to unit testing the binary raw event encoding in `wire_format.py`.
+    '''
+
+    def test_round_trip_every_version(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that every simulated event round-trips, that the header carries its `context.version`, and that
+            the encoding is less than half the size of the JSON.
+        '''
+
+        events = list(iter_events(raw_events_path))
+        encoded = [encode_event(event) for event in events]
+
+        self.assertEqual([decode_event(data)[0] for data in encoded], events)
+        self.assertEqual(set(data[3] for data in encoded), set(VERSION_CODES.values()))
+        for event, data in zip(events[:20], encoded):
+            self.assertEqual(data[:2], MAGIC)
+            self.assertEqual(data[3], VERSION_CODES[event['context']['version']])
+            self.assertEqual(loads_event(json.dumps(event).encode("utf-8")), loads_event(data))
+
+        self.assertLess(sum(map(len, encoded)) * 2, sum(len(json.dumps(event)) for event in events))
+
+    def test_events_outside_the_schema(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that events the schema cannot hold, and unknown versions, raise a ValueError instead of
+            being written or read incorrectly.
+        '''
+
+        event = next(iter_events(raw_events_path))
+
+        for change in (lambda e: e['context'].update(version="9.9.9"),
+                       lambda e: e.update(extra="field"),
+                       lambda e: e['context'].update(id="not-a-uuid"),
+                       lambda e: e['context'].update(timestamp="2023-04-04T22:31:53Z")):
+            changed = deepcopy(event)
+            change(changed)
+            with self.assertRaises(ValueError):
+                encode_event(changed)
+
+        data = bytearray(encode_event(event))
+        data[3] = 250
+        with self.assertRaises(ValueError):
+            decode_event(bytes(data))
+        with self.assertRaises(ValueError):
+            decode_event(encode_event(event)[:-5])
+
+    def test_stream_files(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Checks that `iter_events` reads a gzip-compressed `.cdeb` file of length-prefixed events.
+        '''
+
+        events = list(islice(iter_events(raw_events_path), 500))
+        directory = tempfile.mkdtemp(prefix="cdevents-wire-")
+        try:
+            path = os.path.join(directory, "events.cdeb.gz")
+            with gzip.open(path, "wb") as outfile:
+                outfile.write(encode_stream(events))
+            self.assertEqual(list(iter_events(path)), events)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_send_events_and_lambda(self):
+        '''
+        Inputs: None
+
+        Returns: None
+
+        Function Overview:
+            Sends binary events with `send_events` and checks the Lambda decodes and flattens them, and that an
+            event outside the schema is sent as JSON instead.
+        '''
+
+        events = list(islice(iter_events(raw_events_path), 4))
+        events[3] = deepcopy(events[3])
+        events[3]['context']['timestamp'] = "2023-04-04 22:31:53.5"  ## Valid, but not in `str(datetime)` form
+
+        store = LocalS3()
+        original_s3 = simulation_functions.s3
+        simulation_functions.s3 = store
+        try:
+            simulation_functions.send_events(events, [event['event_id'] for event in events], "bucket",
+                                             layout="flat", manifest=False, compression="none", encoding="binary")
+        finally:
+            simulation_functions.s3 = original_s3
+
+        keys = store.list_keys("bucket", "raw/")
+        self.assertEqual(sorted(key.rsplit(".", 1)[-1] for key in keys), ["cdeb", "cdeb", "cdeb", "json"])
+
+        lambda_function = load_lambda(store, "bucket")
+        for key in keys:
+            lambda_function.lambda_handler(sqs_lambda_event([s3_notification("bucket", key)]), None)
+        self.assertEqual(len(store.list_keys("bucket", "processed/")), len(events))
+
+if __name__ == '__main__':
+    unittest.main()
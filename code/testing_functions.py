@@ -6,9 +6,35 @@ import unittest
 from datetime import datetime
 import json
 from copy import deepcopy
+from validation import Validator
+from schemas import CONTEXT_SCHEMA, SUBJECT_SCHEMA, CONTENT_SCHEMA, RUN_SCHEMA
 
 ## Helper Functions for Unit Testing CDEvent, PipelineRun, and TaskRun classes
 
+## The expected formats are compiled once from `schemas.py` (see `validation.py`), so these checks are cheap
+## enough to run on every generated event and report every problem at once
+context_validator = Validator(CONTEXT_SCHEMA)
+subject_validator = Validator(SUBJECT_SCHEMA)
+content_validator = Validator(CONTENT_SCHEMA)
+run_validator = Validator(RUN_SCHEMA)
+
+def raise_violations(section, problems):
+    '''
+    Input:
+        section (type: str) The name of the section that was checked (i.e. "context")
+        problems (type: list) `(path, error)` tuples from `Validator.check`
+        
+    Returns: None
+    
+    Function Overview:
+        Raises a ValueError listing every problem, if there are any.
+    '''
+    
+    if problems:
+        raise ValueError("Invalid {}: {}".format(section, "; ".join("{} {}".format(path, error) for path, error in problems)))
+    
+    return
+
 def test_context(context):
     '''
     Input: context (type: dict; from: CDEvent.context) This is a context dictionary from the CDEvent.context
@@ -20,23 +46,8 @@ def test_context(context):
         This function will test the format of the CDEvent.context dictionary to ensure
         that it meets the standard format from the CDEvent specs.
     '''
-    print("Testing Context:\n", json.dumps(context, indent=4))
     
-    expected_context_format = {
-        "version": "0.0.2",
-        "id": "6d8f3fc7-f2c2-4511-badc-362d318d2d70",
-        "source": "/staging/userC/",
-        "type": "staging.simulated_events.taskRun.finished",
-        "timestamp": "2023-03-22 21:34:25.586944"
-    }
-    
-    for k, v in context.items():
-        
-        if k not in expected_context_format.keys():
-            raise ValueError("{} not in expected format keys: {}".format(k, expected_context_format.keys()))
-        
-        if type(v) != type(expected_context_format[k]):
-            raise ValueError("type({})={} does not match expected type {}".format(k, type(k), type(expected_context_format[k])))
+    raise_violations("context", context_validator.check(context))
     
     return
 
@@ -52,33 +63,7 @@ def test_subject(subject):
         that it meets the standard format from the CDEvent specs.
     '''
     
-    print("Testing Subject:\n", json.dumps(subject, indent=4))
-    
-    expected_subject_format = {
-        "id": "bbfaf73e-c7af-4cd9-883c-5267c764e25c",
-        "type": "taskRun",
-        "content": {
-            "task": "task3",
-            "url": "/apis/userC.staging/veta/namespaces/default/taskRuns/taskRun2",
-            "taskRun": {
-                "id": "a25a5e3d-5244-4df5-865d-c59a7f938308",
-                "source": "/staging/userC/",
-                "type": "taskRun",
-                "pipelineName": "pipeline3",
-                "url": "https://api.example_stystem.com/namespace/pipeline3",
-                "outcome": "failure",
-                "errors": "Unit tests failed"
-            }
-        }
-    }
-    
-    for k, v in subject.items():
-        
-        if k not in expected_subject_format.keys():
-            raise ValueError("{} not in expected format keys: {}".format(k, expected_subject_format.keys()))
-        
-        if type(v) != type(expected_subject_format[k]):
-            raise ValueError("type({})={} does not match expected type {}".format(k, type(k),type(expected_subject_format[k])))
+    raise_violations("subject", subject_validator.check(subject))
     
     return
 
@@ -94,29 +79,7 @@ def test_content(content):
         that it meets the standard format from the CDEvent specs.
     '''
     
-    print("Testing content:\n", json.dumps(content, indent=4))
-    
-    expected_content_format = {
-        "task": "task3",
-        "url": "/apis/userC.staging/veta/namespaces/default/taskRuns/taskRun2",
-        "taskRun": {
-            "id": "a25a5e3d-5244-4df5-865d-c59a7f938308",
-            "source": "/staging/userC/",
-            "type": "taskRun",
-            "pipelineName": "pipeline3",
-            "url": "https://api.example_stystem.com/namespace/pipeline3",
-            "outcome": "failure",
-            "errors": "Unit tests failed"
-        }
-    }
-    
-    for k, v in content.items():
-        
-        if k not in expected_content_format.keys():
-            raise ValueError("{} not in expected format keys: {}".format(k, expected_content_format.keys()))
-        
-        if type(v) != type(expected_content_format[k]):
-            raise ValueError("type({})={} does not match expected type {}".format(k, type(k),type(expected_content_format[k])))
+    raise_violations("content", content_validator.check(content))
     
     return
 
@@ -183,25 +146,7 @@ def test_taskRun_format(taskRun_entry):
         that it meets the standard format from the CDEvent specs.
     '''
     
-    print("Testing taskRun:\n", json.dumps(taskRun_entry, indent=4))
-    
-    expected_taskRun_entry_format = {
-        "id": "a25a5e3d-5244-4df5-865d-c59a7f938308",
-        "source": "/staging/userC/",
-        "type": "taskRun",
-        "pipelineName": "pipeline3",
-        "url": "https://api.example_stystem.com/namespace/pipeline3",
-        "outcome": "failure",
-        "errors": "Unit tests failed"
-    }
-    
-    for k, v in taskRun_entry.items():
-        
-        if k not in expected_taskRun_entry_format.keys():
-            raise ValueError("{} not in expected format keys: {}".format(k, expected_taskRun_entry_format.keys()))
-        
-        if type(v) != type(expected_taskRun_entry_format[k]):
-            raise ValueError("type({})={} does not match expected type {}".format(k, type(k),type(expected_taskRun_entry_format[k])))
+    raise_violations("taskRun", run_validator.check(taskRun_entry))
             
     if taskRun_entry['type'] != "taskRun":
         raise ValueError("Incorrect event_type:", taskRun_entry['type'], "\nExpected event_type = taskRun")
@@ -220,23 +165,7 @@ def test_pipelineRun_format(pipelineRun_entry):
         that it meets the standard format from the CDEvent specs.
     '''
     
-    expected_pipelineRun_entry_format = {
-        "id": "a25a5e3d-5244-4df5-865d-c59a7f938308",
-        "source": "/staging/userC/",
-        "type": "pipelineRun",
-        "pipelineName": "pipeline3",
-        "url": "https://api.example_stystem.com/namespace/pipeline3",
-        "outcome": "failure",
-        "errors": "Unit tests failed"
-    }
-    
-    for k, v in pipelineRun_entry.items():
-        
-        if k not in expected_pipelineRun_entry_format.keys():
-            raise ValueError("{} not in expected format keys: {}".format(k, expected_pipelineRun_entry_format.keys()))
-        
-        if type(v) != type(expected_pipelineRun_entry_format[k]):
-            raise ValueError("type({})={} does not match expected type {}".format(k, type(k),type(expected_pipelineRun_entry_format[k])))
+    raise_violations("pipelineRun", run_validator.check(pipelineRun_entry))
             
     if pipelineRun_entry['type'] != "pipelineRun":
         raise ValueError("Incorrect event_type:", pipelineRun_entry['type'], "\nExpected event_type = pipelineRun")
@@ -0,0 +1,294 @@
+import re
+import sys
+import csv
+import json
+import argparse
+from collections import Counter
+from schemas import RAW_EVENT_SCHEMA, PROCESSED_EVENT_SCHEMA
+
+## Validate raw and processed CDEvents in bulk.
+##
+## A schema from `schemas.py` is compiled once into a single generated Python function with every check
+## written out inline (regular expressions compiled, enums turned into sets), so checking an event is a handful
+## of dictionary lookups and nothing is printed or formatted unless the event is invalid.  Every problem is collected, with the event_id it
+## belongs to, instead of stopping at the first one:
+##     validator = raw_event_validator()
+##     report = validator.validate(iter_events("simulated_raw_events.json"))
+##     report.summary()   -> {"checked": 3171, "invalid": 0, "violations": 0, "errors": {}}
+##
+## The Lambda uses `check` on each raw event to route malformed events to a quarantine prefix instead of
+## failing on them.
+
+UUID_PATTERN = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+TIMESTAMP_PATTERN = r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d{1,6})?"
+FORMATS = {"uuid": UUID_PATTERN, "timestamp": TIMESTAMP_PATTERN}
+
+TYPE_NAMES = {str: "string", dict: "object", int: "integer", float: "number", bool: "boolean", list: "array"}
+
+class SchemaCompiler():
+    def __init__(self):
+        '''
+        Returns: object (dtype: SchemaCompiler) Turns a schema into the source of one straight-line Python function.
+            Enum sets, compiled patterns, and error messages are kept in `constants`, which the generated code
+            refers to by name.
+        '''
+
+        self.lines = []
+        self.constants = {}
+        self.depth = 0
+
+        return
+
+    def constant(self, value):
+        name = "C{}".format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def report(self, indent, path, error):
+        self.emit(indent, "report({}, {})".format(self.constant(path), self.constant(error)))
+
+    def value(self, indent, variable, path, spec):
+        '''
+        Function Overview:
+            Emits the checks for one field whose value is in `variable`.
+        '''
+
+        expected_type = spec.get('type')
+        pattern = spec.get('pattern') or FORMATS.get(spec.get('format'))
+
+        self.emit(indent, "if {} is None:".format(variable))
+        if spec.get('nullable', False):
+            self.emit(indent + 1, "pass")
+        else:
+            self.report(indent + 1, path, "is null")
+
+        if expected_type is not None:
+            type_name = TYPE_NAMES.get(expected_type, getattr(expected_type, "__name__", str(expected_type)))
+            self.emit(indent, "elif not isinstance({}, {}):".format(variable, self.constant(expected_type)))
+            self.report(indent + 1, path, "expected " + type_name)
+
+        self.emit(indent, "else:")
+        self.emit(indent + 1, "pass")
+
+        if 'enum' in spec:
+            self.emit(indent + 1, "if {} not in {}:".format(variable, self.constant(frozenset(spec['enum']))))
+            self.report(indent + 2, path, "expected one of {}".format(sorted(spec['enum'])))
+
+        if pattern:
+            matcher = self.constant(re.compile(pattern + r"\Z").match)
+            error = "expected {} format".format(spec['format']) if 'format' in spec else "does not match {}".format(pattern)
+            self.emit(indent + 1, "if {}({}) is None:".format(matcher, variable))
+            self.report(indent + 2, path, error)
+
+        if 'fields' in spec:
+            self.object(indent + 1, variable, path, spec['fields'], spec.get('allow_extra', False))
+
+        return
+
+    def object(self, indent, variable, path, fields, allow_extra):
+        '''
+        Function Overview:
+            Emits the checks for every field of the object in `variable`.
+        '''
+
+        prefix = path + "." if path else ""
+        self.depth += 1
+        field_variable = "v{}".format(self.depth)
+
+        for name, spec in fields.items():
+            self.emit(indent, "if {!r} in {}:".format(name, variable))
+            self.emit(indent + 1, "{} = {}[{!r}]".format(field_variable, variable, name))
+            self.value(indent + 1, field_variable, prefix + name, spec)
+            if spec.get('required', True):
+                self.emit(indent, "else:")
+                self.report(indent + 1, prefix + name, "is missing")
+
+        if not allow_extra:
+            known = self.constant(frozenset(fields))
+            self.emit(indent, "if not {}.issuperset({}):".format(known, variable))
+            self.emit(indent + 1, "for name in {}:".format(variable))
+            self.emit(indent + 2, "if name not in {}:".format(known))
+            self.emit(indent + 3, "report({!r} + name, 'is not in the schema')".format(prefix))
+
+        return
+
+def compile_schema(schema, allow_extra=False):
+    '''
+    Inputs:
+        `schema` (dtype: dict): Field name -> field spec (see `schemas.py`)
+        `allow_extra` (dtype: bool): Whether top-level fields that are not in the schema are allowed
+
+    Returns: `check` (dtype: function) Called as `check(event, report)`; calls `report(path, error)` for each problem
+
+    Function Overview:
+        Generates one function with every check written out inline, so validating an event costs no more
+        function calls than there are problems with it.
+    '''
+
+    compiler = SchemaCompiler()
+    compiler.emit(0, "def check(event, report):")
+    compiler.object(1, "event", "", schema, allow_extra)
+
+    namespace = dict(compiler.constants)
+    exec(compile("\n".join(compiler.lines), "<schema>", "exec"), namespace)
+
+    return namespace['check']
+
+def run_matches_subject(event):
+    '''
+    Input: `event` (dtype: dict) A raw event that has passed the field checks
+    Returns: A list of `(path, error)` problems: the content must hold exactly the run named by `subject.type`,
+        and the run and `context.type` must agree with it
+    '''
+
+    problems = []
+    subject_type = event['subject']['type']
+    content = event['subject']['content']
+    runs = [name for name in ("taskRun", "pipelineRun") if name in content]
+
+    if runs != [subject_type]:
+        problems.append(("subject.content", "expected exactly one {} object, found {}".format(subject_type, runs or "none")))
+    elif content[subject_type]['type'] != subject_type:
+        problems.append(("subject.content.{}.type".format(subject_type), "does not match subject.type"))
+
+    if event['context']['type'].split(".")[-2:-1] != [subject_type]:
+        problems.append(("context.type", "does not match subject.type"))
+
+    return problems
+
+class ValidationReport():
+    def __init__(self, max_violations=10000):
+        '''
+        Input: `max_violations` (dtype: int): The most violations to keep in full (all of them are still counted)
+        Returns: object (dtype: ValidationReport) The result of validating a batch or stream of events
+        '''
+
+        self.max_violations = max_violations
+        self.checked = 0
+        self.invalid = 0
+        self.violation_count = 0
+        self.violations = []
+        self.errors = Counter()
+
+        return
+
+    def add(self, event_id, problems):
+        self.invalid += 1
+        for path, error in problems:
+            self.violation_count += 1
+            self.errors["{} {}".format(path, error)] += 1
+            if len(self.violations) < self.max_violations:
+                self.violations.append({"event_id": event_id, "path": path, "error": error})
+
+    @property
+    def ok(self):
+        return self.invalid == 0
+
+    def summary(self):
+        '''
+        Returns: `summary` (dtype: dict) Counts and the most common errors:
+            {"checked": 3171, "invalid": 2, "violations": 3, "errors": {"context.timestamp expected timestamp format": 2, ...}}
+        '''
+
+        return {"checked": self.checked, "invalid": self.invalid, "violations": self.violation_count,
+                "errors": dict(self.errors.most_common(20))}
+
+class Validator():
+    def __init__(self, schema, rules=(), allow_extra=False, id_field="event_id"):
+        '''
+        Inputs:
+            `schema` (dtype: dict): Field name -> field spec (see `schemas.py`)
+            `rules` (dtype: list): Extra checks across fields, called as `rule(event)` on events that passed the
+                field checks and returning a list of `(path, error)` problems
+            `allow_extra` (dtype: bool): Whether top-level fields that are not in the schema are allowed
+            `id_field` (dtype: str): The field identifying an event in reports
+
+        Returns: object (dtype: Validator) A compiled validator.  Build it once and reuse it.
+        '''
+
+        self.checker = compile_schema(schema, allow_extra)
+        self.rules = list(rules)
+        self.id_field = id_field
+
+        return
+
+    def check(self, event):
+        '''
+        Input: `event` (dtype: dict)
+        Returns: `problems` (dtype: list) `(path, error)` for everything wrong with the event (empty if it is valid)
+        '''
+
+        if not isinstance(event, dict):
+            return [("", "expected object")]
+
+        problems = []
+        self.checker(event, lambda path, error: problems.append((path, error)))
+
+        if not problems:
+            for rule in self.rules:
+                problems.extend(rule(event))
+
+        return problems
+
+    def is_valid(self, event):
+        return not self.check(event)
+
+    def validate(self, events, max_violations=10000):
+        '''
+        Inputs:
+            `events` (dtype: iterable): A list or stream of events
+            `max_violations` (dtype: int): The most violations to keep in full (see `ValidationReport`)
+
+        Returns: `report` (dtype: ValidationReport)
+        '''
+
+        report = ValidationReport(max_violations)
+        check = self.check
+
+        for event in events:
+            report.checked += 1
+            problems = check(event)
+            if problems:
+                event_id = event.get(self.id_field) if isinstance(event, dict) else None
+                report.add(event_id, problems)
+
+        return report
+
+def raw_event_validator():
+    return Validator(RAW_EVENT_SCHEMA, rules=[run_matches_subject])
+
+def processed_event_validator():
+    return Validator(PROCESSED_EVENT_SCHEMA)
+
+def iter_processed_csv(path):
+    '''
+    Input: `path` (dtype: str): A processed CSV file (i.e. `simulated_processed_events.csv`)
+    Returns: A generator of processed events, with empty cells read as None
+    '''
+
+    with open(path, newline="") as infile:
+        for row in csv.DictReader(infile):
+            yield {k: (v if v != "" else None) for k, v in row.items()}
+
+if __name__ == '__main__':
+    from event_streams import iter_events
+
+    parser = argparse.ArgumentParser(description="Validate a raw or processed CDEvents dataset")
+    parser.add_argument("path", help="A JSON array or NDJSON file of events (optionally .gz), or a processed CSV")
+    parser.add_argument("--processed", action="store_true", help="Validate flattened events instead of raw events")
+    parser.add_argument("--show", type=int, default=20, help="How many individual violations to print")
+    args = parser.parse_args()
+
+    processed = args.processed or args.path.endswith(".csv")
+    validator = processed_event_validator() if processed else raw_event_validator()
+    events = iter_processed_csv(args.path) if args.path.endswith(".csv") else iter_events(args.path)
+
+    report = validator.validate(events)
+    print(json.dumps(report.summary(), indent=4))
+    for violation in report.violations[:args.show]:
+        print(json.dumps(violation))
+
+    sys.exit(0 if report.ok else 1)
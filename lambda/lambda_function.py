@@ -1,15 +1,120 @@
+import os
 import json
 import csv
 import boto3
+from urllib.parse import unquote_plus
+from instrumentation import timer, timed, increment, reset, emit_emf, profile_run
+from key_layout import parse_partition, MANIFEST_PREFIX
+from itertools import chain
+from compression import decode_body, open_body, put_arguments, default_codec, extension
+from dedup import Deduplicator, MarkerStore, BloomFilterStore, event_id_from_key
+from validation import raw_event_validator
+from wire_format import loads_event
+from event_streams import iter_body
+from adaptive import AIMDController
+from schemas import normalize_processed
 
 s3 = boto3.client("s3")
-ssm = boto3.client("ssm")
 
-bucket_parameter = ssm.get_parameter(Name="CDEVENT_BUCKET")
-bucket_name = bucket_parameter['Parameter']['Value']
+## The bucket name comes from the `CDEVENT_BUCKET` environment variable if it is set,
+## otherwise from Parameter Store
+bucket_name = os.environ.get("CDEVENT_BUCKET")
+if bucket_name is None:
+    ssm = boto3.client("ssm")
+    bucket_parameter = ssm.get_parameter(Name="CDEVENT_BUCKET")
+    bucket_name = bucket_parameter['Parameter']['Value']
 
 s3_folder = "processed/"
 
+## Processed events are compressed with the codec from `CDEVENTS_COMPRESSION` ("none", "gzip", or "zstd")
+processed_compression = default_codec()
+
+## Raw events that fail schema validation are written to `quarantine/` (with the list of problems) instead of
+## being flattened.  Set `CDEVENTS_VALIDATE=0` to turn validation off.
+quarantine_folder = "quarantine/"
+validator = raw_event_validator() if os.environ.get("CDEVENTS_VALIDATE", "1") != "0" else None
+
+## A raw object may hold one event or many (a JSON array, NDJSON, or a `.cdeb` stream, optionally compressed).
+## Bodies are decoded as they stream in, so memory use does not grow with the number of events in an object.
+## The events of a multi-event object are flattened and written as NDJSON parts, one for every `PART_SIZE`
+## events of the object (event n goes to part n // PART_SIZE, whether or not its neighbours were skipped):
+##     processed/<partition><object name>-part-00000.ndjson
+## Part names and contents only depend on the raw object, so an object that fails part way and is retried
+## overwrites the parts it already wrote with the same events.  Nothing in the object is marked as processed
+## until every part has been written.
+PART_SIZE = 1000
+
+## Every raw and flattened event is printed to CloudWatch only when `CDEVENTS_LOG_EVENTS=1`, since one object
+## may carry thousands of them
+log_events = os.environ.get("CDEVENTS_LOG_EVENTS", "0") == "1"
+
+## Part writes go through an AIMD controller (see `code/adaptive.py`), which retries throttled (503 SlowDown)
+## and 5xx writes with backoff and keeps their latency.  The part size stays fixed so that retries line up.
+part_controller = None
+
+def get_part_controller():
+    global part_controller
+
+    if part_controller is None:
+        part_controller = AIMDController(initial_batch=PART_SIZE, min_batch=PART_SIZE, max_batch=PART_SIZE,
+                                         initial_concurrency=1, max_concurrency=1,
+                                         target_latency=float(os.environ.get("CDEVENTS_PART_LATENCY", "2.0")))
+
+    return part_controller
+
+## Duplicate deliveries are skipped using an in-memory LRU of `CDEVENTS_DEDUP_LRU` ids per warm container,
+## plus an optional persistent store from `CDEVENTS_DEDUP_STORE`: "none" (default), "markers" (marker objects
+## under `dedup/processed/` in the bucket), or "bloom:<path>" (a Bloom filter file, i.e. "bloom:/tmp/dedup.bloom")
+## The store is flushed at the end of every invocation.  A "bloom:" file lives in the container's own /tmp, so it
+## only survives as long as that container and is never seen by the others; use "markers" (`MarkerStore`) to skip
+## duplicates that are delivered to a different container.
+deduplicator = None
+
+def get_deduplicator():
+    '''
+    Input: None
+    Returns: deduplicator (dtype: Deduplicator) The container-wide deduplicator (see `code/dedup.py`),
+        created on first use so that it picks up any client set with `configure`
+    '''
+    
+    global deduplicator
+    
+    if deduplicator is None:
+        store_setting = os.environ.get("CDEVENTS_DEDUP_STORE", "none")
+        store = None
+        
+        if store_setting == "markers":
+            store = MarkerStore(s3, bucket_name)
+        elif store_setting.startswith("bloom:"):
+            store = BloomFilterStore(store_setting[len("bloom:"):])
+        
+        deduplicator = Deduplicator(lru_capacity=int(os.environ.get("CDEVENTS_DEDUP_LRU", "100000")), store=store)
+    
+    return deduplicator
+
+def configure(s3_client=None, bucket=None):
+    '''
+    Inputs:
+        `s3_client`: A boto3 S3 client (or a `LocalS3` from `code/local_aws.py`) to read and write events with
+        `bucket` (dtype: str): The name of the CDEvents bucket
+
+    Function Overview:
+        Overrides the module-level S3 client and bucket.  This is used to run `lambda_handler` locally
+        (i.e. from `replay_events.py`) against a local object store instead of AWS.
+    '''
+    
+    global s3, bucket_name, deduplicator, part_controller
+    
+    deduplicator = None
+    part_controller = None
+    if s3_client is not None:
+        s3 = s3_client
+    if bucket is not None:
+        bucket_name = bucket
+    
+    return
+
+@timed("flatten_event")
 def flatten_event(event):
     '''
     Input: `event` (dtype: dict) A CDEvent-style dictionary that is ready to be flattened 
@@ -106,13 +211,17 @@ def flatten_event(event):
     if 'run_errors' not in flattened_event.keys():
         flattened_event['run_errors'] = None
     
-    print("Flattened Event:\n", flattened_event)
+    if log_events:
+        print("Flattened Event:\n", flattened_event)
     
     return flattened_event
     
-def send_event(event):
+def send_event(event, partition=None):
     '''
-    Input: event (dtype: dict) in CDEvent-style (see `flatten_event`)
+    Input: 
+        event (dtype: dict) in CDEvent-style (see `flatten_event`)
+        partition (dtype: str) The "dt=YYYY-MM-DD/hr=HH/" partition of the raw event, if it was written with
+            the partitioned key layout (see `code/key_layout.py`).  The processed event is written to the same partition.
     Returns: response (dtype: json) returns the json payload of putting the flattened
         event to the CDEvents S3 bucket.  This includes the status code and the body
         of the flattened event
@@ -122,19 +231,64 @@ def send_event(event):
         upload it to the processed folder of the CDEvent S3 bucket.
     '''
     
-    json_filename = "{}.json".format(event['event_id'])
-    json_event = json.dumps(event)
+    json_filename = "{}{}.json{}".format(partition or "", event['event_id'], extension(processed_compression))
+    with timer("json_dumps"):
+        json_event = json.dumps(event)
+    with timer("compress"):
+        put_args = put_arguments(json_event, processed_compression)
     
     print("Sending event to: s3://{}/{}{}".format(bucket_name, s3_folder, json_filename))
-    response = s3.put_object(
-        Bucket=bucket_name, 
-        Key=s3_folder + json_filename, 
-        Body=json_event
-    )
+    with timer("s3_put"):
+        response = s3.put_object(
+            Bucket=bucket_name, 
+            Key=s3_folder + json_filename, 
+            **put_args
+        )
+    increment("events_processed")
+    increment("bytes_written", len(put_args['Body']))
     
     return response
     
-def get_event_body(event):
+def quarantine_event(key, event_body, problems, partition=None):
+    '''
+    Input:
+        key (dtype: str) The key of the raw event object
+        event_body (dtype: dict) The raw event
+        problems (dtype: list) `(path, error)` tuples from the validator (see `code/validation.py`)
+        partition (dtype: str) The "dt=YYYY-MM-DD/hr=HH/" partition of the raw event, if any
+    Returns: response (dtype: dict) `{"quarantined": <quarantine key>, "event_id": ..., "violations": [...]}`
+    
+    Function Overview:
+        Writes the malformed event, where it came from, and what is wrong with it to the quarantine folder,
+        so it can be inspected and reprocessed later without blocking the queue or reaching the DLQ.
+    '''
+    
+    event_id = event_body.get('event_id') if isinstance(event_body, dict) else None
+    event_id = event_id if isinstance(event_id, str) and event_id else event_id_from_key(key)
+    violations = [{"path": path, "error": error} for path, error in problems]
+    quarantine_key = "{}{}{}.json".format(quarantine_folder, partition or "", event_id)
+    
+    print("Quarantining invalid event {}: {}".format(event_id, violations))
+    with timer("s3_put_quarantine"):
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=quarantine_key,
+            Body=json.dumps({"source_key": key, "violations": violations, "event": event_body}),
+            ContentType="application/json"
+        )
+    increment("events_quarantined")
+    
+    return {"quarantined": quarantine_key, "event_id": event_id, "violations": violations}
+    
+def get_object_key(event):
+    '''
+    Input: event (dtype: dict) The SQS event passed to `lambda_handler`, wrapping an S3 event notification
+    Returns: key (dtype: str) The key of the object that triggered the notification
+    
+    Function Overview:
+        S3 URL-encodes keys in event notifications (i.e. "dt=2023-04-04" arrives as "dt%3D2023-04-04"),
+        so the key is decoded before it is used.
+    '''
     
     print("Incoming Event:,\n", event)
     
@@ -142,18 +296,253 @@ def get_event_body(event):
     body_dict = json.loads(event['Records'][0]['body'])
     print("Event Body:\n", json.dumps(body_dict))
     
-    key = body_dict['Records'][0]['s3']['object']['key']
-    obj = s3.get_object(Bucket=bucket_name, Key=key)
-    event_body = json.loads(obj['Body'].read())
+    return unquote_plus(body_dict['Records'][0]['s3']['object']['key'])
+
+def read_object(key):
+    '''
+    Input: key (dtype: str) The key of a JSON or binary (`.cdeb`) object in the CDEvents bucket
+    Returns: body (dtype: dict) The decoded object
+    
+    Function Overview:
+        gzip- and zstd-compressed objects are decompressed transparently (see `code/compression.py`), and
+        binary events are decoded by their `context.version` (see `code/wire_format.py`).
+    '''
     
-    print("Event Body:\n", event_body)
+    with timer("s3_get"):
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+    with timer("decompress"):
+        raw_body = decode_body(obj, key)
+    with timer("decode_event"):
+        body = loads_event(raw_body)
+    increment("bytes_read", len(raw_body))
     
-    return event_body
+    return body
+
+def iter_object_events(key):
+    '''
+    Input: key (dtype: str) The key of a raw events object in the CDEvents bucket
+    Returns: A generator of the raw events in the object, decoded one at a time as the body is read
+
+    Function Overview:
+        gzip- and zstd-compressed bodies are decompressed as they stream (see `code/compression.py`), and the
+        decompressed body may be a single JSON or binary event, a JSON array, NDJSON, or a `.cdeb` stream
+        (see `iter_body` in `code/event_streams.py`).
+    '''
+
+    with timer("s3_get"):
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+    body = open_body(obj, key)
+
+    for event_body in iter_body(body, key):
+        increment("events_read")
+        yield event_body
+
+    increment("bytes_read", body.tell())
+
+def get_event_body(event, key=None):
+    '''
+    Input:
+        event (dtype: dict) The SQS event passed to `lambda_handler`
+        key (dtype: str) The key of the raw object, if it is already known
+    Returns: A generator of the raw events in the object (usually one)
+    '''
+
+    if key is None:
+        key = get_object_key(event)
+
+    for event_body in iter_object_events(key):
+        if log_events:
+            print("Event Body:\n", event_body)
+        yield event_body
+
+def process_event(key, event_body, partition):
+    '''
+    Input:
+        key (dtype: str) The key of the raw object the event came from
+        event_body (dtype: dict) The raw event
+        partition (dtype: str) The partition of the raw object, if any
+    Returns: response (dtype: dict) The response from `send_event`, or `{"quarantined": ...}` if it failed validation
+    '''
+
+    problems = None
+    if validator is not None:
+        with timer("validate"):
+            problems = validator.check(event_body)
+
+    if problems:
+        return quarantine_event(key, event_body, problems, partition=partition)
+
+    flattened_event_body = normalize_processed(flatten_event(event_body))
+
+    return send_event(flattened_event_body, partition=partition)
+
+def send_part(records, key, number, partition):
+    '''
+    Input:
+        records (dtype: list) Flattened events from a multi-event raw object
+        key (dtype: str) The key of the raw object
+        number (dtype: int) The part's position in the object
+        partition (dtype: str) The partition of the raw object, if any
+    Returns: part_key (dtype: str) The key the part was written to
+    '''
+
+    part_key = "{}{}{}-part-{:05d}.ndjson{}".format(s3_folder, partition or "", event_id_from_key(key), number,
+                                                   extension(processed_compression))
+    with timer("json_dumps"):
+        body = "".join(json.dumps(record) + "\n" for record in records)
+    with timer("compress"):
+        put_args = put_arguments(body, processed_compression, content_type="application/x-ndjson")
+
+    print("Sending {} events to: s3://{}/{}".format(len(records), bucket_name, part_key))
+    with timer("s3_put"):
+        get_part_controller().call(lambda: s3.put_object(Bucket=bucket_name, Key=part_key, **put_args),
+                                   items=len(records))
+    increment("events_processed", len(records))
+    increment("bytes_written", len(put_args['Body']))
+
+    return part_key
+
+def process_batch(key, events, partition):
+    '''
+    Input:
+        key (dtype: str) The key of a raw object holding several events
+        events (dtype: iterable) Its raw events, as they are decoded
+        partition (dtype: str) The partition of the raw object, if any
+    Returns: response (dtype: dict) `{"batch": key, "events": 2400, "quarantined": 3, "skipped": 0, "parts": [...]}`
+
+    Function Overview:
+        Duplicates are skipped and invalid events quarantined one event at a time, and at most one part
+        (`PART_SIZE` events) of flattened events is held before it is written.  The written event_ids are
+        only marked as processed once the last part is written, so a retry after a failed part redoes them.
+    '''
+
+    response = {"batch": key, "events": 0, "quarantined": 0, "skipped": 0, "parts": []}
+    records = []
+    written_ids = []
+    position = 0
+
+    def write_part(number):
+        if records:
+            response['parts'].append(send_part(records, key, number, partition))
+            written_ids.extend(record['event_id'] for record in records)
+            response['events'] += len(records)
+            del records[:]
+
+    for position, event_body in enumerate(events):
+        if position and position % PART_SIZE == 0:
+            write_part(position // PART_SIZE - 1)
+
+        event_id = event_body.get('event_id') if isinstance(event_body, dict) else None
+        if event_id is not None:
+            with timer("dedup_check"):
+                duplicate = get_deduplicator().is_duplicate(event_id)
+            if duplicate:
+                response['skipped'] += 1
+                continue
+
+        problems = None
+        if validator is not None:
+            with timer("validate"):
+                problems = validator.check(event_body)
+        if problems:
+            quarantine_event(key, event_body, problems, partition=partition)
+            response['quarantined'] += 1
+            continue
+
+        records.append(normalize_processed(flatten_event(event_body)))
+
+    write_part(position // PART_SIZE)
+
+    with timer("dedup_mark"):
+        for event_id in written_ids:
+            get_deduplicator().mark(event_id)
+
+    return response
+
+def process_key(key, event=None):
+    '''
+    Input:
+        key (dtype: str) The key of a raw event object
+        event (dtype: dict) The SQS event, if `key` came straight from it (used by `get_event_body`)
+    Returns: response (dtype: dict) The response from `send_event`, `{"skipped": "duplicate", ...}` if the
+        event has already been processed, or `{"quarantined": ...}` if it failed validation.  Objects holding
+        several events get the response from `process_batch`.
+
+    Function Overview:
+        The event_id is read from the key, so duplicate deliveries are skipped before any GET, flatten, or PUT.
+        The event is only marked as processed once its flattened version has been written.  Multi-event objects
+        are marked under their own name once every part is written, so a redelivered batch is skipped as well.
+    '''
+
+    event_id = event_id_from_key(key)
+    partition = parse_partition(key)
+
+    with timer("dedup_check"):
+        duplicate = get_deduplicator().is_duplicate(event_id)
+    if duplicate:
+        print("Skipping duplicate event:", event_id)
+        return {"skipped": "duplicate", "event_id": event_id}
+
+    ## Look one event ahead to tell a single-event object from a batch
+    events = get_event_body(event, key=key)
+    first, second = next(events, None), next(events, None)
+
+    if first is None:
+        print("No events in object:", key)
+        return {"skipped": "empty", "event_id": event_id}
+
+    if second is None:
+        response = process_event(key, first, partition)
+        marked_id = response.get('event_id') or first.get('event_id', event_id)
+    else:
+        response = process_batch(key, chain([first, second], events), partition)
+        marked_id = event_id
+
+    with timer("dedup_mark"):
+        get_deduplicator().mark(marked_id)
+
+    return response
+
+def process_manifest(manifest_key):
+    '''
+    Input: manifest_key (dtype: str) The key of a batch manifest (see `code/key_layout.py`)
+    Returns: responses (dtype: list) The response from `process_key` for every event in the batch
+    
+    Function Overview:
+        When the S3 notification is configured on the `manifests/` prefix instead of `raw/`, the Lambda is
+        invoked once per uploaded batch rather than once per event, and reads the batch's keys from the
+        manifest instead of listing `raw/`.
+    '''
+    
+    manifest = read_object(manifest_key)
+    responses = []
+    
+    for key in manifest['keys']:
+        responses.append(process_key(key))
+    
+    increment("manifests_processed")
+    
+    return responses
 
 def lambda_handler(event, context):
     
-    event_body = get_event_body(event)
-    flattened_event_body = flatten_event(event_body)
-    response = send_event(flattened_event_body)
+    ## Metrics are per invocation, so clear anything left over from a previous warm invocation
+    reset()
+    
+    with profile_run("lambda_handler"), timer("lambda_handler"):
+        key = get_object_key(event)
+        
+        try:
+            if key.startswith(MANIFEST_PREFIX):
+                response = process_manifest(key)
+            else:
+                response = process_key(key, event)
+        finally:
+            ## Save what was marked, since the container may be frozen or dropped before the next invocation
+            with timer("dedup_flush"):
+                get_deduplicator().flush()
+    
+    ## Print the timers and counters in CloudWatch Embedded Metric Format
+    emit_emf(dimensions={"FunctionName": getattr(context, "function_name", "lambda_handler")})
     
     return response